@@ -16,7 +16,7 @@ a = Analysis(
         'PyQt5.QtWidgets',
         'pyaudio',
         'wave',
-        'audioop',
+        'numpy',
         'struct',
         'socket',
         'threading',
@@ -31,6 +31,9 @@ a = Analysis(
         'shutil',
         'time',
         'base64',
+        'protocol',
+        'log_config',
+        'audio_dsp',
     ],
     hookspath=[],
     hooksconfig={},
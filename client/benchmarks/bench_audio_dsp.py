@@ -0,0 +1,124 @@
+"""语音处理基准：原来逐样本的 Python 实现 vs audio_dsp.py 的 NumPy 实现
+
+对 --durations 中每个时长（秒）生成一段 16kHz 16 位单声道的测试音频（两个正弦波加噪声，
+部分样本接近满幅，用来覆盖限幅），分别计时：
+    change_pitch  女声变调（pitch_factor=1.3）和低沉变调（0.8）
+    decimate      AudioCompressor 压缩级别 4（隔一个样本取一个再重复）
+    gain          音量乘 1.1 并限幅（旧实现为 audioop.mul，Python 3.13 起已移除时跳过）
+每项同时逐字节比较两种实现的输出，不一致时报告并以非零状态退出。
+
+用法:
+    python benchmarks/bench_audio_dsp.py --durations 1 10 60 --repeat 3
+"""
+import argparse
+import os
+import struct
+import sys
+import time
+import warnings
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import audio_dsp  # noqa: E402
+
+try:
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', DeprecationWarning)
+        import audioop
+except ImportError:  # Python 3.13+
+    audioop = None
+
+RATE = 16000  # 与 main.py 的录音采样率相同
+
+
+def legacy_change_pitch(audio_data, pitch_factor):
+    """原 VoiceChanger.change_pitch 的计算部分（去掉日志）"""
+    if len(audio_data) % 2 != 0:
+        audio_data = audio_data[:-1]
+    samples = struct.unpack('<' + 'h' * (len(audio_data) // 2), audio_data)
+    if abs(pitch_factor - 1.0) <= 0.01:
+        return audio_data
+    new_length = max(1, int(len(samples) / pitch_factor))
+    new_samples = []
+    for i in range(new_length):
+        old_index = i * pitch_factor
+        index1 = int(old_index)
+        index2 = min(index1 + 1, len(samples) - 1)
+        if index1 < len(samples):
+            fraction = old_index - index1
+            sample = samples[index1] * (1 - fraction) + samples[index2] * fraction
+            sample = max(-32768, min(32767, int(sample)))
+            new_samples.append(sample)
+    if len(new_samples) < len(samples):
+        last_sample = new_samples[-1] if new_samples else 0
+        while len(new_samples) < len(samples):
+            new_samples.append(last_sample)
+    else:
+        new_samples = new_samples[:len(samples)]
+    return struct.pack('<' + 'h' * len(new_samples), *new_samples)
+
+
+def legacy_decimate(audio_data):
+    """原 AudioCompressor.compress_audio 压缩级别 4"""
+    samples = struct.unpack('<' + 'h' * (len(audio_data) // 2), audio_data)
+    compressed_samples = samples[::2]
+    restored_samples = []
+    for sample in compressed_samples:
+        restored_samples.extend([sample, sample])
+    restored_samples = restored_samples[:len(samples)]
+    return struct.pack('<' + 'h' * len(restored_samples), *restored_samples)
+
+
+def make_audio(seconds, seed=1):
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * RATE)) / RATE
+    wave = 24000 * np.sin(2 * np.pi * 220 * t) + 12000 * np.sin(2 * np.pi * 1800 * t)
+    wave += rng.normal(0, 1500, len(t))
+    return np.clip(wave, -32768, 32767).astype('<i2').tobytes()
+
+
+def best_time(fn, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='语音处理基准')
+    parser.add_argument('--durations', type=float, nargs='+', default=[1, 10, 60], help='测试音频时长（秒）')
+    parser.add_argument('--repeat', type=int, default=3, help='每项重复次数，取最短时间')
+    args = parser.parse_args()
+
+    cases = [
+        ('change_pitch 1.3', lambda d: legacy_change_pitch(d, 1.3), lambda d: audio_dsp.change_pitch(d, 1.3)),
+        ('change_pitch 0.8', lambda d: legacy_change_pitch(d, 0.8), lambda d: audio_dsp.change_pitch(d, 0.8)),
+        ('decimate', legacy_decimate, lambda d: audio_dsp.decimate(d, 2)),
+    ]
+    if audioop is not None:
+        cases.append(('gain 1.1', lambda d: audioop.mul(d, 2, 1.1), lambda d: audio_dsp.apply_gain(d, 1.1)))
+
+    mismatches = 0
+    for seconds in args.durations:
+        audio = make_audio(seconds)
+        print(f'{seconds:g} 秒音频（{len(audio) // 2} 个样本）')
+        for name, legacy, vectorized in cases:
+            legacy_time, expected = best_time(lambda: legacy(audio), args.repeat)
+            numpy_time, actual = best_time(lambda: vectorized(audio), args.repeat)
+            same = expected == actual
+            mismatches += not same
+            print(f'  {name:17s} 旧实现 {legacy_time * 1000:9.2f} ms  NumPy {numpy_time * 1000:8.2f} ms  '
+                  f'({legacy_time / numpy_time:6.1f}x)  输出{"一致" if same else "不一致"}')
+    if mismatches:
+        print(f'{mismatches} 项输出不一致')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""客户端日志：可在运行中调整级别、后台线程写出、按大小轮转、截断和脱敏大消息
+
+代码中仍直接使用 logging.debug/info/...，setup() 把根日志器配置为：
+- 调用线程只把记录放进有界队列（满了就丢弃并计数，不等待），格式化和写文件/终端都在后台线程中进行，
+  接收线程和界面线程不会因为磁盘或终端慢而卡住；
+- 文件为 <日志目录>/client.log，超过 LOG_FILE_MAX_BYTES 时轮转，最多保留 LOG_FILE_BACKUPS 个旧文件；
+  旧版每次启动新建的 client_时间.log 超过 LEGACY_LOG_KEEP_DAYS 天的在启动时删除；
+- 写出前 redact() 处理每条消息：登录/注册/注销命令中的密码换成 ***，长串 base64（语音数据）
+  只保留长度，整条超过 LOG_MESSAGE_MAX_CHARS 时截断并注明原长度。
+
+调用处需要带上整条协议消息时使用 %s 延迟格式化：logging.debug('收到消息: %s', data)，
+级别关闭时不会拼接字符串，开启时拼接和脱敏也都在后台线程中完成。
+
+默认级别为 INFO，可用环境变量 CHAT_CLIENT_LOG_LEVEL=DEBUG 启动时指定，运行中用 set_level() 调整
+（主窗口中 Ctrl+Shift+L 在 DEBUG 和启动级别之间切换）。
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import sys
+import time
+
+LOG_LEVEL_ENV = 'CHAT_CLIENT_LOG_LEVEL'
+DEFAULT_LEVEL = 'INFO'
+LOG_FORMAT = '%(asctime)s [%(levelname)s] %(message)s'
+LOG_FILE_NAME = 'client.log'
+LOG_FILE_MAX_BYTES = 5 * 1024 * 1024
+LOG_FILE_BACKUPS = 3
+LEGACY_LOG_KEEP_DAYS = 7
+LOG_MESSAGE_MAX_CHARS = 1000  # 单条日志消息的最大长度，超出部分截断
+QUEUE_SIZE = 10000  # 等待写出的日志条数上限
+# 协议中带密码的命令：命令名: 密码字段的下标
+PASSWORD_FIELDS = {'LOGIN': 2, 'REGISTER': 2, 'DELETE_USER': 2}
+BASE64_RUN = re.compile(r'[A-Za-z0-9+/]{128,}={0,2}')
+LEGACY_LOG_NAME = re.compile(r'client_\d{8}_\d{6}\.log$')
+
+dropped = 0  # 队列已满被丢弃的日志条数
+startup_level = DEFAULT_LEVEL
+_listener = None
+
+
+def _redact_passwords(text):
+    for cmd, index in PASSWORD_FIELDS.items():
+        start = text.find(cmd + '|')
+        while start >= 0:
+            if start == 0 or not text[start - 1].isalnum() and text[start - 1] != '_':
+                end = text.find('\n', start)
+                end = len(text) if end < 0 else end
+                fields = text[start:end].split('|')
+                if len(fields) > index:
+                    fields[index] = '***'
+                    text = text[:start] + '|'.join(fields) + text[end:]
+            start = text.find(cmd + '|', start + 1)
+    return text
+
+
+def redact(text, limit=LOG_MESSAGE_MAX_CHARS):
+    """去掉日志消息中的密码和大段 base64 数据，并限制长度"""
+    length = len(text)
+    # 历史记录、语音帧可能有几 MB，只处理开头一段，多出的部分反正会被截断
+    text = _redact_passwords(text[:limit * 16])
+    text = BASE64_RUN.sub(lambda m: f'<base64 {len(m.group())} 字符>', text)
+    if len(text) > limit or length > limit * 16:
+        text = f'{text[:limit]}...（已截断，共 {length} 字符）'
+    return text
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # 标准实现在调用线程中格式化整条消息；这里只把异常堆栈转成文本，格式化和脱敏交给后台线程
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        global dropped
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped += 1
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    def prepare(self, record):
+        try:
+            message = record.getMessage()
+        except Exception as e:
+            message = f'{record.msg!r} 格式化失败: {e}'
+        record.msg = redact(message)
+        record.args = None
+        return record
+
+    def enqueue_sentinel(self):
+        # 队列已满时等待后台线程腾出位置，保证退出时写出全部已排队的日志
+        self.queue.put(self._sentinel)
+
+
+def cleanup_legacy_logs(log_dir, keep_days=LEGACY_LOG_KEEP_DAYS):
+    """删除旧版每次启动新建的日志文件中超过 keep_days 天的，返回删除的数量"""
+    removed = 0
+    cutoff = time.time() - keep_days * 24 * 3600
+    for name in os.listdir(log_dir):
+        path = os.path.join(log_dir, name)
+        if LEGACY_LOG_NAME.match(name) and os.path.getmtime(path) < cutoff:
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+    return removed
+
+
+def setup(log_dir, level=None):
+    """配置根日志器，返回日志文件路径；level 为空时取环境变量 CHAT_CLIENT_LOG_LEVEL，默认 INFO"""
+    global _listener, startup_level
+    shutdown()
+    level = (level or os.environ.get(LOG_LEVEL_ENV) or DEFAULT_LEVEL).upper()
+    if not isinstance(logging.getLevelName(level), int):
+        level = DEFAULT_LEVEL
+    startup_level = level
+    os.makedirs(log_dir, exist_ok=True)
+    log_file = os.path.join(log_dir, LOG_FILE_NAME)
+    formatter = logging.Formatter(LOG_FORMAT)
+    targets = [logging.handlers.RotatingFileHandler(log_file, maxBytes=LOG_FILE_MAX_BYTES,
+                                                    backupCount=LOG_FILE_BACKUPS, encoding='utf-8')]
+    if sys.stderr is not None:  # 打包成窗口程序后没有控制台
+        targets.append(logging.StreamHandler())
+    for target in targets:
+        target.setFormatter(formatter)
+    records = queue.Queue(QUEUE_SIZE)
+    root = logging.getLogger()
+    root.handlers[:] = [_QueueHandler(records)]
+    root.setLevel(level)
+    _listener = _QueueListener(records, *targets)
+    _listener.start()
+    atexit.register(shutdown)
+    removed = cleanup_legacy_logs(log_dir)
+    if removed:
+        logging.info('已删除 %s 个旧日志文件', removed)
+    return log_file
+
+
+def get_level():
+    return logging.getLevelName(logging.getLogger().level)
+
+
+def set_level(level):
+    """运行中调整日志级别"""
+    logging.getLogger().setLevel(level)
+    logging.warning('日志级别已切换为 %s', level)
+
+
+def toggle_debug():
+    """在 DEBUG 和启动时的级别之间切换，返回切换后的级别"""
+    if get_level() != 'DEBUG':
+        level = 'DEBUG'
+    else:
+        level = startup_level if startup_level != 'DEBUG' else DEFAULT_LEVEL
+    set_level(level)
+    return level
+
+
+def shutdown():
+    """写出队列中剩余的日志并停止后台线程"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for target in _listener.handlers:
+            target.close()
+        _listener = None
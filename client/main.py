@@ -2,26 +2,30 @@ import sys
 import socket
 from PyQt5.QtWidgets import (QApplication, QWidget, QVBoxLayout, QHBoxLayout, QLabel, QLineEdit, QPushButton, QTextEdit,
                              QListWidget, QMessageBox, QInputDialog, QListWidgetItem, QTabWidget, QDialog,
-                             QDesktopWidget, QFileDialog, QProgressDialog, QGraphicsOpacityEffect, QComboBox)
-from PyQt5.QtCore import Qt, QThread, pyqtSignal, QTimer, QByteArray
-from PyQt5.QtGui import QIcon, QPixmap, QMovie, QColor
+                             QDesktopWidget, QFileDialog, QProgressDialog, QGraphicsOpacityEffect, QComboBox,
+                             QAbstractItemView, QShortcut)
+from PyQt5.QtCore import Qt, QObject, QThread, pyqtSignal, QTimer, QByteArray
+from PyQt5.QtGui import QIcon, QPixmap, QMovie, QColor, QKeySequence
 import os
 import pyaudio
 import wave
 import time
-import struct
 import logging
-import datetime
 import random  # 添加随机数模块用于端口分配
 import shutil
 import tkinter.filedialog
 import tkinter.messagebox
 import json
 import threading
+from concurrent.futures import ThreadPoolExecutor
 import tkinter.messagebox
 import os
 import hashlib
-import audioop  # 添加音频操作模块
+import zlib
+import audio_dsp  # 变调、降采样、音量等语音处理（NumPy）
+from protocol import (PROTOCOL_V1, PROTOCOL_V2, CMD_PROTO, CMD_PROTO_OK, LineDecoder, FrameDecoder,
+                      ProtocolError, encode_message, encode_binary_frame, recv_frame)
+import log_config
 
 def resource_path(relative_path):
     """获取资源文件的绝对路径，兼容开发环境和PyInstaller打包后的环境"""
@@ -46,19 +50,9 @@ def get_user_data_path(relative_path):
     os.makedirs(os.path.dirname(full_path), exist_ok=True)
     return full_path
 
-# 配置日志
+# 配置日志（见 log_config.py）：后台线程写出、按大小轮转，大消息截断、密码和语音数据脱敏
 log_dir = get_user_data_path('logs')
-os.makedirs(log_dir, exist_ok=True)
-log_file = os.path.join(log_dir, f'client_{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}.log')
-
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s [%(levelname)s] %(message)s',
-    handlers=[
-        logging.FileHandler(log_file, encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
+log_file = log_config.setup(log_dir)
 
 # 音频压缩工具类
 class AudioCompressor:
@@ -81,29 +75,19 @@ class AudioCompressor:
             elif compression_level == 2:
                 # 中度压缩：降低音量动态范围，并添加简单的回声抑制
                 # 降低音量以减少反馈
-                reduced_volume = audioop.mul(audio_data, 2, 0.6)  # 降低音量到60%
-                return reduced_volume
+                return audio_dsp.apply_gain(audio_data, 0.6)  # 降低音量到60%
             elif compression_level == 3:
                 # 高度压缩：降低位深度
                 # 将16位音频转换为8位再转回16位
-                audio_8bit = audioop.lin2lin(audio_data, 2, 1)
-                return audioop.lin2lin(audio_8bit, 1, 2)
+                return audio_dsp.reduce_bit_depth(audio_data, 8)
             elif compression_level == 4:
                 # 最高压缩：降低采样率
-                # 模拟降低采样率（每隔一个样本取一个）
-                samples = struct.unpack('<' + 'h' * (len(audio_data) // 2), audio_data)
-                compressed_samples = samples[::2]  # 取每隔一个样本
-                # 重复样本以恢复原始长度
-                restored_samples = []
-                for sample in compressed_samples:
-                    restored_samples.extend([sample, sample])
-                # 截断到原始长度
-                restored_samples = restored_samples[:len(samples)]
-                return struct.pack('<' + 'h' * len(restored_samples), *restored_samples)
+                # 模拟降低采样率（每隔一个样本取一个，再重复一次恢复原始长度）
+                return audio_dsp.decimate(audio_data, 2)
             else:
                 return audio_data
         except Exception as e:
-            logging.error(f"音频压缩失败: {e}")
+            logging.error('音频压缩失败: %s', e)
             return audio_data
     
     @staticmethod
@@ -118,11 +102,11 @@ class AudioCompressor:
             # 对于大多数压缩级别，解压缩就是恢复音量
             if compression_level == 2:
                 # 恢复音量，但保持在合理范围内以避免反馈
-                return audioop.mul(audio_data, 2, 1.1)  # 恢复音量到110%
+                return audio_dsp.apply_gain(audio_data, 1.1)  # 恢复音量到110%
             else:
                 return audio_data
         except Exception as e:
-            logging.error(f"音频解压缩失败: {e}")
+            logging.error('音频解压缩失败: %s', e)
             return audio_data
 
     @staticmethod
@@ -135,17 +119,17 @@ class AudioCompressor:
                 return audio_data
             
             # 计算音频的RMS（均方根）值来判断音量
-            rms = audioop.rms(audio_data, 2)
+            rms = audio_dsp.rms(audio_data)
             
             # 如果音量过高（可能是反馈），则大幅降低音量
             if rms > 8000:  # 阈值可以调整
-                return audioop.mul(audio_data, 2, 0.3)  # 降低到30%
+                return audio_dsp.apply_gain(audio_data, 0.3)  # 降低到30%
             elif rms > 5000:
-                return audioop.mul(audio_data, 2, 0.6)  # 降低到60%
+                return audio_dsp.apply_gain(audio_data, 0.6)  # 降低到60%
             else:
                 return audio_data
         except Exception as e:
-            logging.error(f"回声抑制失败: {e}")
+            logging.error('回声抑制失败: %s', e)
             return audio_data
 
 
@@ -156,97 +140,18 @@ class VoiceChanger:
     @staticmethod
     def change_pitch(audio_data, pitch_factor):
         """
-        改变音调
+        改变音调（线性插值重采样，见 audio_dsp.change_pitch），输出长度与输入相同
         pitch_factor: 音调变化因子，>1提高音调，<1降低音调
         """
         try:
-            if not audio_data or len(audio_data) == 0:
+            if not audio_data or len(audio_data) < 2:
                 logging.warning("变音处理: 音频数据为空")
                 return audio_data
-            
-            # 确保音频数据长度为偶数
-            if len(audio_data) % 2 != 0:
-                audio_data = audio_data[:-1]
-                logging.warning("变音处理: 调整音频数据长度为偶数")
-            
-            # 如果调整后数据为空，返回原始数据
-            if len(audio_data) == 0:
-                logging.warning("变音处理: 调整后音频数据为空")
-                return audio_data
-            
-            # 将字节数据转换为样本数组
-            num_samples = len(audio_data) // 2
-            if num_samples == 0:
-                logging.warning("变音处理: 样本数为0")
-                return audio_data
-                
-            samples = struct.unpack('<' + 'h' * num_samples, audio_data)
-            logging.debug(f"变音处理: 原始样本数={num_samples}, pitch_factor={pitch_factor}")
-            
-            # 简单的音调变化：通过改变采样率来实现
-            if abs(pitch_factor - 1.0) > 0.01:  # 只有当变化明显时才处理
-                # 重新采样以改变音调
-                new_length = max(1, int(len(samples) / pitch_factor))  # 确保至少有1个样本
-                new_samples = []
-                
-                for i in range(new_length):
-                    # 线性插值
-                    old_index = i * pitch_factor
-                    index1 = int(old_index)
-                    index2 = min(index1 + 1, len(samples) - 1)
-                    
-                    if index1 < len(samples):
-                        # 线性插值计算新样本值
-                        fraction = old_index - index1
-                        sample = samples[index1] * (1 - fraction) + samples[index2] * fraction
-                        # 确保样本值在有效范围内
-                        sample = max(-32768, min(32767, int(sample)))
-                        new_samples.append(sample)
-                
-                # 确保有足够的样本
-                if len(new_samples) == 0:
-                    logging.warning("变音处理: 新样本数为0，返回原始数据")
-                    return audio_data
-                
-                # 如果新长度小于原长度，需要填充或截断到原长度
-                if len(new_samples) < len(samples):
-                    # 重复最后的样本来填充
-                    last_sample = new_samples[-1] if new_samples else 0
-                    while len(new_samples) < len(samples):
-                        new_samples.append(last_sample)
-                else:
-                    # 截断到原长度
-                    new_samples = new_samples[:len(samples)]
-                
-                logging.debug(f"变音处理: 新样本数={len(new_samples)}")
-                
-                # 验证样本数据
-                if len(new_samples) == 0:
-                    logging.warning("变音处理: 最终样本数为0，返回原始数据")
-                    return audio_data
-                
-                # 转换回字节数据
-                try:
-                    result = struct.pack('<' + 'h' * len(new_samples), *new_samples)
-                    logging.debug(f"变音处理: 输出数据长度={len(result)}")
-                    
-                    # 验证输出数据
-                    if len(result) == 0:
-                        logging.warning("变音处理: 输出数据长度为0，返回原始数据")
-                        return audio_data
-                    
-                    return result
-                except struct.error as pack_error:
-                    logging.error(f"变音处理: 数据打包失败: {pack_error}")
-                    return audio_data
-            else:
-                logging.debug("变音处理: pitch_factor接近1.0，返回原始数据")
-                return audio_data
-                
+            result = audio_dsp.change_pitch(audio_data, pitch_factor)
+            logging.debug('变音处理: 样本数=%s, pitch_factor=%s', len(result) // 2, pitch_factor)
+            return result
         except Exception as e:
-            logging.error(f"变音处理失败: {e}")
-            import traceback
-            traceback.print_exc()
+            logging.error('变音处理失败: %s', e, exc_info=True)
             return audio_data
     
     @staticmethod
@@ -256,10 +161,10 @@ class VoiceChanger:
         """
         try:
             result = VoiceChanger.change_pitch(audio_data, 1.3)  # 提高30%的音调
-            logging.debug(f"女声变音处理: 输入长度={len(audio_data)}, 输出长度={len(result)}")
+            logging.debug('女声变音处理: 输入长度=%s, 输出长度=%s', len(audio_data), len(result))
             return result
         except Exception as e:
-            logging.error(f"女声变音处理失败: {e}")
+            logging.error('女声变音处理失败: %s', e)
             return audio_data  # 如果变音失败，返回原始音频
     
     @staticmethod
@@ -272,7 +177,18 @@ class VoiceChanger:
 # 服务器配置
 SERVER_HOST = '54.252.240.58'  # 默认本地地址why
 SERVER_PORT = 12345
+HISTORY_PAGE_SIZE = 50  # 每次加载的历史消息条数
 UDP_PORT_BASE = 40000  # 本地UDP端口基址
+DOWNLOAD_BUFFER_SIZE = 1024 * 1024  # 文件下载每次 recv 的最大字节数
+DOWNLOAD_SEGMENT_SIZE = 8 * 1024 * 1024  # 分段下载的段大小，也是断点续传的粒度
+DOWNLOAD_CONNECTIONS = 4  # 分段下载同时使用的连接数
+DOWNLOAD_RETRIES = 5  # 分段下载断线后从已完成的段继续的次数
+TRANSFER_WORKERS = 3  # 同时进行的文件传输数，更多的传输排队等待
+TRANSFER_PROGRESS_INTERVAL_MS = 100  # 传输进度合并刷新的间隔，界面最多每秒更新 10 次
+TRANSFER_REDIRECT_TIMEOUT_MS = 15000  # 等待服务器 USE_FILE_PORT 重定向的最长时间
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 分块上传的块大小，服务器上已有未完成的上传时以服务器的为准
+UPLOAD_CONNECTIONS = 4  # 分块上传同时使用的连接数
+UPLOAD_RETRIES = 5  # 分块上传断线后按服务器位图续传的次数
 
 # 资源文件路径（打包后从临时目录读取）
 EMOJI_DIR = resource_path('resources')
@@ -281,8 +197,11 @@ BG_DIR = resource_path('backgrounds')
 # 用户数据目录（用于存储用户生成的数据）
 FILES_DIR = get_user_data_path('files')
 VOICE_MESSAGES_DIR = get_user_data_path('voice_messages')
+# 从服务器获取过的语音数据，按 SHA-256 保存，再次播放时不用重新下载
+VOICE_BLOB_CACHE_DIR = os.path.join(VOICE_MESSAGES_DIR, 'blobs')
 os.makedirs(FILES_DIR, exist_ok=True)
 os.makedirs(VOICE_MESSAGES_DIR, exist_ok=True)
+os.makedirs(VOICE_BLOB_CACHE_DIR, exist_ok=True)
 
 # 音频配置
 CHUNK = 1024
@@ -305,44 +224,47 @@ def check_network_config():
     try:
         # 尝试解析服务器地址
         socket.gethostbyname(SERVER_HOST)
-        logging.debug(f"服务器地址 {SERVER_HOST} 解析成功")
+        logging.debug('服务器地址 %s 解析成功', SERVER_HOST)
 
         # 测试服务器连接
         test_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         test_sock.settimeout(5)  # 设置5秒超时
         test_sock.connect((SERVER_HOST, SERVER_PORT))
         test_sock.close()
-        logging.debug(f"成功连接到服务器 {SERVER_HOST}:{SERVER_PORT}")
+        logging.debug('成功连接到服务器 %s:%s', SERVER_HOST, SERVER_PORT)
 
         return True
     except socket.gaierror:
-        logging.error(f"无法解析服务器地址: {SERVER_HOST}")
+        logging.error('无法解析服务器地址: %s', SERVER_HOST)
         QMessageBox.critical(None, '网络错误', f'无法解析服务器地址: {SERVER_HOST}\n请确保服务器地址正确')
         return False
     except socket.timeout:
-        logging.error(f"连接服务器超时: {SERVER_HOST}:{SERVER_PORT}")
+        logging.error('连接服务器超时: %s:%s', SERVER_HOST, SERVER_PORT)
         QMessageBox.critical(None, '网络错误', f'连接服务器超时\n请确保服务器正在运行且网络连接正常')
         return False
     except ConnectionRefusedError:
-        logging.error(f"服务器拒绝连接: {SERVER_HOST}:{SERVER_PORT}")
+        logging.error('服务器拒绝连接: %s:%s', SERVER_HOST, SERVER_PORT)
         QMessageBox.critical(None, '网络错误', f'服务器拒绝连接\n请确保服务器正在运行且端口 {SERVER_PORT} 已开放')
         return False
     except Exception as e:
-        logging.error(f"网络配置检查失败: {e}")
+        logging.error('网络配置检查失败: %s', e)
         QMessageBox.critical(None, '网络错误', f'网络配置检查失败: {e}')
         return False
 
 
 class ClientThread(QThread):
     message_received = pyqtSignal(str)
+    binary_received = pyqtSignal(str, bytes)  # v2 二进制帧：命令和原始字节
     connection_lost = pyqtSignal()
 
-    def __init__(self, sock):
+    def __init__(self, sock, protocol=PROTOCOL_V1):
         super().__init__()
         self.sock = sock
+        self.protocol = protocol
         self.running = True
-        self.buffer = b''  # 用于存储部分接收的消息
-        logging.debug("客户端线程初始化")
+        # 用于存储部分接收的消息，完整后才解码
+        self.decoder = FrameDecoder() if protocol == PROTOCOL_V2 else LineDecoder()
+        logging.debug('客户端线程初始化，协议版本: %s', protocol)
 
     def run(self):
         logging.debug("客户端线程开始运行")
@@ -356,22 +278,24 @@ class ClientThread(QThread):
                         logging.warning("服务器连接断开")
                         self.connection_lost.emit()
                         break
-                    self.buffer += data
-                    while b'\n' in self.buffer:
-                        line, self.buffer = self.buffer.split(b'\n', 1)
-                        try:
-                            msg = line.decode('utf-8')
+                    self.decoder.feed(data)
+                    for msg, blob in self.decoder:
+                        if blob is None:
                             self.message_received.emit(msg)
-                        except UnicodeDecodeError:
-                            continue
+                        else:
+                            self.binary_received.emit(msg, blob)
                 except socket.timeout:
                     continue
+            except ProtocolError as e:
+                logging.error('协议错误: %s', e)
+                self.connection_lost.emit()
+                break
             except ConnectionResetError:
                 logging.error("连接被重置")
                 self.connection_lost.emit()
                 break
             except Exception as e:
-                logging.error(f"接收消息出错: {e}")
+                logging.error('接收消息出错: %s', e)
                 self.connection_lost.emit()
                 break
         logging.debug("客户端线程结束")
@@ -383,6 +307,113 @@ class ClientThread(QThread):
         self.wait()
 
 
+class TransferManager(QObject):
+    """后台文件传输：上传和下载在线程池中进行，不阻塞界面和聊天，多个传输可以同时进行
+
+    start_upload / start_download 在聊天连接上发送 FILE_UPLOAD_START / FILE_DOWNLOAD_START，
+    服务器回复的 USE_FILE_PORT 由 MainWindow.on_message 和其他消息一样分发到 on_redirect，
+    再把传输提交到线程池，使用 MainWindow.FileTransfer 通过文件传输端口完成。
+    工作线程只记下最新的进度，界面线程的定时器把变化合并后发出 progress 信号，最多约每秒 10 次。
+    """
+    progress = pyqtSignal(int, int)  # 传输ID, 百分比
+    finished = pyqtSignal(int, bool, str)  # 传输ID, 是否成功, 消息
+    _completed = pyqtSignal(int, bool, str)  # 工作线程发出，经队列连接回到界面线程
+
+    def __init__(self, send_message, username, parent=None):
+        super().__init__(parent)
+        self.send_message = send_message
+        self.username = username
+        self.transfers = {}  # 传输ID: {'kind', 'friend', 'fname', 'path'}
+        self._waiting = {}  # (类型, 好友, 文件名): [等待重定向的传输ID]，按请求顺序
+        self._latest = {}  # 传输ID: 工作线程报告的最新进度
+        self._reported = {}  # 传输ID: 已经发出的进度
+        self._next_id = 1
+        self._executor = ThreadPoolExecutor(max_workers=TRANSFER_WORKERS, thread_name_prefix='file-transfer')
+        self._completed.connect(self._on_completed)
+        self._timer = QTimer(self)
+        self._timer.timeout.connect(self._flush_progress)
+        self._timer.start(TRANSFER_PROGRESS_INTERVAL_MS)
+
+    def start_upload(self, friend, file_path):
+        fname = os.path.basename(file_path)
+        transfer_id = self._add('upload', friend, fname, file_path)
+        self.send_message(f'FILE_UPLOAD_START|{self.username}|{friend}|{fname}|{os.path.getsize(file_path)}|1')
+        return transfer_id
+
+    def start_download(self, friend, fname, save_path):
+        transfer_id = self._add('download', friend, fname, save_path)
+        self.send_message(f'FILE_DOWNLOAD_START|{self.username}|{friend}|{fname}')
+        return transfer_id
+
+    def _add(self, kind, friend, fname, path):
+        transfer_id = self._next_id
+        self._next_id += 1
+        self.transfers[transfer_id] = {'kind': kind, 'friend': friend, 'fname': fname, 'path': path}
+        self._waiting.setdefault((kind, friend, fname), []).append(transfer_id)
+        QTimer.singleShot(TRANSFER_REDIRECT_TIMEOUT_MS, lambda: self._expire(transfer_id))
+        return transfer_id
+
+    def _expire(self, transfer_id):
+        info = self.transfers.get(transfer_id)
+        if info is None:
+            return
+        waiting = self._waiting.get((info['kind'], info['friend'], info['fname']), [])
+        if transfer_id in waiting:
+            waiting.remove(transfer_id)
+            self._on_completed(transfer_id, False, '服务器没有响应文件传输请求')
+
+    def on_redirect(self, parts):
+        """USE_FILE_PORT|端口|用户|好友|文件名[|文件大小]，带文件大小的是上传请求的回复"""
+        if len(parts) < 5:
+            logging.warning('无效的文件端口重定向: %s', parts)
+            return
+        kind = 'upload' if len(parts) >= 6 else 'download'
+        waiting = self._waiting.get((kind, parts[3], parts[4]))
+        if not waiting:
+            logging.warning('收到没有对应传输的文件端口重定向: %s', '|'.join(parts))
+            return
+        transfer_id = waiting.pop(0)
+        port = int(parts[1])
+        logging.info('服务器指示使用专用文件端口: %s', port)
+        self._executor.submit(self._run, transfer_id, port)
+
+    def _run(self, transfer_id, port):
+        """在工作线程中执行一次传输"""
+        info = self.transfers[transfer_id]
+
+        def report(percent):
+            self._latest[transfer_id] = percent
+
+        try:
+            if info['kind'] == 'upload':
+                success, message = MainWindow.FileTransfer.upload_file(
+                    SERVER_HOST, port, self.username, info['friend'], info['path'], report)
+            else:
+                success, message = MainWindow.FileTransfer.download_file(
+                    SERVER_HOST, port, self.username, info['friend'], info['fname'], info['path'], report)
+        except Exception as e:
+            success, message = False, str(e)
+        self._completed.emit(transfer_id, success, message)
+
+    def _flush_progress(self):
+        for transfer_id, percent in list(self._latest.items()):
+            if self._reported.get(transfer_id) != percent:
+                self._reported[transfer_id] = percent
+                self.progress.emit(transfer_id, percent)
+
+    def _on_completed(self, transfer_id, success, message):
+        self._flush_progress()
+        self.finished.emit(transfer_id, success, message)
+        self.transfers.pop(transfer_id, None)
+        self._latest.pop(transfer_id, None)
+        self._reported.pop(transfer_id, None)
+
+    def shutdown(self):
+        """停止进度刷新，不再开始排队的传输；进行中的传输随进程退出中断，下次可以续传"""
+        self._timer.stop()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
 class UDPAudioThread(QThread):
     """处理UDP音频数据接收的线程"""
     audio_received = pyqtSignal(bytes)
@@ -395,7 +426,7 @@ class UDPAudioThread(QThread):
         self.udp_socket.settimeout(0.5)  # 设置超时以便于停止线程
         self.running = True
         self.error_occurred = False
-        logging.debug(f"UDP音频线程绑定到端口: {self.local_port}")
+        logging.debug('UDP音频线程绑定到端口: %s', self.local_port)
 
     def run(self):
         while self.running and not self.error_occurred:
@@ -409,15 +440,15 @@ class UDPAudioThread(QThread):
                             # 提取音频数据（跳过头部）
                             audio_data = data[header_len + 1:]
                             if audio_data and len(audio_data) > 0:
-                                logging.debug(f"收到UDP音频数据: {len(audio_data)} 字节，来自: {addr}")
+                                logging.debug('收到UDP音频数据: %s 字节，来自: %s', len(audio_data), addr)
                                 self.audio_received.emit(audio_data)
                     except Exception as e:
-                        logging.error(f"处理UDP数据包错误: {e}")
+                        logging.error('处理UDP数据包错误: %s', e)
                         self.error_occurred = True
             except socket.timeout:
                 continue
             except Exception as e:
-                logging.error(f"UDP接收错误: {e}")
+                logging.error('UDP接收错误: %s', e)
                 self.error_occurred = True
                 time.sleep(0.1)
 
@@ -429,17 +460,17 @@ class UDPAudioThread(QThread):
 
             # 验证目标地址格式
             if not isinstance(target_addr, tuple) or len(target_addr) != 2:
-                logging.warning(f"无效的目标地址格式: {target_addr}")
+                logging.warning('无效的目标地址格式: %s', target_addr)
                 return
 
             # 验证IP地址和端口
             try:
                 ip, port = target_addr
                 if not ip or port <= 0 or port > 65535:
-                    logging.warning(f"无效的IP或端口: {ip}:{port}")
+                    logging.warning('无效的IP或端口: %s:%s', ip, port)
                     return
             except (ValueError, TypeError):
-                logging.warning(f"目标地址解析失败: {target_addr}")
+                logging.warning('目标地址解析失败: %s', target_addr)
                 return
 
             # 创建头部：发送者|接收者
@@ -462,17 +493,17 @@ class UDPAudioThread(QThread):
                         self.send_count = 1
                     
                     if self.send_count % 50 == 0:
-                        logging.debug(f"发送UDP音频数据: 包 #{self.send_count}, {len(audio_data)} 字节，到: {target_addr}")
+                        logging.debug('发送UDP音频数据: 包 #%s, %s 字节，到: %s', self.send_count, len(audio_data), target_addr)
                     break  # 发送成功，退出重试循环
                 except Exception as send_error:
                     if attempt < max_retries - 1:
-                        logging.warning(f"UDP发送失败，重试 {attempt + 1}/{max_retries}: {send_error}")
+                        logging.warning('UDP发送失败，重试 %s/%s: %s', attempt + 1, max_retries, send_error)
                         time.sleep(0.001)  # 短暂延迟后重试
                     else:
                         raise send_error  # 最后一次重试失败，抛出异常
 
         except Exception as e:
-            logging.error(f"UDP发送错误: {e}")
+            logging.error('UDP发送错误: %s', e)
             self.error_occurred = True
 
     def stop(self):
@@ -482,7 +513,7 @@ class UDPAudioThread(QThread):
         try:
             self.udp_socket.close()
         except Exception as e:
-            print(f"关闭UDP socket错误: {e}")
+            logging.error('关闭UDP socket错误: %s', e)
 
 
 class VoiceMessageDialog(QDialog):
@@ -733,10 +764,10 @@ class VoiceMessageDialog(QDialog):
                     else:
                         logging.warning("录制到空音频数据")
                 except Exception as read_error:
-                    logging.error(f"读取音频数据失败: {read_error}")
+                    logging.error('读取音频数据失败: %s', read_error)
                     break
         except Exception as e:
-            logging.error(f"录制音频出错: {e}")
+            logging.error('录制音频出错: %s', e)
             self.recording = False
 
     def stop_recording(self):
@@ -800,7 +831,7 @@ class VoiceMessageDialog(QDialog):
         try:
             # 合并音频数据
             audio_bytes = b''.join(self.audio_data)
-            logging.debug(f"合并音频数据: 原始长度={len(audio_bytes)}")
+            logging.debug('合并音频数据: 原始长度=%s', len(audio_bytes))
             
             # 验证音频数据
             if len(audio_bytes) == 0:
@@ -811,7 +842,7 @@ class VoiceMessageDialog(QDialog):
             if self.voice_type == "female":
                 logging.debug("应用女声变音效果")
                 audio_bytes = VoiceChanger.apply_female_voice(audio_bytes)
-                logging.debug(f"女声变音后长度: {len(audio_bytes)}")
+                logging.debug('女声变音后长度: %s', len(audio_bytes))
             else:
                 logging.debug("使用原声")
                 audio_bytes = VoiceChanger.apply_original_voice(audio_bytes)
@@ -826,7 +857,7 @@ class VoiceMessageDialog(QDialog):
             self.accept()
             
         except Exception as e:
-            logging.error(f"处理语音消息失败: {e}")
+            logging.error('处理语音消息失败: %s', e)
             import traceback
             traceback.print_exc()
             QMessageBox.warning(self, "发送失败", f"处理语音消息失败: {e}")
@@ -989,7 +1020,7 @@ class AudioDeviceSelector(QDialog):
                     # 读取音频数据
                     data = test_stream_in.read(CHUNK, exception_on_overflow=False)
                     # 降低音量以避免反馈
-                    reduced_data = audioop.mul(data, 2, 0.3)
+                    reduced_data = audio_dsp.apply_gain(data, 0.3)
                     # 播放音频数据
                     test_stream_out.write(reduced_data)
                     
@@ -1029,7 +1060,7 @@ class AudioRecorder(QThread):
         self.error_occurred = False
         self.input_device_index = input_device_index
         self.packet_count = 0
-        logging.debug(f"初始化音频录制器: input_device_index={input_device_index}")
+        logging.debug('初始化音频录制器: input_device_index=%s', input_device_index)
 
     def run(self):
         try:
@@ -1040,12 +1071,12 @@ class AudioRecorder(QThread):
             if self.input_device_index is None:
                 # 使用默认输入设备
                 self.input_device_index = self.audio.get_default_input_device_info()['index']
-                logging.debug(f"使用默认输入设备: {self.input_device_index}")
+                logging.debug('使用默认输入设备: %s', self.input_device_index)
 
             # 获取输入设备信息
             device_info = self.audio.get_device_info_by_index(self.input_device_index)
-            logging.debug(f"使用输入设备: {device_info['name']}")
-            logging.debug(f"设备信息: {device_info}")
+            logging.debug('使用输入设备: %s', device_info['name'])
+            logging.debug('设备信息: %s', device_info)
 
             # 打开音频流，使用更大的缓冲区以减少丢包
             self.stream = self.audio.open(
@@ -1073,7 +1104,7 @@ class AudioRecorder(QThread):
                             self.packet_count += 1
                             # 每录制100个包记录一次日志
                             if self.packet_count % 100 == 0:
-                                logging.debug(f"录制到音频数据: 包 #{self.packet_count}, {len(audio_data)} 字节")
+                                logging.debug('录制到音频数据: 包 #%s, %s 字节', self.packet_count, len(audio_data))
                             
                             # 验证目标地址
                             if self.target_addr and len(self.target_addr) == 2:
@@ -1083,11 +1114,11 @@ class AudioRecorder(QThread):
                                 compressed_audio = AudioCompressor.compress_audio(echo_suppressed, compression_level=2)
                                 self.udp_thread.send_audio(compressed_audio, self.target_addr, self.sender, self.receiver)
                             else:
-                                logging.warning(f"无效的目标地址: {self.target_addr}")
+                                logging.warning('无效的目标地址: %s', self.target_addr)
                         else:
-                            logging.warning(f"录制到空音频数据")
+                            logging.warning('录制到空音频数据')
                     except Exception as e:
-                        logging.error(f"录音错误: {e}")
+                        logging.error('录音错误: %s', e)
                         # 不要立即将error_occurred设为True，尝试恢复
                         time.sleep(0.1)
                 else:
@@ -1098,10 +1129,10 @@ class AudioRecorder(QThread):
                                 self.stream.start_stream()
                                 logging.debug("已重新启动音频流")
                     except Exception as e:
-                        logging.error(f"重启音频流失败: {e}")
+                        logging.error('重启音频流失败: %s', e)
                     time.sleep(0.5)
         except Exception as e:
-            logging.error(f"录音初始化错误: {e}")
+            logging.error('录音初始化错误: %s', e)
             self.error_occurred = True
         finally:
             self.stop_recording()
@@ -1113,7 +1144,7 @@ class AudioRecorder(QThread):
                     self.stream.stop_stream()
                 self.stream.close()
             except Exception as e:
-                print(f"关闭录音流错误: {e}")
+                logging.error('关闭录音流错误: %s', e)
             finally:
                 self.stream = None
 
@@ -1124,7 +1155,7 @@ class AudioRecorder(QThread):
             try:
                 self.audio.terminate()
             except Exception as e:
-                print(f"终止音频设备错误: {e}")
+                logging.error('终止音频设备错误: %s', e)
         self.quit()
         self.wait()
 
@@ -1142,7 +1173,7 @@ class AudioPlayer(QThread):
         self.error_occurred = False
         self.output_device_index = output_device_index
         self.play_count = 0
-        logging.debug(f"初始化音频播放器: output_device_index={output_device_index}")
+        logging.debug('初始化音频播放器: output_device_index=%s', output_device_index)
 
     def run(self):
         try:
@@ -1153,12 +1184,12 @@ class AudioPlayer(QThread):
             if self.output_device_index is None:
                 # 使用默认输出设备
                 self.output_device_index = self.audio.get_default_output_device_info()['index']
-                logging.debug(f"使用默认输出设备: {self.output_device_index}")
+                logging.debug('使用默认输出设备: %s', self.output_device_index)
 
             # 获取输出设备信息
             device_info = self.audio.get_device_info_by_index(self.output_device_index)
-            logging.debug(f"使用输出设备: {device_info['name']}")
-            logging.debug(f"设备信息: {device_info}")
+            logging.debug('使用输出设备: %s', device_info['name'])
+            logging.debug('设备信息: %s', device_info)
 
             # 打开音频流
             self.stream = self.audio.open(
@@ -1185,17 +1216,17 @@ class AudioPlayer(QThread):
                                     self.play_count += 1
                                     # 每播放100个包记录一次日志
                                     if self.play_count % 100 == 0:
-                                        logging.debug(f"播放音频数据: 包 #{self.play_count}, {len(audio_data)} 字节")
+                                        logging.debug('播放音频数据: 包 #%s, %s 字节', self.play_count, len(audio_data))
                                     # 直接播放音频数据（语音消息不需要解压缩）
                                     self.stream.write(audio_data)
                     except Exception as e:
-                        logging.error(f"播放错误: {e}")
+                        logging.error('播放错误: %s', e)
                         self.error_occurred = True
                         time.sleep(0.01)
                 else:
                     time.sleep(0.01)
         except Exception as e:
-            logging.error(f"播放初始化错误: {e}")
+            logging.error('播放初始化错误: %s', e)
             self.error_occurred = True
         finally:
             self.stop_playback()
@@ -1217,7 +1248,7 @@ class AudioPlayer(QThread):
                     self.stream.stop_stream()
                 self.stream.close()
             except Exception as e:
-                print(f"关闭播放流错误: {e}")
+                logging.error('关闭播放流错误: %s', e)
             finally:
                 self.stream = None
 
@@ -1228,7 +1259,7 @@ class AudioPlayer(QThread):
             try:
                 self.audio.terminate()
             except Exception as e:
-                print(f"终止音频设备错误: {e}")
+                logging.error('终止音频设备错误: %s', e)
         self.quit()
         self.wait()
 
@@ -1253,7 +1284,7 @@ class VoiceMessageAudioPlayer(QThread):
 
             # 使用默认输出设备
             output_device_index = self.audio.get_default_output_device_info()['index']
-            logging.debug(f"使用默认输出设备: {output_device_index}")
+            logging.debug('使用默认输出设备: %s', output_device_index)
 
             # 打开音频流
             self.stream = self.audio.open(
@@ -1280,13 +1311,13 @@ class VoiceMessageAudioPlayer(QThread):
                                     # 直接播放音频数据
                                     self.stream.write(audio_data)
                     except Exception as e:
-                        logging.error(f"语音消息播放错误: {e}")
+                        logging.error('语音消息播放错误: %s', e)
                         self.error_occurred = True
                         time.sleep(0.01)
                 else:
                     time.sleep(0.01)
         except Exception as e:
-            logging.error(f"语音消息播放器初始化错误: {e}")
+            logging.error('语音消息播放器初始化错误: %s', e)
             self.error_occurred = True
         finally:
             self.stop_playback()
@@ -1305,7 +1336,7 @@ class VoiceMessageAudioPlayer(QThread):
                     self.stream.stop_stream()
                 self.stream.close()
             except Exception as e:
-                logging.error(f"关闭语音消息播放流错误: {e}")
+                logging.error('关闭语音消息播放流错误: %s', e)
             finally:
                 self.stream = None
 
@@ -1316,7 +1347,7 @@ class VoiceMessageAudioPlayer(QThread):
             try:
                 self.audio.terminate()
             except Exception as e:
-                logging.error(f"终止语音消息音频设备错误: {e}")
+                logging.error('终止语音消息音频设备错误: %s', e)
         self.quit()
         self.wait()
 
@@ -1347,8 +1378,41 @@ class LoginWindow(QWidget):
         except Exception as e:
             QMessageBox.critical(self, '错误', f'无法连接服务器: {e}')
             sys.exit(1)
+        self.protocol = self.negotiate_protocol()
         self.init_ui()
 
+    def negotiate_protocol(self):
+        """尝试切换到 v2 二进制帧协议，旧服务器不支持时继续使用 v1 文本协议"""
+        try:
+            self.sock.settimeout(3)
+            self.sock.sendall(f'{CMD_PROTO}|{PROTOCOL_V2}\n'.encode('utf-8'))
+            resp = b''
+            while not resp.endswith(b'\n'):
+                # 逐字节读取协商回复，不会读走之后的数据
+                chunk = self.sock.recv(1)
+                if not chunk:
+                    break
+                resp += chunk
+            parts = resp.decode('utf-8', errors='replace').strip().split('|')
+            if parts[0] == CMD_PROTO_OK and len(parts) > 1 and parts[1] == str(PROTOCOL_V2):
+                logging.info("已协商使用 v2 二进制帧协议")
+                return PROTOCOL_V2
+            logging.info('服务器不支持 v2 协议，使用文本协议: %r', resp)
+        except Exception as e:
+            logging.warning('协议协商失败，使用文本协议: %s', e)
+        finally:
+            self.sock.settimeout(None)
+        return PROTOCOL_V1
+
+    def send_command(self, msg):
+        self.sock.sendall(encode_message(msg, self.protocol))
+
+    def recv_response(self):
+        """阻塞读取一条服务器回复"""
+        if self.protocol == PROTOCOL_V2:
+            return recv_frame(self.sock)[0]
+        return self.sock.recv(16384).decode('utf-8')
+
     def init_ui(self):
         layout = QVBoxLayout()
         self.user_edit = QLineEdit()
@@ -1382,10 +1446,10 @@ class LoginWindow(QWidget):
         
         # 确保消息以换行符结尾
         login_msg = f'LOGIN|{username}|{password}\n'
-        self.sock.send(login_msg.encode('utf-8'))
+        self.send_command(login_msg)
         
         try:
-            resp = self.sock.recv(16384).decode('utf-8')
+            resp = self.recv_response()
         except Exception as e:
             QMessageBox.critical(self, '错误', f'网络错误: {e}')
             return
@@ -1405,9 +1469,9 @@ class LoginWindow(QWidget):
         
         # 确保消息以换行符结尾
         register_msg = f'REGISTER|{username}|{password}\n'
-        self.sock.send(register_msg.encode('utf-8'))
+        self.send_command(register_msg)
         
-        resp = self.sock.recv(16384).decode('utf-8')
+        resp = self.recv_response()
         parts = resp.split('|', 2)
         if parts[0] == 'REGISTER_RESULT' and parts[1] == 'OK':
             QMessageBox.information(self, '注册成功', parts[2])
@@ -1423,9 +1487,9 @@ class LoginWindow(QWidget):
         try:
             # 确保消息以换行符结尾
             delete_msg = f'DELETE_USER|{username}|{password}\n'
-            self.sock.send(delete_msg.encode('utf-8'))
+            self.send_command(delete_msg)
             
-            resp = self.sock.recv(16384).decode('utf-8')
+            resp = self.recv_response()
             parts = resp.split('|', 2)
             if parts[0] == 'DELETE_USER_RESULT' and parts[1] == 'OK':
                 QMessageBox.information(self, '注销成功', '账号已注销，您可以重新注册同名账号。')
@@ -1439,7 +1503,7 @@ class LoginWindow(QWidget):
     def accept_login(self, username):
         try:
             self.hide()
-            self.main_win = MainWindow(self.sock, username)
+            self.main_win = MainWindow(self.sock, username, self.protocol)
             self.main_win.show()
         except Exception as e:
             QMessageBox.critical(self, '错误', f'登录后主窗口异常: {e}')
@@ -1503,13 +1567,20 @@ class EmojiDialog(QWidget):
 
 
 class VoiceMessagePlayer(QWidget):
-    """语音消息播放器组件"""
+    """语音消息播放器组件
+
+    聊天记录中的语音只带有摘要 blob_hash，此时 audio_data 为 None，
+    第一次点击播放时才通过 fetch_audio(blob_hash, callback) 向服务器获取音频。
+    """
     
-    def __init__(self, audio_data, voice_type="original", duration=0):
+    def __init__(self, audio_data, voice_type="original", duration=0, blob_hash=None, fetch_audio=None):
         super().__init__()
         self.audio_data = audio_data
         self.voice_type = voice_type
         self.duration = duration
+        self.blob_hash = blob_hash
+        self.fetch_audio = fetch_audio
+        self.fetching = False
         self.playing = False
         self.audio_player = None
         
@@ -1571,6 +1642,15 @@ class VoiceMessagePlayer(QWidget):
     def start_play(self):
         """开始播放"""
         try:
+            if not self.audio_data and self.blob_hash and self.fetch_audio:
+                # 音频尚未下载，获取完成后在 on_audio_fetched 中开始播放
+                if not self.fetching:
+                    self.fetching = True
+                    self.play_btn.setEnabled(False)
+                    self.voice_label.setText("⏳ 正在加载...")
+                    self.fetch_audio(self.blob_hash, self.on_audio_fetched)
+                return
+
             if not self.audio_data or len(self.audio_data) == 0:
                 logging.warning("音频数据为空，无法播放")
                 return
@@ -1579,7 +1659,7 @@ class VoiceMessagePlayer(QWidget):
             self.play_btn.setText("⏸")
             self.voice_label.setText("🔊 正在播放...")
             
-            logging.debug(f"开始播放语音消息，数据长度: {len(self.audio_data)} 字节")
+            logging.debug('开始播放语音消息，数据长度: %s 字节', len(self.audio_data))
             
             # 使用简化的播放方法
             import threading
@@ -1600,7 +1680,7 @@ class VoiceMessagePlayer(QWidget):
                         )
                         logging.debug("音频流创建成功")
                     except Exception as stream_error:
-                        logging.error(f"创建音频流失败: {stream_error}")
+                        logging.error('创建音频流失败: %s', stream_error)
                         raise stream_error
                     
                     # 验证音频数据长度
@@ -1614,7 +1694,7 @@ class VoiceMessagePlayer(QWidget):
                     # 分块播放音频数据
                     chunk_size = CHUNK * 2  # 每个样本2字节
                     total_chunks = len(audio_data) // chunk_size
-                    logging.debug(f"总共需要播放 {total_chunks} 个音频块")
+                    logging.debug('总共需要播放 %s 个音频块', total_chunks)
                     
                     for i in range(0, len(audio_data), chunk_size):
                         if not self.playing:  # 检查是否被停止
@@ -1626,13 +1706,13 @@ class VoiceMessagePlayer(QWidget):
                             try:
                                 stream.write(chunk)
                             except Exception as write_error:
-                                logging.error(f"写入音频数据失败: {write_error}")
+                                logging.error('写入音频数据失败: %s', write_error)
                                 break
                     
                     logging.debug("音频播放完成")
                     
                 except Exception as e:
-                    logging.error(f"播放音频失败: {e}")
+                    logging.error('播放音频失败: %s', e)
                     import traceback
                     traceback.print_exc()
                 finally:
@@ -1656,7 +1736,7 @@ class VoiceMessagePlayer(QWidget):
             threading.Thread(target=play_audio, daemon=True).start()
             
         except Exception as e:
-            logging.error(f"启动语音消息播放失败: {e}")
+            logging.error('启动语音消息播放失败: %s', e)
             import traceback
             traceback.print_exc()
             self.stop_play()
@@ -1668,6 +1748,16 @@ class VoiceMessagePlayer(QWidget):
         voice_icon = "🎤" if self.voice_type == "original" else "👩"
         self.voice_label.setText(f"{voice_icon} 语音消息")
     
+    def on_audio_fetched(self, audio_data):
+        """语音数据获取完成，audio_data 为 None 表示获取失败"""
+        self.fetching = False
+        self.play_btn.setEnabled(True)
+        if not audio_data:
+            self.voice_label.setText("⚠ 语音加载失败")
+            return
+        self.audio_data = audio_data
+        self.start_play()
+
     def on_play_finished(self):
         """播放完成回调"""
         if self.playing:
@@ -1675,11 +1765,12 @@ class VoiceMessagePlayer(QWidget):
 
 
 class MainWindow(QWidget):
-    def __init__(self, sock, username):
+    def __init__(self, sock, username, protocol=PROTOCOL_V1):
         super().__init__()
-        logging.debug(f"初始化主窗口: 用户={username}")
+        logging.debug('初始化主窗口: 用户=%s', username)
         self.sock = sock
         self.username = username
+        self.protocol = protocol  # 与服务器协商的协议版本
         self.setWindowTitle(f'聊天 - {username}')
         self.current_friend = None
         self.current_group = None
@@ -1689,6 +1780,13 @@ class MainWindow(QWidget):
         self.anon_mode = False  # 匿名模式
         self.anon_nick = None  # 匿名昵称
         self.selecting_group = False  # 防止群聊选择的重入调用
+        # 历史记录分页状态：游标是已加载的最早一条消息ID，None 表示第一页尚未加载
+        self.private_history_cursor = None
+        self.private_history_has_more = False
+        self.private_history_loading = False
+        self.group_history_cursor = None
+        self.group_history_has_more = False
+        self.group_history_loading = False
 
         # 移除语音通话相关变量，保留UDP线程用于其他功能
         self.udp_thread = None
@@ -1696,45 +1794,66 @@ class MainWindow(QWidget):
 
         # 加载表情缓存
         self.emoji_cache = {}
+        # 语音数据缓存 {sha256: 音频字节}，以及等待服务器返回的回调 {sha256: [callback]}
+        self.voice_blob_cache = {}
+        self.pending_voice_fetches = {}
 
-        logging.debug(f"创建客户端线程")
+        # Ctrl+Shift+L 在 DEBUG 和启动时的日志级别之间切换，排查问题时不用重启客户端
+        self.log_level_shortcut = QShortcut(QKeySequence('Ctrl+Shift+L'), self)
+        self.log_level_shortcut.activated.connect(log_config.toggle_debug)
+
+        logging.debug('创建客户端线程')
         # 创建客户端线程
-        self.client_thread = ClientThread(sock)
+        self.client_thread = ClientThread(sock, protocol)
         self.client_thread.message_received.connect(self.on_message)
+        self.client_thread.binary_received.connect(self.on_binary_message)
         self.client_thread.connection_lost.connect(self.on_connection_lost)
         self.client_thread.start()
 
+        # 文件传输在后台线程池中进行，每个传输一个非模态进度框
+        self.transfers = TransferManager(self.send_message_to_server, username, self)
+        self.transfers.progress.connect(self.on_transfer_progress)
+        self.transfers.finished.connect(self.on_transfer_finished)
+        self.transfer_dialogs = {}
+
         # 移除UDP音频服务初始化
 
         # 预加载表情
         self.preload_emojis()
 
-        logging.debug(f"初始化UI")
+        logging.debug('初始化UI')
         self.init_ui()
 
-        logging.debug(f"初始刷新好友和群组列表")
+        logging.debug('初始刷新好友和群组列表')
         self.initial_refresh()
 
         # 移除语音通话相关的定时器和变量
 
-        logging.debug(f"主窗口初始化完成，用户: {username}, UDP端口: {self.udp_local_port}")
+        logging.debug('主窗口初始化完成，用户: %s, UDP端口: %s', username, self.udp_local_port)
         center_window(self)  # 居中显示窗口
         # 在MainWindow.__init__中添加self.current_bg_index = 0
         self.current_bg_index = 0
         self.private_files = []  # 当前私聊文件列表
 
     def send_message_to_server(self, message):
-        """统一的消息发送方法，确保格式正确"""
+        """统一的消息发送方法，按协商的协议编码，确保格式正确"""
         try:
-            if not message.endswith('\n'):
-                message += '\n'
-            
-            encoded_msg = message.encode('utf-8')
-            logging.debug(f"发送消息: {message.strip()}, 长度: {len(encoded_msg)} 字节")
-            self.sock.send(encoded_msg)
+            encoded_msg = encode_message(message, self.protocol)
+            logging.debug('发送消息（%s 字节）: %s', len(encoded_msg), message)
+            self.sock.sendall(encoded_msg)
+            return True
+        except Exception as e:
+            logging.error('发送消息失败: %s', e)
+            return False
+
+    def send_binary_to_server(self, meta, blob):
+        """以 v2 二进制帧发送命令和原始字节，仅在协商为 v2 后使用"""
+        try:
+            logging.debug('发送二进制消息: %s, 数据长度: %s 字节', meta, len(blob))
+            self.sock.sendall(encode_binary_frame(meta, blob))
             return True
         except Exception as e:
-            logging.error(f"发送消息失败: {e}")
+            logging.error('发送消息失败: %s', e)
             return False
 
     def init_udp_audio(self):
@@ -1743,21 +1862,21 @@ class MainWindow(QWidget):
 
         # 为了避免在同一台计算机上测试时的冲突，使用随机端口而不是基于用户名
         self.udp_local_port = random.randint(40000, 65000)
-        logging.debug(f"分配随机UDP端口: {self.udp_local_port}")
+        logging.debug('分配随机UDP端口: %s', self.udp_local_port)
 
         # 确保端口不被占用
         port_attempts = 0
         while port_attempts < 20:  # 增加尝试次数
             try:
-                logging.debug(f"尝试绑定UDP端口: {self.udp_local_port}")
+                logging.debug('尝试绑定UDP端口: %s', self.udp_local_port)
                 test_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
                 test_socket.bind(('0.0.0.0', self.udp_local_port))
                 test_socket.close()
-                logging.debug(f"UDP端口绑定成功: {self.udp_local_port}")
+                logging.debug('UDP端口绑定成功: %s', self.udp_local_port)
                 break
             except Exception as e:
                 port_attempts += 1
-                logging.warning(f"UDP端口 {self.udp_local_port} 绑定失败: {e}，尝试下一个端口")
+                logging.warning('UDP端口 %s 绑定失败: %s，尝试下一个端口', self.udp_local_port, e)
                 self.udp_local_port = random.randint(40000, 65000)  # 使用新的随机端口
 
         if port_attempts >= 20:
@@ -1767,23 +1886,23 @@ class MainWindow(QWidget):
 
         # 创建UDP音频线程
         try:
-            logging.debug(f"创建UDP音频线程，端口: {self.udp_local_port}")
+            logging.debug('创建UDP音频线程，端口: %s', self.udp_local_port)
             self.udp_thread = UDPAudioThread(self.udp_local_port)
             self.udp_thread.start()
             logging.debug("UDP音频线程启动成功")
         except Exception as e:
-            logging.error(f"创建UDP音频线程失败: {e}", exc_info=True)
+            logging.error('创建UDP音频线程失败: %s', e, exc_info=True)
             QMessageBox.warning(self, '错误', f'初始化语音通话功能失败: {e}')
 
         # 通知服务器我们的UDP端口
         try:
             update_msg = f'UDP_PORT_UPDATE|{self.username}|{self.udp_local_port}'
-            logging.debug(f"发送UDP端口更新消息: {update_msg}")
+            logging.debug('发送UDP端口更新消息: %s', update_msg)
             self.send_message_to_server(update_msg)
         except Exception as e:
-            logging.error(f"发送UDP端口更新消息失败: {e}")
+            logging.error('发送UDP端口更新消息失败: %s', e)
 
-        logging.debug(f"UDP音频服务初始化完成，端口: {self.udp_local_port}")
+        logging.debug('UDP音频服务初始化完成，端口: %s', self.udp_local_port)
 
     def preload_emojis(self):
         """预加载所有表情到缓存"""
@@ -1799,7 +1918,7 @@ class MainWindow(QWidget):
                     if fname.lower().endswith(('.png', '.jpg', '.jpeg', '.gif')):
                         path = os.path.join(EMOJI_DIR, fname)
                         if not os.path.exists(path):
-                            logging.warning(f"表情文件不存在: {path}")
+                            logging.warning('表情文件不存在: %s', path)
                             continue
                             
                         if fname.lower().endswith('.gif'):
@@ -1810,7 +1929,7 @@ class MainWindow(QWidget):
                                 self.emoji_cache[fname] = {'type': 'gif', 'movie': movie, 'path': path}
                                 emoji_count += 1
                             except Exception as gif_error:
-                                logging.warning(f"加载GIF表情失败: {fname}, 错误: {gif_error}")
+                                logging.warning('加载GIF表情失败: %s, 错误: %s', fname, gif_error)
                         else:
                             # 加载静态图片
                             try:
@@ -1820,16 +1939,16 @@ class MainWindow(QWidget):
                                     self.emoji_cache[fname] = {'type': 'image', 'pixmap': scaled_pix}
                                     emoji_count += 1
                                 else:
-                                    logging.warning(f"无法加载图片表情: {fname}")
+                                    logging.warning('无法加载图片表情: %s', fname)
                             except Exception as img_error:
-                                logging.warning(f"加载图片表情失败: {fname}, 错误: {img_error}")
+                                logging.warning('加载图片表情失败: %s, 错误: %s', fname, img_error)
                 except Exception as file_error:
-                    logging.warning(f"处理表情文件失败: {fname}, 错误: {file_error}")
+                    logging.warning('处理表情文件失败: %s, 错误: %s', fname, file_error)
                     continue
                     
-            logging.debug(f"预加载完成，共 {emoji_count} 个表情")
+            logging.debug('预加载完成，共 %s 个表情', emoji_count)
         except Exception as e:
-            logging.error(f"预加载表情出错: {e}")
+            logging.error('预加载表情出错: %s', e)
             # 即使预加载失败也不应该阻塞程序启动
 
     def get_emoji_from_cache(self, emoji_id, label):
@@ -1887,6 +2006,7 @@ class MainWindow(QWidget):
         # 私聊区
         private_layout = QVBoxLayout()
         self.chat_display = QListWidget()
+        self.chat_display.verticalScrollBar().valueChanged.connect(self.on_private_scroll)
         private_layout.addWidget(self.chat_display)
         # 文件区
         file_layout = QHBoxLayout()
@@ -1920,6 +2040,7 @@ class MainWindow(QWidget):
         # 群聊区
         group_layout = QVBoxLayout()
         self.group_chat_display = QListWidget()
+        self.group_chat_display.verticalScrollBar().valueChanged.connect(self.on_group_scroll)
         group_layout.addWidget(self.group_chat_display)
         group_input_layout = QHBoxLayout()
         self.group_input_edit = QLineEdit()
@@ -1962,7 +2083,7 @@ class MainWindow(QWidget):
         try:
             self.send_message_to_server(f'GET_FRIENDS|{self.username}')
         except Exception as e:
-            print(f"获取好友列表出错: {e}")
+            logging.error('获取好友列表出错: %s', e)
             QMessageBox.warning(self, '网络错误', '获取好友列表失败，请检查网络连接')
 
     def get_groups(self):
@@ -1971,15 +2092,20 @@ class MainWindow(QWidget):
             # 清空未读标记
             self.unread_groups = set()
         except Exception as e:
-            print(f"获取群聊列表出错: {e}")
+            logging.error('获取群聊列表出错: %s', e)
             QMessageBox.warning(self, '网络错误', '获取群聊列表失败，请检查网络连接')
 
     def select_friend(self, item):
         self.current_friend = item.text().split(' ')[0]
+        # 先重置分页状态，clear 触发的滚动事件不会再去加载上一个好友的记录
+        self.private_history_cursor = None
+        self.private_history_has_more = False
         self.chat_display.clear()
         self.append_text_message('', f'与 {self.current_friend} 的聊天：')
         self.get_private_history()
-        self.load_and_display_voice_history()
+        if self.protocol == PROTOCOL_V1:
+            # 旧服务器一次返回全部历史；分页时在收到第一页后再显示本地语音记录
+            self.load_and_display_voice_history()
         self.get_private_file_list()
 
     def load_and_display_voice_history(self):
@@ -1991,6 +2117,15 @@ class MainWindow(QWidget):
             voice_history = self.load_voice_message_history(self.current_friend)
             for record in voice_history:
                 try:
+                    sender = record['sender']
+                    is_self = (sender == self.username)
+                    display_sender = '我' if is_self else sender
+                    if record.get('blob_hash'):
+                        # 新记录只保存语音摘要，播放时再获取音频
+                        self.append_voice_message(display_sender, None, record['voice_type'], record['duration'],
+                                                  is_self, blob_hash=record['blob_hash'])
+                        continue
+
                     # 解码音频数据
                     import base64
                     audio_base64 = record['audio_base64']
@@ -2001,7 +2136,7 @@ class MainWindow(QWidget):
                             audio_base64 += '=' * (4 - missing_padding)
                         audio_data = base64.b64decode(audio_base64.encode('utf-8'))
                     except Exception as decode_error:
-                        logging.error(f"语音消息历史记录base64解码失败: {decode_error}")
+                        logging.error('语音消息历史记录base64解码失败: %s', decode_error)
                         continue  # 跳过这条损坏的语音消息
                     
                     # 显示语音消息
@@ -2015,19 +2150,23 @@ class MainWindow(QWidget):
                     self.append_voice_message(display_sender, audio_data, voice_type, duration, is_self)
                     
                 except Exception as e:
-                    logging.error(f"显示语音消息历史失败: {e}")
+                    logging.error('显示语音消息历史失败: %s', e)
                     
         except Exception as e:
-            logging.error(f"加载语音消息历史失败: {e}")
+            logging.error('加载语音消息历史失败: %s', e)
 
     def get_private_history(self):
         """获取与当前好友的私聊历史记录"""
         if not self.current_friend:
             return
         try:
-            self.send_message_to_server(f'GET_PRIVATE_HISTORY|{self.username}|{self.current_friend}')
+            if self.protocol == PROTOCOL_V2:
+                # 支持 v2 协议的服务器同时支持分页，先加载最新的一页
+                self.request_private_history()
+            else:
+                self.send_message_to_server(f'GET_PRIVATE_HISTORY|{self.username}|{self.current_friend}')
         except Exception as e:
-            print(f"获取私聊历史记录出错: {e}")
+            logging.error('获取私聊历史记录出错: %s', e)
             self.append_text_message('[系统]', '获取聊天记录失败，请检查网络连接')
 
     def add_friend(self):
@@ -2041,18 +2180,122 @@ class MainWindow(QWidget):
             return
         self.send_message_to_server(f'DEL_FRIEND|{self.username}|{self.current_friend}')
 
-    def append_text_message(self, sender, text, is_self=False):
+    def add_chat_item(self, display, widget, row=None):
+        """把消息控件放入聊天列表：row 为 None 时追加到末尾并滚动到底部，否则插入到该行"""
+        item = QListWidgetItem()
+        if row is None:
+            display.addItem(item)
+        else:
+            display.insertItem(row, item)
+        display.setItemWidget(item, widget)
+        item.setSizeHint(widget.sizeHint())
+        if row is None:
+            display.scrollToBottom()
+        return item
+
+    def display_private_history_entry(self, sender, msg, row=None):
+        """显示一条私聊历史消息，row 不为 None 时插入到该行（加载更早的消息）"""
+        if msg.startswith('[EMOJI]'):
+            emoji_id = msg[7:]
+            if sender == self.username:
+                self.append_emoji_message('我', emoji_id, row=row)
+            else:
+                self.append_emoji_message(sender, emoji_id, row=row)
+        elif msg.startswith('[VOICE_REF:') and msg.endswith(']'):
+            # 语音引用: [VOICE_REF:voice_type:duration:sha256:size]，音频在点击播放时获取
+            display_sender = '我' if sender == self.username else sender
+            is_self = (sender == self.username)
+            voice_parts = msg[11:-1].split(':')
+            if len(voice_parts) != 4:
+                logging.error('语音消息格式错误: %s', msg)
+                self.append_text_message(display_sender, '[语音消息-格式错误]', is_self, row=row)
+                return
+            voice_type, duration_str, blob_hash, _ = voice_parts
+            try:
+                duration = float(duration_str)
+            except ValueError:
+                logging.warning('无效的历史语音消息时长: %s', duration_str)
+                duration = 0.0
+            self.append_voice_message(display_sender, None, voice_type, duration, is_self, row=row,
+                                      blob_hash=blob_hash)
+        elif msg.startswith('[VOICE:'):
+            # 处理语音消息历史记录
+            try:
+                # 解析语音消息格式: [VOICE:voice_type:duration:audio_base64]
+                voice_content = msg[7:-1]  # 去掉 [VOICE: 和 ]
+                voice_parts = voice_content.split(':', 3)  # 只分割前3个:，剩余的都是audio_base64
+
+                if len(voice_parts) >= 4:
+                    voice_type = voice_parts[0]
+                    duration_str = voice_parts[1]
+                    # voice_parts[2] 是空的或者其他数据
+                    audio_base64 = voice_parts[3]
+
+                    logging.debug('解析历史语音消息: type=%s, duration=%s, data_len=%s', voice_type, duration_str, len(audio_base64))
+
+                    try:
+                        duration = float(duration_str)
+                    except ValueError:
+                        logging.warning('无效的历史语音消息时长: %s', duration_str)
+                        duration = 0.0
+
+                    # 解码音频数据
+                    import base64
+                    try:
+                        # 修复base64填充问题
+                        missing_padding = len(audio_base64) % 4
+                        if missing_padding:
+                            audio_base64 += '=' * (4 - missing_padding)
+                        audio_data = base64.b64decode(audio_base64)
+                        logging.debug('历史语音消息解码成功，长度: %s 字节', len(audio_data))
+                    except Exception as decode_error:
+                        logging.error('历史语音消息base64解码失败: %s', decode_error)
+                        # 如果解析失败，显示为文本消息
+                        display_sender = '我' if sender == self.username else sender
+                        is_self = (sender == self.username)
+                        self.append_text_message(display_sender, '[语音消息-解码失败]', is_self, row=row)
+                        return
+
+                    # 验证音频数据
+                    if len(audio_data) == 0:
+                        logging.warning("历史语音消息数据为空")
+                        display_sender = '我' if sender == self.username else sender
+                        is_self = (sender == self.username)
+                        self.append_text_message(display_sender, '[语音消息-数据为空]', is_self, row=row)
+                        return
+
+                    # 显示语音消息
+                    display_sender = '我' if sender == self.username else sender
+                    is_self = (sender == self.username)
+                    self.append_voice_message(display_sender, audio_data, voice_type, duration, is_self, row=row)
+                else:
+                    logging.error('语音消息格式错误，参数不足: %s', msg)
+                    # 如果解析失败，显示为文本消息
+                    display_sender = '我' if sender == self.username else sender
+                    is_self = (sender == self.username)
+                    self.append_text_message(display_sender, '[语音消息-格式错误]', is_self, row=row)
+            except Exception as e:
+                logging.error('处理历史语音消息失败: %s', e)
+                import traceback
+                traceback.print_exc()
+                # 如果解析失败，显示为文本消息
+                display_sender = '我' if sender == self.username else sender
+                is_self = (sender == self.username)
+                self.append_text_message(display_sender, '[语音消息-处理失败]', is_self, row=row)
+        else:
+            if sender == self.username:
+                self.append_text_message('我', msg, is_self=True, row=row)
+            else:
+                self.append_text_message(sender, msg, row=row)
+
+    def append_text_message(self, sender, text, is_self=False, row=None):
         label = QLabel()
         label.setText(f'<b>{sender}:</b> {text}')
-        item = QListWidgetItem()
-        self.chat_display.addItem(item)
-        self.chat_display.setItemWidget(item, label)
-        item.setSizeHint(label.sizeHint())
         if is_self:
             label.setStyleSheet('color:blue;')
-        self.chat_display.scrollToBottom()
+        self.add_chat_item(self.chat_display, label, row)
 
-    def append_emoji_message(self, sender, emoji_id):
+    def append_emoji_message(self, sender, emoji_id, row=None):
         widget = QWidget()
         layout = QHBoxLayout()
         layout.setContentsMargins(0, 0, 0, 0)
@@ -2065,7 +2308,7 @@ class MainWindow(QWidget):
 
             # 添加路径检查
             if not os.path.exists(path):
-                print(f"表情文件不存在: {path}")
+                logging.warning('表情文件不存在: %s', path)
                 img_label.setText(f"[表情: {emoji_id}]")
             elif emoji_id.lower().endswith('.gif'):
                 # 使用定时器确保GIF加载完成
@@ -2080,7 +2323,7 @@ class MainWindow(QWidget):
                 pix = QPixmap(path)
                 if pix.isNull():
                     # 如果加载失败，尝试重新加载
-                    print(f"表情加载失败，尝试重新加载: {emoji_id}")
+                    logging.error('表情加载失败，尝试重新加载: %s', emoji_id)
                     pix = QPixmap(path)
                 img_label.setPixmap(pix.scaled(40, 40, Qt.KeepAspectRatio, Qt.SmoothTransformation))
                 # 强制处理事件以确保显示更新
@@ -2089,11 +2332,7 @@ class MainWindow(QWidget):
         layout.addWidget(name_label)
         layout.addWidget(img_label)
         widget.setLayout(layout)
-        item = QListWidgetItem()
-        self.chat_display.addItem(item)
-        self.chat_display.setItemWidget(item, widget)
-        item.setSizeHint(widget.sizeHint())
-        self.chat_display.scrollToBottom()
+        self.add_chat_item(self.chat_display, widget, row)
         # 强制刷新UI
         self.chat_display.repaint()
 
@@ -2144,7 +2383,7 @@ class MainWindow(QWidget):
                 QMessageBox.warning(self, '错误', '录制的音频数据为空')
                 return
             
-            logging.debug(f"准备发送语音消息: 数据长度={len(audio_data)}, 类型={voice_type}")
+            logging.debug('准备发送语音消息: 数据长度=%s, 类型=%s', len(audio_data), voice_type)
             
             # 将音频数据编码为base64以便传输
             import base64
@@ -2152,20 +2391,20 @@ class MainWindow(QWidget):
                 audio_base64 = base64.b64encode(audio_data).decode('utf-8')
                 # 移除所有换行符和空白字符，这很重要！
                 audio_base64 = audio_base64.replace('\n', '').replace('\r', '').replace(' ', '').replace('\t', '')
-                logging.debug(f"音频数据编码成功，base64长度: {len(audio_base64)}")
+                logging.debug('音频数据编码成功，base64长度: %s', len(audio_base64))
                 
                 # 验证base64数据不包含特殊字符
                 if '|' in audio_base64 or '\n' in audio_base64:
                     raise Exception("Base64数据包含特殊字符，可能导致传输错误")
                     
             except Exception as encode_error:
-                logging.error(f"音频数据编码失败: {encode_error}")
+                logging.error('音频数据编码失败: %s', encode_error)
                 QMessageBox.warning(self, '发送失败', f'音频数据编码失败: {encode_error}')
                 return
             
             # 计算音频时长
             duration = len(audio_data) / (RATE * 2)  # 估算时长
-            logging.debug(f"计算音频时长: {duration:.1f}秒")
+            logging.debug('计算音频时长: %.1f秒', duration)
             
             # 验证参数
             if not self.current_friend:
@@ -2177,19 +2416,25 @@ class MainWindow(QWidget):
             
             # 发送语音消息到服务器
             try:
-                voice_msg = f'VOICE_MSG|{self.current_friend}|{voice_type}|{duration:.1f}|{audio_base64}'
-                logging.debug(f"发送语音消息: 目标={self.current_friend}, 消息长度={len(voice_msg)}")
-                
-                # 确保消息以换行符结尾，这很重要！
-                if not voice_msg.endswith('\n'):
-                    voice_msg += '\n'
-                
-                # 验证消息格式
-                if voice_msg.count('|') < 4:
-                    raise Exception(f"语音消息格式错误，分隔符数量不足: {voice_msg.count('|')}")
-                
-                # 使用统一的发送方法
-                if self.send_message_to_server(voice_msg):
+                if self.protocol == PROTOCOL_V2:
+                    # v2 协议直接发送原始音频字节，不需要 base64
+                    sent = self.send_binary_to_server(
+                        f'VOICE_MSG|{self.current_friend}|{voice_type}|{duration:.1f}', audio_data)
+                else:
+                    voice_msg = f'VOICE_MSG|{self.current_friend}|{voice_type}|{duration:.1f}|{audio_base64}'
+                    logging.debug('发送语音消息: 目标=%s, 消息长度=%s', self.current_friend, len(voice_msg))
+
+                    # 确保消息以换行符结尾，这很重要！
+                    if not voice_msg.endswith('\n'):
+                        voice_msg += '\n'
+
+                    # 验证消息格式
+                    if voice_msg.count('|') < 4:
+                        raise Exception(f"语音消息格式错误，分隔符数量不足: {voice_msg.count('|')}")
+
+                    # 使用统一的发送方法
+                    sent = self.send_message_to_server(voice_msg)
+                if sent:
                     logging.debug("语音消息发送成功")
                 else:
                     raise Exception("发送语音消息到服务器失败")
@@ -2198,21 +2443,28 @@ class MainWindow(QWidget):
                 self.append_voice_message('我', audio_data, voice_type, duration, is_self=True)
                 
                 # 保存发送的语音消息到本地历史记录
-                self.save_voice_message_history(self.username, voice_type, duration, audio_base64)
+                if self.protocol == PROTOCOL_V2:
+                    # 服务器按内容摘要保存语音，本地也按摘要缓存，聊天记录中的引用可以直接播放
+                    blob_hash = hashlib.sha256(audio_data).hexdigest()
+                    self.cache_voice_blob(blob_hash, audio_data)
+                    self.save_voice_message_history(self.username, voice_type, duration, blob_hash=blob_hash)
+                else:
+                    self.save_voice_message_history(self.username, voice_type, duration, audio_base64)
                 
             except Exception as send_error:
-                logging.error(f"发送语音消息到服务器失败: {send_error}")
+                logging.error('发送语音消息到服务器失败: %s', send_error)
                 QMessageBox.warning(self, '发送失败', f'发送语音消息失败: {send_error}')
                 return
             
         except Exception as e:
-            logging.error(f"处理语音消息失败: {e}")
+            logging.error('处理语音消息失败: %s', e)
             import traceback
             traceback.print_exc()
             QMessageBox.warning(self, '发送失败', f'处理语音消息失败: {e}')
 
-    def append_voice_message(self, sender, audio_data, voice_type="original", duration=0, is_self=False):
-        """在聊天界面添加语音消息"""
+    def append_voice_message(self, sender, audio_data, voice_type="original", duration=0, is_self=False, row=None,
+                             blob_hash=None):
+        """在聊天界面添加语音消息，audio_data 为 None 时按 blob_hash 在播放时获取"""
         widget = QWidget()
         layout = QHBoxLayout()
         layout.setContentsMargins(0, 0, 0, 0)
@@ -2223,7 +2475,7 @@ class MainWindow(QWidget):
             name_label.setStyleSheet('color:blue;')
         
         # 语音消息播放器
-        voice_player = VoiceMessagePlayer(audio_data, voice_type, duration)
+        voice_player = VoiceMessagePlayer(audio_data, voice_type, duration, blob_hash, self.fetch_voice_blob)
         
         layout.addWidget(name_label)
         layout.addWidget(voice_player)
@@ -2231,14 +2483,10 @@ class MainWindow(QWidget):
         
         widget.setLayout(layout)
         
-        item = QListWidgetItem()
-        self.chat_display.addItem(item)
-        self.chat_display.setItemWidget(item, widget)
-        item.setSizeHint(widget.sizeHint())
-        self.chat_display.scrollToBottom()
+        self.add_chat_item(self.chat_display, widget, row)
 
-    def save_voice_message_history(self, from_user, voice_type, duration, audio_base64):
-        """保存语音消息到本地历史记录"""
+    def save_voice_message_history(self, from_user, voice_type, duration, audio_base64=None, blob_hash=None):
+        """保存语音消息到本地历史记录，有 blob_hash 时只保存摘要"""
         try:
             # 使用用户数据目录存储语音消息
             voice_dir = VOICE_MESSAGES_DIR
@@ -2261,9 +2509,12 @@ class MainWindow(QWidget):
                 'sender': from_user,
                 'voice_type': voice_type,
                 'duration': duration,
-                'audio_base64': audio_base64,
                 'timestamp': time.time()
             }
+            if blob_hash:
+                voice_record['blob_hash'] = blob_hash
+            else:
+                voice_record['audio_base64'] = audio_base64
             voice_history.append(voice_record)
             
             # 保存历史记录
@@ -2271,7 +2522,59 @@ class MainWindow(QWidget):
                 json.dump(voice_history, f, ensure_ascii=False, indent=2)
                 
         except Exception as e:
-            logging.error(f"保存语音消息历史失败: {e}")
+            logging.error('保存语音消息历史失败: %s', e)
+
+    def cache_voice_blob(self, blob_hash, audio_data):
+        """缓存语音数据到内存和本地目录"""
+        self.voice_blob_cache[blob_hash] = audio_data
+        try:
+            with open(os.path.join(VOICE_BLOB_CACHE_DIR, blob_hash), 'wb') as f:
+                f.write(audio_data)
+        except Exception as e:
+            logging.error('缓存语音数据失败: %s', e)
+
+    def get_cached_voice_blob(self, blob_hash):
+        audio_data = self.voice_blob_cache.get(blob_hash)
+        if audio_data is None:
+            cache_path = os.path.join(VOICE_BLOB_CACHE_DIR, blob_hash)
+            if os.path.exists(cache_path):
+                with open(cache_path, 'rb') as f:
+                    audio_data = f.read()
+                # 本地文件可能被截断，校验摘要后才使用
+                if hashlib.sha256(audio_data).hexdigest() != blob_hash:
+                    return None
+                self.voice_blob_cache[blob_hash] = audio_data
+        return audio_data
+
+    def fetch_voice_blob(self, blob_hash, callback):
+        """获取语音数据后调用 callback(audio_data)，同一段语音同时只请求一次"""
+        if len(blob_hash) != 64 or blob_hash.strip('0123456789abcdef'):
+            # 摘要会用作缓存文件名，格式不对时直接视为获取失败
+            callback(None)
+            return
+        audio_data = self.get_cached_voice_blob(blob_hash)
+        if audio_data is not None:
+            callback(audio_data)
+            return
+        waiting = self.pending_voice_fetches.setdefault(blob_hash, [])
+        waiting.append(callback)
+        if len(waiting) == 1 and not self.send_message_to_server(f'GET_VOICE|{blob_hash}'):
+            self.on_voice_blob(blob_hash, None)
+
+    def on_voice_blob(self, blob_hash, audio_data):
+        """收到 VOICE_DATA 或 VOICE_DATA_FAIL，通知等待这段语音的播放器"""
+        if audio_data is not None:
+            if hashlib.sha256(audio_data).hexdigest() != blob_hash:
+                logging.error('语音数据摘要不匹配: %s', blob_hash)
+                audio_data = None
+            else:
+                self.cache_voice_blob(blob_hash, audio_data)
+        for callback in self.pending_voice_fetches.pop(blob_hash, []):
+            try:
+                callback(audio_data)
+            except RuntimeError:
+                # 播放器所在的聊天记录已被清空
+                pass
 
     def load_voice_message_history(self, friend_name):
         """加载语音消息历史记录"""
@@ -2289,9 +2592,104 @@ class MainWindow(QWidget):
             return voice_history
             
         except Exception as e:
-            logging.error(f"加载语音消息历史失败: {e}")
+            logging.error('加载语音消息历史失败: %s', e)
             return []
 
+    def request_private_history(self, before_id=0):
+        """分页获取与当前好友的私聊历史，before_id 为 0 时获取最新一页"""
+        self.private_history_loading = True
+        self.send_message_to_server(
+            f'GET_PRIVATE_HISTORY|{self.username}|{self.current_friend}|{before_id}|{HISTORY_PAGE_SIZE}')
+
+    def request_group_history(self, before_id=0):
+        """分页获取当前群聊的历史，before_id 为 0 时获取最新一页"""
+        self.group_history_loading = True
+        self.send_message_to_server(f'GET_GROUP_HISTORY|{self.current_group}|{before_id}|{HISTORY_PAGE_SIZE}')
+
+    def on_private_scroll(self, value):
+        """私聊记录滚动到顶部时加载更早的一页"""
+        if (value == self.chat_display.verticalScrollBar().minimum() and self.current_friend
+                and self.private_history_has_more and not self.private_history_loading):
+            self.request_private_history(self.private_history_cursor)
+
+    def on_group_scroll(self, value):
+        """群聊记录滚动到顶部时加载更早的一页"""
+        if (value == self.group_chat_display.verticalScrollBar().minimum() and self.current_group
+                and self.group_history_has_more and not self.group_history_loading):
+            self.request_group_history(self.group_history_cursor)
+
+    def on_private_history_page(self, parts):
+        """PRIVATE_HISTORY_PAGE|好友|游标|是否还有更早消息|sender|msg|..."""
+        peer, cursor, has_more = parts[1], parts[2], parts[3] == '1'
+        if peer != self.current_friend:
+            return  # 已切换到其他好友，丢弃过期的回复
+        first_page = self.private_history_cursor is None
+        history = parts[4:]
+        logging.debug('接收到私聊历史分页: %s条消息, 游标=%s', len(history) // 2, cursor)
+        # 第一页追加在标题之后，更早的页插入到标题之后、已有消息之前
+        row = None if first_page else 1
+        anchor = None if first_page else self.chat_display.item(row)
+        for i in range(0, len(history) - 1, 2):
+            self.display_private_history_entry(history[i], history[i + 1], row)
+            if row is not None:
+                row += 1
+        self.private_history_cursor = int(cursor) if cursor.isdigit() else 0
+        self.private_history_has_more = has_more
+        self.private_history_loading = False
+        if first_page:
+            self.chat_display.scrollToBottom()
+            self.load_and_display_voice_history()
+        elif anchor is not None:
+            # 保持原来位于顶部的消息不动
+            self.chat_display.scrollToItem(anchor, QAbstractItemView.PositionAtTop)
+
+    def on_group_history_page(self, parts):
+        """GROUP_HISTORY_PAGE|群ID|游标|是否还有更早消息|type|sender|msg|..."""
+        group_id, cursor, has_more = parts[1], parts[2], parts[3] == '1'
+        if str(group_id) != str(self.current_group):
+            return  # 已切换到其他群，丢弃过期的回复
+        first_page = self.group_history_cursor is None
+        history = parts[4:]
+        logging.debug('接收到群聊历史分页: %s条消息, 游标=%s', len(history) // 3, cursor)
+        if first_page:
+            self.group_chat_display.clear()
+        row = None if first_page else 0
+        anchor = None if first_page else self.group_chat_display.item(0)
+        i = 0
+        while i + 2 < len(history):
+            if self.display_group_history_entry(history[i], history[i + 1], history[i + 2], row):
+                i += 3
+                if row is not None:
+                    row += 1
+            else:
+                logging.warning('未知的历史记录类型: %s', history[i])
+                i += 1
+        self.group_history_cursor = int(cursor) if cursor.isdigit() else 0
+        self.group_history_has_more = has_more
+        self.group_history_loading = False
+        if first_page:
+            self.group_chat_display.scrollToBottom()
+        elif anchor is not None:
+            self.group_chat_display.scrollToItem(anchor, QAbstractItemView.PositionAtTop)
+
+    def display_group_history_entry(self, kind, name, msg, row=None):
+        """显示一条群聊历史消息，kind 为 user 或 anon，未知类型时返回 False"""
+        if kind == 'user':
+            logging.debug('历史记录: user=%s, msg=%s', name, msg)
+            if msg.startswith('[EMOJI]'):
+                self.append_group_emoji(name, msg[7:], row=row)
+            else:
+                self.append_group_message(name, msg, row=row)
+        elif kind == 'anon':
+            logging.debug('历史记录: anon=%s, msg=%s', name, msg)
+            if msg.startswith('[EMOJI]'):
+                self.append_group_anon_emoji(name, msg[7:], row=row)
+            else:
+                self.append_group_anon_message(name, msg, row=row)
+        else:
+            return False
+        return True
+
     def select_group(self, item):
         if self.selecting_group:
             return
@@ -2310,12 +2708,18 @@ class MainWindow(QWidget):
                 self.unread_groups.remove(group_info)
                 self.update_group_list()  # 更新群聊列表显示
             self.tab_widget.setCurrentWidget(self.group_tab)
+            self.group_history_cursor = None
+            self.group_history_has_more = False
             self.group_chat_display.clear()
             self.anon_nick = None
             self.group_members_list.clear()
             # 先获取群聊成员，再获取历史记录
             self.send_message_to_server(f'GET_GROUP_MEMBERS|{self.current_group}')
-            self.send_message_to_server(f'GET_GROUP_HISTORY|{self.current_group}')
+            if self.protocol == PROTOCOL_V2:
+                # 支持 v2 协议的服务器同时支持分页，先加载最新的一页
+                self.request_group_history()
+            else:
+                self.send_message_to_server(f'GET_GROUP_HISTORY|{self.current_group}')
         finally:
             self.selecting_group = False
 
@@ -2350,7 +2754,7 @@ class MainWindow(QWidget):
         if not self.group_anon_btn.isChecked():
             self.anon_nick = None
 
-    def append_group_message(self, sender, msg, is_self=False):
+    def append_group_message(self, sender, msg, is_self=False, row=None):
         widget = QWidget()
         layout = QHBoxLayout()
         layout.setContentsMargins(0, 0, 0, 0)
@@ -2361,13 +2765,9 @@ class MainWindow(QWidget):
         layout.addWidget(name_label)
         layout.addWidget(msg_label)
         widget.setLayout(layout)
-        item = QListWidgetItem()
-        self.group_chat_display.addItem(item)
-        self.group_chat_display.setItemWidget(item, widget)
-        item.setSizeHint(widget.sizeHint())
-        self.group_chat_display.scrollToBottom()
+        self.add_chat_item(self.group_chat_display, widget, row)
 
-    def append_group_anon_message(self, anon_nick, msg, is_self=False):
+    def append_group_anon_message(self, anon_nick, msg, is_self=False, row=None):
         widget = QWidget()
         layout = QHBoxLayout()
         layout.setContentsMargins(0, 0, 0, 0)
@@ -2378,11 +2778,7 @@ class MainWindow(QWidget):
         layout.addWidget(name_label)
         layout.addWidget(msg_label)
         widget.setLayout(layout)
-        item = QListWidgetItem()
-        self.group_chat_display.addItem(item)
-        self.group_chat_display.setItemWidget(item, widget)
-        item.setSizeHint(widget.sizeHint())
-        self.group_chat_display.scrollToBottom()
+        self.add_chat_item(self.group_chat_display, widget, row)
 
     def send_group_emoji(self, emoji_id):
         if not self.current_group:
@@ -2399,7 +2795,7 @@ class MainWindow(QWidget):
             self.send_message_to_server(f'GROUP_MSG|{self.current_group}|{self.username}|[EMOJI]{emoji_id}')
             self.append_group_emoji(self.username, emoji_id, is_self=True)
 
-    def append_group_emoji(self, sender, emoji_id, is_self=False):
+    def append_group_emoji(self, sender, emoji_id, is_self=False, row=None):
         widget = QWidget()
         layout = QHBoxLayout()
         layout.setContentsMargins(0, 0, 0, 0)
@@ -2411,7 +2807,7 @@ class MainWindow(QWidget):
             # 路径检查和处理
             path = os.path.join(EMOJI_DIR, emoji_id)
             if not os.path.exists(path):
-                print(f"表情文件不存在: {path}")
+                logging.warning('表情文件不存在: %s', path)
                 # 在图像标签显示错误信息
                 img_label.setText(f"[表情: {emoji_id}]")
             elif emoji_id.lower().endswith('.gif'):
@@ -2427,7 +2823,7 @@ class MainWindow(QWidget):
                 pix = QPixmap(path)
                 if pix.isNull():
                     # 如果加载失败，尝试重新加载
-                    print(f"表情加载失败，尝试重新加载: {emoji_id}")
+                    logging.error('表情加载失败，尝试重新加载: %s', emoji_id)
                     pix = QPixmap(path)
                 img_label.setPixmap(pix.scaled(40, 40, Qt.KeepAspectRatio, Qt.SmoothTransformation))
                 # 强制处理事件以确保显示更新
@@ -2438,15 +2834,11 @@ class MainWindow(QWidget):
         layout.addWidget(name_label)
         layout.addWidget(img_label)
         widget.setLayout(layout)
-        item = QListWidgetItem()
-        self.group_chat_display.addItem(item)
-        self.group_chat_display.setItemWidget(item, widget)
-        item.setSizeHint(widget.sizeHint())
-        self.group_chat_display.scrollToBottom()
+        self.add_chat_item(self.group_chat_display, widget, row)
         # 强制刷新UI
         self.group_chat_display.repaint()
 
-    def append_group_anon_emoji(self, anon_nick, emoji_id, is_self=False):
+    def append_group_anon_emoji(self, anon_nick, emoji_id, is_self=False, row=None):
         widget = QWidget()
         layout = QHBoxLayout()
         layout.setContentsMargins(0, 0, 0, 0)
@@ -2458,7 +2850,7 @@ class MainWindow(QWidget):
             # 路径检查和处理
             path = os.path.join(EMOJI_DIR, emoji_id)
             if not os.path.exists(path):
-                print(f"表情文件不存在: {path}")
+                logging.warning('表情文件不存在: %s', path)
                 # 在图像标签显示错误信息
                 img_label.setText(f"[表情: {emoji_id}]")
             elif emoji_id.lower().endswith('.gif'):
@@ -2474,7 +2866,7 @@ class MainWindow(QWidget):
                 pix = QPixmap(path)
                 if pix.isNull():
                     # 如果加载失败，尝试重新加载
-                    print(f"表情加载失败，尝试重新加载: {emoji_id}")
+                    logging.error('表情加载失败，尝试重新加载: %s', emoji_id)
                     pix = QPixmap(path)
                 img_label.setPixmap(pix.scaled(40, 40, Qt.KeepAspectRatio, Qt.SmoothTransformation))
                 # 强制处理事件以确保显示更新
@@ -2485,27 +2877,21 @@ class MainWindow(QWidget):
         layout.addWidget(name_label)
         layout.addWidget(img_label)
         widget.setLayout(layout)
-        item = QListWidgetItem()
-        self.group_chat_display.addItem(item)
-        self.group_chat_display.setItemWidget(item, widget)
-        item.setSizeHint(widget.sizeHint())
-        self.group_chat_display.scrollToBottom()
+        self.add_chat_item(self.group_chat_display, widget, row)
         # 强制刷新UI
         self.group_chat_display.repaint()
 
     def on_message(self, data):
         try:
-            logging.debug(f"处理收到的消息: {data}")
+            logging.debug('处理收到的消息: %s', data)
             parts = data.split('|')
             cmd = parts[0]
 
-            # 调试专用 - 添加打印所有消息类型的日志
-            print(f"处理消息类型: {cmd}, 完整消息: {data}")
 
             # 强制下线处理 - 最高优先级
             if cmd == 'FORCE_LOGOUT':
                 reason = parts[1] if len(parts) > 1 else "您的账号在其他地方登录"
-                logging.warning(f"账号被强制下线: {reason}")
+                logging.warning('账号被强制下线: %s', reason)
                 QMessageBox.warning(self, "强制下线", reason)
                 self.close()
                 return
@@ -2516,102 +2902,32 @@ class MainWindow(QWidget):
             if cmd == 'PRIVATE_HISTORY':
                 try:
                     if parts[1] == 'error':
+                        self.private_history_loading = False
                         self.append_text_message('[系统]', f'获取历史记录失败: {parts[2]}')
                         return
 
                     history = parts[1:]
-                    print(f"接收到私聊历史记录: {len(history) // 2}条消息")
+                    logging.debug('接收到私聊历史记录: %s条消息', len(history) // 2)
 
                     i = 0
                     while i < len(history):
                         if i + 1 >= len(history):
-                            print(f"历史记录数据不完整: {history[i:]}")
+                            logging.warning('历史记录数据不完整: %s', history[i:])
                             break
 
                         sender = history[i]
                         msg = history[i + 1]
-                        print(f"私聊历史: sender={sender}, msg={msg}")
+                        logging.debug('私聊历史: sender=%s, msg=%s', sender, msg)
 
-                        # 显示历史消息
-                        if msg.startswith('[EMOJI]'):
-                            emoji_id = msg[7:]
-                            if sender == self.username:
-                                self.append_emoji_message('我', emoji_id)
-                            else:
-                                self.append_emoji_message(sender, emoji_id)
-                        elif msg.startswith('[VOICE:'):
-                            # 处理语音消息历史记录
-                            try:
-                                # 解析语音消息格式: [VOICE:voice_type:duration:audio_base64]
-                                voice_content = msg[7:-1]  # 去掉 [VOICE: 和 ]
-                                voice_parts = voice_content.split(':', 3)  # 只分割前3个:，剩余的都是audio_base64
-                                
-                                if len(voice_parts) >= 4:
-                                    voice_type = voice_parts[0]
-                                    duration_str = voice_parts[1]
-                                    # voice_parts[2] 是空的或者其他数据
-                                    audio_base64 = voice_parts[3]
-                                    
-                                    logging.debug(f"解析历史语音消息: type={voice_type}, duration={duration_str}, data_len={len(audio_base64)}")
-                                    
-                                    try:
-                                        duration = float(duration_str)
-                                    except ValueError:
-                                        logging.warning(f"无效的历史语音消息时长: {duration_str}")
-                                        duration = 0.0
-                                    
-                                    # 解码音频数据
-                                    import base64
-                                    try:
-                                        # 修复base64填充问题
-                                        missing_padding = len(audio_base64) % 4
-                                        if missing_padding:
-                                            audio_base64 += '=' * (4 - missing_padding)
-                                        audio_data = base64.b64decode(audio_base64)
-                                        logging.debug(f"历史语音消息解码成功，长度: {len(audio_data)} 字节")
-                                    except Exception as decode_error:
-                                        logging.error(f"历史语音消息base64解码失败: {decode_error}")
-                                        # 如果解析失败，显示为文本消息
-                                        display_sender = '我' if sender == self.username else sender
-                                        is_self = (sender == self.username)
-                                        self.append_text_message(display_sender, '[语音消息-解码失败]', is_self)
-                                        continue
-                                    
-                                    # 验证音频数据
-                                    if len(audio_data) == 0:
-                                        logging.warning("历史语音消息数据为空")
-                                        display_sender = '我' if sender == self.username else sender
-                                        is_self = (sender == self.username)
-                                        self.append_text_message(display_sender, '[语音消息-数据为空]', is_self)
-                                        continue
-                                    
-                                    # 显示语音消息
-                                    display_sender = '我' if sender == self.username else sender
-                                    is_self = (sender == self.username)
-                                    self.append_voice_message(display_sender, audio_data, voice_type, duration, is_self)
-                                else:
-                                    logging.error(f"语音消息格式错误，参数不足: {msg}")
-                                    # 如果解析失败，显示为文本消息
-                                    display_sender = '我' if sender == self.username else sender
-                                    is_self = (sender == self.username)
-                                    self.append_text_message(display_sender, '[语音消息-格式错误]', is_self)
-                            except Exception as e:
-                                logging.error(f"处理历史语音消息失败: {e}")
-                                import traceback
-                                traceback.print_exc()
-                                # 如果解析失败，显示为文本消息
-                                display_sender = '我' if sender == self.username else sender
-                                is_self = (sender == self.username)
-                                self.append_text_message(display_sender, '[语音消息-处理失败]', is_self)
-                        else:
-                            if sender == self.username:
-                                self.append_text_message('我', msg, is_self=True)
-                            else:
-                                self.append_text_message(sender, msg)
+                        self.display_private_history_entry(sender, msg)
                         i += 2
                 except Exception as e:
-                    print(f"处理私聊历史记录出错: {e}")
+                    logging.error('处理私聊历史记录出错: %s', e)
                     self.append_text_message('[系统]', '处理历史记录出错')
+            elif cmd == 'PRIVATE_HISTORY_PAGE':
+                self.on_private_history_page(parts)
+            elif cmd == 'GROUP_HISTORY_PAGE':
+                self.on_group_history_page(parts)
             elif cmd == 'MSG':
                 from_user, msg = parts[1], '|'.join(parts[2:])
                 if self.tab_widget.currentWidget() == self.private_tab and from_user == self.current_friend:
@@ -2626,7 +2942,7 @@ class MainWindow(QWidget):
                     # 使用更安全的方式解析消息，避免base64数据中的|字符干扰
                     msg_parts = data.split('|', 4)  # 只分割前4个|，剩余的都是audio_base64
                     if len(msg_parts) < 5:
-                        logging.error(f"语音消息格式错误: 参数不足，收到 {len(msg_parts)} 个参数")
+                        logging.error('语音消息格式错误: 参数不足，收到 %s 个参数', len(msg_parts))
                         self.append_text_message('[系统]', '收到格式错误的语音消息')
                         return
                     
@@ -2635,7 +2951,7 @@ class MainWindow(QWidget):
                     duration_str = msg_parts[3]
                     audio_base64 = msg_parts[4]
                     
-                    logging.debug(f"收到语音消息: from={from_user}, type={voice_type}, duration={duration_str}, data_len={len(audio_base64)}")
+                    logging.debug('收到语音消息: from=%s, type=%s, duration=%s, data_len=%s', from_user, voice_type, duration_str, len(audio_base64))
                     
                     # 验证参数
                     if not from_user or not voice_type or not duration_str or not audio_base64:
@@ -2646,7 +2962,7 @@ class MainWindow(QWidget):
                     try:
                         duration = float(duration_str)
                     except ValueError:
-                        logging.error(f"无效的时长参数: {duration_str}")
+                        logging.error('无效的时长参数: %s', duration_str)
                         duration = 0.0
                     
                     # 解码音频数据
@@ -2657,41 +2973,54 @@ class MainWindow(QWidget):
                         if missing_padding:
                             audio_base64 += '=' * (4 - missing_padding)
                         audio_data = base64.b64decode(audio_base64)
-                        logging.debug(f"音频数据解码成功，长度: {len(audio_data)} 字节")
+                        logging.debug('音频数据解码成功，长度: %s 字节', len(audio_data))
                     except Exception as decode_error:
-                        logging.error(f"base64解码失败: {decode_error}")
+                        logging.error('base64解码失败: %s', decode_error)
                         self.append_text_message('[系统]', f'语音消息解码失败: {decode_error}')
                         return
                     
-                    # 验证音频数据
-                    if len(audio_data) == 0:
-                        logging.error("音频数据为空")
-                        self.append_text_message('[系统]', '收到空的语音消息')
-                        return
-                    
-                    # 只在当前私聊界面显示
-                    if self.tab_widget.currentWidget() == self.private_tab and from_user == self.current_friend:
-                        self.append_voice_message(from_user, audio_data, voice_type, duration)
-                    
-                    # 保存语音消息历史
-                    self.save_voice_message_history(from_user, voice_type, duration, audio_base64)
+                    self.handle_voice_message(from_user, voice_type, duration, audio_data, audio_base64)
                     
                 except Exception as e:
-                    logging.error(f"处理语音消息失败: {e}")
+                    logging.error('处理语音消息失败: %s', e)
                     import traceback
                     traceback.print_exc()
                     self.append_text_message('[系统]', f'处理语音消息失败: {str(e)}')
+            elif cmd == 'VOICE_MSG_REF':
+                # VOICE_MSG_REF|from_user|voice_type|duration|sha256|size，音频在点击播放时获取
+                if len(parts) < 6 or not parts[1] or not parts[4]:
+                    logging.error('语音消息格式错误: %s', data)
+                    self.append_text_message('[系统]', '收到格式错误的语音消息')
+                    return
+                try:
+                    duration = float(parts[3])
+                except ValueError:
+                    logging.error('无效的时长参数: %s', parts[3])
+                    duration = 0.0
+                self.handle_voice_message(parts[1], parts[2], duration, blob_hash=parts[4])
+            elif cmd == 'VOICE_DATA':
+                # VOICE_DATA|sha256|audio_base64，v2 连接收到的是二进制帧
+                import base64
+                try:
+                    audio_data = base64.b64decode(parts[2]) if len(parts) > 2 else None
+                except Exception as decode_error:
+                    logging.error('语音数据解码失败: %s', decode_error)
+                    audio_data = None
+                self.on_voice_blob(parts[1], audio_data)
+            elif cmd == 'VOICE_DATA_FAIL':
+                logging.warning('获取语音失败: %s', data)
+                self.on_voice_blob(parts[1] if len(parts) > 1 else '', None)
             elif cmd == 'VOICE_MSG_SENT':
                 # 语音消息发送确认
                 try:
                     to_user = parts[1] if len(parts) > 1 else ''
-                    logging.debug(f"语音消息发送成功: 发送给 {to_user}")
+                    logging.debug('语音消息发送成功: 发送给 %s', to_user)
                     # 可以在这里添加发送成功的UI反馈，比如显示一个小提示
                     if to_user == self.current_friend:
                         # 可以在聊天界面显示发送成功的提示
                         pass
                 except Exception as e:
-                    logging.error(f"处理语音消息发送确认失败: {e}")
+                    logging.error('处理语音消息发送确认失败: %s', e)
             # 移除所有语音通话相关的消息处理代码
             elif cmd == 'FRIEND_LIST':
                 self.friends = []
@@ -2729,11 +3058,11 @@ class MainWindow(QWidget):
                 try:
                     # 确保正确解析群聊消息
                     if len(parts) < 4:
-                        print(f"群聊消息格式错误: {data}")
+                        logging.error('群聊消息格式错误: %s', data)
                         return
 
                     group_id, from_user, msg = parts[1], parts[2], '|'.join(parts[3:])
-                    print(f"接收到群聊消息: group_id={group_id}, from_user={from_user}, msg={msg}")
+                    logging.debug('接收到群聊消息: group_id=%s, from_user=%s, msg=%s', group_id, from_user, msg)
 
                     # 统一群组ID格式
                     group_id_str = str(group_id)
@@ -2760,16 +3089,16 @@ class MainWindow(QWidget):
                         self.unread_groups.add(group_id)
                         self.update_group_list()
                 except Exception as e:
-                    print(f"处理群聊消息出错: {e}, 消息内容: {data}")
+                    logging.error('处理群聊消息出错: %s, 消息内容: %s', e, data)
             elif cmd == 'GROUP_MSG_ANON':
                 try:
                     # 确保正确解析匿名群聊消息
                     if len(parts) < 4:
-                        print(f"匿名群聊消息格式错误: {data}")
+                        logging.error('匿名群聊消息格式错误: %s', data)
                         return
 
                     group_id, anon_nick, msg = parts[1], parts[2], '|'.join(parts[3:])
-                    print(f"接收到匿名群聊消息: group_id={group_id}, anon_nick={anon_nick}, msg={msg}")
+                    logging.debug('接收到匿名群聊消息: group_id=%s, anon_nick=%s, msg=%s', group_id, anon_nick, msg)
 
                     # 统一群组ID格式
                     group_id_str = str(group_id)
@@ -2792,44 +3121,30 @@ class MainWindow(QWidget):
                         self.unread_groups.add(group_id)
                         self.update_group_list()
                 except Exception as e:
-                    print(f"处理匿名群聊消息出错: {e}, 消息内容: {data}")
+                    logging.error('处理匿名群聊消息出错: %s, 消息内容: %s', e, data)
             elif cmd == 'GROUP_HISTORY':
                 try:
+                    if len(parts) > 2 and parts[1] == 'error':
+                        self.group_history_loading = False
+                        logging.error('获取群聊历史失败: %s', parts[2])
+                        return
                     self.group_chat_display.clear()
                     history = parts[1:]
-                    print(f"接收到群聊历史记录: {len(history) // 3}条消息")
+                    logging.debug('接收到群聊历史记录: %s条消息', len(history) // 3)
 
                     i = 0
                     while i < len(history):
                         if i + 2 >= len(history):
-                            print(f"历史记录数据不完整: {history[i:]}")
+                            logging.warning('历史记录数据不完整: %s', history[i:])
                             break
 
-                        if history[i] == 'user':
-                            sender = history[i + 1]
-                            msg = history[i + 2]
-                            print(f"历史记录: user={sender}, msg={msg}")
-                            if msg.startswith('[EMOJI]'):
-                                emoji_id = msg[7:]
-                                self.append_group_emoji(sender, emoji_id)
-                            else:
-                                self.append_group_message(sender, msg)
-                            i += 3
-                        elif history[i] == 'anon':
-                            anon_nick = history[i + 1]
-                            msg = history[i + 2]
-                            print(f"历史记录: anon={anon_nick}, msg={msg}")
-                            if msg.startswith('[EMOJI]'):
-                                emoji_id = msg[7:]
-                                self.append_group_anon_emoji(anon_nick, emoji_id)
-                            else:
-                                self.append_group_anon_message(anon_nick, msg)
+                        if self.display_group_history_entry(history[i], history[i + 1], history[i + 2]):
                             i += 3
                         else:
-                            print(f"未知的历史记录类型: {history[i]}")
+                            logging.warning('未知的历史记录类型: %s', history[i])
                             i += 1
                 except Exception as e:
-                    print(f"处理群聊历史记录出错: {e}, 历史记录数据: {history}")
+                    logging.error('处理群聊历史记录出错: %s, 历史记录数据: %s', e, history)
             elif cmd == 'ADD_FRIEND_RESULT':
                 if parts[1] == 'OK':
                     QMessageBox.information(self, '添加好友', parts[2])
@@ -2852,6 +3167,12 @@ class MainWindow(QWidget):
             elif cmd == 'FRIEND_OFFLINE':
                 username = parts[1]
                 self.update_friend_status(username, False)
+            elif cmd == 'PRESENCE_DELTA':
+                # PRESENCE_DELTA|user1:online|user2:offline|...，服务器按批合并的好友上下线通知
+                for entry in parts[1:]:
+                    if ':' in entry:
+                        username, status = entry.rsplit(':', 1)
+                        self.update_friend_status(username, status == 'online')
             elif cmd == 'CREATE_GROUP_RESULT':
                 if parts[1] == 'OK':
                     group_id = parts[3] if len(parts) > 3 else ''
@@ -2869,28 +3190,62 @@ class MainWindow(QWidget):
             elif cmd == 'FILE_LIST':
                 # FILE_LIST|file1|file2|...
                 self.update_private_file_list(parts[1:])
-            elif cmd == 'FILE_DATA':
-                # FILE_DATA|filename|filesize
-                fname = parts[1]
-                filesize = int(parts[2])
-                # 接收文件数据
-                filedata = b''
-                while len(filedata) < filesize:
-                    chunk = self.sock.recv(min(4096, filesize - len(filedata)))
-                    if not chunk:
-                        break
-                    filedata += chunk
-
-                # 确保FILES_DIR存在
-                os.makedirs(FILES_DIR, exist_ok=True)
+            elif cmd == 'USE_FILE_PORT':
+                # 文件传输请求的重定向，交给后台传输管理器
+                self.transfers.on_redirect(parts)
+        except Exception as e:
+            logging.error('处理消息时出错: %s, 消息内容: %s', e, data, exc_info=True)
 
-                # 保存文件到FILES_DIR目录
-                save_path = os.path.join(FILES_DIR, fname)
-                with open(save_path, 'wb') as f:
-                    f.write(filedata)
-                QMessageBox.information(self, '下载完成', f'文件已保存到: {save_path}')
+    def on_binary_message(self, meta, blob):
+        """处理 v2 二进制帧，blob 为原始字节"""
+        try:
+            parts = meta.split('|')
+            cmd = parts[0]
+            logging.debug('处理收到的二进制消息: %s, 数据长度: %s', meta, len(blob))
+            if cmd == 'VOICE_MSG':
+                # VOICE_MSG|from_user|voice_type|duration + 原始音频
+                if len(parts) < 4 or not parts[1] or not parts[2]:
+                    logging.error('语音消息格式错误: %s', meta)
+                    self.append_text_message('[系统]', '收到格式错误的语音消息')
+                    return
+                try:
+                    duration = float(parts[3])
+                except ValueError:
+                    logging.error('无效的时长参数: %s', parts[3])
+                    duration = 0.0
+                self.handle_voice_message(parts[1], parts[2], duration, blob)
+            elif cmd == 'VOICE_DATA':
+                # VOICE_DATA|sha256 + 原始音频
+                self.on_voice_blob(parts[1] if len(parts) > 1 else '', blob)
+            else:
+                logging.warning('未知的二进制消息: %s', cmd)
         except Exception as e:
-            logging.error(f"处理消息时出错: {e}, 消息内容: {data}", exc_info=True)
+            logging.error('处理二进制消息时出错: %s, 消息内容: %s', e, meta, exc_info=True)
+
+    def handle_voice_message(self, from_user, voice_type, duration, audio_data=None, audio_base64=None,
+                             blob_hash=None):
+        """显示并保存收到的语音消息，文本协议和二进制帧共用；只有 blob_hash 时在播放时获取音频"""
+        if blob_hash:
+            if self.tab_widget.currentWidget() == self.private_tab and from_user == self.current_friend:
+                self.append_voice_message(from_user, None, voice_type, duration, blob_hash=blob_hash)
+            self.save_voice_message_history(from_user, voice_type, duration, blob_hash=blob_hash)
+            return
+
+        # 验证音频数据
+        if len(audio_data) == 0:
+            logging.error("音频数据为空")
+            self.append_text_message('[系统]', '收到空的语音消息')
+            return
+
+        # 只在当前私聊界面显示
+        if self.tab_widget.currentWidget() == self.private_tab and from_user == self.current_friend:
+            self.append_voice_message(from_user, audio_data, voice_type, duration)
+
+        # 保存语音消息历史，本地历史文件仍以 base64 保存
+        if audio_base64 is None:
+            import base64
+            audio_base64 = base64.b64encode(audio_data).decode('utf-8')
+        self.save_voice_message_history(from_user, voice_type, duration, audio_base64)
 
     def update_friend_status(self, username, online):
         # 更新好友列表项颜色和状态
@@ -2938,8 +3293,9 @@ class MainWindow(QWidget):
             except:
                 pass
 
-            # 停止客户端线程
+            # 停止客户端线程和后台文件传输
             self.client_thread.stop()
+            self.transfers.shutdown()
 
             # 关闭socket连接
             try:
@@ -2955,7 +3311,7 @@ class MainWindow(QWidget):
                 QApplication.quit()
 
         except Exception as e:
-            print(f"关闭窗口时出错: {e}")
+            logging.error('关闭窗口时出错: %s', e)
             event.accept()
             # 只有在用户主动关闭窗口时才退出程序
             if event.spontaneous():
@@ -2967,7 +3323,7 @@ class MainWindow(QWidget):
             # 使用定时器延迟执行，避免阻塞主窗口初始化
             QTimer.singleShot(100, self.delayed_refresh)
         except Exception as e:
-            logging.error(f"初始化刷新出错: {e}")
+            logging.error('初始化刷新出错: %s', e)
     
     def delayed_refresh(self):
         """延迟执行的刷新操作"""
@@ -2977,7 +3333,7 @@ class MainWindow(QWidget):
             self.get_groups()
             logging.debug("延迟刷新完成")
         except Exception as e:
-            logging.error(f"延迟刷新出错: {e}")
+            logging.error('延迟刷新出错: %s', e)
 
     # 移除所有语音通话相关的方法
 
@@ -3007,7 +3363,139 @@ class MainWindow(QWidget):
 
         @staticmethod
         def upload_file(server_host, server_port, username, to_user, file_path, progress_callback=None):
-            """上传文件到服务器
+            """分块上传文件：多个连接并行发送，断线后只补传服务器位图中缺少的块，最后由服务器校验 SHA-256
+
+            协议见 server/uploads.py。服务器不支持分块上传时退回 upload_file_legacy。
+            progress_callback 只在调用线程中调用，参数为百分比。
+
+            Returns:
+                (success, message): 成功状态和消息
+            """
+            file_size = os.path.getsize(file_path)
+            file_name = os.path.basename(file_path)
+            file_hash = hashlib.sha256()
+            with open(file_path, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    file_hash.update(block)
+            file_hash = file_hash.hexdigest()
+
+            def request(sock, reader, line, payload=None):
+                sock.sendall(line.encode('utf-8') + b'\n' + (payload or b''))
+                reply = reader.readline()
+                if not reply:
+                    raise ConnectionError('服务器关闭了连接')
+                return reply.decode('utf-8').rstrip('\n')
+
+            def connect():
+                sock = socket.create_connection((server_host, server_port), timeout=30)
+                return sock, sock.makefile('rb')
+
+            last_error = None
+            for attempt in range(UPLOAD_RETRIES):
+                if attempt:
+                    time.sleep(min(2 ** attempt, 10))
+                try:
+                    sock, reader = connect()
+                    try:
+                        state = request(sock, reader, f'UPLOAD_INIT|{username}|{to_user}|{file_name}|{file_size}|'
+                                                      f'{file_hash}|{UPLOAD_CHUNK_SIZE}')
+                    finally:
+                        sock.close()
+                    if state.startswith('ERROR|Unknown request type'):
+                        return MainWindow.FileTransfer.upload_file_legacy(
+                            server_host, server_port, username, to_user, file_path, progress_callback)
+                    if state.startswith('ALREADY_HAVE|'):
+                        # 服务器已有相同内容，秒传完成
+                        if progress_callback:
+                            progress_callback(100)
+                        return True, f"文件 {state.split('|', 1)[1]} 已成功上传（服务器已有相同文件）"
+                    if not state.startswith('UPLOAD_STATE|'):
+                        error_msg = state.split('|', 1)[1] if '|' in state else state
+                        return False, f"服务器错误: {error_msg}"
+                    _, upload_id, chunk_size, total_chunks, bitmap = state.split('|')
+                    chunk_size, total_chunks, bitmap = int(chunk_size), int(total_chunks), bytes.fromhex(bitmap)
+                    # 倒序保存，pop() 按编号从小到大取块
+                    pending = [i for i in reversed(range(total_chunks)) if not bitmap[i // 8] & (1 << (i % 8))]
+                    done = [total_chunks - len(pending)]
+                    errors = []
+                    lock = threading.Lock()
+                    if pending:
+                        logging.info('分块上传 %s: 共 %s 块，需要发送 %s 块', file_name, total_chunks, len(pending))
+
+                    def send_chunks():
+                        # 每个连接从共享列表中取块发送，出错时退出，剩下的块由下一轮按位图补传
+                        try:
+                            conn, conn_reader = connect()
+                        except OSError as e:
+                            errors.append(e)
+                            return
+                        try:
+                            with open(file_path, 'rb') as f:
+                                while not errors:
+                                    with lock:
+                                        if not pending:
+                                            return
+                                        chunk_id = pending.pop()
+                                    f.seek(chunk_id * chunk_size)
+                                    data = f.read(chunk_size)
+                                    reply = request(conn, conn_reader,
+                                                    f'UPLOAD_CHUNK|{username}|{upload_id}|{chunk_id}|{len(data)}|'
+                                                    f'{zlib.crc32(data):08x}', data)
+                                    if reply != f'CHUNK_OK|{chunk_id}':
+                                        raise Exception(f"服务器拒绝了第 {chunk_id} 块: {reply}")
+                                    with lock:
+                                        done[0] += 1
+                        except Exception as e:
+                            errors.append(e)
+                        finally:
+                            conn.close()
+
+                    workers = [threading.Thread(target=send_chunks, daemon=True)
+                               for _ in range(min(UPLOAD_CONNECTIONS, len(pending)))]
+                    for worker in workers:
+                        worker.start()
+                    last_progress = -1
+                    while True:
+                        alive = any(worker.is_alive() for worker in workers)
+                        progress = min(99, done[0] * 100 // max(total_chunks, 1))
+                        if progress != last_progress and progress_callback:
+                            progress_callback(progress)
+                            last_progress = progress
+                        if not alive:
+                            break
+                        time.sleep(0.1)
+                    if errors:
+                        raise errors[0]
+
+                    sock, reader = connect()
+                    try:
+                        sock.settimeout(None)  # 服务器要先计算整个文件的 SHA-256
+                        result = request(sock, reader, f'UPLOAD_FINISH|{username}|{upload_id}')
+                    finally:
+                        sock.close()
+                    if result.startswith('SUCCESS'):
+                        if progress_callback:
+                            progress_callback(100)
+                        saved_name = result.split('|', 1)[1] if '|' in result else file_name
+                        return True, f"文件 {saved_name} 已成功上传"
+                    if result.startswith('MISSING'):
+                        last_error = Exception("服务器缺少部分文件块")
+                        continue
+                    error_msg = result.split('|', 1)[1] if '|' in result else result
+                    return False, f"上传失败: {error_msg}"
+                except socket.timeout as e:
+                    last_error = e
+                    logging.warning('分块上传超时，准备续传: %s', file_name)
+                except ConnectionRefusedError:
+                    return False, "服务器拒绝连接，请确认服务器正在运行"
+                except Exception as e:
+                    last_error = e
+                    logging.warning('分块上传中断，准备续传: %s: %s', file_name, e)
+            return False, f"上传出错: {last_error}"
+
+        @staticmethod
+        def upload_file_legacy(server_host, server_port, username, to_user, file_path, progress_callback=None):
+            """上传文件到服务器（旧版服务器不支持分块上传时使用）
 
             Args:
                 server_host: 服务器主机名
@@ -3072,13 +3560,13 @@ class MainWindow(QWidget):
                                 prog_update = sock.recv(1024).decode('utf-8')
                                 if prog_update.startswith('PROGRESS'):
                                     server_progress = int(prog_update.split('|')[1])
-                                    logging.debug(f"服务器确认进度: {server_progress}%")
+                                    logging.debug('服务器确认进度: %s%%', server_progress)
                                 sock.settimeout(30)  # 恢复长超时
                             except socket.timeout:
                                 # 超时不中断传输
                                 sock.settimeout(30)
                             except Exception as e:
-                                logging.warning(f"接收服务器进度更新出错: {e}")
+                                logging.warning('接收服务器进度更新出错: %s', e)
                                 # 继续传输
 
                 # 等待最终确认
@@ -3103,7 +3591,165 @@ class MainWindow(QWidget):
 
         @staticmethod
         def download_file(server_host, server_port, username, from_user, file_name, save_path, progress_callback=None):
-            """从服务器下载文件
+            """分段并行下载文件：按 DOWNLOAD_SEGMENT_SIZE 分段，多个连接同时请求不同的字节范围，
+            写入预分配的 <save_path>.part，完成的段记录在 <save_path>.part.json 中，
+            中断后再次下载同一文件时只请求未完成的段。全部完成后校验 SHA-256 再改名为 save_path。
+
+            服务器不支持范围请求时退回 download_file_legacy。progress_callback 只在调用线程中调用。
+
+            Returns:
+                (success, message): 成功状态和消息
+            """
+            part_path = save_path + '.part'
+            state_path = part_path + '.json'
+
+            def request_range(offset, length):
+                """请求一段数据，返回 (套接字, 消息头字段, 已读到的数据开头)"""
+                sock = socket.create_connection((server_host, server_port), timeout=30)
+                try:
+                    sock.sendall(f'DOWNLOAD|{username}|{from_user}|{file_name}|{offset}|{length}\n'.encode('utf-8'))
+                    data = b''
+                    while b'\n' not in data:
+                        chunk = sock.recv(1024)
+                        if not chunk:
+                            break
+                        data += chunk
+                        if len(data) >= 5 and not data.startswith(b'READY'):
+                            break  # 错误回复没有换行
+                    header, _, body = data.partition(b'\n')
+                    return sock, header.decode('utf-8', errors='replace').split('|'), body
+                except Exception:
+                    sock.close()
+                    raise
+
+            last_error = None
+            for attempt in range(DOWNLOAD_RETRIES):
+                if attempt:
+                    time.sleep(min(2 ** attempt, 10))
+                try:
+                    # 长度为 0 的范围请求只返回文件大小和 SHA-256
+                    sock, header, _ = request_range(0, 0)
+                    sock.close()
+                    if header[0] != 'READY':
+                        return False, f"服务器错误: {header[1] if len(header) > 1 else header[0]}"
+                    if len(header) < 5:
+                        # 旧版服务器忽略范围参数，已经开始发送整个文件
+                        return MainWindow.FileTransfer.download_file_legacy(
+                            server_host, server_port, username, from_user, file_name, save_path, progress_callback)
+                    file_size, file_hash = int(header[1]), header[4]
+
+                    # 上次中断留下的进度只有在同一个文件（大小和摘要相同）时才能继续使用
+                    done = set()
+                    try:
+                        with open(state_path, 'r', encoding='utf-8') as f:
+                            state = json.load(f)
+                        if (state['size'], state['sha256'], state['segment_size']) == \
+                                (file_size, file_hash, DOWNLOAD_SEGMENT_SIZE) and os.path.exists(part_path):
+                            done = set(state['done'])
+                    except (OSError, ValueError, KeyError):
+                        pass
+                    if not done:
+                        with open(part_path, 'wb') as f:
+                            f.truncate(file_size)
+                    total_segments = max(1, -(-file_size // DOWNLOAD_SEGMENT_SIZE))
+                    # 倒序保存，pop() 按编号从小到大取段
+                    pending = [i for i in reversed(range(total_segments)) if i not in done]
+                    if done:
+                        logging.info('继续下载 %s: 已完成 %s/%s 段', file_name, len(done), total_segments)
+                    received = [sum(min(DOWNLOAD_SEGMENT_SIZE, file_size - i * DOWNLOAD_SEGMENT_SIZE) for i in done)]
+                    errors = []
+                    lock = threading.Lock()
+
+                    def save_state():
+                        with open(state_path + '.tmp', 'w', encoding='utf-8') as f:
+                            json.dump({'size': file_size, 'sha256': file_hash, 'segment_size': DOWNLOAD_SEGMENT_SIZE,
+                                       'done': sorted(done)}, f)
+                        os.replace(state_path + '.tmp', state_path)
+
+                    def fetch_segments():
+                        buf = bytearray(DOWNLOAD_BUFFER_SIZE)
+                        view = memoryview(buf)
+                        try:
+                            with open(part_path, 'r+b') as f:
+                                while not errors:
+                                    with lock:
+                                        if not pending:
+                                            return
+                                        segment = pending.pop()
+                                    offset = segment * DOWNLOAD_SEGMENT_SIZE
+                                    length = min(DOWNLOAD_SEGMENT_SIZE, file_size - offset)
+                                    conn, header, body = request_range(offset, length)
+                                    try:
+                                        if header[0] != 'READY' or len(header) < 5 or int(header[3]) != length:
+                                            raise Exception(f"服务器响应错误: {'|'.join(header)}")
+                                        f.seek(offset)
+                                        f.write(body)
+                                        got = len(body)
+                                        while got < length:
+                                            n = conn.recv_into(view, min(len(buf), length - got))
+                                            if not n:
+                                                raise Exception("连接过早关闭，文件不完整")
+                                            f.write(view[:n])
+                                            got += n
+                                            with lock:
+                                                received[0] += n
+                                    finally:
+                                        conn.close()
+                                    f.flush()
+                                    with lock:
+                                        received[0] += len(body)
+                                        done.add(segment)
+                                        save_state()
+                        except Exception as e:
+                            errors.append(e)
+
+                    workers = [threading.Thread(target=fetch_segments, daemon=True)
+                               for _ in range(min(DOWNLOAD_CONNECTIONS, len(pending)))]
+                    for worker in workers:
+                        worker.start()
+                    last_progress = -1
+                    while True:
+                        alive = any(worker.is_alive() for worker in workers)
+                        progress = min(99, received[0] * 100 // max(file_size, 1))
+                        if progress != last_progress and progress_callback:
+                            progress_callback(progress)
+                            last_progress = progress
+                        if not alive:
+                            break
+                        time.sleep(0.1)
+                    if errors:
+                        raise errors[0]
+
+                    digest = hashlib.sha256()
+                    with open(part_path, 'rb') as f:
+                        for block in iter(lambda: f.read(1024 * 1024), b''):
+                            digest.update(block)
+                    if digest.hexdigest() != file_hash:
+                        # 数据损坏，丢弃全部进度重新下载
+                        os.remove(state_path)
+                        last_error = Exception("文件校验失败")
+                        continue
+                    if os.path.exists(save_path):
+                        os.remove(save_path)
+                    os.rename(part_path, save_path)
+                    os.remove(state_path)
+                    if progress_callback:
+                        progress_callback(100)
+                    return True, f"文件已保存到: {save_path}"
+                except socket.timeout as e:
+                    last_error = e
+                    logging.warning('分段下载超时，准备续传: %s', file_name)
+                except ConnectionRefusedError:
+                    return False, "服务器拒绝连接，请确认服务器正在运行"
+                except Exception as e:
+                    last_error = e
+                    logging.warning('分段下载中断，准备续传: %s: %s', file_name, e)
+            return False, f"下载出错: {last_error}（已下载的部分会在下次下载时继续）"
+
+        @staticmethod
+        def download_file_legacy(server_host, server_port, username, from_user, file_name, save_path,
+                                 progress_callback=None):
+            """从服务器下载整个文件（旧版服务器不支持范围请求时使用）
 
             Args:
                 server_host: 服务器主机名
@@ -3128,8 +3774,10 @@ class MainWindow(QWidget):
                 auth_msg = f'DOWNLOAD|{username}|{from_user}|{file_name}'
                 sock.send(auth_msg.encode('utf-8'))
 
-                # 等待服务器准备就绪
-                response = sock.recv(1024).decode('utf-8')
+                # 等待服务器准备就绪：新版服务器的消息头以换行结束，之后紧跟文件内容
+                data = sock.recv(1024)
+                header, _, body = data.partition(b'\n')
+                response = header.decode('utf-8')
                 if not response.startswith('READY'):
                     if response.startswith('ERROR'):
                         error_msg = response.split('|', 1)[1] if '|' in response else "Unknown error"
@@ -3139,25 +3787,28 @@ class MainWindow(QWidget):
                 # 获取文件大小
                 file_size = int(response.split('|')[1])
 
-                # 开始下载文件
+                # 开始下载文件：服务器连续发送，不再每 1MB 等待 ACK，进度由本地已接收的字节数计算
                 received = 0
                 last_progress = 0
+                buf = bytearray(DOWNLOAD_BUFFER_SIZE)
+                view = memoryview(buf)
                 with open(temp_path, 'wb') as f:
+                    if body:
+                        body = body[:file_size]
+                        f.write(body)
+                        received = len(body)
                     while received < file_size:
-                        # 计算剩余大小并接收数据
-                        chunk_size = min(8192, file_size - received)
-                        chunk = sock.recv(chunk_size)
-
-                        if not chunk:
+                        n = sock.recv_into(view, min(len(buf), file_size - received))
+                        if not n:
                             # 如果连接关闭但已收到接近完整的文件，尝试继续
                             if received >= file_size * 0.99:  # 如果收到了99%以上
-                                logging.warning(f"连接关闭，但已接收足够数据: {received}/{file_size}")
+                                logging.warning('连接关闭，但已接收足够数据: %s/%s', received, file_size)
                                 break
                             else:
                                 raise Exception("连接过早关闭，文件不完整")
 
-                        f.write(chunk)
-                        received += len(chunk)
+                        f.write(view[:n])
+                        received += n
 
                         # 更新进度
                         progress = min(100, int(received * 100 / file_size))
@@ -3166,14 +3817,6 @@ class MainWindow(QWidget):
                                 progress_callback(progress)
                             last_progress = progress
 
-                        # 定期发送确认
-                        if received % (1024 * 1024) == 0 or received == file_size:  # 每1MB或完成时
-                            try:
-                                sock.send(f'ACK|{progress}'.encode('utf-8'))
-                            except:
-                                # 发送确认失败不中断下载
-                                pass
-
                 # 验证文件大小
                 if os.path.getsize(temp_path) != file_size:
                     raise Exception(f"文件大小不匹配: 预期{file_size}字节，实际接收{os.path.getsize(temp_path)}字节")
@@ -3211,141 +3854,62 @@ class MainWindow(QWidget):
         file_path, _ = QFileDialog.getOpenFileName(self, '选择要上传的文件', '', 'All Files (*)')
         if not file_path:
             return
-
-        progress = None
         try:
-            # 创建进度对话框
-            progress = QProgressDialog("准备上传文件...", "取消", 0, 100, self)
-            progress.setWindowTitle("上传进度")
-            progress.setWindowModality(Qt.WindowModal)
-            progress.setAutoClose(False)
-            progress.setAutoReset(False)
-            progress.show()
-
-            # 准备上传请求
-            self.send_message_to_server(
-                f'FILE_UPLOAD_START|{self.username}|{self.current_friend}|{os.path.basename(file_path)}|{os.path.getsize(file_path)}|1')
-
-            # 等待服务器响应 - 应该是重定向到文件传输端口
-            response = self.sock.recv(1024).decode('utf-8')
-            if not response.startswith('USE_FILE_PORT'):
-                if response.startswith('ERROR'):
-                    error_msg = response.split('|', 1)[1] if '|' in response else "未知错误"
-                    raise Exception(f"服务器错误: {error_msg}")
-                else:
-                    raise Exception(f"服务器响应错误: {response}")
-
-            # 解析文件传输端口
-            parts = response.split('|')
-            if len(parts) < 3:
-                raise Exception("无效的重定向响应")
-
-            file_port = int(parts[1])
-            logging.info(f"服务器指示使用专用文件端口: {file_port}")
-
-            # 定义进度回调
-            def update_progress(percent):
-                if progress and not progress.wasCanceled():
-                    progress.setValue(percent)
-                    progress.setLabelText(f"正在上传: {os.path.basename(file_path)}\n进度: {percent}%")
-                    QApplication.processEvents()
-
-            # 使用专用连接上传文件
-            success, message = self.FileTransfer.upload_file(
-                SERVER_HOST, file_port, self.username, self.current_friend,
-                file_path, update_progress
-            )
-
-            if success:
-                QMessageBox.information(self, '上传成功', message)
-                # 刷新文件列表
-                self.get_private_file_list()
-            else:
-                raise Exception(message)
-
-        except Exception as e:
-            logging.error(f"文件上传失败: {e}")
-            QMessageBox.warning(self, '上传失败', f'文件上传失败: {str(e)}')
-            # 无论如何都尝试刷新文件列表
-            try:
-                self.get_private_file_list()
-            except:
-                pass
-        finally:
-            if progress is not None:
-                progress.close()
+            transfer_id = self.transfers.start_upload(self.current_friend, file_path)
+        except OSError as e:
+            QMessageBox.warning(self, '上传失败', f'文件上传失败: {e}')
+            return
+        self.show_transfer_dialog(transfer_id, '上传进度', f"正在上传: {os.path.basename(file_path)}")
 
     def download_private_file(self, item):
         if not item:
             return
 
         fname = item.text()
-        progress = None
-
-        try:
-            # 让用户选择保存位置
-            save_path, _ = QFileDialog.getSaveFileName(
-                self,
-                '选择保存位置',
-                os.path.join(FILES_DIR, fname),
-                'All Files (*)'
-            )
-
-            if not save_path:
-                return
-
-            # 创建进度对话框
-            progress = QProgressDialog("准备下载文件...", "取消", 0, 100, self)
-            progress.setWindowTitle("下载进度")
-            progress.setWindowModality(Qt.WindowModal)
-            progress.setAutoClose(False)
-            progress.setAutoReset(False)
-            progress.show()
-
-            # 请求下载文件
-            self.send_message_to_server(f'FILE_DOWNLOAD_START|{self.username}|{self.current_friend}|{fname}')
-
-            # 等待服务器响应
-            response = self.sock.recv(1024).decode('utf-8')
-            if not response.startswith('USE_FILE_PORT'):
-                if response.startswith('ERROR'):
-                    error_msg = response.split('|', 1)[1] if '|' in response else "未知错误"
-                    raise Exception(f"服务器错误: {error_msg}")
-                else:
-                    raise Exception(f"服务器响应错误: {response}")
-
-            # 解析文件传输端口
-            parts = response.split('|')
-            if len(parts) < 3:
-                raise Exception("无效的重定向响应")
-
-            file_port = int(parts[1])
-            logging.info(f"服务器指示使用专用文件端口: {file_port}")
-
-            # 定义进度回调
-            def update_progress(percent):
-                if progress and not progress.wasCanceled():
-                    progress.setValue(percent)
-                    progress.setLabelText(f"正在下载: {fname}\n进度: {percent}%")
-                    QApplication.processEvents()
-
-            # 使用专用连接下载文件
-            success, message = self.FileTransfer.download_file(
-                SERVER_HOST, file_port, self.username, self.current_friend,
-                fname, save_path, update_progress
-            )
-
-            if success:
-                QMessageBox.information(self, '下载完成', message)
-            else:
-                raise Exception(message)
-
-        except Exception as e:
-            logging.error(f"文件下载失败: {e}")
-            QMessageBox.warning(self, '下载失败', f'下载文件失败: {str(e)}')
-        finally:
-            if progress is not None:
-                progress.close()
+        # 让用户选择保存位置
+        save_path, _ = QFileDialog.getSaveFileName(
+            self,
+            '选择保存位置',
+            os.path.join(FILES_DIR, fname),
+            'All Files (*)'
+        )
+        if not save_path:
+            return
+        transfer_id = self.transfers.start_download(self.current_friend, fname, save_path)
+        self.show_transfer_dialog(transfer_id, '下载进度', f"正在下载: {fname}")
+
+    def show_transfer_dialog(self, transfer_id, title, label):
+        """非模态进度框，传输在后台进行，关闭进度框不影响传输和聊天"""
+        progress = QProgressDialog(f"{label}\n等待服务器响应...", None, 0, 100, self)
+        progress.setWindowTitle(title)
+        progress.setWindowModality(Qt.NonModal)
+        progress.setAutoClose(False)
+        progress.setAutoReset(False)
+        progress.setMinimumDuration(0)
+        progress.setProperty('label', label)
+        progress.show()
+        self.transfer_dialogs[transfer_id] = progress
+
+    def on_transfer_progress(self, transfer_id, percent):
+        progress = self.transfer_dialogs.get(transfer_id)
+        if progress is not None:
+            progress.setValue(percent)
+            progress.setLabelText(f"{progress.property('label')}\n进度: {percent}%")
+
+    def on_transfer_finished(self, transfer_id, success, message):
+        info = self.transfers.transfers.get(transfer_id, {})
+        progress = self.transfer_dialogs.pop(transfer_id, None)
+        if progress is not None:
+            progress.close()
+        is_upload = info.get('kind') == 'upload'
+        if success:
+            QMessageBox.information(self, '上传成功' if is_upload else '下载完成', message)
+        else:
+            logging.error('文件传输失败: %s', message)
+            QMessageBox.warning(self, '上传失败' if is_upload else '下载失败', message)
+        # 上传结束后刷新当前好友的文件列表
+        if is_upload and info.get('friend') == self.current_friend:
+            self.get_private_file_list()
 
     def get_private_file_list(self):
         if not self.current_friend:
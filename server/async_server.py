@@ -0,0 +1,190 @@
+"""asyncio 服务器模式
+
+所有聊天连接运行在同一个事件循环上，使用 StreamReader/StreamWriter 收发数据，
+避免线程模式下每个连接一个线程带来的线程栈内存和 GIL 竞争开销。
+命令处理逻辑仍由 main.handle_command 提供，这里只负责连接的读写。
+"""
+import asyncio
+import threading
+
+import logs
+from outbound import POLICY_DISCONNECT, DEFAULT_MAX_BYTES, POLICY_DROP
+from protocol import PROTOCOL_V1, PROTOCOL_V2, FRAME_HEADER_SIZE, ProtocolError, parse_header, decode_payload
+
+log = logs.get_logger('async_server')
+
+# 单行消息的最大长度，语音消息经 base64 编码后可能达到数百KB
+STREAM_LIMIT = 16 * 1024 * 1024
+
+
+class AsyncConnection:
+    """把 StreamWriter 包装成与 socket 相同的 send/close 接口
+
+    命令处理函数和 clients 字典因此可以同时保存线程模式的连接和 asyncio 模式的连接。
+    从事件循环以外的线程调用时，写操作会通过 call_soon_threadsafe 转交给事件循环。
+    transport 自身就是按连接的非阻塞写缓冲，这里只按字节数限制其大小；
+    coalesce 策略下 transport 本来就会合并写入，超限时与 drop 相同。
+    """
+
+    def __init__(self, reader, writer, loop, max_bytes=DEFAULT_MAX_BYTES, policy=POLICY_DROP):
+        self.reader = reader
+        self.writer = writer
+        self.loop = loop
+        self.addr = writer.get_extra_info('peername')
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.protocol = PROTOCOL_V1  # 协商后的协议版本，决定 send_msg 的编码方式
+        self.closed = False
+        self.dropped = 0  # 因写缓冲已满被丢弃的消息数
+        self.bytes_received = 0
+        self.bytes_sent = 0  # 已交给 transport 的字节数
+        self._loop_thread = threading.get_ident()
+
+    @property
+    def pending_bytes(self):
+        return self.writer.transport.get_write_buffer_size()
+
+    def _in_loop(self):
+        return threading.get_ident() == self._loop_thread
+
+    def _write(self, data):
+        if self.closed or self.writer.is_closing():
+            return
+        if self.pending_bytes + len(data) > self.max_bytes:
+            if self.policy == POLICY_DISCONNECT:
+                log.warning('发送缓冲已满，断开慢连接', addr=self.addr)
+                self.closed = True
+                self.writer.transport.abort()
+            else:
+                self.dropped += 1
+            return
+        self.writer.write(data)
+        self.bytes_sent += len(data)
+
+    def send(self, data):
+        if self.closed:
+            raise ConnectionError('连接已关闭')
+        if self._in_loop():
+            self._write(data)
+        else:
+            self.loop.call_soon_threadsafe(self._write, data)
+        return len(data)
+
+    def sendall(self, data):
+        self.send(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._in_loop():
+            self.writer.close()
+        else:
+            self.loop.call_soon_threadsafe(self.writer.close)
+
+
+async def _read_line(conn):
+    """读取一条 v1 文本命令，连接关闭时返回 None，空行返回空字符串"""
+    try:
+        line = await conn.reader.readline()
+    except ValueError as e:
+        # 单行超过 STREAM_LIMIT，readline 已丢弃该行数据
+        log.warning('消息过长', addr=conn.addr, error=e)
+        return ''
+    if not line:
+        return None
+    conn.bytes_received += len(line)
+    return line.decode('utf-8', errors='replace').strip()
+
+
+async def _read_frame(conn):
+    """读取一个 v2 帧，返回 (文本命令, 原始字节)，连接关闭时返回 None"""
+    try:
+        header = await conn.reader.readexactly(FRAME_HEADER_SIZE)
+        frame_type, length = parse_header(header)
+        payload = await conn.reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        return None
+    conn.bytes_received += FRAME_HEADER_SIZE + length
+    return decode_payload(frame_type, payload)
+
+
+async def _handle_connection(reader, writer, handle_command, cleanup_client, max_bytes, policy, offload_commands,
+                             on_connect):
+    conn = AsyncConnection(reader, writer, asyncio.get_running_loop(), max_bytes, policy)
+    addr = conn.addr
+    session = {'username': None}
+    if on_connect is not None:
+        on_connect(conn, addr, session)
+    try:
+        while True:
+            blob = None
+            try:
+                if conn.protocol == PROTOCOL_V2:
+                    message = await _read_frame(conn)
+                    if message is not None:
+                        data, blob = message
+                        if blob is None:
+                            data = data.strip()
+                else:
+                    data = message = await _read_line(conn)
+            except ProtocolError as e:
+                log.warning('协议错误', addr=addr, error=e)
+                break
+            except (ConnectionError, OSError):
+                break
+            if message is None:
+                break
+            if not data:
+                continue
+
+            try:
+                if data.split('|', 1)[0] in offload_commands:
+                    # 会阻塞的命令（如计算密码哈希）在线程中执行，事件循环继续处理其他连接；
+                    # 等待其完成后再读取本连接的下一条命令，保持命令顺序
+                    keep = await asyncio.get_running_loop().run_in_executor(
+                        None, handle_command, conn, addr, data, session, blob)
+                else:
+                    keep = handle_command(conn, addr, data, session, blob)
+                if not keep:
+                    break
+            except Exception as e:
+                log.exception('处理命令出错', addr=addr)
+                continue
+
+            # 本连接的写缓冲过大时暂停读取，形成背压
+            try:
+                await writer.drain()
+            except (ConnectionError, OSError):
+                break
+    finally:
+        cleanup_client(conn, addr, session)
+
+
+async def serve(host, port, handle_command, cleanup_client, backlog=100,
+                max_bytes=DEFAULT_MAX_BYTES, policy=POLICY_DROP, offload_commands=(), reuse_port=False,
+                on_connect=None):
+    """启动 asyncio 聊天服务器并一直运行
+
+    offload_commands 中的命令会阻塞较长时间，交给默认线程池执行；
+    reuse_port 用于多进程分片模式，多个工作进程监听同一个端口；
+    on_connect(conn, addr, session) 在每个新连接开始读取之前调用，与之对应的是连接结束时的 cleanup_client
+    """
+    server = await asyncio.start_server(
+        lambda r, w: _handle_connection(r, w, handle_command, cleanup_client, max_bytes, policy,
+                                        offload_commands, on_connect),
+        host, port,
+        limit=STREAM_LIMIT,
+        reuse_address=True,
+        reuse_port=reuse_port,
+        backlog=backlog,
+    )
+    async with server:
+        await server.serve_forever()
+
+
+def run(host, port, handle_command, cleanup_client, backlog=100,
+        max_bytes=DEFAULT_MAX_BYTES, policy=POLICY_DROP, offload_commands=(), reuse_port=False, on_connect=None):
+    """在当前线程中运行事件循环"""
+    asyncio.run(serve(host, port, handle_command, cleanup_client, backlog, max_bytes, policy, offload_commands,
+                      reuse_port, on_connect))
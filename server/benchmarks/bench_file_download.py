@@ -0,0 +1,157 @@
+"""文件下载吞吐量基准：sendfile 连续发送 vs 旧版 8KB 循环 + 每 1MB 等待 ACK
+
+在临时目录中启动 FileTransferServer（与服务器使用同一份代码），生成 --size-mb 大小的文件，
+通过本机回环地址下载，比较：
+    legacy       旧版做法：服务器每次 read(8192) + sendall，每发送 1MB 停下来等客户端的 ACK
+    sendfile     FileTransferServer.handle_download：sendfile 连续发送，客户端 1MB 缓冲 recv_into
+    sendfile+ack 旧版客户端（8KB recv，每 1MB 发送 ACK）下载新版服务器的文件，确认兼容且不会被 ACK 拖慢
+每种方式先下载一次校验字节数和 SHA-256（不计时），再计时下载 --rounds 次取最好成绩。
+回环地址的往返时间几乎为 0，真实网络上旧版每 1MB 还要多等一个往返，差距会更大。
+
+用法:
+    python benchmarks/bench_file_download.py --size-mb 1024
+"""
+import argparse
+import hashlib
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+
+OWNER = 'alice'
+DOWNLOADER = 'bob'
+FILENAME = 'payload.bin'
+
+
+def legacy_handle_download(client_socket, file_path):
+    """旧版 FileTransferServer.handle_download 的发送循环"""
+    filesize = os.path.getsize(file_path)
+    client_socket.send(f'READY|{filesize}'.encode('utf-8'))
+    sent = 0
+    with open(file_path, 'rb') as f:
+        while sent < filesize:
+            chunk = f.read(8192)
+            if not chunk:
+                break
+            client_socket.sendall(chunk)
+            sent += len(chunk)
+            if sent % (1024 * 1024) == 0 or sent == filesize:
+                try:
+                    client_socket.settimeout(5)
+                    client_socket.recv(1024)
+                except socket.timeout:
+                    pass
+                finally:
+                    client_socket.settimeout(None)
+    client_socket.close()
+
+
+def serve_legacy(listener, file_path):
+    while True:
+        try:
+            sock, _ = listener.accept()
+        except OSError:
+            return
+        sock.recv(1024)  # DOWNLOAD|...
+        threading.Thread(target=legacy_handle_download, args=(sock, file_path), daemon=True).start()
+
+
+def download(port, send_acks, file_size, verify=False):
+    """下载文件并返回 (字节数, SHA-256 或 None)；send_acks 为 True 时模拟旧版客户端"""
+    sock = socket.create_connection(('127.0.0.1', port), timeout=60)
+    sock.sendall(f'DOWNLOAD|{DOWNLOADER}|{OWNER}|{FILENAME}'.encode('utf-8'))
+    # 旧版服务器的 READY 没有结束符，经常和文件开头粘在同一次 recv 里，按已知的文件大小切分
+    header = f'READY|{file_size}'.encode('utf-8')
+    data = sock.recv(1024)
+    if not data.startswith(header):
+        raise RuntimeError(f'服务器响应错误: {data[:64]!r}')
+    body = data[len(header):]
+    if body.startswith(b'\n'):
+        body = body[1:]
+    digest = hashlib.sha256(body) if verify else None
+    received = len(body)
+    buf = bytearray(8192 if send_acks else 1024 * 1024)
+    view = memoryview(buf)
+    while received < file_size:
+        n = sock.recv_into(view, min(len(buf), file_size - received))
+        if not n:
+            break
+        if digest:
+            digest.update(view[:n])
+        received += n
+        if send_acks and (received % (1024 * 1024) == 0 or received == file_size):
+            sock.send(f'ACK|{received * 100 // file_size}'.encode('utf-8'))
+    sock.close()
+    return received, digest.hexdigest() if digest else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='文件下载吞吐量基准')
+    parser.add_argument('--size-mb', type=int, default=1024, help='测试文件大小（MB）')
+    parser.add_argument('--rounds', type=int, default=3, help='每种方式的下载次数')
+    parser.add_argument('--port', type=int, default=22745)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='chat_bench_download_')
+    cwd = os.getcwd()
+    os.chdir(workdir)  # 服务器的存储、用户目录都建在临时目录中
+    try:
+        import main as server
+        from storage import open_storage
+
+        storage = open_storage('csv', history_dir='history')
+        storage.import_friendships([(OWNER, DOWNLOADER)])
+        storage.close()
+        server.init_storage('csv')
+        server.file_store.legacy_root = None  # 不导入仓库中旧版的文件目录
+        file_path = os.path.join(workdir, FILENAME)
+
+        print(f'生成 {args.size_mb}MB 测试文件...')
+        block = b'\0' + os.urandom(1024 * 1024 - 1)  # 开头不能是换行，见 download
+        expected = hashlib.sha256()
+        with open(file_path, 'wb') as f:
+            for _ in range(args.size_mb):
+                f.write(block)
+                expected.update(block)
+        expected = expected.hexdigest()
+        size = args.size_mb * 1024 * 1024
+        server.file_store.add(OWNER, DOWNLOADER, FILENAME, expected, size, file_path)
+        file_path, _, _ = server.file_store.lookup(OWNER, DOWNLOADER, FILENAME)
+
+        file_server = server.FileTransferServer('127.0.0.1', args.port)
+        file_server.start()
+        legacy_listener = socket.create_server(('127.0.0.1', args.port + 1))
+        threading.Thread(target=serve_legacy, args=(legacy_listener, file_path), daemon=True).start()
+
+        cases = [('legacy', args.port + 1, True), ('sendfile', args.port, False), ('sendfile+ack', args.port, True)]
+        baseline = None
+        for name, port, send_acks in cases:
+            received, digest = download(port, send_acks, size, verify=True)
+            if received != size or digest != expected:
+                raise RuntimeError(f'{name}: 文件不完整或内容不一致 ({received}/{size} 字节)')
+            best = None
+            for _ in range(args.rounds):
+                start = time.perf_counter()
+                received, _ = download(port, send_acks, size)
+                elapsed = time.perf_counter() - start
+                if received != size:
+                    raise RuntimeError(f'{name}: 文件不完整 ({received}/{size} 字节)')
+                best = elapsed if best is None else min(best, elapsed)
+            rate = size / best / (1024 * 1024)
+            baseline = baseline or rate
+            print(f'{name:13s} {best:7.2f}s {rate:9,.0f} MB/s ({rate / baseline:.1f}x)')
+        file_server.stop()
+        legacy_listener.close()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""好友判断微基准：逐行扫描 friendships.csv 与内存索引对比
+
+生成指定行数的好友关系 CSV，分别用旧的整表扫描方式和 FriendshipIndex
+完成“发送私聊前检查是否好友”这一步，输出每条消息的平均耗时。
+
+用法:
+    python benchmarks/bench_friendships.py --rows 100000
+"""
+import argparse
+import csv
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from indexes import FriendshipIndex  # noqa: E402
+from storage import CsvStorage  # noqa: E402
+
+
+def legacy_get_friends(csv_path, username):
+    """与旧版 main.get_friends 相同：每次调用都完整解析 CSV"""
+    friends = set()
+    with open(csv_path, 'r', newline='', encoding='utf-8') as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            if row['user_a'] == username:
+                friends.add(row['user_b'])
+            elif row['user_b'] == username:
+                friends.add(row['user_a'])
+    return list(friends)
+
+
+def generate_friendships(csv_path, rows, users):
+    pairs = set()
+    rng = random.Random(42)
+    while len(pairs) < rows:
+        a, b = rng.sample(range(users), 2)
+        pairs.add((min(a, b), max(a, b)))
+    with open(csv_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['user_a', 'user_b'])
+        for a, b in pairs:
+            writer.writerow([f'user{a}', f'user{b}'])
+    return [(f'user{a}', f'user{b}') for a, b in pairs]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='好友判断微基准')
+    parser.add_argument('--rows', type=int, default=100000, help='好友关系行数')
+    parser.add_argument('--users', type=int, default=20000, help='用户数量')
+    parser.add_argument('--legacy-messages', type=int, default=20, help='旧实现测量的消息数（较慢）')
+    parser.add_argument('--index-messages', type=int, default=200000, help='索引实现测量的消息数')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='chat_bench_friends_')
+    csv_path = os.path.join(workdir, 'friendships.csv')
+    pairs = generate_friendships(csv_path, args.rows, args.users)
+    rng = random.Random(7)
+
+    samples = [rng.choice(pairs) for _ in range(args.legacy_messages)]
+    start = time.perf_counter()
+    for a, b in samples:
+        assert b in legacy_get_friends(csv_path, a)
+    legacy = (time.perf_counter() - start) / len(samples)
+
+    start = time.perf_counter()
+    index = FriendshipIndex(CsvStorage(workdir))
+    index.load()
+    load_time = time.perf_counter() - start
+
+    samples = [rng.choice(pairs) for _ in range(args.index_messages)]
+    start = time.perf_counter()
+    for a, b in samples:
+        assert index.are_friends(a, b)
+    indexed = (time.perf_counter() - start) / len(samples)
+
+    print(f'好友关系行数: {args.rows}')
+    print(f'旧实现 (每条消息扫描CSV): {legacy * 1e3:10.3f} ms/消息')
+    print(f'内存索引 (启动加载 {load_time:.2f}s): {indexed * 1e6:10.3f} us/消息')
+    print(f'加速比: {legacy / indexed:,.0f}x')
+
+
+if __name__ == '__main__':
+    main()
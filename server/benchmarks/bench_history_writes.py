@@ -0,0 +1,110 @@
+"""聊天记录写入基准：逐条打开/关闭文件 vs 延迟写入 + 组提交
+
+--threads 个线程模拟服务器的连接线程，各自向 --conversations 个会话中随机追加消息，
+比较三种写法每秒能写入的消息数：
+    legacy       旧版做法，每条消息打开会话的 CSV 文件、追加一行、关闭
+    direct       MessageLogStore 直写（commit_interval=0），每次追加都打开、写入、关闭段文件
+    group-commit MessageLogStore 延迟写入，后台线程按 --interval 秒或 --batch 条组提交并 fsync
+组提交的计时包含最后一次 close()，即所有消息都已写入并 fsync 之后才停止计时。目标是 20k 条/秒以上。
+
+用法:
+    python benchmarks/bench_history_writes.py --messages 100000 --conversations 500 --threads 8
+"""
+import argparse
+import csv
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from message_log import COMMIT_BATCH, COMMIT_INTERVAL, MessageLogStore  # noqa: E402
+
+TARGET_RATE = 20000
+
+
+def run_threads(threads, messages, conversations, append):
+    """每个线程追加 messages // threads 条消息，所有线程就绪后开始计时，返回开始时间"""
+    per_thread = messages // threads
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(seed):
+        rng = random.Random(seed)
+        barrier.wait()
+        for n in range(per_thread):
+            append(f'conv{rng.randrange(conversations)}', [f'user{seed}', f'message {n} ' + 'x' * 60])
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in workers:
+        t.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for t in workers:
+        t.join()
+    return start
+
+
+def bench_legacy(workdir, args):
+    def append(name, fields):
+        with open(os.path.join(workdir, f'{name}.csv'), 'a', newline='', encoding='utf-8') as f:
+            csv.writer(f).writerow([*fields, time.strftime('%Y-%m-%d %H:%M:%S')])
+
+    start = run_threads(args.threads, args.messages, args.conversations, append)
+    return time.perf_counter() - start
+
+
+def bench_store(workdir, args, commit_interval):
+    store = MessageLogStore(workdir, commit_interval=commit_interval, commit_batch=args.batch)
+
+    def append(name, fields):
+        store.get(name).append(fields)
+
+    start = run_threads(args.threads, args.messages, args.conversations, append)
+    store.close()
+    elapsed = time.perf_counter() - start
+    return elapsed, store
+
+
+def main():
+    parser = argparse.ArgumentParser(description='聊天记录写入基准')
+    parser.add_argument('--messages', type=int, default=100000, help='总消息数')
+    parser.add_argument('--conversations', type=int, default=500, help='会话数')
+    parser.add_argument('--threads', type=int, default=8, help='写入线程数')
+    parser.add_argument('--interval', type=float, default=COMMIT_INTERVAL, help='组提交间隔（秒）')
+    parser.add_argument('--batch', type=int, default=COMMIT_BATCH, help='排队达到多少条时立即提交')
+    args = parser.parse_args()
+    total = args.messages // args.threads * args.threads
+
+    print(f'消息数: {total}, 会话数: {args.conversations}, 线程数: {args.threads}, '
+          f'组提交: {args.interval}s / {args.batch} 条')
+    workdir = tempfile.mkdtemp(prefix='chat_bench_history_')
+    try:
+        os.makedirs(os.path.join(workdir, 'legacy'))
+        elapsed = bench_legacy(os.path.join(workdir, 'legacy'), args)
+        legacy_rate = total / elapsed
+        print(f'legacy       {elapsed:7.2f}s {legacy_rate:10,.0f} 条/秒')
+
+        elapsed, _ = bench_store(os.path.join(workdir, 'direct'), args, 0)
+        rate = total / elapsed
+        print(f'direct       {elapsed:7.2f}s {rate:10,.0f} 条/秒 ({rate / legacy_rate:.1f}x)')
+
+        elapsed, store = bench_store(os.path.join(workdir, 'group'), args, args.interval)
+        rate = total / elapsed
+        print(f'group-commit {elapsed:7.2f}s {rate:10,.0f} 条/秒 ({rate / legacy_rate:.1f}x), '
+              f'提交 {store.commits} 次, fsync {store.committed_logs} 个会话')
+        print(f'目标 {TARGET_RATE:,} 条/秒: {"达到" if rate >= TARGET_RATE else "未达到"}')
+
+        # 确认组提交没有丢消息
+        check = MessageLogStore(os.path.join(workdir, 'group'))
+        stored = sum(len(check.get(f'conv{i}')) for i in range(args.conversations))
+        print(f'组提交写入后读回 {stored}/{total} 条')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
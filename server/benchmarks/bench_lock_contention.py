@@ -0,0 +1,171 @@
+"""锁竞争基准：多客户端混合负载下各锁的等待时间
+
+预先写入 N 个用户（两两互为好友）和若干群组，启动服务器子进程（--lock-stats-interval），
+每个用户一个连接，同时发送混合命令：
+    MSG          发给自己的好友
+    GROUP_MSG    发到自己所在的群
+    ADD_FRIEND / DEL_FRIEND  与随机用户反复加删好友
+每个连接发完后用 PING/PONG 确认服务器已处理完。结束后从服务器输出中取最后一次锁等待统计，
+列出每把锁的获取次数、需要等待的次数和总等待时间；不相关的用户之间应当几乎没有等待。
+
+用法:
+    python benchmarks/bench_lock_contention.py --users 200 --ops 200
+"""
+import argparse
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from passwords import ScryptHasher  # noqa: E402
+from storage import STORAGE_BACKENDS, open_storage  # noqa: E402
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_MAIN = os.path.join(SERVER_DIR, 'main.py')
+PASSWORD = 'password'
+STATS_HEADER = '锁等待统计'
+
+
+def wait_for_port(port, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def read_until(sock, buf, prefix):
+    """读取到以 prefix 开头的一行为止，返回剩余缓冲"""
+    while True:
+        while b'\n' not in buf:
+            data = sock.recv(65536)
+            if not data:
+                raise ConnectionError('服务器关闭了连接')
+            buf += data
+        lines = buf.split(b'\n')
+        buf = lines.pop()
+        for i, line in enumerate(lines):
+            if line.startswith(prefix):
+                return b'\n'.join(lines[i + 1:] + [buf])
+
+
+def run_client(port, i, users, groups, ops, barrier, failures):
+    username = f'user{i}'
+    friend = f'user{i ^ 1}'
+    group_id = str(i % groups + 1)
+    rng = random.Random(i)
+    try:
+        sock = socket.create_connection(('127.0.0.1', port), timeout=120)
+        sock.sendall(f'LOGIN|{username}|{PASSWORD}\n'.encode())
+        buf = read_until(sock, b'', b'LOGIN_RESULT|OK')
+        barrier.wait()
+        commands = []
+        for n in range(ops):
+            kind = n % 4
+            if kind in (0, 1):
+                commands.append(f'MSG|{friend}|message {n}')
+            elif kind == 2:
+                commands.append(f'GROUP_MSG|{group_id}|{username}|group message {n}')
+            else:
+                other = f'user{rng.randrange(users)}'
+                commands.append(f'ADD_FRIEND|{username}|{other}' if n % 8 == 3 else f'DEL_FRIEND|{username}|{other}')
+        for command in commands:
+            sock.sendall(command.encode() + b'\n')
+        sock.sendall(b'PING\n')
+        read_until(sock, buf, b'PONG')
+        sock.close()
+    except Exception as e:
+        failures.append(e)
+        try:
+            barrier.abort()
+        except threading.BrokenBarrierError:
+            pass
+
+
+def parse_last_stats(output):
+    lines = output.splitlines()
+    starts = [i for i, line in enumerate(lines) if line.startswith(STATS_HEADER)]
+    if not starts:
+        return []
+    block = []
+    for line in lines[starts[-1] + 1:]:
+        if not line.startswith('  '):
+            break
+        block.append(line.strip())
+    return block
+
+
+def main():
+    parser = argparse.ArgumentParser(description='锁竞争基准')
+    parser.add_argument('--users', type=int, default=200, help='并发用户数（偶数）')
+    parser.add_argument('--groups', type=int, default=10, help='群组数，用户平均分配到各群')
+    parser.add_argument('--ops', type=int, default=200, help='每个用户发送的命令数')
+    parser.add_argument('--mode', choices=['thread', 'asyncio'], default='thread', help='服务器模式')
+    parser.add_argument('--storage', choices=STORAGE_BACKENDS, default='csv', help='服务器存储类型')
+    parser.add_argument('--port', type=int, default=22645)
+    args = parser.parse_args()
+    users = args.users - args.users % 2
+
+    workdir = tempfile.mkdtemp(prefix='chat_bench_locks_')
+    storage = open_storage(args.storage, workdir)
+    # 所有用户共用一个哈希，省去准备时间
+    password_hash = ScryptHasher().hash(PASSWORD)
+    storage.import_users([(f'user{i}', password_hash) for i in range(users)])
+    storage.import_friendships([(f'user{i}', f'user{i + 1}') for i in range(0, users, 2)])
+    storage.import_groups([(str(g + 1), f'group{g + 1}') for g in range(args.groups)])
+    storage.import_group_members([(str(i % args.groups + 1), f'user{i}') for i in range(users)])
+    storage.close()
+
+    log_path = os.path.join(workdir, 'server.log')
+    with open(log_path, 'w', encoding='utf-8') as log:
+        proc = subprocess.Popen(
+            [sys.executable, SERVER_MAIN, '--mode', args.mode, '--storage', args.storage,
+             '--port', str(args.port), '--file-port', str(args.port + 1), '--lock-stats-interval', '0.5'],
+            cwd=workdir, stdout=log, stderr=subprocess.STDOUT, env=dict(os.environ, PYTHONUNBUFFERED='1'),
+        )
+        try:
+            if not wait_for_port(args.port):
+                raise RuntimeError('服务器未能启动')
+            failures = []
+            barrier = threading.Barrier(users + 1)
+            threads = [threading.Thread(target=run_client,
+                                        args=(args.port, i, users, args.groups, args.ops, barrier, failures))
+                       for i in range(users)]
+            for t in threads:
+                t.start()
+            barrier.wait()
+            start = time.perf_counter()
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - start
+            time.sleep(1.0)  # 等下一次统计输出
+        finally:
+            proc.terminate()
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+    with open(log_path, 'r', encoding='utf-8', errors='replace') as f:
+        stats = parse_last_stats(f.read())
+    total = users * args.ops
+    print(f'用户数: {users}, 群组: {args.groups}, 每用户命令: {args.ops}, 模式: {args.mode}, 存储: {args.storage}')
+    print(f'处理 {total} 条命令用时 {elapsed:.2f}s，{total / elapsed:,.0f} 条/秒，失败连接 {len(failures)}')
+    print('各锁等待时间:')
+    for line in stats:
+        print(f'  {line}')
+    if failures:
+        print(f'第一个失败: {failures[0]!r}')
+
+
+if __name__ == '__main__':
+    main()
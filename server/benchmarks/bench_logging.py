@@ -0,0 +1,116 @@
+"""服务器日志开销基准：print vs logs.py（DEBUG 关闭 / 后台线程写出）
+
+--threads 个线程模拟连接线程，每个线程处理 --events 条群聊消息，每条记录一次日志（旧版是两次 print）。
+输出写入一个模拟终端的慢输出：每次写入后等待 --sink-delay-us 微秒（终端滚动、磁盘写满时的情况）。
+    print        旧版做法：每条消息两次 print，调用线程直接写输出
+    logs-info    默认 INFO 级别，每条消息的 DEBUG 日志在调用处直接返回
+    logs-debug   打开 DEBUG，调用线程只把记录放进队列，后台线程格式化并写出
+计时只包含处理线程，logs-debug 另外报告后台线程写完全部日志的时间和队列满时丢弃的条数。
+
+用法:
+    python benchmarks/bench_logging.py --events 20000 --threads 8 --sink-delay-us 20
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import logs  # noqa: E402
+
+
+class SlowSink(io.TextIOBase):
+    """每次 write 等待固定时间的输出，模拟慢终端"""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.writes = 0
+        self._lock = threading.Lock()  # 与终端一样，同一时间只有一个线程在写
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        with self._lock:
+            self.writes += 1
+            if self.delay:
+                time.sleep(self.delay)
+        return len(text)
+
+
+def run_threads(threads, events, handle):
+    """每个线程调用 events 次 handle，返回 (耗时, 单次调用的最长时间)"""
+    barrier = threading.Barrier(threads + 1)
+    worst = [0.0] * threads
+
+    def worker(index):
+        barrier.wait()
+        for n in range(events):
+            start = time.perf_counter()
+            handle(index, n)
+            elapsed = time.perf_counter() - start
+            if elapsed > worst[index]:
+                worst[index] = elapsed
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in workers:
+        t.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for t in workers:
+        t.join()
+    return time.perf_counter() - start, max(worst)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='服务器日志开销基准')
+    parser.add_argument('--events', type=int, default=20000, help='每个线程的消息数')
+    parser.add_argument('--threads', type=int, default=8, help='处理线程数')
+    parser.add_argument('--sink-delay-us', type=float, default=20, help='每次写输出的耗时（微秒）')
+    args = parser.parse_args()
+    total = args.events * args.threads
+    members = [f'user{i}' for i in range(50)]
+    msg = '大家好 ' + 'x' * 100
+
+    def legacy(index, n):
+        from_user = f'user{index}'
+        print(f"处理群聊消息: group_id=1, from_user={from_user}, msg={msg}")
+        print(f'群聊广播: group_id=1, members={len(members)}')
+
+    log = logs.get_logger('bench')
+
+    def structured(index, n):
+        log.debug('群聊广播', group_id=1, from_user=f'user{index}', size=len(msg), members=len(members))
+
+    print(f'消息数: {total}, 线程数: {args.threads}, 每次写输出 {args.sink_delay_us}us')
+    results = []
+    for name, handle, level in [('print', legacy, None), ('logs-info', structured, 'INFO'),
+                                ('logs-debug', structured, 'DEBUG')]:
+        sink = SlowSink(args.sink_delay_us / 1e6)
+        with contextlib.redirect_stdout(sink):
+            if level:
+                logs.dropped = 0
+                logs.setup(level)
+            elapsed, worst = run_threads(args.threads, args.events, handle)
+            drain_start = time.perf_counter()
+            logs.shutdown()
+            drain = time.perf_counter() - drain_start
+        results.append((name, elapsed, worst, drain if level else None, logs.dropped, sink.writes))
+
+    baseline = None
+    for name, elapsed, worst, drain, dropped, writes in results:
+        rate = total / elapsed
+        baseline = baseline or rate
+        line = (f'{name:11s} {elapsed:7.2f}s {rate:12,.0f} 条/秒 ({rate / baseline:6.1f}x), '
+                f'单次最长 {worst * 1000:7.2f} ms, 写出 {writes} 次')
+        if drain is not None:
+            line += f', 后台写完还需 {drain:.2f}s, 丢弃 {dropped} 条'
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
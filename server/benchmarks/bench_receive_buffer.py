@@ -0,0 +1,115 @@
+"""接收缓冲区微基准：旧的 split('\\n', 1) 拼接方式与增量解析器对比
+
+生成约 10MB 的混合流量（短文本命令夹杂约 1MB 的 base64 语音消息），
+按 64KB 一块依次喂给各解析器，统计解析全部消息的耗时和吞吐量。
+v2 一栏使用相同内容的二进制帧，语音为原始字节。
+
+用法:
+    python benchmarks/bench_receive_buffer.py --size-mb 10
+"""
+import argparse
+import base64
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from protocol import LineDecoder, FrameDecoder, encode_text_frame, encode_binary_frame  # noqa: E402
+
+
+def legacy_server_lines(chunks):
+    """与旧版 handle_client 相同：str 缓冲区 + split('\\n', 1)"""
+    count = 0
+    buffer = ''
+    for chunk in chunks:
+        buffer += chunk.decode('utf-8')
+        while '\n' in buffer:
+            line, buffer = buffer.split('\n', 1)
+            if line.strip():
+                count += 1
+    return count
+
+
+def legacy_client_lines(chunks):
+    """与旧版 ClientThread.run 相同：bytes 缓冲区 + split(b'\\n', 1)"""
+    count = 0
+    buffer = b''
+    for chunk in chunks:
+        buffer += chunk
+        while b'\n' in buffer:
+            line, buffer = buffer.split(b'\n', 1)
+            line.decode('utf-8')
+            count += 1
+    return count
+
+
+def decoder_messages(decoder, chunks):
+    count = 0
+    for chunk in chunks:
+        decoder.feed(chunk)
+        for _ in decoder:
+            count += 1
+    return count
+
+
+def generate_traffic(size, voice_size, seed=42):
+    """返回 (v1 文本流, v2 帧流, 消息数)"""
+    rng = random.Random(seed)
+    text_parts = []
+    frame_parts = []
+    total = 0
+    messages = 0
+    while total < size:
+        if rng.random() < 0.002:
+            audio = rng.randbytes(voice_size)
+            meta = f'VOICE_MSG|user{rng.randrange(1000)}|original|{voice_size / 32000:.1f}'
+            line = f'{meta}|{base64.b64encode(audio).decode("ascii")}\n'.encode('utf-8')
+            frame = encode_binary_frame(meta, audio)
+        else:
+            text = 'x' * rng.randrange(10, 300)
+            line = f'GROUP_MSG|{rng.randrange(100)}|user{rng.randrange(1000)}|{text}\n'.encode('utf-8')
+            frame = encode_text_frame(line.decode('utf-8'))
+        text_parts.append(line)
+        frame_parts.append(frame)
+        total += len(line)
+        messages += 1
+    return b''.join(text_parts), b''.join(frame_parts), messages
+
+
+def split_chunks(data, chunk_size):
+    return [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+
+def measure(name, func, chunks, expected, total_bytes):
+    start = time.perf_counter()
+    count = func(chunks)
+    elapsed = time.perf_counter() - start
+    assert count == expected, f'{name}: 解析出 {count} 条消息，应为 {expected}'
+    print(f'{name:<28} {elapsed * 1000:10.1f} ms {total_bytes / elapsed / 1024 / 1024:10.1f} MB/s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='接收缓冲区解析微基准')
+    parser.add_argument('--size-mb', type=float, default=10, help='v1 文本流量大小(MB)')
+    parser.add_argument('--voice-kb', type=int, default=768, help='单条语音原始大小(KB)，base64 后约为 1.33 倍')
+    parser.add_argument('--chunk-kb', type=int, default=64, help='每次 recv 的数据块大小(KB)')
+    args = parser.parse_args()
+
+    text_stream, frame_stream, messages = generate_traffic(int(args.size_mb * 1024 * 1024), args.voice_kb * 1024)
+    text_chunks = split_chunks(text_stream, args.chunk_kb * 1024)
+    frame_chunks = split_chunks(frame_stream, args.chunk_kb * 1024)
+    print(f'消息数: {messages}, v1 流量: {len(text_stream) / 1024 / 1024:.1f} MB, '
+          f'v2 流量: {len(frame_stream) / 1024 / 1024:.1f} MB, 块大小: {args.chunk_kb} KB')
+
+    measure('旧服务端 str split', legacy_server_lines, text_chunks, messages, len(text_stream))
+    measure('旧客户端 bytes split', legacy_client_lines, text_chunks, messages, len(text_stream))
+    measure('LineDecoder (v1)', lambda c: decoder_messages(LineDecoder(), c), text_chunks, messages,
+            len(text_stream))
+    measure('FrameDecoder (v2)', lambda c: decoder_messages(FrameDecoder(), c), frame_chunks, messages,
+            len(frame_stream))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""重连风暴基准：服务器重启后大量用户同时重新登录
+
+预先生成 N 个用户的 users.csv，启动服务器子进程，由 --concurrency 个并发客户端
+为每个用户执行一次 连接 -> LOGIN -> 等待 LOGIN_RESULT -> 断开，统计总耗时、每秒登录数和登录延迟。
+另外在进程内测量旧版 authenticate_user（逐行扫描 CSV 且每行都重新计算哈希）的单次耗时，
+据此估算旧实现完成同样一轮重连需要的时间。
+
+用法:
+    python benchmarks/bench_reconnect_storm.py --users 50000
+"""
+import argparse
+import csv
+import hashlib
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import CsvStorage  # noqa: E402
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_MAIN = os.path.join(SERVER_DIR, 'main.py')
+
+
+def hash_password(password):
+    return hashlib.sha256(password.encode()).hexdigest()
+
+
+def legacy_authenticate(csv_path, username, password):
+    """与旧版 main.authenticate_user 相同"""
+    with open(csv_path, 'r', newline='', encoding='utf-8') as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            if row['username'] == username and row['password_hash'] == hash_password(password):
+                return True
+    return False
+
+
+def wait_for_port(port, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def login(port, username, password):
+    """连接并登录，返回登录往返耗时（毫秒）"""
+    with socket.create_connection(('127.0.0.1', port), timeout=30) as sock:
+        start = time.perf_counter()
+        sock.sendall(f'LOGIN|{username}|{password}\n'.encode('utf-8'))
+        data = b''
+        while b'\n' not in data:
+            chunk = sock.recv(1024)
+            if not chunk:
+                raise ConnectionError('服务器关闭了连接')
+            data += chunk
+        elapsed = (time.perf_counter() - start) * 1000
+        sock.sendall(b'LOGOUT|\n')
+    if not data.startswith(b'LOGIN_RESULT|OK'):
+        raise RuntimeError(f'登录失败: {data!r}')
+    return elapsed
+
+
+def run_storm(port, users, concurrency):
+    latencies = []
+    failures = []
+    next_user = [0]
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                i = next_user[0]
+                next_user[0] += 1
+            if i >= users:
+                return
+            try:
+                elapsed = login(port, f'user{i}', f'password{i}')
+            except Exception as e:
+                with lock:
+                    failures.append(e)
+                continue
+            with lock:
+                latencies.append(elapsed)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start, latencies, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='重连风暴基准')
+    parser.add_argument('--users', type=int, default=50000, help='用户数，每个用户登录一次')
+    parser.add_argument('--concurrency', type=int, default=200, help='并发客户端数')
+    parser.add_argument('--mode', choices=['thread', 'asyncio'], default='thread', help='服务器模式')
+    parser.add_argument('--storage', choices=['csv', 'sqlite'], default='csv', help='服务器存储类型')
+    parser.add_argument('--legacy-samples', type=int, default=20, help='旧实现测量的登录次数（较慢）')
+    parser.add_argument('--port', type=int, default=22445)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='chat_bench_storm_')
+    storage = CsvStorage(workdir)
+    storage.import_users([(f'user{i}', hash_password(f'password{i}')) for i in range(args.users)])
+    if args.storage == 'sqlite':
+        from migrate_storage import migrate
+        from storage import SqliteStorage
+        target = SqliteStorage(os.path.join(workdir, 'chat.db'))
+        migrate(storage, target)
+        target.close()
+
+    # 旧实现每次登录的耗时，取靠后的用户，接近平均扫描长度的两倍
+    csv_path = storage.users_csv
+    start = time.perf_counter()
+    for i in range(args.legacy_samples):
+        u = args.users - 1 - i
+        assert legacy_authenticate(csv_path, f'user{u}', f'password{u}')
+    legacy_ms = (time.perf_counter() - start) / args.legacy_samples * 1000
+
+    proc = subprocess.Popen(
+        [sys.executable, SERVER_MAIN, '--mode', args.mode, '--storage', args.storage,
+         '--port', str(args.port), '--file-port', str(args.port + 1)],
+        cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        if not wait_for_port(args.port):
+            raise RuntimeError('服务器未能启动')
+        elapsed, latencies, failures = run_storm(args.port, args.users, args.concurrency)
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+    latencies.sort()
+    print(f'用户数: {args.users}, 并发: {args.concurrency}, 模式: {args.mode}, 存储: {args.storage}')
+    print(f'完成登录 {len(latencies)} 次，失败 {len(failures)} 次，总耗时 {elapsed:.1f}s，'
+          f'{len(latencies) / elapsed:,.0f} 次/秒')
+    if latencies:
+        print(f'登录延迟 p50 {statistics.median(latencies):.2f} ms, '
+              f'p99 {latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]:.2f} ms')
+    print(f'旧实现单次登录 {legacy_ms:.1f} ms（扫描靠后的用户），'
+          f'同样一轮重连估计需要 {legacy_ms * args.users / 1000 / 2:,.0f}s 以上')
+    if failures:
+        print(f'第一个失败: {failures[0]!r}')
+
+
+if __name__ == '__main__':
+    main()
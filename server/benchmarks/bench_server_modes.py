@@ -0,0 +1,163 @@
+"""线程模式与 asyncio 模式的负载对比
+
+分别以两种模式启动服务器子进程，打开 N 个模拟客户端并保持空闲连接，
+统计建立连接耗时、服务器常驻内存(RSS)、线程数，以及在全部连接保持期间的 PING 往返延迟。
+
+用法:
+    python benchmarks/bench_server_modes.py --clients 10000
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_MAIN = os.path.join(SERVER_DIR, 'main.py')
+
+
+def raise_fd_limit():
+    """尽量提高文件描述符上限，否则无法同时保持上万个连接"""
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def read_proc_status(pid):
+    """读取 /proc/<pid>/status 中的内存和线程信息（仅 Linux）"""
+    info = {'rss_kb': None, 'threads': None}
+    try:
+        with open(f'/proc/{pid}/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    info['rss_kb'] = int(line.split()[1])
+                elif line.startswith('Threads:'):
+                    info['threads'] = int(line.split()[1])
+    except OSError:
+        pass
+    return info
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def ping(sock):
+    """发送 PING 并等待 PONG，返回往返耗时（毫秒）"""
+    start = time.perf_counter()
+    sock.sendall(b'PING\n')
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = sock.recv(1024)
+        if not chunk:
+            raise ConnectionError('服务器关闭了连接')
+        data += chunk
+    return (time.perf_counter() - start) * 1000
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = min(len(values) - 1, int(len(values) * pct / 100))
+    return values[index]
+
+
+def run_mode(mode, clients, pings, port, file_port):
+    workdir = tempfile.mkdtemp(prefix=f'chat_bench_{mode}_')
+    proc = subprocess.Popen(
+        [sys.executable, SERVER_MAIN, '--mode', mode, '--port', str(port), '--file-port', str(file_port)],
+        cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    socks = []
+    try:
+        if not wait_for_port(port):
+            raise RuntimeError(f'{mode} 模式服务器未能启动')
+        baseline = read_proc_status(proc.pid)
+
+        start = time.perf_counter()
+        failed = 0
+        for _ in range(clients):
+            try:
+                socks.append(socket.create_connection(('127.0.0.1', port), timeout=10))
+            except OSError:
+                failed += 1
+        connect_time = time.perf_counter() - start
+
+        # 等服务器为所有连接分配好资源后再采样
+        time.sleep(1)
+        loaded = read_proc_status(proc.pid)
+
+        latencies = []
+        step = max(1, len(socks) // max(1, pings))
+        for sock in socks[::step][:pings]:
+            try:
+                latencies.append(ping(sock))
+            except OSError:
+                failed += 1
+
+        return {
+            'mode': mode,
+            'connected': len(socks),
+            'failed': failed,
+            'connect_s': connect_time,
+            'rss_idle_mb': (baseline['rss_kb'] or 0) / 1024,
+            'rss_loaded_mb': (loaded['rss_kb'] or 0) / 1024,
+            'threads': loaded['threads'],
+            'p50_ms': statistics.median(latencies) if latencies else float('nan'),
+            'p99_ms': percentile(latencies, 99) if latencies else float('nan'),
+        }
+    finally:
+        for sock in socks:
+            try:
+                sock.close()
+            except OSError:
+                pass
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='对比线程模式与 asyncio 模式的连接容量')
+    parser.add_argument('--clients', type=int, default=2000, help='模拟客户端数量')
+    parser.add_argument('--pings', type=int, default=200, help='测量延迟的 PING 次数')
+    parser.add_argument('--modes', nargs='+', default=['thread', 'asyncio'], help='要测试的模式')
+    parser.add_argument('--port', type=int, default=22345, help='起始端口')
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    results = []
+    for i, mode in enumerate(args.modes):
+        port = args.port + i * 2
+        print(f'测试 {mode} 模式，{args.clients} 个客户端...')
+        results.append(run_mode(mode, args.clients, args.pings, port, port + 1))
+
+    print()
+    print(f"{'mode':<8} {'conns':>7} {'fail':>5} {'connect(s)':>10} {'RSS idle':>9} {'RSS load':>9} "
+          f"{'threads':>8} {'p50(ms)':>8} {'p99(ms)':>8}")
+    for r in results:
+        print(f"{r['mode']:<8} {r['connected']:>7} {r['failed']:>5} {r['connect_s']:>10.2f} "
+              f"{r['rss_idle_mb']:>8.1f}M {r['rss_loaded_mb']:>8.1f}M {str(r['threads']):>8} "
+              f"{r['p50_ms']:>8.2f} {r['p99_ms']:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+"""多进程分片基准：私聊消息吞吐量随工作进程数的变化
+
+对每个工作进程数分别启动服务器（--workers N --storage sqlite），预先写入 2 * pairs 个用户，
+两两互为好友。负载由 --client-procs 个客户端进程产生，每对用户中一个发送 --messages 条 MSG，
+另一个接收；连接由内核分配到各工作进程，发送方和接收方经常不在同一个进程，消息经消息总线转交。
+统计从开始发送到全部消息送达的时间和每秒送达的消息数。
+
+每条私聊消息都会写入聊天记录，SQLite 的写入在各进程间串行，这部分不会随进程数扩展。
+工作进程数超过 CPU 核心数时不会再有提升，单核机器上多进程只会增加总线转发的开销。
+
+用法:
+    python benchmarks/bench_sharding.py --workers 1 2 4 --pairs 200
+"""
+import argparse
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from passwords import ScryptHasher  # noqa: E402
+from storage import SqliteStorage  # noqa: E402
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_MAIN = os.path.join(SERVER_DIR, 'main.py')
+PASSWORD = 'password'
+
+
+def wait_for_port(port, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+class Client:
+    def __init__(self, port, username):
+        self.sock = socket.create_connection(('127.0.0.1', port), timeout=60)
+        self.buf = b''
+        self.username = username
+
+    def send(self, line):
+        self.sock.sendall(line.encode('utf-8') + b'\n')
+
+    def lines(self):
+        while True:
+            while b'\n' not in self.buf:
+                data = self.sock.recv(65536)
+                if not data:
+                    raise ConnectionError('服务器关闭了连接')
+                self.buf += data
+            lines = self.buf.split(b'\n')
+            self.buf = lines.pop()
+            yield from lines
+
+    def login(self):
+        self.send(f'LOGIN|{self.username}|{PASSWORD}')
+        for line in self.lines():
+            if line.startswith(b'LOGIN_RESULT|'):
+                if not line.startswith(b'LOGIN_RESULT|OK'):
+                    raise RuntimeError(f'{self.username} 登录失败: {line!r}')
+                return
+
+
+def run_client_proc(port, pairs, messages, barrier, results):
+    """一个客户端进程：登录分到的用户对，等所有进程就绪后开始发送，返回 (开始时间, 结束时间, 收到条数)"""
+    clients = []
+    for i in pairs:
+        sender, receiver = Client(port, f'user{2 * i}'), Client(port, f'user{2 * i + 1}')
+        sender.login()
+        receiver.login()
+        clients.append((sender, receiver, f'user{2 * i + 1}'))
+    received = [0]
+    lock = threading.Lock()
+
+    def send_all(sender, to_user):
+        payload = 'x' * 100
+        for n in range(messages):
+            sender.send(f'MSG|{to_user}|{n} {payload}')
+
+    def receive_all(receiver):
+        count = 0
+        for line in receiver.lines():
+            if line.startswith(b'MSG|'):
+                count += 1
+                if count == messages:
+                    break
+        with lock:
+            received[0] += count
+
+    barrier.wait()
+    start = time.time()
+    threads = []
+    for sender, receiver, to_user in clients:
+        threads.append(threading.Thread(target=receive_all, args=(receiver,)))
+        threads.append(threading.Thread(target=send_all, args=(sender, to_user)))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    results.put((start, time.time(), received[0]))
+
+
+def bench_workers(workers, args):
+    workdir = tempfile.mkdtemp(prefix=f'chat_bench_sharding_{workers}_')
+    storage = SqliteStorage(os.path.join(workdir, 'chat.db'))
+    # 所有用户共用一个哈希，省去准备时间；登录时每个用户仍要计算一次 scrypt
+    password_hash = ScryptHasher().hash(PASSWORD)
+    storage.import_users([(f'user{i}', password_hash) for i in range(2 * args.pairs)])
+    storage.import_friendships([(f'user{2 * i}', f'user{2 * i + 1}') for i in range(args.pairs)])
+    storage.close()
+
+    proc = subprocess.Popen(
+        [sys.executable, SERVER_MAIN, '--mode', args.mode, '--storage', 'sqlite', '--workers', str(workers),
+         '--port', str(args.port), '--file-port', str(args.port + 1)],
+        cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        if not wait_for_port(args.port):
+            raise RuntimeError('服务器未能启动')
+        client_procs = min(args.client_procs, args.pairs)
+        barrier = multiprocessing.Barrier(client_procs)
+        results = multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=run_client_proc,
+                                         args=(args.port, range(p, args.pairs, client_procs), args.messages,
+                                               barrier, results))
+                 for p in range(client_procs)]
+        for p in procs:
+            p.start()
+        stats = [results.get() for _ in procs]
+        for p in procs:
+            p.join()
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+    start = min(s[0] for s in stats)
+    end = max(s[1] for s in stats)
+    received = sum(s[2] for s in stats)
+    return received, end - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='多进程分片基准')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='要测试的工作进程数')
+    parser.add_argument('--pairs', type=int, default=100, help='发送/接收用户对数')
+    parser.add_argument('--messages', type=int, default=200, help='每个发送方的消息数')
+    parser.add_argument('--client-procs', type=int, default=4, help='产生负载的客户端进程数')
+    parser.add_argument('--mode', choices=['thread', 'asyncio'], default='asyncio', help='服务器模式')
+    parser.add_argument('--port', type=int, default=22545)
+    args = parser.parse_args()
+
+    print(f'CPU 核心数: {os.cpu_count()}, 用户对: {args.pairs}, 每对消息数: {args.messages}, 模式: {args.mode}')
+    baseline = None
+    for workers in args.workers:
+        received, elapsed = bench_workers(workers, args)
+        rate = received / elapsed
+        baseline = baseline or rate
+        print(f'工作进程 {workers}: 送达 {received}/{args.pairs * args.messages} 条，用时 {elapsed:.2f}s，'
+              f'{rate:,.0f} 条/秒，相对 {args.workers[0]} 个进程 {rate / baseline:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""存储后端基准：CSV 与 SQLite 在大量用户下的每秒操作数
+
+在临时目录中分别创建两种存储，预先写入 N 个用户，然后按服务器的实际调用方式测量：
+    register    新用户注册（检查重名 + 写入）
+    login       读取密码哈希并比较
+    add_friend  检查对方存在 + 写入好友关系（经过 FriendshipIndex）
+    history     追加一条私聊消息并读取最新一页（50 条）
+CSV 的用户操作需要逐行扫描 users.csv，操作数单独用 --csv-ops 指定。
+
+用法:
+    python benchmarks/bench_storage.py --users 100000
+"""
+import argparse
+import hashlib
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from indexes import FriendshipIndex  # noqa: E402
+from storage import STORAGE_BACKENDS, open_storage  # noqa: E402
+
+PAGE_SIZE = 50
+
+
+def password_hash(i):
+    return hashlib.sha256(f'password{i}'.encode()).hexdigest()
+
+
+def run_ops(name, ops, func):
+    start = time.perf_counter()
+    for i in range(ops):
+        func(i)
+    elapsed = time.perf_counter() - start
+    return name, ops / elapsed
+
+
+def bench_backend(backend, users, ops, conversations):
+    workdir = tempfile.mkdtemp(prefix=f'chat_bench_storage_{backend}_')
+    storage = open_storage(backend, workdir)
+    rng = random.Random(42)
+
+    start = time.perf_counter()
+    storage.import_users([(f'user{i}', password_hash(i)) for i in range(users)])
+    load_time = time.perf_counter() - start
+    index = FriendshipIndex(storage)
+    index.load()
+
+    def register(i):
+        assert storage.add_user(f'new{i}', password_hash(i))
+
+    def login(i):
+        u = rng.randrange(users)
+        assert storage.get_password_hash(f'user{u}') == password_hash(u)
+
+    def add_friend(i):
+        a, b = rng.sample(range(users), 2)
+        if storage.user_exists(f'user{b}'):
+            index.add(f'user{a}', f'user{b}')
+
+    def history(i):
+        log = storage.history_log(f'private_bench_{rng.randrange(conversations)}')
+        log.append(['user0', f'message {i} ' + 'x' * rng.randrange(10, 200)])
+        log.read_last(PAGE_SIZE)
+
+    results = [run_ops(name, ops, func) for name, func in
+               (('register', register), ('login', login), ('add_friend', add_friend), ('history', history))]
+    storage.close()
+    return load_time, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='存储后端基准')
+    parser.add_argument('--users', type=int, default=100000, help='预先写入的用户数')
+    parser.add_argument('--ops', type=int, default=5000, help='sqlite 每项操作的次数')
+    parser.add_argument('--csv-ops', type=int, default=100, help='csv 每项操作的次数（逐行扫描，较慢）')
+    parser.add_argument('--conversations', type=int, default=1000, help='history 测试使用的会话数')
+    parser.add_argument('--backends', nargs='+', choices=STORAGE_BACKENDS, default=list(STORAGE_BACKENDS))
+    args = parser.parse_args()
+
+    print(f'用户数: {args.users}')
+    table = {}
+    for backend in args.backends:
+        ops = args.csv_ops if backend == 'csv' else args.ops
+        load_time, results = bench_backend(backend, args.users, ops, args.conversations)
+        print(f'{backend}: 写入 {args.users} 个用户用时 {load_time:.2f}s，每项操作 {ops} 次')
+        table[backend] = dict(results)
+
+    names = ('register', 'login', 'add_friend', 'history')
+    print(f'{"操作/秒":<12}' + ''.join(f'{backend:>14}' for backend in table))
+    for name in names:
+        print(f'{name:<12}' + ''.join(f'{table[backend][name]:14,.0f}' for backend in table))
+
+
+if __name__ == '__main__':
+    main()
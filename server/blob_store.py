@@ -0,0 +1,141 @@
+"""按内容寻址的二进制数据存储
+
+数据以 SHA-256 十六进制摘要为名保存，同样的内容只存一份：
+    <root>/<摘要前2位>/<摘要>
+写入时先写临时文件再改名，读到的要么是完整数据要么不存在。
+大文件用 put_file 直接把已写好的文件移入存储，不经过内存。
+"""
+import base64
+import hashlib
+import os
+import shutil
+import threading
+
+HASH_HEX_LEN = 64
+
+
+def blob_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def is_valid_hash(value):
+    """判断是否是合法的 SHA-256 十六进制摘要，防止借文件名访问存储目录之外的路径"""
+    if len(value) != HASH_HEX_LEN:
+        return False
+    try:
+        int(value, 16)
+    except ValueError:
+        return False
+    return value == value.lower()
+
+
+class BlobStore:
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, digest):
+        if not is_valid_hash(digest):
+            raise ValueError(f'无效的摘要: {digest!r}')
+        return os.path.join(self.root, digest[:2], digest)
+
+    def has(self, digest):
+        return is_valid_hash(digest) and os.path.exists(self.path(digest))
+
+    def size(self, digest):
+        """返回数据大小，不存在时返回 None"""
+        try:
+            return os.path.getsize(self.path(digest))
+        except (OSError, ValueError):
+            return None
+
+    def put(self, data):
+        """保存数据并返回摘要，内容已存在时不会重复写入"""
+        digest = blob_hash(data)
+        path = self.path(digest)
+        if os.path.exists(path):
+            return digest
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        with self._lock:
+            os.replace(tmp_path, path)
+        return digest
+
+    def get(self, digest):
+        """读取数据，不存在或摘要无效时返回 None"""
+        try:
+            with open(self.path(digest), 'rb') as f:
+                return f.read()
+        except (OSError, ValueError):
+            return None
+
+    def put_file(self, src_path, digest):
+        """把内容摘要为 digest 的文件移入存储（调用方已校验过摘要），内容已存在时删除 src_path"""
+        path = self.path(digest)
+        if os.path.exists(path):
+            os.remove(src_path)
+            return digest
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        shutil.move(src_path, tmp_path)  # 不在同一文件系统时退回复制
+        with self._lock:
+            os.replace(tmp_path, path)
+        return digest
+
+    def remove(self, digest):
+        try:
+            os.remove(self.path(digest))
+        except (OSError, ValueError):
+            pass
+
+    def digests(self):
+        """遍历存储中所有数据的摘要"""
+        for prefix in os.listdir(self.root):
+            directory = os.path.join(self.root, prefix)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if is_valid_hash(name):
+                    yield name
+
+
+# 聊天记录中的语音只保存引用 [VOICE_REF:类型:时长:SHA-256:字节数]，音频本身保存在 BlobStore 中；
+# 旧版记录中内嵌 base64 的 [VOICE:类型:时长:base64] 仍可识别
+VOICE_INLINE_PREFIX = '[VOICE:'
+VOICE_REF_PREFIX = '[VOICE_REF:'
+
+
+def voice_ref_text(voice_type, duration, digest, size):
+    return f'[VOICE_REF:{voice_type}:{duration}:{digest}:{size}]'
+
+
+def externalize_voice(msg, store):
+    """把内嵌 base64 的旧版语音记录转换为引用，音频写入 store；其他消息原样返回"""
+    if not (msg.startswith(VOICE_INLINE_PREFIX) and msg.endswith(']')):
+        return msg
+    parts = msg[len(VOICE_INLINE_PREFIX):-1].split(':', 2)
+    if len(parts) != 3:
+        return msg
+    voice_type, duration, audio_base64 = parts
+    try:
+        audio_data = base64.b64decode(audio_base64)
+    except Exception:
+        return msg
+    return voice_ref_text(voice_type, duration, store.put(audio_data), len(audio_data))
+
+
+def inline_voice(msg, store):
+    """把语音引用还原为内嵌 base64 的旧格式，供不认识引用的旧客户端使用"""
+    if not (msg.startswith(VOICE_REF_PREFIX) and msg.endswith(']')):
+        return msg
+    parts = msg[len(VOICE_REF_PREFIX):-1].split(':')
+    if len(parts) != 4:
+        return msg
+    voice_type, duration, digest, _ = parts
+    audio_data = store.get(digest)
+    if audio_data is None:
+        return msg
+    return f"[VOICE:{voice_type}:{duration}:{base64.b64encode(audio_data).decode('ascii')}]"
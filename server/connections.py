@@ -0,0 +1,54 @@
+"""在线连接登记：用户名 -> 连接
+
+消息转发、群聊广播和在线状态查询只读取登记，不加锁（CPython 中单次 dict 读写是原子的）；
+登录和断开需要“比较后替换”，按用户名分段加锁，只有同一个用户的并发登录/断开才会互相等待。
+"""
+from locks import StripedLock
+
+
+class ConnectionRegistry:
+    def __init__(self):
+        self._conns = {}
+        self._locks = StripedLock('connections')
+
+    def __contains__(self, username):
+        return username in self._conns
+
+    def __len__(self):
+        return len(self._conns)
+
+    def get(self, username):
+        return self._conns.get(username)
+
+    def usernames(self):
+        return list(self._conns)
+
+    def connections(self, usernames):
+        """返回 usernames 中在线用户的 {用户名: 连接}"""
+        conns = self._conns
+        result = {}
+        for username in usernames:
+            conn = conns.get(username)
+            if conn is not None:
+                result[username] = conn
+        return result
+
+    def register(self, username, conn):
+        """登记用户的新连接，返回被替换的旧连接（没有时为 None）"""
+        with self._locks.lock_for(username):
+            old = self._conns.get(username)
+            self._conns[username] = conn
+            return old
+
+    def unregister(self, username, conn):
+        """只有登记的仍是 conn 时才移除，避免误删重新登录后的新连接，返回是否移除"""
+        with self._locks.lock_for(username):
+            if self._conns.get(username) is not conn:
+                return False
+            del self._conns[username]
+            return True
+
+    def pop(self, username):
+        """移除并返回用户的连接（用户在其他工作进程登录时使用）"""
+        with self._locks.lock_for(username):
+            return self._conns.pop(username, None)
@@ -0,0 +1,178 @@
+"""会话文件的去重存储
+
+文件内容按 SHA-256 保存在 BlobStore 中，同样的内容只存一份，不论发给多少个好友、上传多少次。
+每个会话（两个用户之间）一个清单，记录文件名到内容摘要的对应：
+    <root>/blobs/<摘要前2位>/<摘要>
+    <root>/manifests/<用户1>__<用户2>.json   {文件名: {"sha256", "size", "uploader", "time"}}
+清单整体写入临时文件再改名。每个摘要被多少个清单条目引用在 load() 时统计，
+删除文件时引用数归零才删除数据。
+
+旧版把文件直接存放在 <legacy_root>/<用户1>__<用户2>/ 下，load() 时逐个会话导入（旧目录保留不动，
+确认无误后可以手动删除），之后只读写清单。
+
+分片模式下只有运行文件传输服务器的进程调用 load() 并修改存储；其他进程只用 list_files 读取清单。
+"""
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import logs
+from blob_store import BlobStore
+from locks import TimedLock
+from uploads import calculate_file_hash
+
+log = logs.get_logger('file_store')
+
+
+def conversation_key(user1, user2):
+    users = sorted([user1, user2])
+    return f'{users[0]}__{users[1]}'
+
+
+class FileStore:
+    def __init__(self, root, legacy_root=None):
+        self.root = root
+        self.legacy_root = legacy_root
+        self.blobs = BlobStore(os.path.join(root, 'blobs'))
+        self.manifest_dir = os.path.join(root, 'manifests')
+        self._refs = {}  # 摘要: 引用该内容的清单条目数
+        self._lock = TimedLock('file_store')
+        os.makedirs(self.manifest_dir, exist_ok=True)
+
+    def _manifest_path(self, conversation):
+        return os.path.join(self.manifest_dir, f'{conversation}.json')
+
+    def _read_manifest(self, conversation):
+        try:
+            with open(self._manifest_path(conversation), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _write_manifest(self, conversation, manifest):
+        path = self._manifest_path(conversation)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def load(self):
+        """导入旧版文件目录，统计引用数并删除没有被引用的数据，返回 (会话数, 文件数)"""
+        if self.legacy_root and os.path.isdir(self.legacy_root):
+            for name in sorted(os.listdir(self.legacy_root)):
+                directory = os.path.join(self.legacy_root, name)
+                if '__' in name and os.path.isdir(directory) and not os.path.exists(self._manifest_path(name)):
+                    self._import_legacy(name, directory)
+        refs = {}
+        conversations = 0
+        for name in os.listdir(self.manifest_dir):
+            if not name.endswith('.json'):
+                continue
+            conversations += 1
+            for entry in self._read_manifest(name[:-len('.json')]).values():
+                refs[entry['sha256']] = refs.get(entry['sha256'], 0) + 1
+        with self._lock:
+            self._refs = refs
+        # 删除文件时进程退出可能留下没有清单引用的数据
+        for digest in list(self.blobs.digests()):
+            if digest not in refs:
+                self.blobs.remove(digest)
+        return conversations, sum(refs.values())
+
+    def _import_legacy(self, conversation, directory):
+        manifest = {}
+        for filename in sorted(os.listdir(directory)):
+            path = os.path.join(directory, filename)
+            if filename.startswith('.') or not os.path.isfile(path):
+                continue
+            digest = calculate_file_hash(path)
+            if not self.blobs.has(digest):
+                # 复制一份再移入存储，旧目录保持不变
+                fd, tmp_path = tempfile.mkstemp(dir=self.root)
+                os.close(fd)
+                shutil.copyfile(path, tmp_path)
+                self.blobs.put_file(tmp_path, digest)
+            manifest[filename] = {'sha256': digest, 'size': os.path.getsize(path), 'uploader': '',
+                                  'time': int(os.path.getmtime(path))}
+        self._write_manifest(conversation, manifest)
+        log.info('已导入旧版文件目录', directory=directory, files=len(manifest))
+
+    def list_files(self, user1, user2):
+        """会话中的文件名列表，按上传顺序；清单尚未创建时列出旧版目录"""
+        conversation = conversation_key(user1, user2)
+        if not os.path.exists(self._manifest_path(conversation)) and self.legacy_root:
+            directory = os.path.join(self.legacy_root, conversation)
+            if os.path.isdir(directory):
+                return [name for name in os.listdir(directory) if not name.startswith('.')]
+        return list(self._read_manifest(conversation))
+
+    def lookup(self, user1, user2, filename):
+        """返回 (数据文件路径, 大小, SHA-256)，文件不存在时返回 None"""
+        entry = self._read_manifest(conversation_key(user1, user2)).get(filename)
+        if entry is None:
+            return None
+        path = self.blobs.path(entry['sha256'])
+        if not os.path.exists(path):
+            return None
+        return path, entry['size'], entry['sha256']
+
+    def has_content(self, digest, size):
+        """存储中已有这份内容时返回 True，上传可以直接引用而不用传输数据"""
+        return self.blobs.size(digest) == size
+
+    def add(self, uploader, to_user, filename, digest, size, src_path=None):
+        """把内容登记到会话清单中并返回最终的文件名
+
+        src_path 是已校验过摘要的上传文件，会被移入存储（内容已存在时删除）；
+        为 None 时引用存储中已有的内容，内容不存在（例如刚被删除）时返回 None。
+        同名文件内容相同时直接返回原文件名，不同时在文件名后添加时间戳。
+        """
+        conversation = conversation_key(uploader, to_user)
+        # 移入数据和登记引用在同一把锁内完成，不会被同时进行的 remove 删掉刚移入的数据
+        with self._lock:
+            if src_path is not None:
+                self.blobs.put_file(src_path, digest)
+            elif not self.blobs.has(digest):
+                return None
+            manifest = self._read_manifest(conversation)
+            existing = manifest.get(filename)
+            if existing is not None and existing['sha256'] == digest:
+                return filename
+            if existing is not None:
+                base, ext = os.path.splitext(filename)
+                filename = f"{base}_{int(time.time())}{ext}"
+                while filename in manifest:
+                    filename = f"{base}_{int(time.time())}_{len(manifest)}{ext}"
+            manifest[filename] = {'sha256': digest, 'size': size, 'uploader': uploader, 'time': int(time.time())}
+            self._write_manifest(conversation, manifest)
+            self._refs[digest] = self._refs.get(digest, 0) + 1
+        return filename
+
+    def remove(self, user1, user2, filename):
+        """从会话清单中删除文件，内容不再被任何清单引用时删除数据，返回是否删除了条目"""
+        conversation = conversation_key(user1, user2)
+        with self._lock:
+            manifest = self._read_manifest(conversation)
+            entry = manifest.pop(filename, None)
+            if entry is None:
+                return False
+            self._write_manifest(conversation, manifest)
+            digest = entry['sha256']
+            count = self._refs.get(digest, 1) - 1
+            if count > 0:
+                self._refs[digest] = count
+                return True
+            self._refs.pop(digest, None)
+            self.blobs.remove(digest)
+        return True
+
+    def references(self, digest):
+        return self._refs.get(digest, 0)
+
+    def stats(self):
+        """返回 (清单条目数, 实际保存的内容数)"""
+        with self._lock:
+            return sum(self._refs.values()), len(self._refs)
+
@@ -0,0 +1,241 @@
+"""常驻内存的数据索引
+
+服务器启动时从存储（见 storage.py）加载一次，之后所有查询都走内存，修改操作同步写回存储，
+避免每条消息都重新读取 CSV 文件或查询数据库。
+多进程分片模式下其他工作进程已经写入了存储，收到消息总线的通知后只用 cache_* 方法更新内存。
+
+查询不加锁。修改按用户名、好友对或群ID分段加锁（locks.StripedLock），锁内完成“检查 + 写存储”，
+不相关的用户和群组互不等待；需要整体替换的内存结构另有一把只在内存操作期间持有的短锁。
+"""
+from locks import StripedLock, TimedLock
+
+
+class CredentialIndex:
+    """用户凭据索引：用户名 -> 密码哈希
+
+    登录只需一次字典查找，注册和注销在修改存储的同时更新索引。
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self._hashes = {}
+        # 单个用户名的 dict 读写是原子的，锁只用来让同一用户的“检查 + 写存储”不被打断
+        self._user_locks = StripedLock('credentials')
+
+    def load(self):
+        """从存储重建索引"""
+        self._hashes = dict(self.storage.iter_users())
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def password_hash(self, username):
+        """返回用户的密码哈希，用户不存在时返回 None"""
+        return self._hashes.get(username)
+
+    def exists(self, username):
+        return username in self._hashes
+
+    def add(self, username, password_hash):
+        """注册新用户并写入存储，用户名已存在时返回 False"""
+        with self._user_locks.lock_for(username):
+            if username in self._hashes:
+                return False
+            if not self.storage.add_user(username, password_hash):
+                # 存储中已有该用户（例如被其他进程写入），同步到索引
+                self._hashes[username] = self.storage.get_password_hash(username)
+                return False
+            self._hashes[username] = password_hash
+            return True
+
+    def update(self, username, old_hash, new_hash):
+        """把密码哈希从 old_hash 替换为 new_hash，期间哈希已被修改时返回 False"""
+        with self._user_locks.lock_for(username):
+            if self._hashes.get(username) != old_hash:
+                return False
+            self.storage.update_password_hash(username, new_hash)
+            self._hashes[username] = new_hash
+            return True
+
+    def remove(self, username, password_hash):
+        """密码哈希仍为 password_hash 时删除用户（调用方已验证密码），返回是否删除"""
+        with self._user_locks.lock_for(username):
+            if self._hashes.get(username) != password_hash:
+                return False
+            self.storage.delete_user(username, password_hash)
+            del self._hashes[username]
+            return True
+
+    def cache(self, username, password_hash):
+        """只更新内存，password_hash 为 None 表示用户已删除"""
+        with self._user_locks.lock_for(username):
+            if password_hash is None:
+                self._hashes.pop(username, None)
+            else:
+                self._hashes[username] = password_hash
+
+
+class FriendshipIndex:
+    """好友关系索引：用户名 -> 好友集合（邻接表）"""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self._friends = {}
+        self._lock = TimedLock('friendships')  # 只在修改内存中的邻接表时持有
+        self._pair_locks = StripedLock('friendship_pairs')  # 按好友对串行化“检查 + 写存储”
+        # 每次好友关系变化时递增，供依赖好友关系的缓存判断是否失效
+        self.version = 0
+
+    def load(self):
+        """从存储重建索引"""
+        friends = {}
+        for a, b in self.storage.load_friendships():
+            friends.setdefault(a, set()).add(b)
+            friends.setdefault(b, set()).add(a)
+        with self._lock:
+            self._friends = friends
+            self.version += 1
+
+    def are_friends(self, user_a, user_b):
+        """常数时间判断两个用户是否是好友"""
+        return user_b in self._friends.get(user_a, ())
+
+    def friends_of(self, username):
+        """返回好友集合的副本，调用方可以放心遍历（复制集合在 CPython 中是原子操作）"""
+        return set(self._friends.get(username, ()))
+
+    def _pair_lock(self, user_a, user_b):
+        return self._pair_locks.lock_for((min(user_a, user_b), max(user_a, user_b)))
+
+    def add(self, user_a, user_b):
+        """添加好友关系并写入存储，已是好友时返回 False"""
+        with self._pair_lock(user_a, user_b):
+            if user_b in self._friends.get(user_a, ()):
+                return False
+            self.storage.add_friendship(user_a, user_b)
+            self.cache_add(user_a, user_b)
+            return True
+
+    def remove(self, user_a, user_b):
+        """删除好友关系并写入存储，原本不是好友时返回 False"""
+        with self._pair_lock(user_a, user_b):
+            if user_b not in self._friends.get(user_a, ()):
+                return False
+            self.storage.remove_friendship(user_a, user_b)
+            self.cache_remove(user_a, user_b)
+            return True
+
+    def cache_add(self, user_a, user_b):
+        """只更新内存"""
+        with self._lock:
+            self._friends.setdefault(user_a, set()).add(user_b)
+            self._friends.setdefault(user_b, set()).add(user_a)
+            self.version += 1
+
+    def cache_remove(self, user_a, user_b):
+        """只更新内存"""
+        with self._lock:
+            self._friends.get(user_a, set()).discard(user_b)
+            self._friends.get(user_b, set()).discard(user_a)
+            self.version += 1
+
+
+def normalize_group_id(group_id):
+    """统一群ID格式，去除前导零"""
+    try:
+        return str(int(group_id))
+    except (TypeError, ValueError):
+        return str(group_id)
+
+
+class GroupIndex:
+    """群组索引：群ID -> 群名、群ID -> 成员列表、用户 -> 所在群
+
+    成员列表以元组保存，加入新成员时整体替换，群聊广播可以直接遍历而无需复制。
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self._groups = {}  # group_id: group_name，保持创建顺序
+        self._members = {}  # group_id: (username, ...)
+        self._user_groups = {}  # username: {group_id, ...}
+        self._lock = TimedLock('groups')  # 只在读写内存结构时持有
+        self._create_lock = TimedLock('group_create')  # 创建群组需要串行分配群ID
+        self._member_locks = StripedLock('group_members')  # 按群ID串行化“检查 + 写存储”
+
+    def load(self):
+        """从存储重建索引"""
+        groups = {}
+        for group_id, group_name in self.storage.load_groups():
+            groups[normalize_group_id(group_id)] = group_name
+        members = {}
+        user_groups = {}
+        for group_id, username in self.storage.load_group_members():
+            gid = normalize_group_id(group_id)
+            group_members = members.setdefault(gid, [])
+            if username not in group_members:
+                group_members.append(username)
+            user_groups.setdefault(username, set()).add(gid)
+        with self._lock:
+            self._groups = groups
+            self._members = {gid: tuple(m) for gid, m in members.items()}
+            self._user_groups = user_groups
+
+    def create(self, group_name):
+        """创建群组并写入存储
+
+        返回 (是否新建, group_id)，群名已存在时返回已有群的 ID
+        """
+        with self._create_lock:
+            while True:
+                with self._lock:
+                    groups = list(self._groups.items())
+                max_id = 0
+                for gid, name in groups:
+                    if name == group_name:
+                        return False, gid
+                    try:
+                        max_id = max(max_id, int(gid))
+                    except ValueError:
+                        continue
+                group_id = str(max_id + 1)
+                if self.storage.add_group(group_id, group_name):
+                    self.cache_group(group_id, group_name)
+                    return True, group_id
+                # 该ID已被其他进程占用，从存储补全群组后重试
+                for gid, name in self.storage.load_groups():
+                    self.cache_group(gid, name)
+
+    def join(self, group_id, username):
+        """加入群组并写入存储，已在群中时返回 False"""
+        gid = normalize_group_id(group_id)
+        with self._member_locks.lock_for(gid):
+            if username in self._members.get(gid, ()):
+                return False
+            self.storage.add_group_member(gid, username)
+            self.cache_member(gid, username)
+            return True
+
+    def cache_group(self, group_id, group_name):
+        """只更新内存"""
+        with self._lock:
+            self._groups.setdefault(normalize_group_id(group_id), group_name)
+
+    def cache_member(self, group_id, username):
+        """只更新内存"""
+        gid = normalize_group_id(group_id)
+        with self._lock:
+            current = self._members.get(gid, ())
+            if username not in current:
+                self._members[gid] = current + (username,)
+                self._user_groups.setdefault(username, set()).add(gid)
+
+    def members(self, group_id):
+        """返回群成员元组（不可变快照）"""
+        return self._members.get(normalize_group_id(group_id), ())
+
+    def groups_of(self, username):
+        """返回用户所在的群 [(group_id, group_name)]"""
+        with self._lock:
+            gids = self._user_groups.get(username, ())
+            return [(gid, name) for gid, name in self._groups.items() if gid in gids]
@@ -0,0 +1,92 @@
+"""带等待时间统计的锁
+
+TimedLock 的用法与 threading.Lock 相同，未发生竞争时只多一次非阻塞 acquire；
+需要等待时记录等待次数、总等待时间和最长等待时间，用来确认哪些锁在负载下成为瓶颈。
+StripedLock 按键把操作分散到多把 TimedLock 上，不同用户、不同群组的操作几乎不会互相等待。
+
+同名的锁（例如每个会话各有一把的 history_log）在统计中合并显示，lock_stats() 返回当前的汇总。
+统计计数在持有该锁时更新，不需要额外的锁。
+"""
+import threading
+import time
+import weakref
+
+DEFAULT_STRIPES = 64
+
+_registry = {}  # 名称: WeakSet[TimedLock]
+_registry_lock = threading.Lock()
+
+
+class TimedLock:
+    def __init__(self, name=None):
+        self._lock = threading.Lock()
+        self.acquisitions = 0
+        self.contended = 0  # 需要等待的次数
+        self.wait_total = 0.0  # 秒
+        self.wait_max = 0.0
+        if name:
+            with _registry_lock:
+                _registry.setdefault(name, weakref.WeakSet()).add(self)
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self._lock.acquire(False):
+            self.acquisitions += 1
+            return True
+        if not blocking:
+            return False
+        start = time.perf_counter()
+        if not self._lock.acquire(True, timeout):
+            return False
+        wait = time.perf_counter() - start
+        self.acquisitions += 1
+        self.contended += 1
+        self.wait_total += wait
+        if wait > self.wait_max:
+            self.wait_max = wait
+        return True
+
+    def release(self):
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class StripedLock:
+    """按键分段的一组锁，lock_for(key) 返回该键对应的 TimedLock"""
+
+    def __init__(self, name, stripes=DEFAULT_STRIPES):
+        self._locks = [TimedLock(name) for _ in range(stripes)]
+
+    def lock_for(self, key):
+        return self._locks[hash(key) % len(self._locks)]
+
+
+def lock_stats():
+    """返回 {名称: (获取次数, 等待次数, 总等待秒数, 最长等待秒数)}，按名称排序"""
+    with _registry_lock:
+        groups = {name: list(locks) for name, locks in _registry.items()}
+    stats = {}
+    for name in sorted(groups):
+        locks = groups[name]
+        stats[name] = (sum(lock.acquisitions for lock in locks),
+                       sum(lock.contended for lock in locks),
+                       sum(lock.wait_total for lock in locks),
+                       max((lock.wait_max for lock in locks), default=0.0))
+    return stats
+
+
+def format_lock_stats(stats=None):
+    """每把锁一行的文本汇总"""
+    if stats is None:
+        stats = lock_stats()
+    return [f'{name}: 获取 {acquisitions} 次, 等待 {contended} 次, 总等待 {wait_total * 1000:.1f} ms, '
+            f'最长 {wait_max * 1000:.2f} ms'
+            for name, (acquisitions, contended, wait_total, wait_max) in stats.items()]
@@ -0,0 +1,228 @@
+"""服务器日志：分级、结构化字段、高频事件采样，终端和文件输出都在后台线程中完成
+
+用法与 logging 相近，附加信息作为关键字参数传入，不在调用处拼接字符串：
+    log = get_logger('main')
+    log.debug('收到命令', cmd=cmd, user=username, size=len(data))
+    log.info('连接已关闭', addr=addr, sample='conn_closed')
+
+- 级别低于当前设置的调用在第一行检查后直接返回，不创建记录；每条命令一次的日志都使用 DEBUG。
+- sample=键 的日志按键采样：每 SAMPLE_INTERVAL 秒最多记录 SAMPLE_BURST 条，其余只计数，
+  下一条被记录的日志带上 suppressed=被略过的条数。用于连接建立/断开、群聊广播这类负载越高越多的事件。
+- 调用线程只把记录放入有界队列，QueueListener 的后台线程负责格式化和写终端/文件；
+  队列满时丢弃记录（dropped 计数）而不是等待，处理请求的线程不会因为终端或磁盘慢而阻塞。
+
+setup() 之前（例如基准脚本直接导入 main）没有输出目标，只有 WARNING 以上由 logging 默认打印到 stderr。
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+LOG_FORMATS = ('text', 'json')
+ROOT = 'chat'
+QUEUE_SIZE = 10000  # 等待写出的日志条数上限
+SAMPLE_INTERVAL = 1.0  # 秒
+SAMPLE_BURST = 10  # 同一采样键每个间隔最多记录的条数
+LOG_FILE_MAX_BYTES = 50 * 1024 * 1024
+LOG_FILE_BACKUPS = 5
+
+dropped = 0  # 队列已满被丢弃的日志条数
+_listener = None
+
+
+class Sampler:
+    """按键限制记录频率，allow 返回 None 表示丢弃，否则返回自上次记录以来被略过的条数"""
+
+    def __init__(self, interval=SAMPLE_INTERVAL, burst=SAMPLE_BURST):
+        self.interval = interval
+        self.burst = burst
+        self._windows = {}  # 键: [窗口开始时间, 本窗口已记录条数, 被略过条数]
+        self._lock = threading.Lock()
+
+    def allow(self, key):
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window is not None else 0
+                self._windows[key] = [now, 1, 0]
+                return suppressed
+            if window[1] < self.burst:
+                window[1] += 1
+                suppressed, window[2] = window[2], 0
+                return suppressed
+            window[2] += 1
+            return None
+
+
+_sampler = Sampler()
+
+
+class Logger:
+    """logging.Logger 的包装，关键字参数作为结构化字段保存在记录的 fields 属性中"""
+
+    def __init__(self, name):
+        self._logger = logging.getLogger(f'{ROOT}.{name}')
+
+    def isEnabledFor(self, level):
+        return self._logger.isEnabledFor(level)
+
+    def debug(self, msg, **fields):
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._log(logging.DEBUG, msg, fields)
+
+    def info(self, msg, **fields):
+        if self._logger.isEnabledFor(logging.INFO):
+            self._log(logging.INFO, msg, fields)
+
+    def warning(self, msg, **fields):
+        if self._logger.isEnabledFor(logging.WARNING):
+            self._log(logging.WARNING, msg, fields)
+
+    def error(self, msg, **fields):
+        if self._logger.isEnabledFor(logging.ERROR):
+            self._log(logging.ERROR, msg, fields)
+
+    def exception(self, msg, **fields):
+        """在 except 块中使用，ERROR 级别并附带异常堆栈"""
+        if self._logger.isEnabledFor(logging.ERROR):
+            self._log(logging.ERROR, msg, fields, sys.exc_info())
+
+    def _log(self, level, msg, fields, exc_info=None):
+        sample = fields.pop('sample', None)
+        if sample is not None:
+            suppressed = _sampler.allow(sample)
+            if suppressed is None:
+                return
+            if suppressed:
+                fields['suppressed'] = suppressed
+        # 直接构造记录，跳过 logging 查找调用位置的栈遍历（输出格式中不需要文件名和行号）
+        record = self._logger.makeRecord(self._logger.name, level, '', 0, msg, (), exc_info)
+        record.fields = fields
+        self._logger.handle(record)
+
+
+def get_logger(name):
+    return Logger(name)
+
+
+def _plain(value):
+    """地址元组 (主机, 端口) 显示为 主机:端口，其他值转为字符串"""
+    if isinstance(value, tuple) and len(value) == 2:
+        return f'{value[0]}:{value[1]}'
+    return str(value)
+
+
+def _format_value(value):
+    text = _plain(value)
+    if not text or any(c in text for c in ' ="\n'):
+        return json.dumps(text, ensure_ascii=False)
+    return text
+
+
+class TextFormatter(logging.Formatter):
+    """时间 级别 模块 消息 键=值 ...，值中有空格或引号时加引号"""
+
+    def __init__(self, tag=None):
+        super().__init__()
+        self.tag = tag
+
+    def format(self, record):
+        parts = [time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record.created)) + f'.{int(record.msecs):03d}',
+                 f'{record.levelname:7s}']
+        if self.tag:
+            parts.append(self.tag)
+        parts.append(record.name[len(ROOT) + 1:] if record.name.startswith(ROOT + '.') else record.name)
+        parts.append(record.getMessage())
+        for key, value in getattr(record, 'fields', {}).items():
+            parts.append(f'{key}={_format_value(value)}')
+        line = ' '.join(parts)
+        if record.exc_text:
+            line += '\n' + record.exc_text
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志一行 JSON，便于日志收集系统解析"""
+
+    def __init__(self, tag=None):
+        super().__init__()
+        self.tag = tag
+
+    def format(self, record):
+        entry = {'time': record.created, 'level': record.levelname, 'logger': record.name, 'msg': record.getMessage()}
+        if self.tag:
+            entry['worker'] = self.tag
+        for key, value in getattr(record, 'fields', {}).items():
+            entry.setdefault(key, value if isinstance(value, (int, float, bool)) or value is None else _plain(value))
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # 标准实现会在调用线程中格式化整条消息；这里只把异常堆栈转成文本（traceback 对象不能跨线程保留），
+        # 格式化交给后台线程
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        global dropped
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped += 1
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # 队列已满时等待后台线程腾出位置，保证停止时能写出全部已排队的日志
+        self.queue.put(self._sentinel)
+
+
+def setup(level='INFO', log_file=None, fmt='text', tag=None, queue_size=QUEUE_SIZE):
+    """配置日志输出：终端，log_file 不为空时再写入按大小轮转的文件；tag 标在每一行上（分片模式下的工作进程编号）"""
+    global _listener
+    shutdown()
+    formatter = (JsonFormatter if fmt == 'json' else TextFormatter)(tag)
+    targets = [logging.StreamHandler(sys.stdout)]
+    if log_file:
+        targets.append(logging.handlers.RotatingFileHandler(log_file, maxBytes=LOG_FILE_MAX_BYTES,
+                                                            backupCount=LOG_FILE_BACKUPS, encoding='utf-8'))
+    for target in targets:
+        target.setFormatter(formatter)
+    records = queue.Queue(queue_size)
+    root = logging.getLogger(ROOT)
+    root.handlers[:] = [_QueueHandler(records)]
+    root.setLevel(level)
+    root.propagate = False
+    _listener = _QueueListener(records, *targets)
+    _listener.start()
+    atexit.register(shutdown)
+
+
+def get_level():
+    return logging.getLevelName(logging.getLogger(ROOT).level)
+
+
+def set_level(level):
+    """运行中调整日志级别"""
+    logging.getLogger(ROOT).setLevel(level)
+
+
+def shutdown():
+    """写出队列中剩余的日志并停止后台线程"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for target in _listener.handlers:
+            target.close()
+        _listener = None
@@ -1,751 +1,1038 @@
 import socket
 import threading
-import csv
 import hashlib
 import os
 import time
-import shutil
 import threading
 import json
+import argparse
+import base64
+import signal
+import subprocess
+import sys
+import tempfile
+
+import async_server
+import logs
+from outbound import OutboundConnection, QUEUE_POLICIES
+from indexes import CredentialIndex, FriendshipIndex, GroupIndex, normalize_group_id
+from storage import STORAGE_BACKENDS, open_storage
+from passwords import HASHER_CHOICES, DEFAULT_HASHER, PasswordService
+from presence import PresenceService
+from shard_bus import MessageBus
+from connections import ConnectionRegistry
+from locks import format_lock_stats
+from metrics import TRANSFER_BUCKETS, Counter, Gauge, Histogram, MetricsServer
+from uploads import FINISH_ALREADY, FINISH_HASH_MISMATCH, FileTransfer, SocketReader, chunk_checksum
+from file_store import FileStore
+from blob_store import BlobStore, is_valid_hash, voice_ref_text, externalize_voice, inline_voice
+from protocol import (PROTOCOL_V1, PROTOCOL_V2, CMD_PROTO, CMD_PROTO_OK, LineDecoder, FrameDecoder,
+                      ProtocolError, encode_message, encode_binary_frame)
+
+log = logs.get_logger('main')
 
 # 服务器配置
 HOST = '0.0.0.0'
 PORT = 12345
 # UDP_PORT removed - voice messages now use TCP
 FILE_PORT = 12347  # 专用文件传输端口
-USER_CSV = 'users.csv'
-FRIENDSHIP_CSV = 'friendships.csv'
-GROUP_CSV = 'groups.csv'
-GROUP_MEMBERS_CSV = 'group_members.csv'
+SERVER_MODES = ('thread', 'asyncio')  # 连接处理模式
+LISTEN_BACKLOG = 4096  # 监听队列长度，重连风暴时避免连接被丢弃
+# 每个连接的发送队列上限，以及队列已满时的策略：drop / disconnect / coalesce
+OUTBOUND_QUEUE_MAX_MESSAGES = 1024
+OUTBOUND_QUEUE_MAX_BYTES = 8 * 1024 * 1024
+OUTBOUND_QUEUE_POLICY = 'drop'
+STORAGE_BACKEND = 'csv'  # 持久化存储：csv 为原有的 CSV 文件，sqlite 为单个数据库文件
+SQLITE_PATH = 'chat.db'  # sqlite 存储的数据库文件，可用 migrate_storage.py 从 CSV 迁移
+HISTORY_DIR = 'history'  # csv 存储的聊天记录消息日志目录，每个会话一个子目录
+# csv 存储的聊天记录延迟写入：每隔这么多秒或排队达到这么多条时统一写入并 fsync，0 表示每条消息直接写入
+HISTORY_COMMIT_INTERVAL = 0.2
+HISTORY_COMMIT_BATCH = 1000
+HISTORY_PAGE_SIZE = 50  # 分页获取历史记录时的默认条数
+HISTORY_PAGE_MAX = 200  # 单页最多条数
+VOICE_BLOB_DIR = os.path.join('blobs', 'voice')  # 语音数据按内容寻址保存，聊天记录中只保存摘要
+PASSWORD_HASHER = DEFAULT_HASHER  # 新密码使用的哈希算法，旧哈希在登录成功后自动替换
+PASSWORD_WORKERS = os.cpu_count() or 1  # 同时计算密码哈希的线程数上限
+PRESENCE_TICK = 0.5  # 在线状态变化的批量发送间隔（秒）
+PRESENCE_DEBOUNCE = 1.0  # 在线状态保持不变多久后才通知好友（秒），过滤断线重连
+# 需要计算密码哈希的命令，asyncio 模式下转交给线程执行，不阻塞事件循环
+PASSWORD_COMMANDS = ('REGISTER', 'LOGIN', 'DELETE_USER')
+LOCK_STATS_INTERVAL = 0  # 大于 0 时每隔这么多秒打印一次各锁的等待时间统计
+WORKERS = 1  # 工作进程数，大于 1 时为多进程分片模式（见 shard_bus.py），需要 sqlite 存储
+WORKER_ID = None  # 分片模式下本工作进程的编号，单进程模式为 None
+LOG_LEVEL = 'INFO'  # 每条命令一次的日志为 DEBUG，默认不输出
+LOG_FILE = None  # 不为空时日志同时写入该文件（按大小轮转），分片模式下文件名后加 .工作进程编号
+LOG_FORMAT = 'text'  # text 或 json（每行一个 JSON 对象）
+METRICS_HOST = '127.0.0.1'  # 指标接口只监听本机
+METRICS_PORT = 0  # 大于 0 时在该端口提供 Prometheus 格式的 /metrics，分片模式下工作进程 i 使用 METRICS_PORT + i
+# 按命令统计处理时间，不在其中的命令合并为 OTHER，避免任意字符串成为指标标签
+COMMANDS = (CMD_PROTO, 'REGISTER', 'LOGIN', 'ADD_FRIEND', 'DEL_FRIEND', 'DELETE_USER', 'GET_FRIENDS', 'MSG', 'EMOJI',
+            'VOICE_MSG', 'GET_VOICE', 'LOGOUT', 'CREATE_GROUP', 'JOIN_GROUP', 'GET_GROUPS', 'GET_GROUP_MEMBERS',
+            'GROUP_MSG', 'GROUP_MSG_ANON', 'GET_GROUP_HISTORY', 'GET_PRIVATE_HISTORY', 'FILE_UPLOAD_START',
+            'FILE_DOWNLOAD_START', 'FILE_LIST', 'PING')
 # Voice call functionality removed - now using voice messages
 USER_FILES_DIR = 'user_files'
 os.makedirs(USER_FILES_DIR, exist_ok=True)
+UPLOAD_DIR = os.path.join(USER_FILES_DIR, '.uploads')  # 未完成的分块上传（见 uploads.py）
+UPLOAD_REAP_INTERVAL = 60  # 秒，检查空闲的分块上传（关闭文件）和过期的未完成上传（删除）的间隔
 
 # 文件传输相关配置
+# 旧版按会话保存文件的目录，文件存储启动时从这里导入
 FILES_DIR = os.path.join(os.path.dirname(__file__), 'files')
 os.makedirs(FILES_DIR, exist_ok=True)
+# 会话文件按 SHA-256 去重保存，每个会话一个清单（见 file_store.py）；与 UPLOAD_DIR 在同一文件系统时上传完成只需改名
+FILE_STORE_DIR = 'file_store'
+SENDFILE_CHUNK = 16 * 1024 * 1024  # 下载时每次 sendfile 的字节数，两次调用之间更新进度
+DOWNLOAD_PROGRESS_INTERVAL = 5.0  # 秒，下载进度的打印间隔
+LINGER_TIMEOUT = 5.0  # 秒，下载完成后等待客户端关闭连接的最长时间
 
 # 文件传输服务器
 file_transfer_server = None
 
 
-# 确保CSV文件存在
-def ensure_csv(file_path, header):
-    if not os.path.exists(file_path):
-        with open(file_path, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerow(header)
-
-
-ensure_csv(USER_CSV, ['username', 'password_hash'])
-ensure_csv(FRIENDSHIP_CSV, ['user_a', 'user_b'])
-ensure_csv(GROUP_CSV, ['group_id', 'group_name'])
-ensure_csv(GROUP_MEMBERS_CSV, ['group_id', 'username'])
-
-clients = {}  # username: conn
+# 持久化存储及其内存索引，由 init_storage 按启动参数创建
+storage = None
+# 用户名 -> 密码哈希，登录和注册不再扫描用户表
+credential_index = None
+# 密码哈希计算服务，由启动参数创建
+password_service = None
+# 在线状态服务，好友上下线通知经过防抖后批量发送，由 start_server 创建
+presence = None
+# 好友关系索引，启动时加载一次，之后的好友判断不再访问存储
+friendship_index = None
+# 群组与群成员索引，群聊广播直接从内存获取成员列表
+group_index = None
+voice_blobs = BlobStore(VOICE_BLOB_DIR)
+# 会话文件存储，由运行文件传输服务器的进程加载和修改
+file_store = FileStore(FILE_STORE_DIR, FILES_DIR)
+# 多进程分片模式下与其他工作进程通信的消息总线，单进程模式为 None
+bus = None
+# Prometheus 格式的指标接口，METRICS_PORT 大于 0 时由 start_server 创建
+metrics_server = None
+
+
+def init_storage(backend):
+    global storage, credential_index, friendship_index, group_index
+    storage = open_storage(backend, history_dir=HISTORY_DIR, sqlite_path=SQLITE_PATH,
+                           history_commit_interval=HISTORY_COMMIT_INTERVAL, history_commit_batch=HISTORY_COMMIT_BATCH)
+    credential_index = CredentialIndex(storage)
+    credential_index.load()
+    friendship_index = FriendshipIndex(storage)
+    friendship_index.load()
+    group_index = GroupIndex(storage)
+    group_index.load()
+    log.info('存储已加载', backend=backend, users=len(credential_index))
+
+# 在线连接登记 username: conn，查询不加锁，登录/断开按用户名分段加锁
+clients = ConnectionRegistry()
+# 打开的聊天连接 conn: (地址, 会话)，包括尚未登录的，用于统计连接数、收发字节数和发送队列
+open_connections = {}
+closed_connection_bytes = {'received': 0, 'sent': 0}  # 已关闭连接累计收发的字节数
+
+
+def connection_totals(attr, closed_key):
+    return closed_connection_bytes[closed_key] + sum(getattr(conn, attr) for conn in list(open_connections))
+
+
+def per_connection(attr):
+    return {(f'{addr[0]}:{addr[1]}' if addr else '', session.get('username') or ''): getattr(conn, attr)
+            for conn, (addr, session) in list(open_connections.items())}
+
+
+# 运行指标（见 metrics.py）
+command_latency = Histogram('chat_command_duration_seconds', '命令处理时间（秒），_count 为处理次数', ('command',))
+command_errors = Counter('chat_command_errors_total', '处理时抛出异常的命令数', ('command',))
+connections_accepted = Counter('chat_connections_accepted_total', '接受的聊天连接数')
+Gauge('chat_connections_open', '打开的聊天连接数（包括未登录的）', lambda: len(open_connections))
+Gauge('chat_users_online', '本进程中登录的在线用户数', lambda: len(clients))
+Gauge('chat_bytes_received_total', '聊天连接收到的字节数',
+      lambda: connection_totals('bytes_received', 'received'), kind='counter')
+Gauge('chat_bytes_sent_total', '聊天连接发出的字节数', lambda: connection_totals('bytes_sent', 'sent'), kind='counter')
+Gauge('chat_connection_bytes_received', '每个打开的连接收到的字节数', lambda: per_connection('bytes_received'),
+      labels=('addr', 'user'))
+Gauge('chat_connection_bytes_sent', '每个打开的连接发出的字节数', lambda: per_connection('bytes_sent'),
+      labels=('addr', 'user'))
+Gauge('chat_outbound_queue_bytes', '所有连接发送队列中等待发送的字节数',
+      lambda: sum(conn.pending_bytes for conn in list(open_connections)))
+Gauge('chat_outbound_queue_max_bytes', '发送队列最长的连接中等待发送的字节数',
+      lambda: max((conn.pending_bytes for conn in list(open_connections)), default=0))
+Gauge('chat_outbound_dropped_messages', '打开的连接中因发送队列已满被丢弃的消息数',
+      lambda: sum(conn.dropped for conn in list(open_connections)))
+file_bytes = Counter('chat_file_bytes_total', '文件传输端口收发的文件数据字节数', ('direction',))
+file_transfers = Counter('chat_file_transfers_total', '文件传输请求数', ('kind', 'result'))
+file_transfer_duration = Histogram('chat_file_transfer_duration_seconds', '文件传输请求的处理时间（秒）', ('kind',),
+                                   TRANSFER_BUCKETS)
+Gauge('chat_log_dropped_records', '日志队列已满被丢弃的日志条数', lambda: logs.dropped, kind='counter')
+Gauge('chat_file_connections_active', '正在处理的文件传输连接数',
+      lambda: len(file_transfer_server.active_connections) if file_transfer_server is not None else 0)
 # Voice call variables removed - using voice messages instead
-lock = threading.Lock()
 
 # UDP socket removed - voice messages now use TCP
 
 
-def hash_password(password):
-    return hashlib.sha256(password.encode()).hexdigest()
-
-
 def register_user(username, password):
-    with lock:
-        with open(USER_CSV, 'r', newline='', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                if row['username'] == username:
-                    return False, 'Username already exists.'
-        with open(USER_CSV, 'a', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerow([username, hash_password(password)])
-        return True, 'Registration successful.'
+    # 先检查重名，避免为已存在的用户名计算哈希
+    if credential_index.exists(username):
+        return False, 'Username already exists.'
+    password_hash = password_service.hash(password)
+    if not credential_index.add(username, password_hash):
+        return False, 'Username already exists.'
+    publish(['user', username, password_hash])
+    return True, 'Registration successful.'
+
+
+def verify_user(username, password):
+    """验证密码，返回当前保存的哈希，密码错误或用户不存在时返回 None"""
+    stored = credential_index.password_hash(username)
+    if stored is None:
+        return None
+    ok, new_hash = password_service.verify(password, stored)
+    if not ok:
+        return None
+    if new_hash and credential_index.update(username, stored, new_hash):
+        log.info('密码哈希已升级', user=username, algorithm=password_service.default.algorithm)
+        publish(['user', username, new_hash])
+        stored = new_hash
+    return stored
 
 
 def authenticate_user(username, password):
-    with open(USER_CSV, 'r', newline='', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            if row['username'] == username and row['password_hash'] == hash_password(password):
-                return True
-    return False
+    return verify_user(username, password) is not None
 
 
 def add_friend(user_a, user_b):
     if user_a == user_b:
         return False, 'Cannot add yourself as a friend.'
     # 检查用户是否存在
-    users = set()
-    with open(USER_CSV, 'r', newline='', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            users.add(row['username'])
-    if user_b not in users:
+    if not credential_index.exists(user_b):
         return False, 'User does not exist.'
-    # 检查是否已是好友
-    with lock:
-        with open(FRIENDSHIP_CSV, 'r', newline='', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                if (row['user_a'] == user_a and row['user_b'] == user_b) or (
-                        row['user_a'] == user_b and row['user_b'] == user_a):
-                    return False, 'Already friends.'
-        with open(FRIENDSHIP_CSV, 'a', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerow([user_a, user_b])
-        return True, 'Friend added.'
+    # 检查是否已是好友，索引负责写回存储
+    if not friendship_index.add(user_a, user_b):
+        return False, 'Already friends.'
+    publish(['friend_add', user_a, user_b])
+    return True, 'Friend added.'
 
 
 def del_friend(user_a, user_b):
-    changed = False
-    with lock:
-        rows = []
-        with open(FRIENDSHIP_CSV, 'r', newline='', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                if (row['user_a'] == user_a and row['user_b'] == user_b) or (
-                        row['user_a'] == user_b and row['user_b'] == user_a):
-                    changed = True
-                    continue
-                rows.append(row)
-        with open(FRIENDSHIP_CSV, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=['user_a', 'user_b'])
-            writer.writeheader()
-            writer.writerows(rows)
+    changed = friendship_index.remove(user_a, user_b)
+    if changed:
+        publish(['friend_remove', user_a, user_b])
     return changed, 'Friend deleted.' if changed else 'Not friends.'
 
 
 def delete_user(username, password):
-    # 删除 users.csv 中指定用户名和密码的行
-    deleted = False
-    with lock:
-        rows = []
-        with open(USER_CSV, 'r', newline='', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                if row['username'] == username and row['password_hash'] == hash_password(password):
-                    deleted = True
-                    continue
-                rows.append(row)
-        if deleted:
-            with open(USER_CSV, 'w', newline='', encoding='utf-8') as f:
-                writer = csv.DictWriter(f, fieldnames=['username', 'password_hash'])
-                writer.writeheader()
-                writer.writerows(rows)
-    return deleted
+    # 删除用户名和密码都匹配的用户
+    stored = verify_user(username, password)
+    if stored is None or not credential_index.remove(username, stored):
+        return False
+    publish(['user', username, None])
+    return True
 
 
 def get_friends(username):
-    friends = set()
-    with open(FRIENDSHIP_CSV, 'r', newline='', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            if row['user_a'] == username:
-                friends.add(row['user_b'])
-            elif row['user_b'] == username:
-                friends.add(row['user_a'])
-    return list(friends)
+    return list(friendship_index.friends_of(username))
+
+
+def is_friend(user_a, user_b):
+    return friendship_index.are_friends(user_a, user_b)
 
 
 def get_friends_with_status(username):
-    friends = []
-    with open(FRIENDSHIP_CSV, 'r', newline='', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            if row['user_a'] == username:
-                friends.append(row['user_b'])
-            elif row['user_b'] == username:
-                friends.append(row['user_a'])
+    friends = friendship_index.friends_of(username)
     # 返回 [(friend, online_status)]
-    with lock:
-        return [(f, f in clients) for f in friends]
+    # 断线后尚未超过防抖时间的好友仍算在线，与其他好友收到的通知一致；
+    # 分片模式下连接在其他工作进程上的好友按消息总线的登记判断
+    return [(f, f in clients or presence.is_online(f) or (bus is not None and bus.owner_of(f) is not None))
+            for f in friends]
 
 
-def notify_friends_status(username, online):
-    friends = get_friends(username)
-    with lock:
-        for f in friends:
-            if f in clients:
-                try:
-                    if online:
-                        send_msg(clients[f], f'FRIEND_ONLINE|{username}')
-                    else:
-                        send_msg(clients[f], f'FRIEND_OFFLINE|{username}')
-                except Exception:
-                    pass
+def online_connections(usernames):
+    """返回 usernames 中在本进程在线的用户 {用户名: 连接}"""
+    return clients.connections(usernames)
+
+
+def local_usernames():
+    return clients.usernames()
+
+
+def deliver(username, msg):
+    """把消息发给在线用户，连接在其他工作进程上时经消息总线转交，返回用户是否在线"""
+    conn = online_connections((username,)).get(username)
+    if conn is not None:
+        send_msg(conn, msg)
+        return True
+    worker = bus.owner_of(username) if bus is not None else None
+    return worker is not None and bus.send(worker, ['deliver', username, msg])
+
+
+def deliver_group(members, msg):
+    """把群消息发给在线的群成员，其他工作进程上的成员按进程合并为一个总线事件"""
+    targets = online_connections(members)
+    for m, target in targets.items():
+        try:
+            # 发送者的在线状态由 presence 统一通知，这里不再附带 FRIEND_ONLINE
+            send_msg(target, msg)
+        except Exception as e:
+            log.warning('群消息发送失败', user=m, error=e)
+    if bus is None:
+        return
+    remote = {}
+    for m in members:
+        worker = bus.owner_of(m) if m not in targets else None
+        if worker is not None:
+            remote.setdefault(worker, []).append(m)
+    for worker, usernames in remote.items():
+        bus.send(worker, ['deliver_many', usernames, msg])
+
+
+def forward_voice(target, from_user, voice_type, duration, digest, size, audio_base64=None):
+    """把语音消息转发给接收方的连接：v2 只转发引用，点击播放时再获取音频；旧客户端仍使用 base64 文本"""
+    if getattr(target, 'protocol', PROTOCOL_V1) == PROTOCOL_V2:
+        send_msg(target, f'VOICE_MSG_REF|{from_user}|{voice_type}|{duration}|{digest}|{size}')
+    else:
+        audio_base64 = audio_base64 or base64.b64encode(voice_blobs.get(digest) or b'').decode('ascii')
+        send_msg(target, f'VOICE_MSG|{from_user}|{voice_type}|{duration}|{audio_base64}')
+
+
+def force_logout(username, conn):
+    """通知并关闭用户的旧连接"""
+    try:
+        # 尝试向旧连接发送下线通知
+        try:
+            send_msg(conn, 'FORCE_LOGOUT|另一个客户端登录了您的账号')
+        except:
+            pass
+        # 关闭旧连接
+        try:
+            conn.close()
+        except:
+            pass
+        log.info('旧连接已被强制下线', user=username)
+    except Exception as e:
+        log.warning('强制下线旧连接异常', user=username, error=e)
+
+
+def set_presence(username, online):
+    """记录上下线，分片模式下交给负责该用户的工作进程防抖和发布"""
+    if bus is not None and bus.home(username) != WORKER_ID:
+        bus.send(bus.home(username), ['presence', username, online])
+    elif online:
+        presence.set_online(username)
+    else:
+        presence.set_offline(username)
+
+
+def forward_presence(deltas):
+    """在线状态通知的接收者不在本进程时，转交给持有其连接的工作进程"""
+    for friend, items in deltas.items():
+        worker = bus.owner_of(friend)
+        if worker is not None:
+            bus.send(worker, ['presence_delta', friend, items])
+
+
+def publish(event):
+    """分片模式下把已写入存储的修改通知其他工作进程，由它们更新各自的内存索引"""
+    if bus is not None:
+        bus.broadcast(event)
+
+
+def handle_bus_event(event):
+    """处理其他工作进程经消息总线发来的事件"""
+    kind = event[0]
+    if kind == 'deliver':
+        _, username, msg = event
+        conn = online_connections((username,)).get(username)
+        if conn is not None:
+            send_msg(conn, msg)
+    elif kind == 'deliver_many':
+        _, usernames, msg = event
+        for conn in online_connections(usernames).values():
+            send_msg(conn, msg)
+    elif kind == 'voice':
+        _, to_user, from_user, voice_type, duration, digest, size = event
+        conn = online_connections((to_user,)).get(to_user)
+        if conn is not None:
+            forward_voice(conn, from_user, voice_type, duration, digest, size)
+    elif kind == 'presence':
+        _, username, online = event
+        set_presence(username, online)
+    elif kind == 'presence_delta':
+        _, friend, items = event
+        conn = online_connections((friend,)).get(friend)
+        if conn is not None:
+            presence.send_delta(conn, [tuple(item) for item in items])
+    elif kind == 'online':
+        # 用户在其他工作进程登录，断开本进程上的旧连接；旧连接的清理不会再通知下线
+        username = event[1]
+        conn = clients.pop(username)
+        if conn is not None:
+            force_logout(username, conn)
+    elif kind == 'user':
+        credential_index.cache(event[1], event[2])
+    elif kind == 'friend_add':
+        friendship_index.cache_add(event[1], event[2])
+    elif kind == 'friend_remove':
+        friendship_index.cache_remove(event[1], event[2])
+    elif kind == 'group':
+        group_index.cache_group(event[1], event[2])
+    elif kind == 'group_member':
+        group_index.cache_member(event[1], event[2])
 
 
 # UDP audio handling removed - voice messages now use TCP
 
 
 def send_msg(conn, msg):
+    """把一条消息按连接协商的协议编码后放入发送队列，不会阻塞在慢客户端上"""
     try:
-        if not msg.endswith('\n'):
-            msg += '\n'
-        conn.send(msg.encode('utf-8'))
+        conn.send(encode_message(msg, getattr(conn, 'protocol', PROTOCOL_V1)))
     except Exception as e:
-        print(f"发送消息失败: {e}")
+        log.warning('发送消息失败', error=e, sample='send_failed')
         # 不抛出异常，避免中断连接
 
 
-class FileTransfer:
-    CHUNK_SIZE = 1024 * 1024  # 1MB per chunk
-    MAX_RETRIES = 3
-
-    @staticmethod
-    def calculate_file_hash(file_path):
-        """计算文件的MD5哈希值"""
-        hash_md5 = hashlib.md5()
-        with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
-
-    @staticmethod
-    def save_file_chunk(file_path, chunk_id, chunk_data):
-        """保存文件块到临时文件"""
-        chunk_dir = os.path.join(os.path.dirname(file_path), '.chunks')
-        os.makedirs(chunk_dir, exist_ok=True)
-        chunk_path = os.path.join(chunk_dir, f'{os.path.basename(file_path)}.chunk{chunk_id}')
-        with open(chunk_path, 'wb') as f:
-            f.write(chunk_data)
-
-    @staticmethod
-    def get_file_chunk(file_path, chunk_id):
-        """获取文件块"""
-        with open(file_path, 'rb') as f:
-            f.seek(chunk_id * FileTransfer.CHUNK_SIZE)
-            return f.read(FileTransfer.CHUNK_SIZE)
-
-    @staticmethod
-    def cleanup_chunks(file_path):
-        """清理临时文件块"""
-        chunk_dir = os.path.join(os.path.dirname(file_path), '.chunks')
-        if os.path.exists(chunk_dir):
-            shutil.rmtree(chunk_dir)
-
-
-def get_user_file_dir(user1, user2):
-    """获取两个用户之间的文件存储目录"""
-    users = sorted([user1, user2])
-    dir_path = os.path.join(FILES_DIR, f'{users[0]}__{users[1]}')
-    os.makedirs(dir_path, exist_ok=True)
-    return dir_path
+def send_binary(conn, meta, blob, legacy_msg):
+    """发送带原始字节的消息：v2 连接使用二进制帧，v1 连接退回到 base64 文本行 legacy_msg"""
+    if getattr(conn, 'protocol', PROTOCOL_V1) != PROTOCOL_V2:
+        send_msg(conn, legacy_msg)
+        return
+    try:
+        conn.send(encode_binary_frame(meta, blob))
+    except Exception as e:
+        log.warning('发送消息失败', error=e, sample='send_failed')
 
 
 def handle_file_upload(conn, from_user, to_user, fname, file_size, total_chunks):
-    """通知客户端使用专用文件传输连接"""
-    try:
-        # 发送重定向指令，告知客户端使用专用端口
-        redirect_msg = f'USE_FILE_PORT|{FILE_PORT}|{from_user}|{to_user}|{fname}|{file_size}'
-        conn.send(redirect_msg.encode('utf-8'))
-        print(f"已通知客户端使用专用文件传输端口: {FILE_PORT}")
-    except Exception as e:
-        print(f"通知客户端使用专用文件端口出错: {e}")
-        conn.send(f'ERROR|{str(e)}'.encode('utf-8'))
+    """通知客户端使用专用文件传输连接
+
+    重定向和其他消息一样按协商的协议成帧发送，客户端在消息分发中处理，不用在聊天连接上抢读回复
+    """
+    # 发送重定向指令，告知客户端使用专用端口
+    send_msg(conn, f'USE_FILE_PORT|{FILE_PORT}|{from_user}|{to_user}|{fname}|{file_size}')
+    log.debug('已通知客户端使用文件传输端口', port=FILE_PORT, user=from_user, file=fname)
 
 
 def handle_file_download(conn, from_user, to_user, fname):
     """通知客户端使用专用文件传输连接"""
+    send_msg(conn, f'USE_FILE_PORT|{FILE_PORT}|{from_user}|{to_user}|{fname}')
+    log.debug('已通知客户端使用文件传输端口', port=FILE_PORT, user=from_user, file=fname)
+
+
+def handle_command(conn, addr, data, session, blob=None):
+    """处理一条完整的命令，线程模式与 asyncio 模式共用
+
+    blob 是 v2 二进制帧携带的原始字节，文本命令为 None。
+    返回 False 表示客户端请求断开连接
+    """
+    username = session.get('username')
+    parts = data.split('|')
+    cmd = parts[0] if parts else ''
+    # 健壮性检查
+    if not cmd:
+        log.debug('收到空命令', data=repr(data[:100]))
+        return True
+
+    if cmd != 'PING':
+        log.debug('收到命令', cmd=cmd, user=username, size=len(data) if blob is None else len(data) + len(blob))
+
+    if cmd == CMD_PROTO:
+        # PROTO|version 协商协议版本，回复仍使用协商前的 v1 格式
+        try:
+            requested = int(parts[1])
+        except (IndexError, ValueError):
+            requested = PROTOCOL_V1
+        version = PROTOCOL_V2 if requested >= PROTOCOL_V2 else PROTOCOL_V1
+        send_msg(conn, f'{CMD_PROTO_OK}|{version}')
+        conn.protocol = version
+    elif cmd == 'REGISTER':
+        _, u, p = parts
+        success, msg = register_user(u, p)
+        send_msg(conn, f'REGISTER_RESULT|{"OK" if success else "FAIL"}|{msg}')
+    elif cmd == 'LOGIN':
+        _, u, p = parts
+        if authenticate_user(u, p):
+            # 检查用户是否已经登录，如果是，则断开前一个连接
+            # 更新连接信息，同一用户已有的旧连接被替换后断开
+            old = clients.register(u, conn)
+            if old is not None and old is not conn:
+                force_logout(u, old)
+            if bus is not None:
+                bus.announce_online(u)
+
+            session['username'] = username = u
+            send_msg(conn, 'LOGIN_RESULT|OK|Login successful.')
+            set_presence(username, True)
+        else:
+            send_msg(conn, 'LOGIN_RESULT|FAIL|Invalid username or password.')
+    elif cmd == 'ADD_FRIEND':
+        _, u, f = parts
+        success, msg = add_friend(u, f)
+        send_msg(conn, f'ADD_FRIEND_RESULT|{"OK" if success else "FAIL"}|{msg}')
+    elif cmd == 'DEL_FRIEND':
+        _, u, f = parts
+        success, msg = del_friend(u, f)
+        send_msg(conn, f'DEL_FRIEND_RESULT|{"OK" if success else "FAIL"}|{msg}')
+    elif cmd == 'DELETE_USER':
+        # DELETE_USER|username|password
+        _, u, p = parts
+        success = delete_user(u, p)
+        send_msg(conn, f'DELETE_USER_RESULT|{"OK" if success else "FAIL"}')
+    elif cmd == 'GET_FRIENDS':
+        _, u = parts[:2]
+        friends_status = get_friends_with_status(u)
+        # 格式 FRIEND_LIST|user1:online|user2:offline|...
+        friend_strs = [f"{f}:{'online' if online else 'offline'}" for f, online in friends_status]
+        send_msg(conn, f"FRIEND_LIST|{'|'.join(friend_strs)}")
+    elif cmd == 'MSG':
+        # MSG|to_user|message
+        _, to_user, msg = parts
+        # 只允许发给好友
+        if not is_friend(username, to_user):
+            send_msg(conn, f'ERROR|You are not friends with {to_user}.')
+        else:
+            # 保存消息历史
+            save_private_message(username, to_user, msg)
+
+            if not deliver(to_user, f'MSG|{username}|{msg}'):
+                send_msg(conn, f'ERROR|User {to_user} not online.')
+    elif cmd == 'EMOJI':
+        # EMOJI|to_user|emoji_id
+        _, to_user, emoji_id = parts
+        if not is_friend(username, to_user):
+            send_msg(conn, f'ERROR|You are not friends with {to_user}.')
+        else:
+            # 保存表情消息历史
+            save_private_message(username, to_user, f"[EMOJI]{emoji_id}")
+
+            if not deliver(to_user, f'EMOJI|{username}|{emoji_id}'):
+                send_msg(conn, f'ERROR|User {to_user} not online.')
+    # 处理语音消息
+    elif cmd == 'VOICE_MSG':
+        # v1: VOICE_MSG|to_user|voice_type|duration|audio_base64
+        # v2: 二进制帧，meta 为 VOICE_MSG|to_user|voice_type|duration，音频是原始字节
+        try:
+            # 使用更安全的方式解析消息，避免base64数据中的|字符干扰
+            expected = 5 if blob is None else 4
+            msg_parts = data.split('|', expected - 1)  # v1 只分割前4个|，剩余的都是audio_base64
+            if len(msg_parts) < expected:
+                log.warning('语音消息格式错误', user=username, fields=len(msg_parts))
+                send_msg(conn, 'ERROR|Voice message format error: insufficient parameters')
+                return True
+
+            _, to_user, voice_type, duration = msg_parts[:4]
+            audio_base64 = msg_parts[4] if blob is None else ''
+            from_user = username
+
+            log.debug('收到语音消息', from_user=from_user, to_user=to_user, type=voice_type, duration=duration,
+                      size=len(blob) if blob is not None else len(audio_base64))
+
+            # 验证参数
+            if not to_user or not voice_type or not duration or not (blob or audio_base64):
+                log.warning('语音消息参数无效', user=from_user)
+                send_msg(conn, 'ERROR|Invalid voice message parameters')
+                return True
+
+            # 检查是否为好友关系
+            if not is_friend(from_user, to_user):
+                log.warning('语音消息接收者不是好友', from_user=from_user, to_user=to_user)
+                send_msg(conn, f'ERROR|You are not friends with {to_user}.')
+                return True
+
+            if blob is not None:
+                audio_data = blob
+            else:
+                # 验证base64数据格式
+                try:
+                    # 修复base64填充问题
+                    missing_padding = len(audio_base64) % 4
+                    if missing_padding:
+                        audio_base64 += '=' * (4 - missing_padding)
+                    # 尝试解码验证数据完整性
+                    audio_data = base64.b64decode(audio_base64)
+                except Exception as decode_error:
+                    log.warning('语音消息 base64 数据无效', user=from_user, error=decode_error)
+                    send_msg(conn, 'ERROR|Invalid audio data format')
+                    return True
+
+            # 音频按内容寻址单独保存，私聊历史中只记录摘要、时长和大小
+            digest = voice_blobs.put(audio_data)
+            save_private_message(from_user, to_user,
+                                 voice_ref_text(voice_type, duration, digest, len(audio_data)))
+
+            # 转发语音消息给接收方（如果在线）
+            target = online_connections((to_user,)).get(to_user)
+            worker = bus.owner_of(to_user) if target is None and bus is not None else None
+            if target is not None:
+                try:
+                    forward_voice(target, from_user, voice_type, duration, digest, len(audio_data),
+                                  audio_base64 or base64.b64encode(audio_data).decode('ascii'))
+                    log.debug('语音消息已转发', to_user=to_user)
+                except Exception as e:
+                    log.warning('转发语音消息失败', to_user=to_user, error=e)
+                    # 从客户端列表中移除无效连接
+                    clients.unregister(to_user, target)
+            elif worker is not None:
+                # 接收方连接在其他工作进程上，音频已在共享的 blob 目录中，只转交引用
+                bus.send(worker, ['voice', to_user, from_user, voice_type, duration, digest, len(audio_data)])
+            else:
+                log.debug('接收者不在线，语音消息已保存', to_user=to_user)
+
+            # 发送确认给发送方
+            send_msg(conn, f'VOICE_MSG_SENT|{to_user}')
+
+        except Exception as e:
+            log.exception('处理语音消息出错', user=username)
+            send_msg(conn, f'ERROR|Failed to process voice message: {str(e)}')
+    elif cmd == 'GET_VOICE':
+        # GET_VOICE|sha256，v2 回复二进制帧 VOICE_DATA|sha256 + 原始音频，v1 回复 VOICE_DATA|sha256|base64
+        digest = parts[1] if len(parts) > 1 else ''
+        audio_data = voice_blobs.get(digest) if is_valid_hash(digest) else None
+        if audio_data is None:
+            send_msg(conn, f'VOICE_DATA_FAIL|{digest}|语音不存在')
+        else:
+            send_binary(conn, f'VOICE_DATA|{digest}', audio_data,
+                        f"VOICE_DATA|{digest}|{base64.b64encode(audio_data).decode('ascii')}")
+    elif cmd == 'LOGOUT':
+        return False
+    elif cmd == 'CREATE_GROUP':
+        _, u, group_name = parts
+        success, msg, group_id = create_group(group_name)
+        if success:
+            join_group(group_id, u)
+        send_msg(conn, f'CREATE_GROUP_RESULT|{"OK" if success else "FAIL"}|{msg}|{group_id}')
+    elif cmd == 'JOIN_GROUP':
+        _, u, group_id = parts
+        success, msg = join_group(group_id, u)
+        send_msg(conn, f'JOIN_GROUP_RESULT|{"OK" if success else "FAIL"}|{msg}|{group_id}')
+    elif cmd == 'GET_GROUPS':
+        _, u = parts[:2]
+        groups = get_user_groups(u)
+        # 格式 GROUP_LIST|group_id:group_name|...
+        group_strs = [f'{gid}:{gname}' for gid, gname in groups]
+        send_msg(conn, f'GROUP_LIST|{"|".join(group_strs)}')
+    elif cmd == 'GET_GROUP_MEMBERS':
+        _, group_id = parts[:2]
+        members = get_group_members(group_id)
+        send_msg(conn, f'GROUP_MEMBERS|{"|".join(members)}')
+    elif cmd == 'GROUP_MSG':
+        # GROUP_MSG|group_id|from_user|msg
+        try:
+            if len(parts) < 3:
+                log.warning('群聊消息格式错误', user=username, data=repr(data[:100]))
+                return True
+
+            _, group_id, from_user = parts[:3]
+            msg = '|'.join(parts[3:])  # 正确获取消息内容
+
+            members = group_index.members(group_id)
+            log.debug('群聊广播', group_id=group_id, from_user=from_user, size=len(msg), members=len(members))
+            save_group_message(group_id, from_user, msg)
+            deliver_group(members, f'GROUP_MSG|{normalize_group_id(group_id)}|{from_user}|{msg}')
+        except Exception as e:
+            log.exception('处理群聊消息出错', user=username)
+
+    elif cmd == 'GROUP_MSG_ANON':
+        # GROUP_MSG_ANON|group_id|anon_nick|msg
+        try:
+            if len(parts) < 3:
+                log.warning('匿名群聊消息格式错误', user=username, data=repr(data[:100]))
+                return True
+
+            _, group_id, anon_nick = parts[:3]
+            msg = '|'.join(parts[3:])  # 正确获取消息内容
+
+            members = group_index.members(group_id)
+            log.debug('匿名群聊广播', group_id=group_id, size=len(msg), members=len(members))
+            save_group_message(group_id, None, msg, anon_nick=anon_nick)
+            deliver_group(members, f'GROUP_MSG_ANON|{normalize_group_id(group_id)}|{anon_nick}|{msg}')
+        except Exception as e:
+            log.exception('处理匿名群聊消息出错', user=username)
+    elif cmd == 'GET_GROUP_HISTORY' and len(parts) >= 4:
+        # GET_GROUP_HISTORY|group_id|before_id|limit 分页获取，before_id 为空或 0 表示最新一页
+        # 回复 GROUP_HISTORY_PAGE|group_id|游标|是否还有更早消息|type|sender|msg|...
+        try:
+            group_id = parts[1]
+            before_id, limit = parse_history_page_args(parts[2], parts[3])
+            records, cursor, has_more = read_history_page(group_history_log(group_id), before_id, limit)
+            resp = ['GROUP_HISTORY_PAGE', group_id, str(cursor), '1' if has_more else '0']
+            for _, _, fields in records:
+                resp.extend(fields)
+            log.debug('发送群聊历史分页', group_id=group_id, count=len(records), cursor=cursor)
+            send_msg(conn, '|'.join(resp))
+        except Exception as e:
+            log.exception('处理群聊历史请求出错', user=username)
+            send_msg(conn, 'GROUP_HISTORY|error|获取群聊历史失败')
+    elif cmd == 'GET_GROUP_HISTORY':
+        # 旧客户端不带分页参数，返回全部历史
+        try:
+            _, group_id = parts[:2]
+            history = get_group_history(group_id)
+            # 格式 GROUP_HISTORY|type|sender|msg|...
+            resp = ['GROUP_HISTORY']
+            for row in history:
+                resp.extend(row)
+            response_str = '|'.join(resp)
+            log.debug('发送群聊历史', group_id=group_id, count=len(history))
+            send_msg(conn, response_str)
+        except Exception as e:
+            log.exception('处理群聊历史请求出错', user=username)
+            send_msg(conn, 'GROUP_HISTORY|error|获取群聊历史失败')
+    elif cmd == 'GET_PRIVATE_HISTORY':
+        # GET_PRIVATE_HISTORY|from_user|to_user[|before_id|limit]
+        # 带分页参数时回复 PRIVATE_HISTORY_PAGE|to_user|游标|是否还有更早消息|sender|msg|...
+        # 旧客户端不带分页参数，回复全部历史 PRIVATE_HISTORY|sender|msg|...
+        _, from_user, to_user = parts[:3]
+        if not is_friend(from_user, to_user):
+            send_msg(conn, 'PRIVATE_HISTORY|error|不是好友关系')
+        elif len(parts) >= 5:
+            try:
+                before_id, limit = parse_history_page_args(parts[3], parts[4])
+                records, cursor, has_more = read_history_page(private_history_log(from_user, to_user),
+                                                              before_id, limit)
+                resp = ['PRIVATE_HISTORY_PAGE', to_user, str(cursor), '1' if has_more else '0']
+                for _, _, (sender, msg) in records:
+                    resp.extend((sender, externalize_voice(msg, voice_blobs)))
+                send_msg(conn, '|'.join(resp))
+            except Exception as e:
+                log.exception('获取私聊历史出错', user=username)
+                send_msg(conn, 'PRIVATE_HISTORY|error|获取历史记录失败')
+        else:
+            try:
+                history = get_private_history(from_user, to_user)
+                # 格式 PRIVATE_HISTORY|sender1|msg1|sender2|msg2|...
+                # 不带分页参数的是旧客户端，语音引用需要还原为内嵌 base64
+                resp = ['PRIVATE_HISTORY']
+                for sender, msg in history:
+                    resp.extend((sender, inline_voice(msg, voice_blobs)))
+                response_str = '|'.join(resp)
+                send_msg(conn, response_str)
+            except Exception as e:
+                log.exception('获取私聊历史出错', user=username)
+                send_msg(conn, 'PRIVATE_HISTORY|error|获取历史记录失败')
+    elif cmd == 'FILE_UPLOAD_START':
+        # 新的文件上传处理
+        from_user = parts[1]
+        to_user = parts[2]
+        fname = parts[3]
+        file_size = int(parts[4])
+        total_chunks = int(parts[5])
+        handle_file_upload(conn, from_user, to_user, fname, file_size, total_chunks)
+
+    elif cmd == 'FILE_DOWNLOAD_START':
+        # 新的文件下载处理
+        from_user = parts[1]
+        to_user = parts[2]
+        fname = parts[3]
+        handle_file_download(conn, from_user, to_user, fname)
+
+    elif cmd == 'FILE_LIST':
+        # FILE_LIST|from_user|to_user
+        _, from_user, to_user = parts
+        files = file_store.list_files(from_user, to_user)
+        send_msg(conn, 'FILE_LIST|' + '|'.join(files))
+    elif cmd == 'PING':
+        # 响应客户端的PING请求以保持连接
+        send_msg(conn, 'PONG')
+    else:
+        log.warning('未知命令', cmd=cmd, user=username, data=repr(data[:100]), sample='unknown_command')
+        send_msg(conn, f'ERROR|Unknown command: {cmd}')
+    return True
+
+
+def run_command(conn, addr, data, session, blob=None):
+    """调用 handle_command 并记录该命令的处理时间，线程模式与 asyncio 模式都经过这里"""
+    cmd = data.split('|', 1)[0]
+    if cmd not in COMMANDS:
+        cmd = 'OTHER'
+    start = time.perf_counter()
+    try:
+        return handle_command(conn, addr, data, session, blob)
+    except Exception:
+        command_errors.inc(cmd)
+        raise
+    finally:
+        command_latency.observe(time.perf_counter() - start, cmd)
+
+
+def dispatch_command(conn, addr, data, session, blob=None):
+    """调用 run_command，单条命令出错不影响连接上的后续命令"""
     try:
-        # 发送重定向指令，告知客户端使用专用端口
-        redirect_msg = f'USE_FILE_PORT|{FILE_PORT}|{from_user}|{to_user}|{fname}'
-        conn.send(redirect_msg.encode('utf-8'))
-        print(f"已通知客户端使用专用文件传输端口: {FILE_PORT}")
+        return run_command(conn, addr, data, session, blob)
     except Exception as e:
-        print(f"通知客户端使用专用文件端口出错: {e}")
-        conn.send(f'ERROR|{str(e)}'.encode('utf-8'))
+        log.exception('处理命令出错', addr=addr)
+        return True
+
+
+def open_client(conn, addr, session):
+    """新连接开始读取前登记，连接结束时由 cleanup_client 移除"""
+    connections_accepted.inc()
+    open_connections[conn] = (addr, session)
 
 
 def handle_client(conn, addr):
-    username = None
-    buffer = ""  # 用于存储不完整的消息
+    session = {'username': None}
+    open_client(conn, addr, session)
+    decoder = LineDecoder()  # 协商为 v2 后换成 FrameDecoder
     try:
         while True:
             try:
-                raw_data = conn.recv(65536).decode('utf-8')  # 增加缓冲区大小以支持语音消息
-                if not raw_data:
-                    print(f"客户端 {addr} 连接关闭")
+                raw_data = conn.recv(65536)  # 增加缓冲区大小以支持语音消息
+            except OSError as e:
+                log.info('连接异常', addr=addr, error=e, sample='conn_error')
+                break
+            if not raw_data:
+                break
+
+            # 将新数据添加到缓冲区，处理其中所有完整消息
+            decoder.feed(raw_data)
+            while True:
+                message = decoder.next_message()
+                if message is None:
                     break
-
-                # 将新数据添加到缓冲区
-                buffer += raw_data
-                
-                # 处理缓冲区中的所有完整消息（以换行符分隔）
-                while '\n' in buffer:
-                    line, buffer = buffer.split('\n', 1)
-                    data = line.strip()
-                    
+                data, blob = message
+                if blob is None:
+                    data = data.strip()
                     if not data:
                         continue
-                    
-                    parts = data.split('|')
-                    cmd = parts[0] if parts else ''
-                    # 健壮性检查
-                    if not cmd:
-                        print(f"收到空命令，原始数据: {repr(data[:100])}...")
-                        continue
-                    
-                    # 调试信息：记录收到的命令
-                    if cmd not in ['PING']:  # 不记录PING命令以减少日志
-                        print(f"收到命令: {cmd}, 来自用户: {username}, 数据长度: {len(data)}")
-
-                    if cmd == 'REGISTER':
-                        _, u, p = parts
-                        success, msg = register_user(u, p)
-                        send_msg(conn, f'REGISTER_RESULT|{"OK" if success else "FAIL"}|{msg}')
-                    elif cmd == 'LOGIN':
-                        _, u, p = parts
-                        if authenticate_user(u, p):
-                            # 检查用户是否已经登录，如果是，则断开前一个连接
-                            with lock:
-                                if u in clients:
-                                    try:
-                                        # 尝试向旧连接发送下线通知
-                                        try:
-                                            send_msg(clients[u], 'FORCE_LOGOUT|另一个客户端登录了您的账号')
-                                        except:
-                                            pass
-                                        # 关闭旧连接
-                                        try:
-                                            clients[u].close()
-                                        except:
-                                            pass
-                                        print(f"用户 {u} 的旧连接已被强制下线")
-                                    except Exception as e:
-                                        print(f"强制下线旧连接异常: {e}")
-
-                                # 更新连接信息
-                                clients[u] = conn
-
-                            username = u
-                            send_msg(conn, 'LOGIN_RESULT|OK|Login successful.')
-                            notify_friends_status(username, True)
-                        else:
-                            send_msg(conn, 'LOGIN_RESULT|FAIL|Invalid username or password.')
-                    elif cmd == 'ADD_FRIEND':
-                        _, u, f = parts
-                        success, msg = add_friend(u, f)
-                        send_msg(conn, f'ADD_FRIEND_RESULT|{"OK" if success else "FAIL"}|{msg}')
-                    elif cmd == 'DEL_FRIEND':
-                        _, u, f = parts
-                        success, msg = del_friend(u, f)
-                        send_msg(conn, f'DEL_FRIEND_RESULT|{"OK" if success else "FAIL"}|{msg}')
-                    elif cmd == 'DELETE_USER':
-                        # DELETE_USER|username|password
-                        _, u, p = parts
-                        success = delete_user(u, p)
-                        send_msg(conn, f'DELETE_USER_RESULT|{"OK" if success else "FAIL"}')
-                    elif cmd == 'GET_FRIENDS':
-                        _, u = parts[:2]
-                        friends_status = get_friends_with_status(u)
-                        # 格式 FRIEND_LIST|user1:online|user2:offline|...
-                        friend_strs = [f"{f}:{'online' if online else 'offline'}" for f, online in friends_status]
-                        send_msg(conn, f"FRIEND_LIST|{'|'.join(friend_strs)}")
-                    elif cmd == 'MSG':
-                        # MSG|to_user|message
-                        _, to_user, msg = parts
-                        # 只允许发给好友
-                        if to_user not in get_friends(username):
-                            send_msg(conn, f'ERROR|You are not friends with {to_user}.')
-                        else:
-                            # 保存消息历史
-                            save_private_message(username, to_user, msg)
-
-                            with lock:
-                                if to_user in clients:
-                                    send_msg(clients[to_user], f'MSG|{username}|{msg}')
-                                else:
-                                    send_msg(conn, f'ERROR|User {to_user} not online.')
-                    elif cmd == 'EMOJI':
-                        # EMOJI|to_user|emoji_id
-                        _, to_user, emoji_id = parts
-                        if to_user not in get_friends(username):
-                            send_msg(conn, f'ERROR|You are not friends with {to_user}.')
-                        else:
-                            # 保存表情消息历史
-                            save_private_message(username, to_user, f"[EMOJI]{emoji_id}")
-
-                            with lock:
-                                if to_user in clients:
-                                    send_msg(clients[to_user], f'EMOJI|{username}|{emoji_id}')
-                                else:
-                                    send_msg(conn, f'ERROR|User {to_user} not online.')
-                    # 处理语音消息
-                    elif cmd == 'VOICE_MSG':
-                        # VOICE_MSG|to_user|voice_type|duration|audio_base64
-                        try:
-                            # 使用更安全的方式解析消息，避免base64数据中的|字符干扰
-                            msg_parts = data.split('|', 4)  # 只分割前4个|，剩余的都是audio_base64
-                            if len(msg_parts) < 5:
-                                print(f"VOICE_MSG消息格式错误: 参数不足，收到 {len(msg_parts)} 个参数")
-                                send_msg(conn, 'ERROR|Voice message format error: insufficient parameters')
-                                continue
-                            
-                            _, to_user, voice_type, duration, audio_base64 = msg_parts
-                            from_user = username
-                            
-                            print(f"收到语音消息: {from_user} -> {to_user}, 类型: {voice_type}, 时长: {duration}s, 数据长度: {len(audio_base64)}")
-                            
-                            # 验证参数
-                            if not to_user or not voice_type or not duration or not audio_base64:
-                                print(f"语音消息参数无效")
-                                send_msg(conn, 'ERROR|Invalid voice message parameters')
-                                continue
-                            
-                            # 检查是否为好友关系
-                            if to_user not in get_friends(from_user):
-                                print(f"错误: {to_user} 不是 {from_user} 的好友")
-                                send_msg(conn, f'ERROR|You are not friends with {to_user}.')
-                                continue
-                            
-                            # 验证base64数据格式
-                            try:
-                                import base64
-                                # 修复base64填充问题
-                                missing_padding = len(audio_base64) % 4
-                                if missing_padding:
-                                    audio_base64 += '=' * (4 - missing_padding)
-                                # 尝试解码验证数据完整性
-                                test_decode = base64.b64decode(audio_base64)
-                                print(f"语音数据验证成功，解码后长度: {len(test_decode)} 字节")
-                            except Exception as decode_error:
-                                print(f"语音消息base64数据无效: {decode_error}")
-                                send_msg(conn, 'ERROR|Invalid audio data format')
-                                continue
-                            
-                            # 保存语音消息到私聊历史
-                            voice_msg_data = f"[VOICE:{voice_type}:{duration}:{audio_base64}]"
-                            save_private_message(from_user, to_user, voice_msg_data)
-                            
-                            # 转发语音消息给接收方（如果在线）
-                            with lock:
-                                if to_user in clients:
-                                    try:
-                                        # 使用相同的分割方式发送消息
-                                        forward_msg = f'VOICE_MSG|{from_user}|{voice_type}|{duration}|{audio_base64}'
-                                        send_msg(clients[to_user], forward_msg)
-                                        print(f"语音消息已转发给 {to_user}")
-                                    except Exception as e:
-                                        print(f"转发语音消息失败: {e}")
-                                        # 从客户端列表中移除无效连接
-                                        try:
-                                            del clients[to_user]
-                                        except:
-                                            pass
-                                else:
-                                    print(f"目标用户 {to_user} 不在线，语音消息已保存")
-                            
-                            # 发送确认给发送方
-                            send_msg(conn, f'VOICE_MSG_SENT|{to_user}')
-                            
-                        except Exception as e:
-                            print(f"处理语音消息出错: {e}")
-                            import traceback
-                            traceback.print_exc()
-                            send_msg(conn, f'ERROR|Failed to process voice message: {str(e)}')
-                    elif cmd == 'LOGOUT':
-                        break
-                    elif cmd == 'CREATE_GROUP':
-                        _, u, group_name = parts
-                        success, msg, group_id = create_group(group_name)
-                        if success:
-                            join_group(group_id, u)
-                        send_msg(conn, f'CREATE_GROUP_RESULT|{"OK" if success else "FAIL"}|{msg}|{group_id}')
-                    elif cmd == 'JOIN_GROUP':
-                        _, u, group_id = parts
-                        success, msg = join_group(group_id, u)
-                        send_msg(conn, f'JOIN_GROUP_RESULT|{"OK" if success else "FAIL"}|{msg}|{group_id}')
-                    elif cmd == 'GET_GROUPS':
-                        _, u = parts[:2]
-                        groups = get_user_groups(u)
-                        # 格式 GROUP_LIST|group_id:group_name|...
-                        group_strs = [f'{gid}:{gname}' for gid, gname in groups]
-                        send_msg(conn, f'GROUP_LIST|{"|".join(group_strs)}')
-                    elif cmd == 'GET_GROUP_MEMBERS':
-                        _, group_id = parts[:2]
-                        members = get_group_members(group_id)
-                        send_msg(conn, f'GROUP_MEMBERS|{"|".join(members)}')
-                    elif cmd == 'GROUP_MSG':
-                        # GROUP_MSG|group_id|from_user|msg
-                        try:
-                            if len(parts) < 3:
-                                print(f"群聊消息格式错误: {data}")
-                                continue
-
-                            _, group_id, from_user = parts[:3]
-                            msg = '|'.join(parts[3:])  # 正确获取消息内容
-
-                            print(f"处理群聊消息: group_id={group_id}, from_user={from_user}, msg={msg}")
-
-                            members = get_group_members(group_id)
-                            print(f'群聊广播: group_id={group_id}, members={members}')
-                            save_group_message(group_id, from_user, msg)
-                            with lock:
-                                for m in members:
-                                    if m in clients:
-                                        try:
-                                            # 发送消息时，带上发送者的在线状态信息
-                                            send_msg(clients[m], f'GROUP_MSG|{str(int(group_id))}|{from_user}|{msg}')
-                                            # 如果消息接收者与发送者是好友关系，通知发送者在线
-                                            if m != from_user and from_user in get_friends(m):
-                                                send_msg(clients[m], f'FRIEND_ONLINE|{from_user}')
-                                        except Exception as e:
-                                            print(f'发送给{m}失败: {e}')
-                        except Exception as e:
-                            print(f"处理群聊消息出错: {e}, 原始数据: {data}")
-
-                    elif cmd == 'GROUP_MSG_ANON':
-                        # GROUP_MSG_ANON|group_id|anon_nick|msg
-                        try:
-                            if len(parts) < 3:
-                                print(f"匿名群聊消息格式错误: {data}")
-                                continue
-
-                            _, group_id, anon_nick = parts[:3]
-                            msg = '|'.join(parts[3:])  # 正确获取消息内容
-
-                            print(f"处理匿名群聊消息: group_id={group_id}, anon_nick={anon_nick}, msg={msg}")
-
-                            members = get_group_members(group_id)
-                            print(f'匿名群聊广播: group_id={group_id}, members={members}')
-                            save_group_message(group_id, None, msg, anon_nick=anon_nick)
-                            with lock:
-                                for m in members:
-                                    if m in clients:
-                                        try:
-                                            send_msg(clients[m], f'GROUP_MSG_ANON|{str(int(group_id))}|{anon_nick}|{msg}')
-                                        except Exception as e:
-                                            print(f'发送给{m}失败: {e}')
-                        except Exception as e:
-                            print(f"处理匿名群聊消息出错: {e}, 原始数据: {data}")
-                    elif cmd == 'GET_GROUP_HISTORY':
-                        try:
-                            _, group_id = parts[:2]
-                            print(f"获取群聊历史: group_id={group_id}")
-                            history = get_group_history(group_id)
-                            # 格式 GROUP_HISTORY|type|sender|msg|...
-                            resp = ['GROUP_HISTORY']
-                            for row in history:
-                                resp.extend(row)
-                            response_str = '|'.join(resp)
-                            print(f"发送群聊历史: {len(history)}条消息")
-                            send_msg(conn, response_str)
-                        except Exception as e:
-                            print(f"处理群聊历史请求出错: {e}")
-                            send_msg(conn, 'GROUP_HISTORY|error|获取群聊历史失败')
-                    elif cmd == 'GET_PRIVATE_HISTORY':
-                        # GET_PRIVATE_HISTORY|from_user|to_user
-                        _, from_user, to_user = parts
-                        if to_user not in get_friends(from_user):
-                            send_msg(conn, 'PRIVATE_HISTORY|error|不是好友关系')
-                        else:
-                            try:
-                                history = get_private_history(from_user, to_user)
-                                # 格式 PRIVATE_HISTORY|sender1|msg1|sender2|msg2|...
-                                resp = ['PRIVATE_HISTORY']
-                                for row in history:
-                                    resp.extend(row)
-                                response_str = '|'.join(resp)
-                                send_msg(conn, response_str)
-                            except Exception as e:
-                                print(f"获取私聊历史出错: {e}")
-                                send_msg(conn, 'PRIVATE_HISTORY|error|获取历史记录失败')
-                    elif cmd == 'FILE_UPLOAD_START':
-                        # 新的文件上传处理
-                        from_user = parts[1]
-                        to_user = parts[2]
-                        fname = parts[3]
-                        file_size = int(parts[4])
-                        total_chunks = int(parts[5])
-                        handle_file_upload(conn, from_user, to_user, fname, file_size, total_chunks)
-
-                    elif cmd == 'FILE_DOWNLOAD_START':
-                        # 新的文件下载处理
-                        from_user = parts[1]
-                        to_user = parts[2]
-                        fname = parts[3]
-                        handle_file_download(conn, from_user, to_user, fname)
-
-                    elif cmd == 'FILE_LIST':
-                        # FILE_LIST|from_user|to_user
-                        _, from_user, to_user = parts
-                        user_dir = get_user_file_dir(from_user, to_user)
-                        if os.path.exists(user_dir):
-                            files = os.listdir(user_dir)
-                        else:
-                            files = []
-                        send_msg(conn, 'FILE_LIST|' + '|'.join(files))
-                    elif cmd == 'PING':
-                        # 响应客户端的PING请求以保持连接
-                        send_msg(conn, 'PONG')
-                    else:
-                        print(f"未知命令: {cmd}, 完整数据: {repr(data[:100])}...")
-                        send_msg(conn, f'ERROR|Unknown command: {cmd}')
-            except Exception as e:
-                print(f"处理客户端 {addr} 命令出错: {e}")
-                continue
+                if not dispatch_command(conn, addr, data, session, blob):
+                    return
+                if conn.protocol == PROTOCOL_V2 and isinstance(decoder, LineDecoder):
+                    # 协商完成，缓冲区剩余数据已经是 v2 帧
+                    decoder = FrameDecoder(decoder.take_remaining())
+    except ProtocolError as e:
+        log.warning('协议错误', addr=addr, error=e)
     except Exception as e:
-        print(f"客户端处理总体错误: {e}")
+        log.exception('连接处理出错', addr=addr)
     finally:
-        if username:
-            with lock:
-                if username in clients:
-                    del clients[username]
-# Voice call cleanup removed - using voice messages instead
-            notify_friends_status(username, False)
-        try:
-            conn.close()
-        except:
-            pass
-        print(f'连接 {addr} 已关闭')
-
-
-def start_server():
-    global file_transfer_server
-
-    print(f'Server listening on {HOST}:{PORT} (TCP) - Voice messages enabled')
-
-    # 启动文件传输服务器
-    file_transfer_server = FileTransferServer(HOST, FILE_PORT)
-    file_transfer_server.start()
+        cleanup_client(conn, addr, session)
+        conn.wait_closed()
+
+
+def cleanup_client(conn, addr, session):
+    """连接断开后的清理：移除在线状态并通知好友"""
+    username = session.get('username')
+    if username:
+        # 只移除属于本连接的登记，避免误删重新登录后的新连接
+        if clients.unregister(username, conn):
+            if bus is not None:
+                bus.announce_offline(username)
+            set_presence(username, False)
+    try:
+        conn.close()
+    except:
+        pass
+    if open_connections.pop(conn, None) is not None:
+        closed_connection_bytes['received'] += conn.bytes_received
+        closed_connection_bytes['sent'] += conn.bytes_sent
+    log.info('连接已关闭', addr=addr, user=username, sample='conn_closed')
+
+
+
+def report_lock_stats(interval):
+    """定期打印各锁的等待时间，用于在多客户端负载下确认锁竞争情况"""
+    while True:
+        time.sleep(interval)
+        log.info('\n  '.join([f'锁等待统计（在线 {len(clients)}）:'] + format_lock_stats()))
+
+
+def start_server(mode='thread'):
+    """启动聊天服务器
+
+    mode: 'thread' 每个连接一个线程；'asyncio' 所有连接共用一个事件循环
+    分片模式下每个工作进程各自调用，共享 SO_REUSEPORT 监听端口
+    """
+    global file_transfer_server, presence, bus, metrics_server
+    sharded = WORKER_ID is not None
+
+    presence = PresenceService(friendship_index.friends_of, online_connections, send_msg,
+                               PRESENCE_TICK, PRESENCE_DEBOUNCE, forward=forward_presence if sharded else None)
+    presence.start()
+    if LOCK_STATS_INTERVAL > 0:
+        threading.Thread(target=report_lock_stats, args=(LOCK_STATS_INTERVAL,), daemon=True).start()
+    if METRICS_PORT > 0:
+        metrics_port = METRICS_PORT + (WORKER_ID or 0)
+        metrics_server = MetricsServer(METRICS_HOST, metrics_port)
+        metrics_server.start()
+        log.info('运行指标', url=f'http://{METRICS_HOST}:{metrics_port}/metrics')
+    if sharded:
+        bus = MessageBus(WORKER_ID, WORKERS, PORT, handle_bus_event, local_usernames)
+        bus.start()
+        if not bus.wait_ready():
+            log.warning('消息总线: 等待其他工作进程超时，部分跨进程消息可能丢失')
+        log.info('工作进程已启动', worker=WORKER_ID, workers=WORKERS, pid=os.getpid())
+
+    log.info('聊天服务器开始监听', host=HOST, port=PORT, mode=mode)
+
+    # 启动文件传输服务器，分片模式下只由 0 号工作进程负责
+    if not sharded or WORKER_ID == 0:
+        file_transfer_server = FileTransferServer(HOST, FILE_PORT)
+        file_transfer_server.start()
+
+    if mode == 'asyncio':
+        async_server.run(HOST, PORT, run_command, cleanup_client, LISTEN_BACKLOG,
+                         OUTBOUND_QUEUE_MAX_BYTES, OUTBOUND_QUEUE_POLICY, PASSWORD_COMMANDS, reuse_port=sharded,
+                         on_connect=open_client)
+        return
 
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if sharded:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         s.bind((HOST, PORT))
-        s.listen()
+        s.listen(LISTEN_BACKLOG)
         while True:
             try:
-                conn, addr = s.accept()
+                sock, addr = s.accept()
+                conn = OutboundConnection(sock, OUTBOUND_QUEUE_MAX_MESSAGES, OUTBOUND_QUEUE_MAX_BYTES,
+                                          OUTBOUND_QUEUE_POLICY)
                 threading.Thread(target=handle_client, args=(conn, addr), daemon=True).start()
             except Exception as e:
-                print(f"接受连接错误: {e}")
+                log.error('接受连接错误', error=e)
                 time.sleep(1)  # 避免CPU空转
 
 
-def get_next_group_id():
-    max_id = 0
-    with open(GROUP_CSV, 'r', newline='', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            try:
-                gid = int(row['group_id'])
-                if gid > max_id:
-                    max_id = gid
-            except Exception:
-                continue
-    return str(max_id + 1)
+def toggle_debug_logging():
+    """kill -USR1 <pid>：在 DEBUG 和启动时的日志级别之间切换，排查问题时不用重启服务器"""
+    level = LOG_LEVEL if logs.get_level() == 'DEBUG' else 'DEBUG'
+    logs.set_level(level)
+    log.warning('日志级别已切换', level=level)
+
+
+def shutdown_server():
+    """正常关闭：停止后台服务，把延迟写入的聊天记录全部写入磁盘"""
+    if presence is not None:
+        presence.stop()
+    if metrics_server is not None:
+        metrics_server.stop()
+    if file_transfer_server is not None:
+        file_transfer_server.stop()
+    if bus is not None:
+        bus.stop()
+    if storage is not None:
+        storage.close()
+        log.info('服务器已关闭，聊天记录已写入磁盘')
+    if password_service is not None:
+        password_service.shutdown()
+    logs.shutdown()
 
 
 def create_group(group_name):
-    with lock:
-        with open(GROUP_CSV, 'r', newline='', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                if row['group_name'] == group_name:
-                    return False, 'Group name exists.', row['group_id']
-        group_id = get_next_group_id()
-        with open(GROUP_CSV, 'a', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerow([group_id, group_name])
+    created, group_id = group_index.create(group_name)
+    if not created:
+        return False, 'Group name exists.', group_id
+    publish(['group', group_id, group_name])
     return True, 'Group created.', group_id
 
 
 def join_group(group_id, username):
-    with lock:
-        # 检查是否已在群中
-        found = False
-        with open(GROUP_MEMBERS_CSV, 'r', newline='', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                if row['group_id'] == group_id and row['username'] == username:
-                    found = True
-                    break
-        if not found:
-            with open(GROUP_MEMBERS_CSV, 'a', newline='', encoding='utf-8') as f:
-                writer = csv.writer(f)
-                writer.writerow([group_id, username])
+    # 已在群中时不重复写入
+    if group_index.join(group_id, username):
+        publish(['group_member', group_id, username])
     return True, 'Joined group.'
 
 
 def get_user_groups(username):
-    group_ids = set()
-    with open(GROUP_MEMBERS_CSV, 'r', newline='', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            if row['username'] == username:
-                group_ids.add(row['group_id'])
-    groups = []
-    with open(GROUP_CSV, 'r', newline='', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            if row['group_id'] in group_ids:
-                groups.append((row['group_id'], row['group_name']))
-    return groups
+    return group_index.groups_of(username)
 
 
 def get_group_members(group_id):
-    group_id = str(int(group_id))  # 统一格式，去除前导零
-    members = []
-    with open(GROUP_MEMBERS_CSV, 'r', newline='', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            if str(int(row['group_id'])) == group_id:
-                members.append(row['username'])
-    return members
+    return list(group_index.members(group_id))
+
+
+def group_history_log(group_id):
+    """群聊消息日志，csv 存储首次打开时导入旧版 group_<id>_history.csv"""
+    gid = normalize_group_id(group_id)
+    return storage.history_log(f'group_{gid}')
+
+
+def private_history_log(user1, user2):
+    """私聊消息日志，csv 存储首次打开时导入旧版 private_<a>_<b>_history.csv"""
+    # 使用字典序排序确保两个用户之间的消息保存在同一个会话中
+    users = sorted([user1, user2])
+    return storage.history_log(f'private_{users[0]}_{users[1]}', import_row=externalize_voice_row)
+
+
+def externalize_voice_row(row):
+    """导入旧版 CSV 时把内嵌的语音移出聊天记录，消息内容总是每行最后一个字段"""
+    return row[:-1] + [externalize_voice(row[-1], voice_blobs)] if row else row
 
 
 def save_group_message(group_id, sender, msg, anon_nick=None):
-    fname = f'group_{group_id}_history.csv'
-    with open(fname, 'a', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        if anon_nick:
-            writer.writerow(['anon', anon_nick, msg])
-        else:
-            writer.writerow(['user', sender, msg])
+    if anon_nick:
+        group_history_log(group_id).append(['anon', anon_nick, msg])
+    else:
+        group_history_log(group_id).append(['user', sender, msg])
 
 
 def get_group_history(group_id):
-    fname = f'group_{group_id}_history.csv'
-    if not os.path.exists(fname):
-        return []
-    history = []
-    with open(fname, 'r', newline='', encoding='utf-8') as f:
-        reader = csv.reader(f)
-        for row in reader:
-            history.append(row)
-    return history
+    return [fields for _, _, fields in group_history_log(group_id).read_all()]
+
+
+def parse_history_page_args(before, limit):
+    """解析分页参数，返回 (before_id, limit)，before_id 为 0 表示从最新消息开始"""
+    try:
+        before_id = int(before) if before else 0
+    except ValueError:
+        before_id = 0
+    try:
+        limit = int(limit) if limit else HISTORY_PAGE_SIZE
+    except ValueError:
+        limit = HISTORY_PAGE_SIZE
+    return max(0, before_id), max(1, min(limit, HISTORY_PAGE_MAX))
+
+
+def read_history_page(log, before_id, limit):
+    """读取一页历史记录，返回 (记录列表, 游标, 是否还有更早的消息)
+
+    游标是本页最早一条消息的ID，客户端下次以它作为 before_id 获取更早的一页
+    """
+    records = log.read_before(before_id, limit) if before_id else log.read_last(limit)
+    cursor = records[0][0] if records else 0
+    return records, cursor, bool(records) and cursor > log.first_id
 
 
 def save_private_message(sender, receiver, msg):
     """保存私聊消息历史"""
-    # 使用字典序排序确保两个用户之间的消息保存在同一个文件中
-    users = sorted([sender, receiver])
-    fname = f'private_{users[0]}_{users[1]}_history.csv'
-    with open(fname, 'a', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        writer.writerow([sender, msg])
+    private_history_log(sender, receiver).append([sender, msg])
 
 
 def get_private_history(user1, user2):
     """获取两个用户之间的私聊历史记录"""
-    users = sorted([user1, user2])
-    fname = f'private_{users[0]}_{users[1]}_history.csv'
-    if not os.path.exists(fname):
-        return []
-    history = []
-    with open(fname, 'r', newline='', encoding='utf-8') as f:
-        reader = csv.reader(f)
-        for row in reader:
-            history.append(row)
-    return history
+    return [fields for _, _, fields in private_history_log(user1, user2).read_all()]
 
 
 # 文件传输服务
+def send_file_body(sock, f, offset, length, filename):
+    """用 sendfile 把 f 中从 offset 开始的 length 字节发送到 sock，返回实际发送的字节数
+
+    每次 sendfile 后累加下载字节数，大文件下载过程中也能从指标看到当前吞吐量
+    """
+    sent = 0
+    last_report = time.monotonic()
+    while sent < length:
+        count = sock.sendfile(f, offset + sent, min(SENDFILE_CHUNK, length - sent))
+        if count == 0:
+            break  # 文件比预期短
+        sent += count
+        file_bytes.inc('download', amount=count)
+        now = time.monotonic()
+        if now - last_report >= DOWNLOAD_PROGRESS_INTERVAL:
+            last_report = now
+            log.debug('文件下载进度', file=filename, sent=sent, size=length)
+    return sent
+
+
+def linger_close(sock):
+    """半关闭后读完对方发来的数据，等对方关闭连接或超时"""
+    try:
+        sock.shutdown(socket.SHUT_WR)
+        sock.settimeout(LINGER_TIMEOUT)
+        while sock.recv(65536):
+            pass
+    except OSError:
+        pass
+
+
 class FileTransferServer:
     def __init__(self, host, port):
         self.host = host
@@ -753,14 +1040,36 @@ class FileTransferServer:
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.socket.bind((host, port))
-        self.socket.listen(5)
+        self.socket.listen(LISTEN_BACKLOG)  # 分块上传时每个客户端同时建立多个连接
         self.running = True
+        self.active_connections = set()  # 正在处理的连接，用于运行指标
+        conversations, files = file_store.load()
+        log.info('文件存储已加载', conversations=conversations, files=files, blobs=file_store.stats()[1])
+        # 未完成的分块上传，清理很久没有继续的
+        self.uploads = FileTransfer(UPLOAD_DIR)
+        removed = self.uploads.cleanup_stale()
+        if removed:
+            log.info('已清理过期的未完成上传', count=removed)
         self.thread = threading.Thread(target=self.run)
         self.thread.daemon = True
-        print(f"文件传输服务器开始监听 {host}:{port}")
+        self.reaper = threading.Thread(target=self.reap_uploads, daemon=True)
+        log.info('文件传输服务器开始监听', host=host, port=port)
 
     def start(self):
         self.thread.start()
+        self.reaper.start()
+
+    def reap_uploads(self):
+        """定期关闭客户端中途放弃的分块上传打开的文件，删除过期的未完成上传"""
+        while self.running:
+            time.sleep(UPLOAD_REAP_INTERVAL)
+            try:
+                closed = self.uploads.expire_idle()
+                removed = self.uploads.cleanup_stale()
+                if closed or removed:
+                    log.info('已清理空闲的分块上传', closed=closed, removed=removed)
+            except Exception as e:
+                log.warning('清理分块上传出错', error=e)
 
     def run(self):
         while self.running:
@@ -773,14 +1082,20 @@ class FileTransferServer:
                 client_handler.daemon = True
                 client_handler.start()
             except Exception as e:
-                print(f"接受文件传输连接错误: {e}")
+                log.error('接受文件传输连接错误', error=e)
                 time.sleep(1)  # 避免CPU空转
 
     def handle_client(self, client_socket, addr):
-        print(f"新文件传输连接: {addr}")
+        log.debug('新文件传输连接', addr=addr)
+        self.active_connections.add(client_socket)
         try:
             # 接收登录凭证和请求类型
-            auth_data = client_socket.recv(1024).decode('utf-8')
+            data = client_socket.recv(1024)
+            if data.startswith(b'UPLOAD_'):
+                # 分块上传的请求以换行结束，后面可能紧跟块数据，不能整体解码
+                self.handle_chunked_upload(client_socket, data)
+                return
+            auth_data = data.decode('utf-8')
             parts = auth_data.split('|')
             if len(parts) < 3:
                 client_socket.send('ERROR|Invalid request format'.encode('utf-8'))
@@ -810,7 +1125,7 @@ class FileTransferServer:
                 self.handle_upload(client_socket, username, to_user, filename, filesize)
 
             elif request_type == 'DOWNLOAD':
-                # DOWNLOAD|username|from_user|filename
+                # DOWNLOAD|username|from_user|filename[|offset|length] 带范围时只发送文件的一段
                 if len(parts) < 4:
                     client_socket.send('ERROR|Invalid download request'.encode('utf-8'))
                     client_socket.close()
@@ -825,61 +1140,159 @@ class FileTransferServer:
                     client_socket.close()
                     return
 
-                self.handle_download(client_socket, username, from_user, filename)
+                if len(parts) >= 6:
+                    self.handle_download(client_socket, username, from_user, filename, int(parts[4]), int(parts[5]))
+                else:
+                    self.handle_download(client_socket, username, from_user, filename)
+
+            elif request_type == 'DELETE':
+                # DELETE|username|other_user|filename 从两人的会话中删除文件，内容没有其他引用时释放空间
+                if len(parts) < 4:
+                    client_socket.send('ERROR|Invalid delete request'.encode('utf-8'))
+                elif not self.is_friend(username, parts[2]):
+                    # 与上传、下载一样只允许在好友之间的会话中删除
+                    client_socket.send('ERROR|Not friends'.encode('utf-8'))
+                elif file_store.remove(username, parts[2], parts[3]):
+                    log.info('文件已删除', file=parts[3], user=username, peer=parts[2])
+                    client_socket.send('DELETED'.encode('utf-8'))
+                else:
+                    client_socket.send(f'ERROR|File not found: {parts[3]}'.encode('utf-8'))
+                client_socket.close()
 
             else:
                 client_socket.send('ERROR|Unknown request type'.encode('utf-8'))
                 client_socket.close()
 
         except Exception as e:
-            print(f"文件传输处理错误: {e}")
+            log.warning('文件传输处理错误', addr=addr, error=e)
             try:
                 client_socket.send(f'ERROR|{str(e)}'.encode('utf-8'))
             except:
                 pass
             finally:
                 client_socket.close()
+        finally:
+            self.active_connections.discard(client_socket)
 
     def is_friend(self, user1, user2):
         """检查两个用户是否是好友"""
+        return is_friend(user1, user2)
+
+    def handle_chunked_upload(self, client_socket, initial):
+        """处理分块上传连接，一个连接上可以有多个请求，直到客户端关闭（协议见 uploads.py）"""
+        reader = SocketReader(client_socket, initial)
         try:
-            with open(FRIENDSHIP_CSV, 'r', newline='', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    if (row['user_a'] == user1 and row['user_b'] == user2) or \
-                            (row['user_a'] == user2 and row['user_b'] == user1):
-                        return True
-            return False
-        except Exception as e:
-            print(f"检查好友关系错误: {e}")
-            return False
+            while True:
+                line = reader.readline()
+                if line is None:
+                    break
+                parts = line.decode('utf-8').split('|')
+                if parts[0] == 'UPLOAD_INIT':
+                    reply = self.upload_init(parts)
+                elif parts[0] == 'UPLOAD_CHUNK':
+                    reply = self.upload_chunk(parts, reader)
+                elif parts[0] == 'UPLOAD_FINISH':
+                    reply = self.upload_finish(parts)
+                else:
+                    reply = 'ERROR|Unknown request type'
+                client_socket.sendall(f'{reply}\n'.encode('utf-8'))
+        except (OSError, ValueError, IndexError) as e:
+            # 请求格式错误时无法确定块数据的边界，只能断开，客户端重连后按位图继续
+            log.info('分块上传连接出错', error=e)
+        finally:
+            client_socket.close()
+
+    def upload_init(self, parts):
+        # UPLOAD_INIT|username|to_user|filename|filesize|sha256|chunk_size
+        if len(parts) < 7:
+            return 'ERROR|Invalid upload request'
+        username, to_user = parts[1], parts[2]
+        filename = os.path.basename(parts[3])
+        filesize, file_hash, chunk_size = int(parts[4]), parts[5], int(parts[6])
+        if not filename or filesize < 0 or not is_valid_hash(file_hash):
+            return 'ERROR|Invalid upload request'
+        if not self.is_friend(username, to_user):
+            return 'ERROR|Not friends'
+        if file_store.has_content(file_hash, filesize):
+            # 服务器已有相同内容（发给过其他好友、或重复上传），直接登记，不传输数据
+            saved = file_store.add(username, to_user, filename, file_hash, filesize)
+            if saved is not None:
+                log.info('文件上传成功（已有相同内容）', file=saved, size=filesize, from_user=username, to_user=to_user)
+                file_transfers.inc('upload', 'dedup')
+                return f'ALREADY_HAVE|{saved}'
+        session = self.uploads.open(username, to_user, filename, filesize, file_hash, chunk_size)
+        log.info('分块上传', file=filename, from_user=username, to_user=to_user,
+                 received=session.received_chunks(), chunks=session.total_chunks)
+        return f'UPLOAD_STATE|{session.upload_id}|{session.chunk_size}|{session.total_chunks}|{session.bitmap_hex()}'
+
+    def upload_chunk(self, parts, reader):
+        # UPLOAD_CHUNK|username|upload_id|chunk_id|length|crc32，后面紧跟块数据
+        username, upload_id, chunk_id, length, checksum = parts[1], parts[2], int(parts[3]), int(parts[4]), parts[5]
+        if not 0 < length <= FileTransfer.MAX_CHUNK_SIZE:
+            raise ValueError(f'块长度无效: {length}')
+        start = time.perf_counter()
+        data = reader.read_exact(length)
+        file_bytes.inc('upload', amount=length)
+        file_transfer_duration.observe(time.perf_counter() - start, 'upload_chunk')
+        session = self.uploads.get(upload_id)
+        if session is None or session.from_user != username:
+            return f'CHUNK_ERROR|{chunk_id}|Unknown upload'
+        if not 0 <= chunk_id < session.total_chunks or length != session.chunk_length(chunk_id):
+            return f'CHUNK_ERROR|{chunk_id}|Invalid chunk'
+        if chunk_checksum(data) != checksum:
+            return f'CHUNK_ERROR|{chunk_id}|Checksum mismatch'
+        if not session.write_chunk(chunk_id, data):
+            if session.result is not None:
+                return f'CHUNK_ERROR|{chunk_id}|Upload finished'
+            # 刚因空闲超时被关闭，从磁盘重新加载后写入
+            session = self.uploads.get(upload_id)
+            if session is None or not session.write_chunk(chunk_id, data):
+                return f'CHUNK_ERROR|{chunk_id}|Upload finished'
+        return f'CHUNK_OK|{chunk_id}'
+
+    def upload_finish(self, parts):
+        # UPLOAD_FINISH|username|upload_id
+        if len(parts) < 3:
+            return 'ERROR|Invalid finish request'
+        session = self.uploads.get(parts[2])
+        if session is None or session.from_user != parts[1]:
+            return 'ERROR|Unknown upload'
+        if not session.is_complete():
+            return f'MISSING|{session.bitmap_hex()}'
+        status, filename = self.uploads.finish(session, lambda part_path: file_store.add(
+            session.from_user, session.to_user, session.filename, session.file_hash, session.filesize, part_path))
+        if status == FINISH_ALREADY:
+            # 客户端重试或多个连接同时结束，上传已经保存过
+            log.debug('重复的上传完成请求', file=filename, from_user=session.from_user)
+            return f'SUCCESS|{filename}'
+        if status == FINISH_HASH_MISMATCH:
+            log.warning('分块上传校验失败，已丢弃', file=session.filename, from_user=session.from_user)
+            file_transfers.inc('upload', 'hash_mismatch')
+            return 'ERROR|Hash mismatch'
+        log.info('文件上传成功', file=filename, size=session.filesize, from_user=session.from_user, to_user=session.to_user)
+        file_transfers.inc('upload', 'ok')
+        return f'SUCCESS|{filename}'
 
     def handle_upload(self, client_socket, from_user, to_user, filename, filesize):
         """处理文件上传"""
         file_path = None
+        received = 0
+        start = time.perf_counter()
         try:
-            # 获取存储目录
-            file_dir = get_user_file_dir(from_user, to_user)
-            file_path = os.path.join(file_dir, filename)
-
-            # 检查文件是否已存在，如果存在则添加时间戳
-            if os.path.exists(file_path):
-                base, ext = os.path.splitext(filename)
-                timestamp = int(time.time())
-                filename = f"{base}_{timestamp}{ext}"
-                file_path = os.path.join(file_dir, filename)
-
+            filename = os.path.basename(filename)
             # 通知客户端准备好接收
             client_socket.send(f'READY|{filename}'.encode('utf-8'))
 
-            # 接收文件数据
-            received = 0
-            with open(file_path, 'wb') as f:
+            # 接收文件数据，先写入临时文件，边收边计算 SHA-256，收完后移入文件存储
+            digest = hashlib.sha256()
+            fd, file_path = tempfile.mkstemp(dir=UPLOAD_DIR, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
                 while received < filesize:
                     chunk = client_socket.recv(min(8192, filesize - received))
                     if not chunk:
                         raise Exception("Connection closed during upload")
                     f.write(chunk)
+                    digest.update(chunk)
                     received += len(chunk)
                     # 发送进度更新
                     if received % (1024 * 1024) == 0 or received == filesize:  # 每1MB或完成时更新
@@ -889,12 +1302,18 @@ class FileTransferServer:
                         except:
                             pass
 
+            filename = file_store.add(from_user, to_user, filename, digest.hexdigest(), filesize, file_path)
+            file_path = None
+
             # 发送成功消息
             client_socket.send('SUCCESS'.encode('utf-8'))
-            print(f"文件上传成功: {filename}, 大小: {filesize}字节, 从 {from_user} 到 {to_user}")
+            log.info('文件上传成功', file=filename, size=filesize, from_user=from_user, to_user=to_user)
+            file_transfers.inc('upload', 'ok')
+            file_transfer_duration.observe(time.perf_counter() - start, 'upload')
 
         except Exception as e:
-            print(f"文件上传错误: {e}")
+            log.warning('文件上传错误', file=filename, from_user=from_user, error=e)
+            file_transfers.inc('upload', 'error')
             try:
                 client_socket.send(f'ERROR|{str(e)}'.encode('utf-8'))
             except:
@@ -906,61 +1325,56 @@ class FileTransferServer:
                 except:
                     pass
         finally:
+            file_bytes.inc('upload', amount=received)
             client_socket.close()
 
-    def handle_download(self, client_socket, username, from_user, filename):
-        """处理文件下载"""
-        try:
-            # 获取文件路径
-            file_dir = get_user_file_dir(from_user, username)
-            file_path = os.path.join(file_dir, filename)
+    def handle_download(self, client_socket, username, from_user, filename, offset=None, length=None):
+        """处理文件下载
 
-            if not os.path.exists(file_path):
+        不带范围时回复 READY|文件大小，之后发送整个文件；
+        带范围时回复 READY|文件大小|偏移|长度|SHA-256，之后只发送这一段（长度按文件末尾截断），
+        长度为 0 时只返回文件信息，客户端据此把大文件分成多段并行下载。
+        """
+        start = time.perf_counter()
+        try:
+            # 从会话清单找到文件内容
+            found = file_store.lookup(from_user, username, filename)
+            if found is None:
+                file_transfers.inc('download', 'not_found')
                 client_socket.send(f'ERROR|File not found: {filename}'.encode('utf-8'))
                 client_socket.close()
                 return
+            file_path, filesize, file_hash = found
 
-            # 获取文件大小
-            filesize = os.path.getsize(file_path)
-
-            # 发送准备就绪消息
-            client_socket.send(f'READY|{filesize}'.encode('utf-8'))
+            # 发送准备就绪消息，换行结束，客户端据此区分消息头和紧随其后的文件内容
+            # （旧版客户端用 int() 解析文件大小，会忽略结尾的换行）
+            if offset is None:
+                offset, length = 0, filesize
+                client_socket.send(f'READY|{filesize}\n'.encode('utf-8'))
+            else:
+                if offset < 0 or length < 0 or offset > filesize:
+                    client_socket.send(f'ERROR|Invalid range: {offset}+{length}'.encode('utf-8'))
+                    return
+                length = min(length, filesize - offset)
+                client_socket.send(f'READY|{filesize}|{offset}|{length}|{file_hash}\n'.encode('utf-8'))
 
-            # 发送文件数据
-            sent = 0
+            # 文件内容用 sendfile 直接从页缓存发送到套接字（不支持的平台上 socket.sendfile 自动退回 send），
+            # 不再每 1MB 停下来等客户端 ACK；进度只在服务器端按时间间隔打印，不阻塞发送
             with open(file_path, 'rb') as f:
-                while sent < filesize:
-                    # 读取并发送数据块
-                    chunk = f.read(8192)
-                    if not chunk:
-                        break
-                    client_socket.sendall(chunk)
-                    sent += len(chunk)
-                    # 每发送1MB数据或完成时检查客户端进度确认
-                    if sent % (1024 * 1024) == 0 or sent == filesize:
-                        try:
-                            # 设置短超时等待确认
-                            client_socket.settimeout(5)
-                            ack = client_socket.recv(1024).decode('utf-8')
-                            if ack.startswith('ACK'):
-                                progress = min(100, int(sent * 100 / filesize))
-                                print(f"文件下载进度: {progress}%, {sent}/{filesize}字节")
-                            else:
-                                print(f"意外的客户端响应: {ack}")
-                        except socket.timeout:
-                            # 不因超时中断传输
-                            print("等待客户端确认超时，继续传输")
-                        except Exception as e:
-                            print(f"检查客户端确认时出错: {e}")
-                            # 继续传输而不中断
-                        finally:
-                            # 恢复无超时
-                            client_socket.settimeout(None)
-
-            print(f"文件下载完成: {filename}, 大小: {filesize}字节, 发送给 {username}")
+                sent = send_file_body(client_socket, f, offset, length, filename)
+            if sent < length:
+                raise Exception(f"文件在发送过程中被截断: {sent}/{length}字节")
+            file_transfers.inc('download', 'ok')
+            file_transfer_duration.observe(time.perf_counter() - start, 'download')
+            # 旧版客户端仍会每 1MB 发送 ACK：先半关闭再读完对方发来的数据，
+            # 避免接收缓冲区中有未读数据时 close 发出 RST，导致客户端丢失尚未读取的文件尾部
+            linger_close(client_socket)
+            if length == filesize:
+                log.info('文件下载完成', file=filename, size=filesize, user=username)
 
         except Exception as e:
-            print(f"文件下载错误: {e}")
+            log.warning('文件下载错误', file=filename, user=username, error=e)
+            file_transfers.inc('download', 'error')
             try:
                 client_socket.send(f'ERROR|{str(e)}'.encode('utf-8'))
             except:
@@ -977,5 +1391,105 @@ class FileTransferServer:
             pass
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description='聊天服务器')
+    parser.add_argument('--mode', choices=SERVER_MODES, default='thread',
+                        help='连接处理模式：thread 每连接一个线程，asyncio 单事件循环')
+    parser.add_argument('--port', type=int, default=PORT, help='聊天端口')
+    parser.add_argument('--file-port', type=int, default=FILE_PORT, help='文件传输端口')
+    parser.add_argument('--queue-policy', choices=QUEUE_POLICIES, default=OUTBOUND_QUEUE_POLICY,
+                        help='发送队列已满时的策略')
+    parser.add_argument('--queue-max-messages', type=int, default=OUTBOUND_QUEUE_MAX_MESSAGES,
+                        help='每个连接发送队列的最大消息数')
+    parser.add_argument('--queue-max-bytes', type=int, default=OUTBOUND_QUEUE_MAX_BYTES,
+                        help='每个连接发送队列的最大字节数')
+    parser.add_argument('--storage', choices=STORAGE_BACKENDS, default=STORAGE_BACKEND,
+                        help='持久化存储类型')
+    parser.add_argument('--sqlite-path', default=SQLITE_PATH, help='sqlite 存储的数据库文件')
+    parser.add_argument('--history-commit-interval', type=float, default=HISTORY_COMMIT_INTERVAL,
+                        help='csv 存储的聊天记录组提交间隔（秒），0 表示每条消息直接写入')
+    parser.add_argument('--history-commit-batch', type=int, default=HISTORY_COMMIT_BATCH,
+                        help='排队的聊天记录达到多少条时立即提交')
+    parser.add_argument('--password-hasher', choices=HASHER_CHOICES, default=PASSWORD_HASHER,
+                        help='新密码使用的哈希算法')
+    parser.add_argument('--password-workers', type=int, default=PASSWORD_WORKERS,
+                        help='同时计算密码哈希的线程数上限')
+    parser.add_argument('--lock-stats-interval', type=float, default=LOCK_STATS_INTERVAL,
+                        help='每隔多少秒打印锁等待统计，0 表示不打印')
+    parser.add_argument('--log-level', choices=logs.LOG_LEVELS, default=LOG_LEVEL,
+                        help='日志级别，DEBUG 记录每条命令')
+    parser.add_argument('--log-file', default=LOG_FILE, help='同时写入的日志文件，按大小轮转')
+    parser.add_argument('--log-format', choices=logs.LOG_FORMATS, default=LOG_FORMAT, help='日志格式')
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help='大于 0 时在本机该端口提供 Prometheus 格式的运行指标 /metrics，分片模式下每个工作进程依次加 1')
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='工作进程数，大于 1 时多个进程共享监听端口，需要 --storage sqlite')
+    parser.add_argument('--worker-id', type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.workers > 1:
+        if args.storage != 'sqlite':
+            parser.error('多进程模式下各进程需要共享同一个数据库，请使用 --storage sqlite')
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            parser.error('当前系统不支持 SO_REUSEPORT，无法使用多进程模式')
+    return args
+
+
+def run_workers(workers):
+    """分片模式的父进程：启动工作进程并等待，任一工作进程退出时结束全部"""
+    # 先建好数据库表，避免多个工作进程同时初始化
+    open_storage('sqlite', history_dir=HISTORY_DIR, sqlite_path=SQLITE_PATH).close()
+    procs = [subprocess.Popen([sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + ['--worker-id', str(i)])
+             for i in range(workers)]
+    log.info('已启动工作进程', workers=workers, port=PORT)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while all(p.poll() is None for p in procs):
+            time.sleep(0.5)
+        log.warning('有工作进程退出，关闭全部工作进程')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for p in procs:
+            if p.poll() is None:
+                p.terminate()
+        for p in procs:
+            try:
+                p.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                p.kill()
+
+
 if __name__ == '__main__':
-    start_server() 
\ No newline at end of file
+    args = parse_args()
+    PORT = args.port
+    FILE_PORT = args.file_port
+    OUTBOUND_QUEUE_POLICY = args.queue_policy
+    OUTBOUND_QUEUE_MAX_MESSAGES = args.queue_max_messages
+    OUTBOUND_QUEUE_MAX_BYTES = args.queue_max_bytes
+    SQLITE_PATH = args.sqlite_path
+    HISTORY_COMMIT_INTERVAL = args.history_commit_interval
+    HISTORY_COMMIT_BATCH = args.history_commit_batch
+    LOCK_STATS_INTERVAL = args.lock_stats_interval
+    METRICS_PORT = args.metrics_port
+    LOG_LEVEL, LOG_FILE, LOG_FORMAT = args.log_level, args.log_file, args.log_format
+    if args.worker_id is not None:
+        logs.setup(LOG_LEVEL, LOG_FILE and f'{LOG_FILE}.{args.worker_id}', LOG_FORMAT, tag=f'w{args.worker_id}')
+    else:
+        logs.setup(LOG_LEVEL, LOG_FILE, LOG_FORMAT)
+    if args.workers > 1 and args.worker_id is None:
+        run_workers(args.workers)
+        sys.exit(0)
+    WORKERS = args.workers
+    WORKER_ID = args.worker_id
+    init_storage(args.storage)
+    password_service = PasswordService(args.password_hasher, args.password_workers)
+    # SIGTERM 与 Ctrl+C 一样走正常关闭流程，排队中的聊天记录不会丢失
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: toggle_debug_logging())
+    try:
+        start_server(args.mode)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shutdown_server()
@@ -0,0 +1,435 @@
+"""按会话分段的追加式消息日志
+
+每个会话（私聊或群聊）一个目录，消息按顺序追加到段文件中：
+    <第一条消息ID，20位补零>.log  二进制记录，逐条追加
+    <第一条消息ID，20位补零>.idx  稠密偏移索引，第 i 项是该段第 i 条消息在 .log 中的偏移
+段文件超过 SEGMENT_MAX_BYTES 后新建下一段。消息ID在会话内从 1 开始连续递增，
+因此“最后 N 条”和“ID X 之前的消息”只需在索引中定位偏移后一次 seek 读取，不用扫描整个会话。
+
+记录格式：
+    长度(I) | 消息ID(Q) | 时间戳(d) | 字段数(H) | 每个字段: 长度(I) + UTF-8 内容
+
+写入方式（MessageLogStore 的 commit_interval）：
+    0     直写：每次追加都打开、写入、关闭段文件，不 fsync
+    > 0   延迟写入 + 组提交：追加只在内存中分配消息ID并排队，后台线程每 commit_interval 秒
+          或排队消息达到 commit_batch 条时，把所有会话的排队记录一次性写入（段文件句柄保持打开）并 fsync。
+          读取会先把本会话的排队记录写入文件，总能读到刚追加的消息；进程崩溃最多丢失最近一次提交之后的消息，
+          正常关闭（close）会写入全部排队记录。
+"""
+import bisect
+import collections
+import csv
+import os
+import shutil
+import struct
+import threading
+import time
+
+import logs
+from locks import StripedLock, TimedLock
+
+log = logs.get_logger('message_log')
+
+RECORD_LEN = struct.Struct('!I')
+RECORD_META = struct.Struct('!QdH')
+FIELD_LEN = struct.Struct('!I')
+INDEX_ENTRY = struct.Struct('!Q')
+
+LOG_SUFFIX = '.log'
+INDEX_SUFFIX = '.idx'
+SEGMENT_MAX_BYTES = 16 * 1024 * 1024
+COMMIT_INTERVAL = 0.2  # 秒，组提交的间隔
+COMMIT_BATCH = 1000  # 排队消息达到这么多条时立即提交
+MAX_OPEN_LOGS = 256  # 延迟写入模式下最多保持打开的会话数，超出时关闭最久未写入的
+# 旧版 CSV 中内嵌 base64 语音的单个字段可能远超 csv 模块默认的 128KB 上限
+CSV_FIELD_LIMIT = 64 * 1024 * 1024
+
+
+def encode_record(msg_id, timestamp, fields):
+    parts = [RECORD_META.pack(msg_id, timestamp, len(fields))]
+    for field in fields:
+        data = str(field).encode('utf-8')
+        parts.append(FIELD_LEN.pack(len(data)))
+        parts.append(data)
+    body = b''.join(parts)
+    return RECORD_LEN.pack(len(body)) + body
+
+
+def decode_record(body):
+    """解析去掉长度前缀的记录，返回 (消息ID, 时间戳, 字段列表)"""
+    msg_id, timestamp, count = RECORD_META.unpack_from(body)
+    pos = RECORD_META.size
+    fields = []
+    for _ in range(count):
+        (length,) = FIELD_LEN.unpack_from(body, pos)
+        pos += FIELD_LEN.size
+        fields.append(str(body[pos:pos + length], 'utf-8'))
+        pos += length
+    return msg_id, timestamp, fields
+
+
+def iter_records(data):
+    """依次解析一段连续的记录，遇到不完整的尾部记录时停止，产出 (记录结束偏移, 记录)"""
+    view = memoryview(data)
+    pos = 0
+    while pos + RECORD_LEN.size <= len(view):
+        (length,) = RECORD_LEN.unpack_from(view, pos)
+        end = pos + RECORD_LEN.size + length
+        if end > len(view):
+            break
+        yield end, decode_record(view[pos + RECORD_LEN.size:end])
+        pos = end
+
+
+class MessageLog:
+    """单个会话的消息日志，追加和读取都是线程安全的
+
+    每个会话有自己的写锁，不同会话的写入互不等待。
+    on_pending 不为 None 时为延迟写入模式：追加的记录先排队，由 on_pending(log, 条数) 通知提交线程，
+    之后由 sync 写入并 fsync；否则每次追加直接写入文件。
+    """
+
+    def __init__(self, directory, segment_max_bytes=SEGMENT_MAX_BYTES, on_pending=None):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.on_pending = on_pending
+        self._lock = TimedLock('history_log')
+        self._bases = []  # 各段第一条消息的ID，升序
+        self._next_id = 1
+        self._active_size = 0  # 最后一段 .log 的字节数，包括尚未写入的排队记录
+        self._pending = []  # [(偏移, 记录)] 已分配ID但尚未写入文件的记录
+        self._files = None  # 最后一段的 (.log, .idx) 文件，延迟写入模式下保持打开
+        self._dirty = False  # 已写入文件但尚未 fsync
+        self._load()
+
+    def _paths(self, base):
+        name = os.path.join(self.directory, f'{base:020d}')
+        return name + LOG_SUFFIX, name + INDEX_SUFFIX
+
+    def _load(self):
+        os.makedirs(self.directory, exist_ok=True)
+        bases = []
+        for fname in os.listdir(self.directory):
+            stem, ext = os.path.splitext(fname)
+            if ext == LOG_SUFFIX and stem.isdigit():
+                bases.append(int(stem))
+        bases.sort()
+        self._bases = bases
+        if not bases:
+            return
+        base = bases[-1]
+        count, size = self._recover_segment(base)
+        self._next_id = base + count
+        self._active_size = size
+
+    def _recover_segment(self, base):
+        """校验最后一段的索引，进程在写入中途退出时截掉不完整的记录并重建索引
+
+        返回 (该段消息数, .log 字节数)
+        """
+        log_path, idx_path = self._paths(base)
+        size = os.path.getsize(log_path)
+        count = os.path.getsize(idx_path) // INDEX_ENTRY.size if os.path.exists(idx_path) else 0
+        if count:
+            with open(idx_path, 'rb') as f:
+                f.seek((count - 1) * INDEX_ENTRY.size)
+                (offset,) = INDEX_ENTRY.unpack(f.read(INDEX_ENTRY.size))
+            with open(log_path, 'rb') as f:
+                f.seek(offset)
+                header = f.read(RECORD_LEN.size)
+            if len(header) == RECORD_LEN.size and offset + RECORD_LEN.size + RECORD_LEN.unpack(header)[0] == size:
+                if os.path.getsize(idx_path) != count * INDEX_ENTRY.size:
+                    os.truncate(idx_path, count * INDEX_ENTRY.size)
+                return count, size
+        elif size == 0:
+            open(idx_path, 'wb').close()
+            return 0, 0
+
+        with open(log_path, 'rb') as f:
+            data = f.read()
+        offsets = []
+        end = 0
+        for record_end, _ in iter_records(data):
+            offsets.append(end)
+            end = record_end
+        if end != size:
+            log.warning('消息日志尾部有不完整记录，已截断', path=log_path, bytes=size - end)
+            os.truncate(log_path, end)
+        with open(idx_path, 'wb') as f:
+            f.write(b''.join(INDEX_ENTRY.pack(o) for o in offsets))
+        return len(offsets), end
+
+    @property
+    def first_id(self):
+        return self._bases[0] if self._bases else 1
+
+    @property
+    def last_id(self):
+        """最后一条消息的ID，没有消息时为 0"""
+        return self._next_id - 1
+
+    def __len__(self):
+        return self._next_id - self.first_id
+
+    def append(self, fields, timestamp=None):
+        """追加一条消息，返回消息ID"""
+        return self.append_many([fields], timestamp)[-1]
+
+    def append_many(self, rows, timestamp=None):
+        """按顺序追加多条消息，返回消息ID列表"""
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            ids = []
+            for fields in rows:
+                if not self._bases or self._active_size >= self.segment_max_bytes:
+                    self._roll()
+                msg_id = self._next_id
+                record = encode_record(msg_id, timestamp, fields)
+                self._pending.append((self._active_size, record))
+                self._active_size += len(record)
+                self._next_id += 1
+                ids.append(msg_id)
+            if self.on_pending is None:
+                self._write_pending()
+                self._close_files(sync=False)
+        if self.on_pending is not None:
+            self.on_pending(self, len(rows))
+        return ids
+
+    def _write_pending(self):
+        """把排队的记录写入最后一段，调用方需持有 self._lock"""
+        if not self._pending:
+            return
+        if self._files is None:
+            log_path, idx_path = self._paths(self._bases[-1])
+            self._files = (open(log_path, 'ab'), open(idx_path, 'ab'))
+        log_file, idx_file = self._files
+        # 先写记录再写索引，中途退出时由 _recover_segment 修复
+        log_file.write(b''.join(record for _, record in self._pending))
+        log_file.flush()
+        idx_file.write(b''.join(INDEX_ENTRY.pack(offset) for offset, _ in self._pending))
+        idx_file.flush()
+        self._pending = []
+        self._dirty = True
+
+    def _close_files(self, sync=True):
+        """关闭最后一段的文件句柄，调用方需持有 self._lock"""
+        if self._files is None:
+            return
+        for f in self._files:
+            if sync and self._dirty:
+                os.fsync(f.fileno())
+            f.close()
+        self._files = None
+        self._dirty = False
+
+    def _roll(self):
+        if self._bases:
+            self._write_pending()
+            self._close_files(sync=self.on_pending is not None)
+        base = self._next_id
+        log_path, idx_path = self._paths(base)
+        open(log_path, 'ab').close()
+        open(idx_path, 'ab').close()
+        self._bases.append(base)
+        self._active_size = 0
+
+    def sync(self):
+        """写入排队的记录并 fsync，返回是否有数据落盘"""
+        with self._lock:
+            self._write_pending()
+            if not self._dirty:
+                return False
+            self._dirty = False
+            # 复制文件描述符：fsync 期间 _roll 或 close 关闭原文件时，复制的描述符仍指向同一个文件，
+            # 不会失败，也不会碰到被其他文件重新使用的描述符号
+            fds = [os.dup(f.fileno()) for f in self._files]
+        # fsync 不持有锁，期间其他线程可以继续追加
+        synced = True
+        for fd in fds:
+            try:
+                os.fsync(fd)
+            except OSError:
+                synced = False
+            finally:
+                os.close(fd)
+        if not synced:
+            with self._lock:
+                self._dirty = True  # 下次提交时重试
+        return synced
+
+    def close(self):
+        """写入排队的记录、fsync 并关闭文件句柄，之后仍可继续追加（会重新打开文件）"""
+        with self._lock:
+            self._write_pending()
+            self._close_files()
+
+    def read(self, start_id, end_id):
+        """读取ID在 [start_id, end_id) 内的消息，返回 [(消息ID, 时间戳, 字段列表)]"""
+        with self._lock:
+            # 排队中的记录先写入文件（不 fsync），刚追加的消息也能读到
+            self._write_pending()
+            bases = list(self._bases)
+            next_id = self._next_id
+            active_size = self._active_size
+        start_id = max(start_id, bases[0] if bases else 1)
+        end_id = min(end_id, next_id)
+        records = []
+        if start_id >= end_id:
+            return records
+
+        i = bisect.bisect_right(bases, start_id) - 1
+        while start_id < end_id:
+            base = bases[i]
+            segment_end = bases[i + 1] if i + 1 < len(bases) else next_id
+            stop = min(end_id, segment_end)
+            log_path, idx_path = self._paths(base)
+            with open(idx_path, 'rb') as f:
+                f.seek((start_id - base) * INDEX_ENTRY.size)
+                (offset,) = INDEX_ENTRY.unpack(f.read(INDEX_ENTRY.size))
+                if stop < segment_end:
+                    f.seek((stop - base) * INDEX_ENTRY.size)
+                    (end_offset,) = INDEX_ENTRY.unpack(f.read(INDEX_ENTRY.size))
+                else:
+                    end_offset = active_size if i == len(bases) - 1 else os.path.getsize(log_path)
+            with open(log_path, 'rb') as f:
+                f.seek(offset)
+                data = f.read(end_offset - offset)
+            records.extend(record for _, record in iter_records(data))
+            start_id = stop
+            i += 1
+        return records
+
+    def read_last(self, limit):
+        """读取最后 limit 条消息"""
+        next_id = self._next_id
+        return self.read(next_id - limit, next_id)
+
+    def read_before(self, before_id, limit):
+        """读取ID小于 before_id 的最后 limit 条消息"""
+        end_id = min(before_id, self._next_id)
+        return self.read(end_id - limit, end_id)
+
+    def read_all(self):
+        return self.read(self.first_id, self._next_id)
+
+
+def import_csv(log, csv_path, import_row=None):
+    """把旧版 CSV 历史文件逐行导入日志，时间戳未知记为 0
+
+    import_row 可在写入前转换每一行，例如把内嵌的语音数据移出聊天记录
+    """
+    csv.field_size_limit(max(csv.field_size_limit(), CSV_FIELD_LIMIT))
+    with open(csv_path, 'r', newline='', encoding='utf-8') as f:
+        rows = [row for row in csv.reader(f) if row]
+    if import_row is not None:
+        rows = [import_row(row) for row in rows]
+    if rows:
+        log.append_many(rows, timestamp=0)
+    return len(rows)
+
+
+class MessageLogStore:
+    """按会话名管理 MessageLog，首次打开时自动导入旧版 CSV 历史
+
+    已打开的会话直接从字典返回，不加锁；首次打开（可能要导入很大的旧版 CSV）只锁住该会话名所在的分段。
+    commit_interval > 0 时启动提交线程，所有会话的延迟写入在这里统一组提交（见模块说明）。
+    """
+
+    def __init__(self, root, segment_max_bytes=SEGMENT_MAX_BYTES, commit_interval=0, commit_batch=COMMIT_BATCH,
+                 max_open=MAX_OPEN_LOGS):
+        self.root = root
+        self.segment_max_bytes = segment_max_bytes
+        self.commit_interval = commit_interval
+        self.commit_batch = commit_batch
+        self.max_open = max_open
+        self._logs = {}
+        self._open_locks = StripedLock('history_open')
+        self._cond = threading.Condition()
+        self._dirty = set()  # 有排队记录等待提交的会话
+        self._queued = 0  # 自上次提交以来排队的消息数
+        self._open_logs = collections.OrderedDict()  # 保持文件句柄打开的会话，按最近写入排序
+        self._stopped = False
+        self.commits = 0  # 提交次数
+        self.committed_logs = 0  # 累计 fsync 的会话数
+        self._thread = None
+        if commit_interval > 0:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def get(self, name, legacy_csv=None, import_row=None):
+        log = self._logs.get(name)
+        if log is not None:
+            return log
+        with self._open_locks.lock_for(name):
+            log = self._logs.get(name)
+            if log is None:
+                directory = os.path.join(self.root, name)
+                if not os.path.isdir(directory) and legacy_csv and os.path.exists(legacy_csv):
+                    self._migrate(directory, legacy_csv, import_row)
+                log = MessageLog(directory, self.segment_max_bytes,
+                                 self._on_pending if self._thread is not None else None)
+                self._logs[name] = log
+            return log
+
+    def _on_pending(self, log, count):
+        with self._cond:
+            self._dirty.add(log)
+            self._queued += count
+            if self._queued >= self.commit_batch:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._stopped and self._queued < self.commit_batch:
+                    self._cond.wait(self.commit_interval)
+                if self._stopped:
+                    return
+            try:
+                self.commit()
+            except Exception as e:
+                log.exception('提交聊天记录出错')
+
+    def commit(self):
+        """组提交：把所有会话排队的记录写入文件并 fsync，返回落盘的会话数"""
+        with self._cond:
+            dirty = self._dirty
+            self._dirty = set()
+            self._queued = 0
+        synced = 0
+        for log in dirty:
+            if log.sync():
+                synced += 1
+            self._open_logs[log] = None
+            self._open_logs.move_to_end(log)
+        # 会话很多时不能每个都占着两个文件描述符，关闭最久没有写入的
+        while len(self._open_logs) > self.max_open:
+            log, _ = self._open_logs.popitem(last=False)
+            log.close()
+        if dirty:
+            self.commits += 1
+            self.committed_logs += synced
+        return synced
+
+    def close(self):
+        """停止提交线程，写入并 fsync 所有排队的记录，关闭文件句柄"""
+        if self._thread is not None:
+            with self._cond:
+                self._stopped = True
+                self._cond.notify()
+            self._thread.join()
+            self._thread = None
+        self.commit()
+        for log in list(self._logs.values()):
+            log.close()
+        self._open_logs.clear()
+
+    def _migrate(self, directory, legacy_csv, import_row=None):
+        # 先导入到临时目录再改名，导入中途退出不会留下半个会话
+        tmp_dir = directory + '.importing'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        count = import_csv(MessageLog(tmp_dir, self.segment_max_bytes), legacy_csv, import_row)
+        os.replace(tmp_dir, directory)
+        log.info('已将旧版聊天记录导入消息日志', path=legacy_csv, count=count)
@@ -0,0 +1,202 @@
+"""服务器运行指标，按 Prometheus 文本格式输出
+
+Counter、Gauge、Histogram 创建时登记到模块的注册表，render() 按登记顺序输出全部指标和 locks.py 的锁等待统计。
+记录只是在一把普通锁内更新字典（不用 TimedLock，避免统计自己），处理命令时的额外开销在微秒级。
+Gauge 不保存数值，输出时调用 fn 取当前值，适合在线人数、发送队列长度这类随时可以算出来的量。
+
+MetricsServer 在本机端口上提供 HTTP 接口，GET /metrics 返回 render() 的内容：
+    curl http://127.0.0.1:9108/metrics
+也可以直接配置为 Prometheus 的抓取目标。指标都是进程内的，分片模式下每个工作进程各自监听一个端口。
+"""
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from locks import lock_stats
+
+# 命令处理时间的分桶上限（秒）
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+# 文件传输时间的分桶上限（秒）
+TRANSFER_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _label_text(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def header(self):
+        return [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(_Metric):
+    """只增不减的计数，inc 的位置参数按 labels 的顺序给出标签值"""
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels=()):
+        super().__init__(name, help_text, labels)
+        self._values = {}
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def collect(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f'{self.name}{_label_text(self.labels, key)} {_number(value)}' for key, value in values]
+
+
+class Gauge(_Metric):
+    """输出时调用 fn 取值；有标签时 fn 返回 {标签值元组: 数值}
+
+    fn 算出的是累计值（例如所有连接收发的字节数之和）时用 kind='counter'
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, fn, labels=(), kind='gauge'):
+        super().__init__(name, help_text, labels)
+        self.fn = fn
+        self.kind = kind
+
+    def collect(self):
+        result = self.fn()
+        if not self.labels:
+            return [f'{self.name} {_number(result)}']
+        return [f'{self.name}{_label_text(self.labels, key)} {_number(value)}'
+                for key, value in sorted(result.items())]
+
+
+class Histogram(_Metric):
+    """按 buckets 分桶统计观测值的分布，输出累计桶、总和与次数"""
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # 标签值元组: [各桶计数（最后一个为 +Inf）, 总和, 次数]
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def collect(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items())
+        lines = []
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = 'le="' + _number(bound) + '"'
+                lines.append(f'{self.name}_bucket{_label_text(self.labels, key, le)} {cumulative}')
+            labels = _label_text(self.labels, key)
+            lines.append(f'{self.name}_sum{labels} {_number(total)}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+def collect_lock_stats():
+    """locks.py 的锁等待统计，按锁名称作为标签"""
+    stats = lock_stats()
+    sections = [
+        ('chat_lock_acquisitions_total', 'counter', '锁获取次数', 0),
+        ('chat_lock_contended_total', 'counter', '获取锁时需要等待的次数', 1),
+        ('chat_lock_wait_seconds_total', 'counter', '等待锁的总时间（秒）', 2),
+        ('chat_lock_wait_max_seconds', 'gauge', '单次等待锁的最长时间（秒）', 3),
+    ]
+    lines = []
+    for name, kind, help_text, index in sections:
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for lock_name, values in stats.items():
+            lines.append(f'{name}{{lock="{_escape(lock_name)}"}} {_number(values[index])}')
+    return lines
+
+
+def render():
+    """全部指标的 Prometheus 文本格式"""
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        try:
+            samples = metric.collect()
+        except Exception as e:
+            # 某个 Gauge 取值出错时不影响其他指标
+            lines.append(f'# {metric.name} 取值出错: {_escape(e)}')
+            continue
+        lines.extend(metric.header())
+        lines.extend(samples)
+    lines.extend(collect_lock_stats())
+    return '\n'.join(lines) + '\n'
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # 不为每次抓取打印访问日志
+
+
+class MetricsServer:
+    """在后台线程中提供 GET /metrics"""
+
+    def __init__(self, host, port):
+        self.httpd = ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
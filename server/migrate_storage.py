@@ -0,0 +1,90 @@
+"""把 CSV 存储一次性迁移到 SQLite
+
+迁移用户、好友关系、群组、群成员和全部聊天记录（history/ 下的消息日志以及尚未导入的旧版
+*_history.csv）。聊天记录中内嵌 base64 的旧版语音会转存到 blobs/voice/，只在数据库中保存引用。
+重复运行是安全的：已存在的用户、好友和群组会跳过，数据库中已有消息的会话不再导入。
+
+用法:
+    cd server
+    python migrate_storage.py --db chat.db
+    python main.py --storage sqlite
+"""
+import argparse
+import os
+import time
+
+import logs
+from blob_store import BlobStore, externalize_voice
+from storage import CsvStorage, SqliteStorage
+
+VOICE_BLOB_DIR = os.path.join('blobs', 'voice')
+
+
+def migrate(source, target, voice_blobs=None):
+    """把 source 存储的全部数据写入 target，返回各类数据的条数"""
+    counts = {}
+    users = list(source.iter_users())
+    target.import_users(users)
+    counts['用户'] = len(users)
+
+    friendships = source.load_friendships()
+    target.import_friendships(friendships)
+    counts['好友关系'] = len(friendships)
+
+    groups = source.load_groups()
+    target.import_groups(groups)
+    counts['群组'] = len(groups)
+
+    members = source.load_group_members()
+    target.import_group_members(members)
+    counts['群成员'] = len(members)
+
+    messages = 0
+    skipped = 0
+    for name in source.conversations():
+        log = target.history_log(name)
+        if len(log):
+            skipped += 1
+            continue
+        # 同一会话的消息按原时间戳分批写入，保持消息ID和顺序不变
+        batch = []
+        batch_ts = None
+        for _, timestamp, fields in source.history_log(name).read_all():
+            if voice_blobs is not None and fields:
+                fields = fields[:-1] + [externalize_voice(fields[-1], voice_blobs)]
+            if batch and timestamp != batch_ts:
+                log.append_many(batch, batch_ts)
+                batch = []
+            batch.append(fields)
+            batch_ts = timestamp
+            messages += 1
+        if batch:
+            log.append_many(batch, batch_ts)
+    counts['聊天记录'] = messages
+    counts['跳过的已有会话'] = skipped
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='把 CSV 存储迁移到 SQLite')
+    parser.add_argument('--source', default='.', help='CSV 文件所在目录（服务器工作目录）')
+    parser.add_argument('--history-dir', default='history', help='消息日志目录，相对于 --source')
+    parser.add_argument('--db', default='chat.db', help='目标 SQLite 数据库文件，相对于 --source')
+    args = parser.parse_args()
+    logs.setup()  # 显示导入旧版聊天记录等进度信息
+
+    start = time.perf_counter()
+    source = CsvStorage(args.source, args.history_dir)
+    target = SqliteStorage(os.path.join(args.source, args.db))
+    voice_blobs = BlobStore(os.path.join(args.source, VOICE_BLOB_DIR))
+    try:
+        counts = migrate(source, target, voice_blobs)
+    finally:
+        target.close()
+    for name, count in counts.items():
+        print(f"{name}: {count}")
+    print(f"迁移完成，用时 {time.perf_counter() - start:.2f}s，启动服务器时使用 --storage sqlite")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""每个连接独立的有界发送队列
+
+send_msg 只负责把数据放进目标连接的队列，由该连接自己的写线程用 sendall 发出。
+一个 TCP 窗口已满的慢客户端只会堆积自己的队列，不会阻塞群聊广播或其他用户的登录。
+"""
+import collections
+import socket
+import threading
+
+import logs
+from protocol import PROTOCOL_V1
+
+log = logs.get_logger('outbound')
+
+# 队列已满时的处理策略
+POLICY_DROP = 'drop'  # 丢弃新消息
+POLICY_DISCONNECT = 'disconnect'  # 断开慢连接
+POLICY_COALESCE = 'coalesce'  # 把排队中的消息合并为一次写入，超过字节上限时丢弃新消息
+QUEUE_POLICIES = (POLICY_DROP, POLICY_DISCONNECT, POLICY_COALESCE)
+
+DEFAULT_MAX_MESSAGES = 1024
+DEFAULT_MAX_BYTES = 8 * 1024 * 1024
+# 关闭连接时等待队列发送完毕的最长时间（秒）
+CLOSE_TIMEOUT = 5
+
+
+class OutboundConnection:
+    """线程模式下的连接包装：接收直接读 socket，发送走队列和独立写线程"""
+
+    def __init__(self, sock, max_messages=DEFAULT_MAX_MESSAGES, max_bytes=DEFAULT_MAX_BYTES,
+                 policy=POLICY_DROP):
+        if policy not in QUEUE_POLICIES:
+            raise ValueError(f'未知的队列策略: {policy}')
+        self.sock = sock
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.protocol = PROTOCOL_V1  # 协商后的协议版本，决定 send_msg 的编码方式
+        self.closed = False
+        self.dropped = 0  # 因队列已满被丢弃的消息数
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self._queue = collections.deque()
+        self._queued_bytes = 0
+        self._sending = False  # 写线程是否正在执行 sendall
+        self._cond = threading.Condition()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    @property
+    def pending_messages(self):
+        return len(self._queue)
+
+    @property
+    def pending_bytes(self):
+        return self._queued_bytes
+
+    def recv(self, bufsize):
+        data = self.sock.recv(bufsize)
+        self.bytes_received += len(data)
+        return data
+
+    def send(self, data):
+        """把一条完整消息放入队列，返回入队的字节数（被丢弃时为 0）"""
+        with self._cond:
+            if self.closed:
+                raise ConnectionError('连接已关闭')
+            if len(self._queue) >= self.max_messages or self._queued_bytes + len(data) > self.max_bytes:
+                if not self._handle_full(data):
+                    return 0
+            else:
+                self._queue.append(data)
+                self._queued_bytes += len(data)
+            self._cond.notify()
+        return len(data)
+
+    def sendall(self, data):
+        self.send(data)
+
+    def _handle_full(self, data):
+        """队列已满时按策略处理新消息，调用方需持有 self._cond，返回是否已入队"""
+        if self.policy == POLICY_COALESCE and self._queued_bytes + len(data) <= self.max_bytes:
+            # 消息条数到达上限但字节数未超：合并成一个写缓冲，顺序和内容都不变
+            self._queue.append(data)
+            merged = b''.join(self._queue)
+            self._queue.clear()
+            self._queue.append(merged)
+            self._queued_bytes = len(merged)
+            return True
+        if self.policy == POLICY_DISCONNECT:
+            log.warning('发送队列已满，断开慢连接', addr=self._peer())
+            self._abort()
+            raise ConnectionError('发送队列已满，连接已断开')
+        self.dropped += 1
+        return False
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self.closed:
+                    self._cond.wait()
+                if not self._queue:
+                    break
+                data = self._queue.popleft()
+                self._queued_bytes -= len(data)
+                self._sending = True
+            try:
+                self.sock.sendall(data)
+                self.bytes_sent += len(data)
+                self._sending = False
+            except OSError as e:
+                log.info('发送消息失败', addr=self._peer(), error=e, sample='send_failed')
+                with self._cond:
+                    self.closed = True
+                    self._queue.clear()
+                    self._queued_bytes = 0
+                break
+        self._shutdown_socket()
+
+    def _peer(self):
+        try:
+            return self.sock.getpeername()
+        except OSError:
+            return None
+
+    def _shutdown_socket(self):
+        # shutdown 会唤醒阻塞在 recv 上的读线程，单独 close 在 Linux 上做不到；
+        # 真正关闭文件描述符由读线程在 wait_closed 中完成，避免描述符被其他连接复用
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _abort(self):
+        """立即断开，丢弃尚未发送的数据"""
+        self.closed = True
+        self._queue.clear()
+        self._queued_bytes = 0
+        self._cond.notify_all()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        """发送完已排队的数据后关闭连接，超时仍未发完则强制断开"""
+        with self._cond:
+            if self.closed:
+                return
+            self.closed = True
+            self._cond.notify_all()
+            if not self._queue and not self._sending:
+                return
+        timer = threading.Timer(CLOSE_TIMEOUT, self._force_close)
+        timer.daemon = True
+        timer.start()
+
+    def _force_close(self):
+        if self._writer.is_alive():
+            with self._cond:
+                self._abort()
+
+    def wait_closed(self):
+        """由读线程在连接结束时调用：等待写线程退出后释放 socket"""
+        self._writer.join(CLOSE_TIMEOUT)
+        if self._writer.is_alive():
+            with self._cond:
+                self._abort()
+            self._writer.join(1)
+        try:
+            self.sock.close()
+        except OSError:
+            pass
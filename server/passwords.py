@@ -0,0 +1,150 @@
+"""密码哈希
+
+保存的哈希字符串以算法名开头，参数和盐一起保存，便于以后更换算法或调整参数：
+    scrypt$<n>$<r>$<p>$<盐 base64>$<哈希 base64>
+    pbkdf2_sha256$<迭代次数>$<盐 base64>$<哈希 base64>
+    <64 位十六进制>                          旧版无盐 SHA-256，只用于验证
+登录验证成功后，如果保存的哈希不是当前默认算法或参数已过时，会用默认算法重新计算（rehash）。
+
+scrypt 和 PBKDF2 都是有意做慢的计算，PasswordService 把它们放到有上限的线程池中执行：
+hashlib 在计算期间会释放 GIL，多个核心可以并行计算，同时限制了同时进行的计算数量（scrypt 每次约占 16MB 内存）。
+"""
+import base64
+import hashlib
+import hmac
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+SALT_BYTES = 16
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SCRYPT_DKLEN = 32
+PBKDF2_ITERATIONS = 600000
+PBKDF2_DKLEN = 32
+
+
+def _b64encode(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+def _b64decode(text):
+    return base64.b64decode(text.encode('ascii'))
+
+
+class ScryptHasher:
+    algorithm = 'scrypt'
+
+    def __init__(self, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P):
+        self.n = n
+        self.r = r
+        self.p = p
+
+    def _derive(self, password, salt, n, r, p, dklen):
+        # maxmem 需要大于 128 * n * r * p，否则 OpenSSL 会拒绝计算
+        return hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=p,
+                              maxmem=256 * n * r * p, dklen=dklen)
+
+    def hash(self, password):
+        salt = os.urandom(SALT_BYTES)
+        derived = self._derive(password, salt, self.n, self.r, self.p, SCRYPT_DKLEN)
+        return f'{self.algorithm}${self.n}${self.r}${self.p}${_b64encode(salt)}${_b64encode(derived)}'
+
+    def verify(self, password, encoded):
+        _, n, r, p, salt, expected = encoded.split('$')
+        expected = _b64decode(expected)
+        derived = self._derive(password, _b64decode(salt), int(n), int(r), int(p), len(expected))
+        return hmac.compare_digest(derived, expected)
+
+    def needs_update(self, encoded):
+        _, n, r, p, _, _ = encoded.split('$')
+        return (int(n), int(r), int(p)) != (self.n, self.r, self.p)
+
+
+class Pbkdf2Hasher:
+    algorithm = 'pbkdf2_sha256'
+
+    def __init__(self, iterations=PBKDF2_ITERATIONS):
+        self.iterations = iterations
+
+    def hash(self, password):
+        salt = os.urandom(SALT_BYTES)
+        derived = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, self.iterations, PBKDF2_DKLEN)
+        return f'{self.algorithm}${self.iterations}${_b64encode(salt)}${_b64encode(derived)}'
+
+    def verify(self, password, encoded):
+        _, iterations, salt, expected = encoded.split('$')
+        expected = _b64decode(expected)
+        derived = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), _b64decode(salt), int(iterations),
+                                      len(expected))
+        return hmac.compare_digest(derived, expected)
+
+    def needs_update(self, encoded):
+        return int(encoded.split('$')[1]) != self.iterations
+
+
+class LegacySha256Hasher:
+    """旧版无盐 SHA-256，只用于验证已有用户，登录成功后会被替换"""
+    algorithm = 'sha256'
+
+    def hash(self, password):
+        return hashlib.sha256(password.encode()).hexdigest()
+
+    def verify(self, password, encoded):
+        return hmac.compare_digest(self.hash(password), encoded)
+
+    def needs_update(self, encoded):
+        return False
+
+
+HASHERS = {hasher.algorithm: hasher for hasher in (ScryptHasher(), Pbkdf2Hasher(), LegacySha256Hasher())}
+DEFAULT_HASHER = 'scrypt'
+# 可以作为默认算法的哈希方式，旧版 SHA-256 只用于验证
+HASHER_CHOICES = ('scrypt', 'pbkdf2_sha256')
+
+
+def identify(encoded):
+    """根据哈希字符串找到对应的算法，无法识别时返回 None"""
+    if '$' in encoded:
+        return HASHERS.get(encoded.split('$', 1)[0])
+    if len(encoded) == 64:
+        return HASHERS['sha256']
+    return None
+
+
+class PasswordService:
+    """在有上限的线程池中计算和验证密码哈希
+
+    hash 和 verify 会阻塞调用线程直到计算完成，线程模式下每个连接有自己的线程，
+    asyncio 模式下相关命令由事件循环转交给线程执行（见 async_server），都不会阻塞其他连接的消息处理。
+    """
+
+    def __init__(self, default=DEFAULT_HASHER, workers=None):
+        self.default = HASHERS[default]
+        self.workers = workers or os.cpu_count() or 1
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='password')
+
+    def hash(self, password):
+        """用默认算法计算新的哈希字符串"""
+        return self._pool.submit(self.default.hash, password).result()
+
+    def verify(self, password, encoded):
+        """验证密码，返回 (是否正确, 需要替换的新哈希或 None)"""
+        return self._pool.submit(self._verify, password, encoded).result()
+
+    def _verify(self, password, encoded):
+        hasher = identify(encoded)
+        if hasher is None:
+            return False, None
+        try:
+            if not hasher.verify(password, encoded):
+                return False, None
+        except (ValueError, TypeError):
+            # 哈希字符串已损坏
+            return False, None
+        if hasher is not self.default or self.default.needs_update(encoded):
+            return True, self.default.hash(password)
+        return True, None
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
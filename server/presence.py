@@ -0,0 +1,121 @@
+"""在线状态服务
+
+登录和断开连接只记录状态变化，由后台线程每个 tick 统一处理：
+    - 防抖：状态变化后 debounce 秒内没有再变化才发布，断线后立刻重连不会产生任何通知；
+      持续抖动的用户最多延迟 max_delay 秒也会发布最终状态
+    - 批量：同一个 tick 内的所有变化，按接收者合并为一条
+      PRESENCE_DELTA|user1:online|user2:offline|...
+旧版文本协议客户端不认识 PRESENCE_DELTA，仍逐条收到 FRIEND_ONLINE / FRIEND_OFFLINE。
+多进程分片模式下每个用户的状态只由一个工作进程（见 shard_bus.home_of）防抖和发布，
+好友的连接在其他进程上时，通知经 forward 交给消息总线转发。
+"""
+import threading
+import time
+
+import logs
+from locks import TimedLock
+from protocol import PROTOCOL_V2
+
+log = logs.get_logger('presence')
+
+DEFAULT_TICK = 0.5  # 秒
+DEFAULT_DEBOUNCE = 1.0  # 秒
+DEFAULT_MAX_DELAY = 5.0  # 秒
+
+
+class PresenceService:
+    """friends_of(username) 返回好友集合，connections_of(usernames) 返回其中在线用户的 {用户名: 连接}，
+    send(conn, msg) 发送一条文本消息，forward({接收者: [(用户名, 是否在线)]}) 处理不在本进程的接收者"""
+
+    def __init__(self, friends_of, connections_of, send, tick=DEFAULT_TICK, debounce=DEFAULT_DEBOUNCE,
+                 max_delay=DEFAULT_MAX_DELAY, forward=None):
+        self.friends_of = friends_of
+        self.connections_of = connections_of
+        self.send = send
+        self.forward = forward
+        self.tick = tick
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self._published = set()  # 已通知好友为在线的用户
+        self._pending = {}  # username: (是否在线, 第一次变化时间, 最后一次变化时间)
+        self._lock = TimedLock('presence')
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self.deltas_sent = 0  # 发出的 PRESENCE_DELTA / FRIEND_* 消息数
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def set_online(self, username):
+        self._record(username, True)
+
+    def set_offline(self, username):
+        self._record(username, False)
+
+    def _record(self, username, online):
+        now = time.monotonic()
+        with self._lock:
+            pending = self._pending.get(username)
+            first = pending[1] if pending else now
+            self._pending[username] = (online, first, now)
+
+    def is_online(self, username):
+        """已发布的在线状态，与好友收到的通知保持一致"""
+        return username in self._published
+
+    def _run(self):
+        while not self._stopped.wait(self.tick):
+            try:
+                self.flush()
+            except Exception as e:
+                log.exception('发送在线状态出错')
+
+    def flush(self, now=None):
+        """发布已稳定的状态变化，返回发布的用户数"""
+        if now is None:
+            now = time.monotonic()
+        changes = []
+        with self._lock:
+            for username, (online, first, last) in list(self._pending.items()):
+                if now - last < self.debounce and now - first < self.max_delay:
+                    continue
+                del self._pending[username]
+                if online == (username in self._published):
+                    # 断线后在防抖时间内重连，好友看到的状态没有变化
+                    continue
+                if online:
+                    self._published.add(username)
+                else:
+                    self._published.discard(username)
+                changes.append((username, online))
+        if not changes:
+            return 0
+
+        # 按接收者汇总
+        deltas = {}
+        for username, online in changes:
+            for friend in self.friends_of(username):
+                deltas.setdefault(friend, []).append((username, online))
+        connections = self.connections_of(deltas)
+        for friend, conn in connections.items():
+            self.send_delta(conn, deltas[friend])
+        if self.forward is not None and len(connections) < len(deltas):
+            self.forward({friend: items for friend, items in deltas.items() if friend not in connections})
+        return len(changes)
+
+    def send_delta(self, conn, items):
+        """把 [(用户名, 是否在线)] 发给一个连接"""
+        try:
+            if getattr(conn, 'protocol', None) == PROTOCOL_V2:
+                entries = '|'.join(f"{name}:{'online' if online else 'offline'}" for name, online in items)
+                self.send(conn, f'PRESENCE_DELTA|{entries}')
+                self.deltas_sent += 1
+            else:
+                for name, online in items:
+                    self.send(conn, f"{'FRIEND_ONLINE' if online else 'FRIEND_OFFLINE'}|{name}")
+                    self.deltas_sent += 1
+        except Exception as e:
+            log.warning('发送在线状态失败', error=e, sample='presence_send_failed')
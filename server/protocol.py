@@ -0,0 +1,218 @@
+"""聊天协议的帧格式
+
+v1 是原有的文本协议：每条消息是一行以 '|' 分隔的 UTF-8 文本，以 '\\n' 结尾，
+语音等二进制数据需要 base64 编码后放进同一行。
+
+v2 使用带类型的长度前缀二进制帧，头部固定 8 字节：
+    magic(2s) 'CM' | version(B) | type(B) | payload 长度(I, 网络字节序)
+    FRAME_TEXT   payload 是一条不含 '\\n' 的 UTF-8 命令，格式与 v1 相同
+    FRAME_BINARY payload 是 meta 长度(H) + meta(UTF-8 命令) + 原始字节，
+                 用于语音等二进制数据，不再需要 base64
+
+连接建立后双方都使用 v1。客户端发送 'PROTO|2'，服务器回复 'PROTO_OK|2'（仍是 v1 文本行），
+此后双方都改用 v2 帧；旧服务器会回复 'ERROR|Unknown command'，客户端继续使用 v1。
+本文件在 server/protocol.py 与 client/protocol.py 各有一份，修改时需保持一致。
+"""
+import struct
+
+PROTOCOL_V1 = 1
+PROTOCOL_V2 = 2
+
+FRAME_MAGIC = b'CM'
+FRAME_HEADER = struct.Struct('!2sBBI')
+FRAME_HEADER_SIZE = FRAME_HEADER.size
+BINARY_META = struct.Struct('!H')
+
+FRAME_TEXT = 1
+FRAME_BINARY = 2
+FRAME_TYPES = (FRAME_TEXT, FRAME_BINARY)
+
+# 单帧最大长度，超过时视为协议错误并断开连接
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+# 协商命令
+CMD_PROTO = 'PROTO'
+CMD_PROTO_OK = 'PROTO_OK'
+
+
+class ProtocolError(Exception):
+    """收到无法解析的帧"""
+
+
+def encode_text_frame(text):
+    """把一条文本命令编码为 v2 文本帧"""
+    payload = text.rstrip('\n').encode('utf-8')
+    return FRAME_HEADER.pack(FRAME_MAGIC, PROTOCOL_V2, FRAME_TEXT, len(payload)) + payload
+
+
+def encode_binary_frame(meta, blob):
+    """把命令和原始字节编码为 v2 二进制帧"""
+    meta_bytes = meta.encode('utf-8')
+    length = BINARY_META.size + len(meta_bytes) + len(blob)
+    return b''.join((
+        FRAME_HEADER.pack(FRAME_MAGIC, PROTOCOL_V2, FRAME_BINARY, length),
+        BINARY_META.pack(len(meta_bytes)),
+        meta_bytes,
+        blob,
+    ))
+
+
+def encode_message(text, protocol=PROTOCOL_V1):
+    """按连接协商的协议编码一条文本消息"""
+    if protocol == PROTOCOL_V2:
+        return encode_text_frame(text)
+    if not text.endswith('\n'):
+        text += '\n'
+    return text.encode('utf-8')
+
+
+def parse_header(header):
+    """解析帧头，返回 (类型, payload 长度)"""
+    magic, version, frame_type, length = FRAME_HEADER.unpack(header)
+    if magic != FRAME_MAGIC or version != PROTOCOL_V2:
+        raise ProtocolError(f'无效的帧头: {bytes(header)!r}')
+    if frame_type not in FRAME_TYPES:
+        raise ProtocolError(f'未知的帧类型: {frame_type}')
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError(f'帧过大: {length} 字节')
+    return frame_type, length
+
+
+def decode_payload(frame_type, payload):
+    """把 payload 解码为 (文本命令, 原始字节)，文本帧的原始字节为 None"""
+    if frame_type == FRAME_TEXT:
+        return str(payload, 'utf-8', 'replace'), None
+    if len(payload) < BINARY_META.size:
+        raise ProtocolError('二进制帧缺少 meta 长度')
+    (meta_len,) = BINARY_META.unpack_from(payload)
+    meta_end = BINARY_META.size + meta_len
+    if meta_end > len(payload):
+        raise ProtocolError('二进制帧 meta 长度越界')
+    meta = str(payload[BINARY_META.size:meta_end], 'utf-8', 'replace')
+    return meta, bytes(payload[meta_end:])
+
+
+class ReceiveBuffer:
+    """增量接收缓冲区，子类实现 next_message 从中切出完整的消息
+
+    数据追加到 bytearray 末尾，已取出的消息只推进读偏移 _pos，
+    等已消费部分超过缓冲区一半时才一次性删除，整体复制开销是线性的。
+    """
+
+    COMPACT_THRESHOLD = 64 * 1024
+
+    def __init__(self, data=b''):
+        self._buffer = bytearray(data)
+        self._pos = 0
+
+    def __len__(self):
+        """尚未取出的字节数"""
+        return len(self._buffer) - self._pos
+
+    def feed(self, data):
+        self._buffer += data
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        message = self.next_message()
+        if message is None:
+            raise StopIteration
+        return message
+
+    def next_message(self):
+        """返回下一条完整消息 (文本命令, 原始字节)，数据不足时返回 None"""
+        raise NotImplementedError
+
+    def take_remaining(self):
+        """取出尚未解析的字节，用于切换到另一种解析器"""
+        data = bytes(self._buffer[self._pos:])
+        self._buffer = bytearray()
+        self._pos = 0
+        return data
+
+    def _compact(self):
+        if not self._pos:
+            return
+        if self._pos == len(self._buffer):
+            self._buffer.clear()
+            self._pos = 0
+        elif self._pos >= self.COMPACT_THRESHOLD and self._pos * 2 >= len(self._buffer):
+            del self._buffer[:self._pos]
+            self._pos = 0
+
+
+class LineDecoder(ReceiveBuffer):
+    """增量解析 v1 文本行
+
+    记录上次查找换行符的位置，新数据到达后只扫描新增部分，
+    每个字节只被查找一次；整行到齐后才解码为字符串。
+    """
+
+    def __init__(self, data=b'', max_line=MAX_FRAME_SIZE):
+        super().__init__(data)
+        self.max_line = max_line
+        self._scan = 0
+
+    def next_message(self):
+        end = self._buffer.find(b'\n', max(self._scan, self._pos))
+        if end < 0:
+            self._scan = len(self._buffer)
+            if len(self) > self.max_line:
+                raise ProtocolError(f'单行消息过长: 超过 {self.max_line} 字节')
+            self._compact_scan()
+            return None
+        with memoryview(self._buffer) as view:
+            line = str(view[self._pos:end], 'utf-8', 'replace')
+        self._pos = self._scan = end + 1
+        return line, None
+
+    def take_remaining(self):
+        self._scan = 0
+        return super().take_remaining()
+
+    def _compact_scan(self):
+        pos = self._pos
+        self._compact()
+        self._scan -= pos - self._pos
+
+
+class FrameDecoder(ReceiveBuffer):
+    """增量解析 v2 帧
+
+    帧头给出长度，数据不足一帧时直接等待，大帧分多次到达也不会重复扫描已收到的部分。
+    """
+
+    def next_message(self):
+        if len(self) < FRAME_HEADER_SIZE:
+            self._compact()
+            return None
+        frame_type, length = parse_header(bytes(self._buffer[self._pos:self._pos + FRAME_HEADER_SIZE]))
+        if len(self) < FRAME_HEADER_SIZE + length:
+            self._compact()
+            return None
+        start = self._pos + FRAME_HEADER_SIZE
+        with memoryview(self._buffer) as view:
+            message = decode_payload(frame_type, view[start:start + length])
+        self._pos = start + length
+        return message
+
+
+def recv_exact(sock, size):
+    """从阻塞 socket 读取恰好 size 字节，连接关闭时抛出 ConnectionError"""
+    buf = bytearray(size)
+    view = memoryview(buf)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:], size - received)
+        if not n:
+            raise ConnectionError('连接已关闭')
+        received += n
+    return buf
+
+
+def recv_frame(sock):
+    """从阻塞 socket 读取一个完整的 v2 帧，返回 (文本命令, 原始字节)"""
+    frame_type, length = parse_header(recv_exact(sock, FRAME_HEADER_SIZE))
+    return decode_payload(frame_type, recv_exact(sock, length))
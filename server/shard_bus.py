@@ -0,0 +1,222 @@
+"""多进程分片模式的本地消息总线
+
+python main.py --workers N 启动 N 个工作进程，它们用 SO_REUSEPORT 监听同一个聊天端口，
+由内核把新连接分给其中一个进程，每个进程只持有自己接受的连接（各自的 clients 字典），
+Python 代码因此可以同时运行在多个核心上。
+
+进程之间通过 Unix 域套接字交换事件：每个工作进程监听 bus/<聊天端口>-<编号>.sock，
+并主动连接其他所有进程，自己的连接只用来发送，接受的连接只用来接收。
+每个事件是一个 v2 文本帧（见 protocol.py），内容是 JSON 数组 [事件类型, 参数...]。
+
+总线自己维护其他进程上的在线用户（online / offline / hello 事件），
+消息的接收者不在本进程时，用 owner_of 找到持有其连接的进程，再用 send 转交。
+每个用户的在线状态固定由 home(用户名) 对应的进程防抖和发布，断线后重连到其他进程也不会产生抖动。
+工作进程在总线与其他所有进程互相连通（wait_ready）后才开始接受客户端连接，启动期间不会丢失事件。
+"""
+import json
+import os
+import socket
+import threading
+import time
+import zlib
+
+import logs
+from outbound import OutboundConnection, POLICY_COALESCE
+from protocol import FrameDecoder, ProtocolError, encode_text_frame
+
+log = logs.get_logger('shard_bus')
+
+BUS_DIR = 'bus'
+CONNECT_RETRY = 0.2  # 秒，其他进程尚未启动或连接断开时的重连间隔
+READY_TIMEOUT = 30  # 秒，启动时等待其他进程连通的最长时间
+# 进程间连接的发送队列：积压的事件合并写入，只有对方进程卡死、积压超过字节上限时才会丢弃
+PEER_QUEUE_MAX_MESSAGES = 4096
+PEER_QUEUE_MAX_BYTES = 64 * 1024 * 1024
+
+
+def home_of(username, workers):
+    """负责该用户在线状态的工作进程编号，各进程的计算结果相同（不能用随机化的 hash()）"""
+    return zlib.crc32(username.encode('utf-8')) % workers
+
+
+class MessageBus:
+    """handler(event) 处理其他进程发来的事件，local_users() 返回本进程的在线用户列表"""
+
+    def __init__(self, worker_id, workers, port, handler, local_users, bus_dir=BUS_DIR):
+        self.worker_id = worker_id
+        self.workers = workers
+        self.port = port
+        self.handler = handler
+        self.local_users = local_users
+        self.bus_dir = bus_dir
+        self.locations = {}  # 其他进程上的在线用户: 进程编号
+        self._peers = {}  # 进程编号: OutboundConnection
+        self._lock = threading.Lock()
+        self._server = None
+        self._hello_from = set()  # 已收到 hello 的进程编号
+        self._ready = threading.Event()
+        self.events_sent = 0
+        self.events_received = 0
+
+    def socket_path(self, worker_id):
+        return os.path.join(self.bus_dir, f'{self.port}-{worker_id}.sock')
+
+    def start(self):
+        os.makedirs(self.bus_dir, exist_ok=True)
+        path = self.socket_path(self.worker_id)
+        try:
+            os.unlink(path)  # 上次运行遗留的套接字文件
+        except FileNotFoundError:
+            pass
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(path)
+        self._server.listen(self.workers)
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        for worker_id in range(self.workers):
+            if worker_id != self.worker_id:
+                threading.Thread(target=self._connect_loop, args=(worker_id,), daemon=True).start()
+
+    def wait_ready(self, timeout=READY_TIMEOUT):
+        """等待与其他所有进程双向连通，返回是否连通"""
+        if self.workers == 1:
+            return True
+        return self._ready.wait(timeout)
+
+    def _check_ready(self):
+        if len(self._peers) == self.workers - 1 and len(self._hello_from) == self.workers - 1:
+            self._ready.set()
+
+    def stop(self):
+        try:
+            self._server.close()
+            os.unlink(self.socket_path(self.worker_id))
+        except (AttributeError, OSError):
+            pass
+
+    def home(self, username):
+        return home_of(username, self.workers)
+
+    def owner_of(self, username):
+        """持有该用户连接的其他进程编号，用户不在其他进程上在线时返回 None"""
+        return self.locations.get(username)
+
+    def announce_online(self, username):
+        """用户在本进程登录，其他进程上的旧连接会被对方断开"""
+        self.locations.pop(username, None)
+        self.broadcast(['online', username, self.worker_id])
+
+    def announce_offline(self, username):
+        self.broadcast(['offline', username, self.worker_id])
+
+    def send(self, worker_id, event):
+        """把事件发给指定进程，对方尚未连接时返回 False"""
+        peer = self._peers.get(worker_id)
+        if peer is None:
+            log.warning('消息总线: 工作进程未连接，丢弃事件', worker=worker_id, event=event[0], sample='bus_drop')
+            return False
+        try:
+            peer.send(self._encode(event))
+        except ConnectionError:
+            return False
+        self.events_sent += 1
+        return True
+
+    def broadcast(self, event):
+        """把事件发给其他所有进程"""
+        frame = self._encode(event)
+        # 与 _connect_loop 中的 hello 使用同一把锁，保证新连接上 hello 之后的广播不会丢失
+        with self._lock:
+            for peer in self._peers.values():
+                try:
+                    peer.send(frame)
+                    self.events_sent += 1
+                except ConnectionError:
+                    pass
+
+    def _encode(self, event):
+        return encode_text_frame(json.dumps(event, ensure_ascii=False))
+
+    def _connect_loop(self, worker_id):
+        """保持到另一个进程的发送连接，对方尚未启动或连接断开时不断重试"""
+        path = self.socket_path(worker_id)
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(path)
+            except OSError:
+                sock.close()
+                time.sleep(CONNECT_RETRY)
+                continue
+            peer = OutboundConnection(sock, PEER_QUEUE_MAX_MESSAGES, PEER_QUEUE_MAX_BYTES, POLICY_COALESCE)
+            with self._lock:
+                # 先告诉对方本进程已有的在线用户，登记之后的 online / offline 广播都排在它后面
+                peer.send(self._encode(['hello', self.worker_id, self.local_users()]))
+                self._peers[worker_id] = peer
+                self._check_ready()
+            log.info('消息总线: 已连接工作进程', worker=worker_id)
+            # 对方不会在这个连接上发送数据，recv 返回说明连接已断开
+            try:
+                sock.recv(1)
+            except OSError:
+                pass
+            with self._lock:
+                if self._peers.get(worker_id) is peer:
+                    del self._peers[worker_id]
+            peer.close()
+            peer.wait_closed()
+            log.warning('消息总线: 与工作进程的连接已断开', worker=worker_id)
+            time.sleep(CONNECT_RETRY)
+
+    def _accept_loop(self):
+        while True:
+            try:
+                sock, _ = self._server.accept()
+            except OSError:
+                return  # stop 关闭了监听套接字
+            threading.Thread(target=self._read_loop, args=(sock,), daemon=True).start()
+
+    def _read_loop(self, sock):
+        decoder = FrameDecoder()
+        peer_id = None
+        try:
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                decoder.feed(data)
+                for text, _ in decoder:
+                    event = json.loads(text)
+                    self.events_received += 1
+                    if event[0] == 'hello':
+                        peer_id = event[1]
+                    self._dispatch(event)
+        except (OSError, ProtocolError, ValueError) as e:
+            log.warning('消息总线: 读取事件出错', worker=peer_id, error=e)
+        finally:
+            sock.close()
+            if peer_id is not None:
+                # 对方进程已退出，它持有的连接也都断开了
+                for username, worker_id in list(self.locations.items()):
+                    if worker_id == peer_id:
+                        self.locations.pop(username, None)
+
+    def _dispatch(self, event):
+        kind = event[0]
+        if kind == 'hello':
+            _, worker_id, usernames = event
+            for username in usernames:
+                self.locations[username] = worker_id
+            with self._lock:
+                self._hello_from.add(worker_id)
+                self._check_ready()
+            return
+        if kind == 'online':
+            self.locations[event[1]] = event[2]
+        elif kind == 'offline':
+            # 用户可能已经在另一个进程重新登录，只移除仍指向发送方的登记
+            if self.locations.get(event[1]) == event[2]:
+                del self.locations[event[1]]
+        try:
+            self.handler(event)
+        except Exception as e:
+            log.exception('消息总线: 处理事件出错', event=kind)
@@ -0,0 +1,493 @@
+"""持久化存储接口
+
+服务器的用户、好友关系、群组、群成员和聊天记录都通过 Storage 读写，有两种实现：
+    CsvStorage     原有的 CSV 文件（聊天记录使用 message_log 的分段日志）
+    SqliteStorage  单个 SQLite 数据库，WAL 模式，用户名、群ID、会话/时间都有索引
+好友关系和群组在内存中另有索引（见 indexes.py），Storage 只负责落盘和启动时加载。
+"""
+import csv
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from locks import TimedLock
+from message_log import COMMIT_BATCH, MessageLogStore
+
+STORAGE_BACKENDS = ('csv', 'sqlite')
+
+USER_CSV = 'users.csv'
+FRIENDSHIP_CSV = 'friendships.csv'
+GROUP_CSV = 'groups.csv'
+GROUP_MEMBERS_CSV = 'group_members.csv'
+HISTORY_CSV_SUFFIX = '_history.csv'
+SQLITE_BUSY_TIMEOUT = 5.0  # 秒，等待其他连接写入完成
+
+
+class Storage:
+    """存储接口，子类实现全部方法"""
+
+    # 用户
+    def add_user(self, username, password_hash):
+        """新增用户，用户名已存在时返回 False"""
+        raise NotImplementedError
+
+    def get_password_hash(self, username):
+        """返回用户的密码哈希，用户不存在时返回 None"""
+        raise NotImplementedError
+
+    def user_exists(self, username):
+        return self.get_password_hash(username) is not None
+
+    def delete_user(self, username, password_hash):
+        """用户名和密码哈希都匹配时删除用户，返回是否删除"""
+        raise NotImplementedError
+
+    def update_password_hash(self, username, password_hash):
+        """替换用户的密码哈希，例如登录时升级哈希算法"""
+        raise NotImplementedError
+
+    def iter_users(self):
+        """产出 (用户名, 密码哈希)"""
+        raise NotImplementedError
+
+    def import_users(self, rows):
+        """批量写入 (用户名, 密码哈希)，用于迁移和基准测试，已存在的用户名跳过"""
+        raise NotImplementedError
+
+    # 好友关系
+    def load_friendships(self):
+        """返回全部好友关系 [(user_a, user_b)]"""
+        raise NotImplementedError
+
+    def add_friendship(self, user_a, user_b):
+        raise NotImplementedError
+
+    def remove_friendship(self, user_a, user_b):
+        raise NotImplementedError
+
+    def import_friendships(self, pairs):
+        raise NotImplementedError
+
+    # 群组
+    def load_groups(self):
+        """按创建顺序返回 [(group_id, group_name)]"""
+        raise NotImplementedError
+
+    def add_group(self, group_id, group_name):
+        """写入新群组，group_id 已被占用（例如被其他进程写入）时返回 False"""
+        raise NotImplementedError
+
+    def load_group_members(self):
+        """按加入顺序返回 [(group_id, username)]"""
+        raise NotImplementedError
+
+    def add_group_member(self, group_id, username):
+        raise NotImplementedError
+
+    def import_groups(self, rows):
+        raise NotImplementedError
+
+    def import_group_members(self, rows):
+        raise NotImplementedError
+
+    # 聊天记录
+    def history_log(self, name, import_row=None):
+        """返回会话的消息日志，接口与 message_log.MessageLog 相同
+
+        import_row 用于首次打开会话时转换旧版 CSV 历史中的每一行
+        """
+        raise NotImplementedError
+
+    def conversations(self):
+        """返回已有的会话名列表"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+def ensure_csv(file_path, header):
+    if not os.path.exists(file_path):
+        with open(file_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+
+
+class CsvStorage(Storage):
+    """原有的 CSV 文件存储
+
+    用户查询逐行扫描 users.csv，删除操作重写整个文件；更新密码哈希时追加一行，
+    同一用户名出现多次时以最后一行为准，避免登录时升级哈希重写整个文件；聊天记录保存在 history_dir 下的消息日志中，
+    旧版 <会话名>_history.csv 在首次打开会话时导入。
+    每个 CSV 文件有自己的锁，注册用户不会等待好友关系文件的重写。
+    history_commit_interval > 0 时聊天记录延迟写入并定期组提交（见 message_log），需要调用 close 写入剩余记录。
+    """
+
+    def __init__(self, directory='.', history_dir='history', history_commit_interval=0,
+                 history_commit_batch=COMMIT_BATCH):
+        self.directory = directory
+        self.users_csv = os.path.join(directory, USER_CSV)
+        self.friendships_csv = os.path.join(directory, FRIENDSHIP_CSV)
+        self.groups_csv = os.path.join(directory, GROUP_CSV)
+        self.members_csv = os.path.join(directory, GROUP_MEMBERS_CSV)
+        self._users_lock = TimedLock('csv_users')
+        self._friendships_lock = TimedLock('csv_friendships')
+        self._groups_lock = TimedLock('csv_groups')
+        self._members_lock = TimedLock('csv_group_members')
+        ensure_csv(self.users_csv, ['username', 'password_hash'])
+        ensure_csv(self.friendships_csv, ['user_a', 'user_b'])
+        ensure_csv(self.groups_csv, ['group_id', 'group_name'])
+        ensure_csv(self.members_csv, ['group_id', 'username'])
+        self.history_logs = MessageLogStore(os.path.join(directory, history_dir),
+                                            commit_interval=history_commit_interval,
+                                            commit_batch=history_commit_batch)
+
+    def _read_rows(self, path):
+        with open(path, 'r', newline='', encoding='utf-8') as f:
+            return list(csv.DictReader(f))
+
+    def _append_rows(self, path, rows):
+        with open(path, 'a', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerows(rows)
+
+    def add_user(self, username, password_hash):
+        with self._users_lock:
+            if self.get_password_hash(username) is not None:
+                return False
+            self._append_rows(self.users_csv, [[username, password_hash]])
+            return True
+
+    def get_password_hash(self, username):
+        password_hash = None
+        with open(self.users_csv, 'r', newline='', encoding='utf-8') as f:
+            reader = csv.DictReader(f)
+            for row in reader:
+                if row['username'] == username:
+                    password_hash = row['password_hash']
+        return password_hash
+
+    def delete_user(self, username, password_hash):
+        with self._users_lock:
+            if self.get_password_hash(username) != password_hash:
+                return False
+            kept = [row for row in self._read_rows(self.users_csv) if row['username'] != username]
+            with open(self.users_csv, 'w', newline='', encoding='utf-8') as f:
+                writer = csv.DictWriter(f, fieldnames=['username', 'password_hash'])
+                writer.writeheader()
+                writer.writerows(kept)
+            return True
+
+    def update_password_hash(self, username, password_hash):
+        with self._users_lock:
+            self._append_rows(self.users_csv, [[username, password_hash]])
+
+    def iter_users(self):
+        users = {}
+        for row in self._read_rows(self.users_csv):
+            users[row['username']] = row['password_hash']
+        return iter(users.items())
+
+    def import_users(self, rows):
+        with self._users_lock:
+            existing = {username for username, _ in self.iter_users()}
+            new_rows = []
+            for username, password_hash in rows:
+                if username not in existing:
+                    existing.add(username)
+                    new_rows.append([username, password_hash])
+            self._append_rows(self.users_csv, new_rows)
+
+    def load_friendships(self):
+        return [(row['user_a'], row['user_b']) for row in self._read_rows(self.friendships_csv)]
+
+    def add_friendship(self, user_a, user_b):
+        with self._friendships_lock:
+            self._append_rows(self.friendships_csv, [[user_a, user_b]])
+
+    def remove_friendship(self, user_a, user_b):
+        with self._friendships_lock:
+            rows = [row for row in self._read_rows(self.friendships_csv)
+                    if {row['user_a'], row['user_b']} != {user_a, user_b}]
+            with open(self.friendships_csv, 'w', newline='', encoding='utf-8') as f:
+                writer = csv.DictWriter(f, fieldnames=['user_a', 'user_b'])
+                writer.writeheader()
+                writer.writerows(rows)
+
+    def import_friendships(self, pairs):
+        with self._friendships_lock:
+            self._append_rows(self.friendships_csv, pairs)
+
+    def load_groups(self):
+        return [(row['group_id'], row['group_name']) for row in self._read_rows(self.groups_csv)]
+
+    def add_group(self, group_id, group_name):
+        with self._groups_lock:
+            self._append_rows(self.groups_csv, [[group_id, group_name]])
+        return True
+
+    def load_group_members(self):
+        return [(row['group_id'], row['username']) for row in self._read_rows(self.members_csv)]
+
+    def add_group_member(self, group_id, username):
+        with self._members_lock:
+            self._append_rows(self.members_csv, [[group_id, username]])
+
+    def import_groups(self, rows):
+        with self._groups_lock:
+            self._append_rows(self.groups_csv, rows)
+
+    def import_group_members(self, rows):
+        with self._members_lock:
+            self._append_rows(self.members_csv, rows)
+
+    def history_log(self, name, import_row=None):
+        legacy_csv = os.path.join(self.directory, name + HISTORY_CSV_SUFFIX)
+        return self.history_logs.get(name, legacy_csv=legacy_csv, import_row=import_row)
+
+    def conversations(self):
+        names = set()
+        if os.path.isdir(self.history_logs.root):
+            for name in os.listdir(self.history_logs.root):
+                if os.path.isdir(os.path.join(self.history_logs.root, name)) and not name.endswith('.importing'):
+                    names.add(name)
+        for fname in os.listdir(self.directory):
+            if fname.endswith(HISTORY_CSV_SUFFIX) and fname.startswith(('private_', 'group_')):
+                names.add(fname[:-len(HISTORY_CSV_SUFFIX)])
+        return sorted(names)
+
+    def close(self):
+        self.history_logs.close()
+
+
+SQLITE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    password_hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS friendships (
+    user_a TEXT NOT NULL,
+    user_b TEXT NOT NULL,
+    PRIMARY KEY (user_a, user_b)
+);
+CREATE INDEX IF NOT EXISTS idx_friendships_user_b ON friendships (user_b);
+CREATE TABLE IF NOT EXISTS chat_groups (
+    group_id TEXT PRIMARY KEY,
+    group_name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS group_members (
+    group_id TEXT NOT NULL,
+    username TEXT NOT NULL,
+    UNIQUE (group_id, username)
+);
+CREATE INDEX IF NOT EXISTS idx_group_members_username ON group_members (username);
+CREATE TABLE IF NOT EXISTS messages (
+    conversation TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    timestamp REAL NOT NULL,
+    fields TEXT NOT NULL,
+    PRIMARY KEY (conversation, id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_messages_conversation_time ON messages (conversation, timestamp);
+'''
+
+
+class SqliteStorage(Storage):
+    """SQLite 存储
+
+    每个线程使用自己的连接，WAL 模式下读操作互不阻塞；写操作由 _write_lock 串行化，
+    避免多个连接同时升级写锁时出现 SQLITE_BUSY。好友关系按 (较小用户名, 较大用户名) 保存一行。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._write_lock = TimedLock('sqlite_write')
+        self._logs = {}
+        conn = self._conn()
+        conn.executescript(SQLITE_SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _write(self, sql, params=()):
+        with self._write_lock:
+            conn = self._conn()
+            with conn:
+                return conn.execute(sql, params).rowcount
+
+    def _write_many(self, sql, rows):
+        with self._write_lock:
+            conn = self._conn()
+            with conn:
+                conn.executemany(sql, rows)
+
+    def _query(self, sql, params=()):
+        return self._conn().execute(sql, params).fetchall()
+
+    def add_user(self, username, password_hash):
+        return self._write('INSERT OR IGNORE INTO users (username, password_hash) VALUES (?, ?)',
+                           (username, password_hash)) == 1
+
+    def get_password_hash(self, username):
+        rows = self._query('SELECT password_hash FROM users WHERE username = ?', (username,))
+        return rows[0][0] if rows else None
+
+    def delete_user(self, username, password_hash):
+        return self._write('DELETE FROM users WHERE username = ? AND password_hash = ?',
+                           (username, password_hash)) == 1
+
+    def update_password_hash(self, username, password_hash):
+        self._write('UPDATE users SET password_hash = ? WHERE username = ?', (password_hash, username))
+
+    def iter_users(self):
+        return iter(self._query('SELECT username, password_hash FROM users ORDER BY rowid'))
+
+    def import_users(self, rows):
+        self._write_many('INSERT OR IGNORE INTO users (username, password_hash) VALUES (?, ?)', rows)
+
+    def load_friendships(self):
+        return self._query('SELECT user_a, user_b FROM friendships')
+
+    def add_friendship(self, user_a, user_b):
+        self._write('INSERT OR IGNORE INTO friendships (user_a, user_b) VALUES (?, ?)',
+                    (min(user_a, user_b), max(user_a, user_b)))
+
+    def remove_friendship(self, user_a, user_b):
+        self._write('DELETE FROM friendships WHERE user_a = ? AND user_b = ?',
+                    (min(user_a, user_b), max(user_a, user_b)))
+
+    def import_friendships(self, pairs):
+        self._write_many('INSERT OR IGNORE INTO friendships (user_a, user_b) VALUES (?, ?)',
+                         [(min(a, b), max(a, b)) for a, b in pairs])
+
+    def load_groups(self):
+        return self._query('SELECT group_id, group_name FROM chat_groups ORDER BY rowid')
+
+    def add_group(self, group_id, group_name):
+        return self._write('INSERT OR IGNORE INTO chat_groups (group_id, group_name) VALUES (?, ?)',
+                           (group_id, group_name)) == 1
+
+    def load_group_members(self):
+        return self._query('SELECT group_id, username FROM group_members ORDER BY rowid')
+
+    def add_group_member(self, group_id, username):
+        self._write('INSERT OR IGNORE INTO group_members (group_id, username) VALUES (?, ?)',
+                    (group_id, username))
+
+    def import_groups(self, rows):
+        self._write_many('INSERT OR IGNORE INTO chat_groups (group_id, group_name) VALUES (?, ?)', rows)
+
+    def import_group_members(self, rows):
+        self._write_many('INSERT OR IGNORE INTO group_members (group_id, username) VALUES (?, ?)', rows)
+
+    def history_log(self, name, import_row=None):
+        # 旧版 CSV 历史由迁移工具一次性导入，这里不再自动导入，import_row 不使用
+        log = self._logs.get(name)
+        if log is None:
+            log = self._logs.setdefault(name, SqliteMessageLog(self, name))
+        return log
+
+    def conversations(self):
+        return [row[0] for row in self._query('SELECT DISTINCT conversation FROM messages')]
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class SqliteMessageLog:
+    """messages 表中一个会话的消息，接口与 message_log.MessageLog 相同
+
+    消息ID在会话内从 1 开始连续递增，字段列表以 JSON 保存。
+    """
+
+    def __init__(self, storage, conversation):
+        self.storage = storage
+        self.conversation = conversation
+
+    def _rows(self, rows):
+        return [(msg_id, timestamp, json.loads(fields)) for msg_id, timestamp, fields in rows]
+
+    @property
+    def first_id(self):
+        rows = self.storage._query('SELECT MIN(id) FROM messages WHERE conversation = ?', (self.conversation,))
+        return rows[0][0] or 1
+
+    @property
+    def last_id(self):
+        """最后一条消息的ID，没有消息时为 0"""
+        rows = self.storage._query('SELECT MAX(id) FROM messages WHERE conversation = ?', (self.conversation,))
+        return rows[0][0] or 0
+
+    def __len__(self):
+        rows = self.storage._query('SELECT COUNT(*) FROM messages WHERE conversation = ?', (self.conversation,))
+        return rows[0][0]
+
+    def append(self, fields, timestamp=None):
+        """追加一条消息，返回消息ID"""
+        return self.append_many([fields], timestamp)[-1]
+
+    def append_many(self, rows, timestamp=None):
+        """按顺序追加多条消息，返回消息ID列表"""
+        if timestamp is None:
+            timestamp = time.time()
+        storage = self.storage
+        with storage._write_lock:
+            conn = storage._conn()
+            with conn:
+                # 先取得写锁再读取最大ID，多个服务器进程同时追加同一会话时不会分配到相同的ID
+                conn.execute('BEGIN IMMEDIATE')
+                (last_id,) = conn.execute('SELECT MAX(id) FROM messages WHERE conversation = ?',
+                                          (self.conversation,)).fetchone()
+                first = (last_id or 0) + 1
+                ids = list(range(first, first + len(rows)))
+                conn.executemany(
+                    'INSERT INTO messages (conversation, id, timestamp, fields) VALUES (?, ?, ?, ?)',
+                    [(self.conversation, msg_id, timestamp, json.dumps([str(f) for f in fields], ensure_ascii=False))
+                     for msg_id, fields in zip(ids, rows)])
+        return ids
+
+    def read(self, start_id, end_id):
+        """读取ID在 [start_id, end_id) 内的消息，返回 [(消息ID, 时间戳, 字段列表)]"""
+        return self._rows(self.storage._query(
+            'SELECT id, timestamp, fields FROM messages WHERE conversation = ? AND id >= ? AND id < ? ORDER BY id',
+            (self.conversation, start_id, end_id)))
+
+    def read_last(self, limit):
+        """读取最后 limit 条消息"""
+        rows = self.storage._query(
+            'SELECT id, timestamp, fields FROM messages WHERE conversation = ? ORDER BY id DESC LIMIT ?',
+            (self.conversation, limit))
+        return self._rows(reversed(rows))
+
+    def read_before(self, before_id, limit):
+        """读取ID小于 before_id 的最后 limit 条消息"""
+        rows = self.storage._query(
+            'SELECT id, timestamp, fields FROM messages WHERE conversation = ? AND id < ? ORDER BY id DESC LIMIT ?',
+            (self.conversation, before_id, limit))
+        return self._rows(reversed(rows))
+
+    def read_all(self):
+        return self._rows(self.storage._query(
+            'SELECT id, timestamp, fields FROM messages WHERE conversation = ? ORDER BY id', (self.conversation,)))
+
+
+def open_storage(backend, directory='.', history_dir='history', sqlite_path='chat.db', history_commit_interval=0,
+                 history_commit_batch=COMMIT_BATCH):
+    """按名称创建存储实现，history_commit_* 只用于 csv 存储的聊天记录"""
+    if backend == 'csv':
+        return CsvStorage(directory, history_dir, history_commit_interval, history_commit_batch)
+    if backend == 'sqlite':
+        return SqliteStorage(os.path.join(directory, sqlite_path))
+    raise ValueError(f'未知的存储类型: {backend}')
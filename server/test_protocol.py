@@ -0,0 +1,139 @@
+"""protocol.py 的帧编码和增量解析测试
+
+    python -m unittest test_protocol     （在 server/ 下运行，也可以用 pytest）
+"""
+import os
+import unittest
+
+from protocol import (FRAME_BINARY, FRAME_HEADER, FRAME_MAGIC, FRAME_TEXT, MAX_FRAME_SIZE, PROTOCOL_V1, PROTOCOL_V2,
+                      FrameDecoder, LineDecoder, ProtocolError, encode_binary_frame, encode_message,
+                      encode_text_frame)
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def feed_in_pieces(decoder, data, size):
+    """每次 feed size 字节，返回途中解析出的全部消息"""
+    messages = []
+    for i in range(0, len(data), size):
+        decoder.feed(data[i:i + size])
+        messages.extend(decoder)
+    return messages
+
+
+class FrameDecoderTest(unittest.TestCase):
+    def test_text_frame_split_byte_by_byte(self):
+        decoder = FrameDecoder()
+        frame = encode_text_frame('MSG|alice|bob|你好')
+        self.assertEqual(feed_in_pieces(decoder, frame, 1), [('MSG|alice|bob|你好', None)])
+        self.assertEqual(len(decoder), 0)
+
+    def test_incomplete_frame_waits(self):
+        decoder = FrameDecoder()
+        frame = encode_text_frame('GET_FRIENDS|alice')
+        decoder.feed(frame[:5])  # 帧头不完整
+        self.assertIsNone(decoder.next_message())
+        decoder.feed(frame[5:-1])  # 帧头完整，payload 少一个字节
+        self.assertIsNone(decoder.next_message())
+        decoder.feed(frame[-1:])
+        self.assertEqual(decoder.next_message(), ('GET_FRIENDS|alice', None))
+
+    def test_coalesced_frames(self):
+        blob = bytes(range(256)) * 4
+        data = (encode_text_frame('LOGIN_OK|alice') + encode_binary_frame('VOICE_MSG|alice|bob|1.5', blob)
+                + encode_text_frame('FRIEND_LIST|bob'))
+        decoder = FrameDecoder()
+        decoder.feed(data)
+        self.assertEqual(list(decoder), [('LOGIN_OK|alice', None), ('VOICE_MSG|alice|bob|1.5', blob),
+                                         ('FRIEND_LIST|bob', None)])
+
+    def test_frames_split_at_every_boundary(self):
+        frames = [encode_text_frame(f'MSG|a|b|第{i}条') for i in range(5)]
+        frames.append(encode_binary_frame('VOICE_MSG|a|b|1.0', b'\0\1\2' * 100))
+        data = b''.join(frames)
+        expected = list(FrameDecoder(data))
+        self.assertEqual(len(expected), 6)
+        for size in (1, 2, 3, 7, 8, 9, 64, len(data)):
+            with self.subTest(size=size):
+                self.assertEqual(feed_in_pieces(FrameDecoder(), data, size), expected)
+
+    def test_many_frames_across_compaction(self):
+        # 已消费数据超过 COMPACT_THRESHOLD 后缓冲区会被截断，之后的帧仍要正确解析
+        count = 3 * FrameDecoder.COMPACT_THRESHOLD // 100
+        data = b''.join(encode_text_frame(f'MSG|a|b|{i:090d}') for i in range(count))
+        messages = feed_in_pieces(FrameDecoder(), data, 1000)
+        self.assertEqual([m[0] for m in messages], [f'MSG|a|b|{i:090d}' for i in range(count)])
+
+    def test_bad_magic(self):
+        decoder = FrameDecoder(b'XX' + encode_text_frame('MSG|a|b|c')[2:])
+        with self.assertRaises(ProtocolError):
+            decoder.next_message()
+
+    def test_bad_version_and_type(self):
+        for header in (FRAME_HEADER.pack(FRAME_MAGIC, 3, FRAME_TEXT, 0),
+                       FRAME_HEADER.pack(FRAME_MAGIC, PROTOCOL_V2, 9, 0)):
+            with self.subTest(header=header), self.assertRaises(ProtocolError):
+                FrameDecoder(header).next_message()
+
+    def test_oversize_length_rejected_from_header(self):
+        # 只凭帧头就拒绝，不等待（也不缓存）声明的 payload
+        decoder = FrameDecoder(FRAME_HEADER.pack(FRAME_MAGIC, PROTOCOL_V2, FRAME_TEXT, MAX_FRAME_SIZE + 1))
+        with self.assertRaises(ProtocolError):
+            decoder.next_message()
+
+    def test_binary_meta_length_out_of_range(self):
+        payload = b'\xff\xff' + b'VOICE'
+        decoder = FrameDecoder(FRAME_HEADER.pack(FRAME_MAGIC, PROTOCOL_V2, FRAME_BINARY, len(payload)) + payload)
+        with self.assertRaises(ProtocolError):
+            decoder.next_message()
+
+    def test_file_port_redirect(self):
+        # 聊天连接上的 USE_FILE_PORT 重定向必须按协商的协议成帧，未成帧的原始字节会被当作帧头而断开连接
+        redirect = 'USE_FILE_PORT|12347|alice|bob|report.pdf|1048576'
+        decoder = FrameDecoder()
+        decoder.feed(encode_message(redirect, PROTOCOL_V2) + encode_text_frame('MSG|bob|alice|hi'))
+        self.assertEqual(list(decoder), [(redirect, None), ('MSG|bob|alice|hi', None)])
+        with self.assertRaises(ProtocolError):
+            FrameDecoder(redirect.encode('utf-8')).next_message()
+
+
+class LineDecoderTest(unittest.TestCase):
+    def test_line_split_inside_utf8_character(self):
+        data = 'MSG|alice|bob|你好\n'.encode('utf-8')
+        self.assertEqual(feed_in_pieces(LineDecoder(), data, 1), [('MSG|alice|bob|你好', None)])
+
+    def test_coalesced_lines(self):
+        decoder = LineDecoder()
+        decoder.feed(b'LOGIN_OK|alice\nFRIEND_LIST|bob|carol\nMSG|a|b|')
+        self.assertEqual(list(decoder), [('LOGIN_OK|alice', None), ('FRIEND_LIST|bob|carol', None)])
+        decoder.feed(b'c\n')
+        self.assertEqual(list(decoder), [('MSG|a|b|c', None)])
+
+    def test_oversize_line(self):
+        decoder = LineDecoder(max_line=16)
+        decoder.feed(b'x' * 17)
+        with self.assertRaises(ProtocolError):
+            decoder.next_message()
+
+    def test_switch_to_frames_after_negotiation(self):
+        # PROTO_OK 之后紧跟的 v2 帧可能与它在同一次 recv 中到达
+        decoder = LineDecoder()
+        decoder.feed(encode_message('PROTO_OK|2', PROTOCOL_V1) + encode_text_frame('FRIEND_LIST|bob'))
+        self.assertEqual(decoder.next_message(), ('PROTO_OK|2', None))
+        frames = FrameDecoder(decoder.take_remaining())
+        self.assertEqual(list(frames), [('FRIEND_LIST|bob', None)])
+        self.assertEqual(len(decoder), 0)
+
+
+class ClientCopyTest(unittest.TestCase):
+    def test_client_protocol_is_identical(self):
+        # 客户端单独打包，带有一份相同的 protocol.py
+        with open(os.path.join(SERVER_DIR, 'protocol.py'), 'rb') as f:
+            server_copy = f.read()
+        with open(os.path.join(SERVER_DIR, os.pardir, 'client', 'protocol.py'), 'rb') as f:
+            client_copy = f.read()
+        self.assertEqual(server_copy, client_copy)
+
+
+if __name__ == '__main__':
+    unittest.main()
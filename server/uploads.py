@@ -0,0 +1,302 @@
+"""文件传输端口上的分块上传：可续传、多连接并行、最终校验 SHA-256
+
+文件按 chunk_size 切成编号从 0 开始的块，服务器为每次上传保存一个位图记录已收到的块。
+所有请求和回复都是以 '\\n' 结尾的一行文本（旧版的 UPLOAD / DOWNLOAD 请求不受影响）：
+
+    UPLOAD_INIT|用户名|接收者|文件名|文件大小|SHA-256|块大小
+        -> UPLOAD_STATE|上传ID|块大小|块数|位图(十六进制)
+        或 ALREADY_HAVE|保存的文件名  服务器已有这份内容，直接登记到会话中，不用传输任何数据
+    UPLOAD_CHUNK|用户名|上传ID|块编号|长度|CRC32(十六进制)  后面紧跟“长度”字节的块数据
+        -> CHUNK_OK|块编号  或  CHUNK_ERROR|块编号|原因
+    UPLOAD_FINISH|用户名|上传ID
+        -> SUCCESS|保存的文件名  或  MISSING|位图  或  ERROR|原因
+           重复的 UPLOAD_FINISH（客户端重试、多个连接同时结束）得到与第一次相同的回复
+
+上传ID由发送者、接收者、文件名、大小和 SHA-256 决定，同一个文件断线后重新 UPLOAD_INIT 得到同一个ID，
+位图中已有的块不用再传；服务器重启后也能从磁盘上的位图继续。块大小以服务器第一次创建时的为准。
+一个连接上可以连续发送多个请求，客户端用多个连接同时上传不同的块。
+全部块收到后 UPLOAD_FINISH 计算整个文件的 SHA-256，与 UPLOAD_INIT 声明的一致才保存到文件存储（见 file_store.py），
+不一致时丢弃已收到的数据，客户端需要重新上传。
+
+未完成的上传保存在 upload_dir 下：<上传ID>.part（预分配到文件大小的数据）、.bitmap（位图）、.json（元数据），
+超过 UPLOAD_EXPIRE 没有写入的在启动时清理。内存中超过 SESSION_IDLE_TIMEOUT 没有写入的上传由 expire_idle()
+关闭文件（磁盘上的数据保留，客户端继续上传时重新加载）。
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from locks import TimedLock
+
+UPLOAD_EXPIRE = 7 * 24 * 3600  # 秒，未完成的上传保留多久
+SESSION_IDLE_TIMEOUT = 600  # 秒，内存中的上传多久没有写入就关闭文件
+FINISHED_KEEP = 1000  # 记住最近完成的上传数，用于回复重复的 UPLOAD_FINISH
+
+# finish() 的结果
+FINISH_OK = 'ok'
+FINISH_HASH_MISMATCH = 'hash_mismatch'
+FINISH_ALREADY = 'already_finished'  # 重复的 UPLOAD_FINISH，上传已经成功保存
+
+
+def calculate_file_hash(file_path):
+    """计算文件的 SHA-256 十六进制摘要"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def chunk_checksum(data):
+    return f'{zlib.crc32(data):08x}'
+
+
+def is_valid_upload_id(value):
+    """上传ID是 32 位小写十六进制，用作文件名前先校验，防止访问上传目录之外的路径"""
+    return len(value) == 32 and all(c in '0123456789abcdef' for c in value)
+
+
+class SocketReader:
+    """从套接字读取文本行和定长数据，initial 是已经读到但尚未处理的字节"""
+
+    def __init__(self, sock, initial=b''):
+        self.sock = sock
+        self.buf = bytearray(initial)
+
+    def readline(self, limit=4096):
+        """返回去掉换行的一行，对方关闭连接时返回 None"""
+        while True:
+            end = self.buf.find(b'\n')
+            if end >= 0:
+                line = bytes(self.buf[:end])
+                del self.buf[:end + 1]
+                return line
+            if len(self.buf) > limit:
+                raise ValueError('请求行过长')
+            data = self.sock.recv(65536)
+            if not data:
+                return None
+            self.buf += data
+
+    def read_exact(self, size):
+        data = bytearray(size)
+        view = memoryview(data)
+        pos = min(size, len(self.buf))
+        view[:pos] = self.buf[:pos]
+        del self.buf[:pos]
+        while pos < size:
+            n = self.sock.recv_into(view[pos:])
+            if not n:
+                raise ConnectionError('连接在块数据中途关闭')
+            pos += n
+        return data
+
+
+class UploadSession:
+    """一次分块上传：块数据写入预分配的 .part 文件，每收到一块在位图中置位并写回磁盘"""
+
+    def __init__(self, upload_id, paths, meta):
+        self.upload_id = upload_id
+        self.part_path, self.bitmap_path, self.meta_path = paths
+        self.from_user = meta['from_user']
+        self.to_user = meta['to_user']
+        self.filename = meta['filename']
+        self.filesize = meta['filesize']
+        self.file_hash = meta['file_hash']
+        self.chunk_size = meta['chunk_size']
+        self.total_chunks = -(-self.filesize // self.chunk_size)  # 空文件没有块
+        with open(self.bitmap_path, 'rb') as f:
+            self.bitmap = bytearray(f.read().ljust((self.total_chunks + 7) // 8, b'\0'))
+        self._part = open(self.part_path, 'r+b')
+        self._bitmap_file = open(self.bitmap_path, 'r+b')
+        self._lock = TimedLock('upload_chunks')
+        self._finish_lock = threading.Lock()  # 同时到达的 UPLOAD_FINISH 等第一个处理完
+        self.closed = False
+        self.result = None  # finish() 之后为 (结果, 文件名)
+        self.last_active = time.monotonic()
+
+    def chunk_length(self, chunk_id):
+        if chunk_id == self.total_chunks - 1:
+            return self.filesize - chunk_id * self.chunk_size
+        return self.chunk_size
+
+    def has_chunk(self, chunk_id):
+        return bool(self.bitmap[chunk_id // 8] & (1 << (chunk_id % 8)))
+
+    def received_chunks(self):
+        return sum(1 for i in range(self.total_chunks) if self.has_chunk(i))
+
+    def is_complete(self):
+        return all(self.has_chunk(i) for i in range(self.total_chunks))
+
+    def bitmap_hex(self):
+        return self.bitmap.hex()
+
+    def write_chunk(self, chunk_id, data):
+        """写入一块并在位图中置位，上传已结束时返回 False"""
+        with self._lock:
+            if self.closed:
+                return False
+            self.last_active = time.monotonic()
+            self._part.seek(chunk_id * self.chunk_size)
+            self._part.write(data)
+            # 先让块数据进入文件再写位图，进程退出后位图中置位的块一定已经写入
+            self._part.flush()
+            index = chunk_id // 8
+            self.bitmap[index] |= 1 << (chunk_id % 8)
+            self._bitmap_file.seek(index)
+            self._bitmap_file.write(self.bitmap[index:index + 1])
+            self._bitmap_file.flush()
+            return True
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            self._part.close()
+            self._bitmap_file.close()
+
+    def remove_files(self):
+        for path in (self.part_path, self.bitmap_path, self.meta_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class FileTransfer:
+    """管理所有未完成的分块上传（协议见模块说明）"""
+    CHUNK_SIZE = 1024 * 1024  # 客户端未指定时的块大小
+    MIN_CHUNK_SIZE = 64 * 1024
+    MAX_CHUNK_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, upload_dir):
+        self.upload_dir = upload_dir
+        self._sessions = {}  # 上传ID: UploadSession
+        self._finished = OrderedDict()  # 最近完成的上传ID: UploadSession
+        self._lock = TimedLock('uploads')
+        os.makedirs(upload_dir, exist_ok=True)
+
+    @staticmethod
+    def upload_id(from_user, to_user, filename, filesize, file_hash):
+        key = f'{from_user}|{to_user}|{filename}|{filesize}|{file_hash}'
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+
+    def _paths(self, upload_id):
+        base = os.path.join(self.upload_dir, upload_id)
+        return base + '.part', base + '.bitmap', base + '.json'
+
+    def open(self, from_user, to_user, filename, filesize, file_hash, chunk_size=CHUNK_SIZE):
+        """返回该文件的上传，已有未完成的上传时继续使用它（包括上次运行留下的）"""
+        upload_id = self.upload_id(from_user, to_user, filename, filesize, file_hash)
+        with self._lock:
+            session = self._sessions.get(upload_id)
+            if session is not None:
+                session.last_active = time.monotonic()
+                return session
+            paths = self._paths(upload_id)
+            part_path, bitmap_path, meta_path = paths
+            try:
+                with open(meta_path, 'r', encoding='utf-8') as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                chunk_size = min(max(chunk_size, self.MIN_CHUNK_SIZE), self.MAX_CHUNK_SIZE)
+                meta = {'from_user': from_user, 'to_user': to_user, 'filename': filename,
+                        'filesize': filesize, 'file_hash': file_hash, 'chunk_size': chunk_size}
+                with open(part_path, 'wb') as f:
+                    f.truncate(filesize)
+                total_chunks = -(-filesize // chunk_size)
+                with open(bitmap_path, 'wb') as f:
+                    f.write(bytes((total_chunks + 7) // 8))
+                # 元数据最后写入并改名，它存在就说明另外两个文件已经创建好
+                with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+                    json.dump(meta, f, ensure_ascii=False)
+                os.replace(meta_path + '.tmp', meta_path)
+            session = UploadSession(upload_id, paths, meta)
+            self._sessions[upload_id] = session
+            return session
+
+    def get(self, upload_id):
+        """返回进行中或最近完成的上传，不存在时返回 None；内存中没有时从磁盘加载"""
+        session = self._sessions.get(upload_id) or self._finished.get(upload_id)
+        if session is not None or not is_valid_upload_id(upload_id):
+            return session
+        paths = self._paths(upload_id)
+        try:
+            with open(paths[2], 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        with self._lock:
+            session = self._sessions.get(upload_id)
+            if session is None:
+                session = UploadSession(upload_id, paths, meta)
+                self._sessions[upload_id] = session
+            return session
+
+    def finish(self, session, save):
+        """校验 SHA-256 后调用 save(数据文件路径) 保存文件，返回 (结果, save 的返回值)
+
+        结果为 FINISH_OK；校验失败时丢弃这次上传，结果为 FINISH_HASH_MISMATCH。
+        同一个上传再次调用时不重复处理：成功过的返回 (FINISH_ALREADY, 文件名)，失败过的返回同样的失败。
+        save 负责移走数据文件，之后剩余的临时文件都会删除。
+        """
+        with session._finish_lock:
+            if session.result is not None:
+                status, filename = session.result
+                return (FINISH_ALREADY if status == FINISH_OK else status), filename
+            session.close()
+            result = (FINISH_HASH_MISMATCH, None)
+            try:
+                if calculate_file_hash(session.part_path) == session.file_hash:
+                    result = (FINISH_OK, save(session.part_path))
+            finally:
+                session.result = result
+                session.remove_files()
+                with self._lock:
+                    if self._sessions.get(session.upload_id) is session:
+                        del self._sessions[session.upload_id]
+                    self._finished[session.upload_id] = session
+                    while len(self._finished) > FINISHED_KEEP:
+                        self._finished.popitem(last=False)
+            return result
+
+    def expire_idle(self, max_idle=SESSION_IDLE_TIMEOUT):
+        """关闭超过 max_idle 秒没有写入的上传的文件并移出内存，返回关闭的数量；磁盘上的数据保留，可以继续上传"""
+        now = time.monotonic()
+        with self._lock:
+            idle = [session for session in self._sessions.values() if now - session.last_active > max_idle]
+            for session in idle:
+                del self._sessions[session.upload_id]
+        for session in idle:
+            session.close()
+        return len(idle)
+
+    def cleanup_stale(self, max_age=UPLOAD_EXPIRE):
+        """删除超过 max_age 秒没有写入的未完成上传，返回删除的数量"""
+        now = time.time()
+        removed = 0
+        for name in os.listdir(self.upload_dir):
+            if not name.endswith('.json'):
+                continue
+            upload_id = name[:-len('.json')]
+            if upload_id in self._sessions:
+                continue
+            paths = self._paths(upload_id)
+            try:
+                mtime = max(os.path.getmtime(path) for path in paths if os.path.exists(path))
+            except ValueError:
+                continue
+            if now - mtime > max_age:
+                for path in paths:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                removed += 1
+        return removed